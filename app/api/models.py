@@ -412,6 +412,7 @@ class RouteStopBase(BaseModel):
     location: Optional[str] = Field(None, max_length=100)
     latitude: Optional[float] = Field(None, ge=-90, le=90)
     longitude: Optional[float] = Field(None, ge=-180, le=180)
+    geofence_radius_m: Optional[int] = Field(None, ge=10, le=5000)
     pickup_stop_order: int
     drop_stop_order: int
 
@@ -433,6 +434,7 @@ class RouteStopUpdate(BaseModel):
     location: Optional[str] = Field(None, max_length=100)
     latitude: Optional[float] = Field(None, ge=-90, le=90)
     longitude: Optional[float] = Field(None, ge=-180, le=180)
+    geofence_radius_m: Optional[int] = Field(None, ge=10, le=5000)
     pickup_stop_order: Optional[int] = None
     drop_stop_order: Optional[int] = None
 
@@ -443,12 +445,25 @@ class RouteStopResponse(BaseModel):
     location: Optional[str] = None
     latitude: Optional[float] = Field(None, ge=-90, le=90)
     longitude: Optional[float] = Field(None, ge=-180, le=180)
+    geofence_radius_m: Optional[int] = None
     pickup_stop_order: int
     drop_stop_order: int
     created_at: datetime
 
     model_config = ConfigDict(from_attributes=True)
 
+class NearbyStopResponse(BaseModel):
+    stop_id: str
+    route_id: str
+    stop_name: str
+    location: Optional[str] = None
+    latitude: float
+    longitude: float
+    geofence_radius_m: int
+    pickup_stop_order: int
+    drop_stop_order: int
+    distance_m: float
+
 # Student Models
 class StudentCreate(BaseModel):
     parent_id: Optional[str] = None
@@ -669,9 +684,22 @@ class BusLocationUpdate(BaseModel):
     longitude: float = Field(..., ge=-180, le=180)
     timestamp: Optional[datetime] = None
 
+class LocationFix(BaseModel):
+    latitude: float = Field(..., ge=-90, le=90)
+    longitude: float = Field(..., ge=-180, le=180)
+    timestamp: datetime
+
+class BusLocationBatch(BaseModel):
+    trip_id: str
+    fixes: List[LocationFix] = Field(..., min_length=1, max_length=500)
+
+class FleetLocationBatch(BaseModel):
+    positions: List[BusLocationUpdate] = Field(..., min_length=1, max_length=1000)
+
 class DriverLocationUpdate(BaseModel):
     latitude: float = Field(..., ge=-90, le=90)
     longitude: float = Field(..., ge=-180, le=180)
+    timestamp: Optional[datetime] = None
 
 class DriverLocationResponse(BaseModel):
     driver_id: str
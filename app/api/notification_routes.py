@@ -1,13 +1,22 @@
 from fastapi import APIRouter, Header, HTTPException, Body, status
 from fastapi.responses import JSONResponse
-from app.notification_api.service import notification_service, ADMIN_KEY
+from app.notification_api.service import notification_service, fcm_executor, ADMIN_KEY
+from app.services.notification_outbox import notification_outbox
+from app.services.broadcast_jobs import broadcast_jobs
+from app.services.token_cleanup import dead_token_pruner
+from app.services.route_recipients import route_recipient_cache
+from app.services.trip_manifest import trip_manifests
+from app.services.route_cache_rebuilder import route_cache_rebuilder
+from app.services.topic_subscriptions import (
+    topic_subscriptions, route_audience, class_topic, stop_topic, topic_condition
+)
 from typing import Optional, List
 from app.api.models import *
-from app.core.database import execute_query
+from fastapi.concurrency import run_in_threadpool
+from app.core.database import execute_query, execute_query_async, run_in_db_executor
 from app.core.auth import create_access_token
 from app.core.security import verify_password
 from datetime import datetime, timedelta
-import asyncio
 import os
 import uuid
 import logging
@@ -16,6 +25,17 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+def _topic_send_response(result: dict, audience: dict, notification_id: str):
+    """Response for a broadcast sent as one topic send (FCM does not report per-device delivery)"""
+    return {
+        "success": result.get("success", False),
+        "fanout": "topic",
+        "audience": audience.get("topic") or audience.get("condition"),
+        "message_id": result.get("messageId"),
+        "error": result.get("error"),
+        "notification_id": notification_id
+    }
+
 def get_system_admin_id():
     """Helper to get a valid admin_id for logging system-triggered notifications"""
     try:
@@ -35,15 +55,15 @@ async def admin_login(login_data: LoginRequest):
         logger.info(f"Admin login attempt for phone: {login_data.phone}")
         
         query = "SELECT admin_id, phone, password_hash, name FROM admins WHERE phone = %s AND status = 'ACTIVE'"
-        admin = execute_query(query, (login_data.phone,), fetch_one=True)
+        admin = await execute_query_async(query, (login_data.phone,), fetch_one=True)
         
         if admin:
             logger.info(f"Admin found: {admin['name']}")
-            if verify_password(login_data.password, admin['password_hash']):
+            if await run_in_threadpool(verify_password, login_data.password, admin['password_hash']):
                 logger.info(f"Password verified for admin: {admin['name']}")
                 # Update last login
                 try:
-                    execute_query("UPDATE admins SET last_login_at = %s WHERE admin_id = %s", 
+                    await execute_query_async("UPDATE admins SET last_login_at = %s WHERE admin_id = %s", 
                                  (datetime.now(), admin['admin_id']))
                 except Exception as update_err:
                     logger.warning(f"Failed to update last_login_at: {update_err}")
@@ -75,29 +95,29 @@ async def parent_login(login_data: LoginRequest):
         logger.info(f"Parent login attempt for phone: {login_data.phone}")
         
         query = "SELECT parent_id, phone, password_hash, name FROM parents WHERE phone = %s AND parents_active_status = 'ACTIVE'"
-        parent = execute_query(query, (login_data.phone,), fetch_one=True)
+        parent = await execute_query_async(query, (login_data.phone,), fetch_one=True)
         
         if parent:
             logger.info(f"Parent found: {parent['name']}")
-            if verify_password(login_data.password, parent['password_hash']):
+            if await run_in_threadpool(verify_password, login_data.password, parent['password_hash']):
                 logger.info(f"Password verified for parent: {parent['name']}")
                 parent_id = parent['parent_id']
 
                 # Device Approval Check
                 old_token_query = "SELECT fcm_token FROM fcm_tokens WHERE parent_id = %s"
-                old_token_data = execute_query(old_token_query, (parent_id,), fetch_one=True)
+                old_token_data = await execute_query_async(old_token_query, (parent_id,), fetch_one=True)
 
                 if old_token_data and old_token_data['fcm_token'] and login_data.fcm_token and old_token_data['fcm_token'] != login_data.fcm_token:
                     logger.info(f"Multi-device login for parent {parent_id}. Requesting permission from old device.")
 
                     from app.api.routes import ensure_login_requests_columns
-                    ensure_login_requests_columns()
+                    await run_in_db_executor(ensure_login_requests_columns)
 
                     request_id = str(uuid.uuid4())
                     expires_at = datetime.now() + timedelta(minutes=10)
                     device_info = login_data.device_info or "New Device"
 
-                    execute_query(
+                    await execute_query_async(
                         "INSERT INTO login_requests (request_id, user_id, user_type, new_fcm_token, expires_at, status) VALUES (%s, %s, %s, %s, %s, 'PENDING')",
                         (request_id, parent_id, 'parent', login_data.fcm_token, expires_at)
                     )
@@ -119,14 +139,14 @@ async def parent_login(login_data: LoginRequest):
 
                 # Direct Login flow: Update last login and FCM token
                 try:
-                    execute_query("UPDATE parents SET last_login_at = %s WHERE parent_id = %s", 
+                    await execute_query_async("UPDATE parents SET last_login_at = %s WHERE parent_id = %s", 
                                  (datetime.now(), parent_id))
                 except Exception as update_err:
                     logger.warning(f"Failed to update last_login_at: {update_err}")
 
                 if login_data.fcm_token:
                     fcm_id = str(uuid.uuid4())
-                    execute_query(
+                    await execute_query_async(
                         """
                         INSERT INTO fcm_tokens (fcm_id, fcm_token, parent_id) 
                         VALUES (%s, %s, %s)
@@ -136,6 +156,7 @@ async def parent_login(login_data: LoginRequest):
                         """,
                         (fcm_id, login_data.fcm_token, parent_id)
                     )
+                    topic_subscriptions.request_sync(tokens=[login_data.fcm_token])
                 
                 access_token = create_access_token(
                     data={"sub": parent_id, "user_type": "parent", "phone": parent['phone']}
@@ -165,29 +186,29 @@ async def driver_login(login_data: LoginRequest):
         logger.info(f"Driver login attempt for phone: {login_data.phone}")
         
         query = "SELECT driver_id, phone, password_hash, name FROM drivers WHERE phone = %s AND status = 'ACTIVE'"
-        driver = execute_query(query, (login_data.phone,), fetch_one=True)
+        driver = await execute_query_async(query, (login_data.phone,), fetch_one=True)
         
         if driver:
             logger.info(f"Driver found: {driver['name']}")
-            if verify_password(login_data.password, driver['password_hash']):
+            if await run_in_threadpool(verify_password, login_data.password, driver['password_hash']):
                 logger.info(f"Password verified for driver: {driver['name']}")
                 driver_id = driver['driver_id']
 
                 # Device Approval Check
                 old_token_query = "SELECT fcm_token FROM drivers WHERE driver_id = %s AND fcm_token IS NOT NULL"
-                old_token_data = execute_query(old_token_query, (driver_id,), fetch_one=True)
+                old_token_data = await execute_query_async(old_token_query, (driver_id,), fetch_one=True)
 
                 if old_token_data and old_token_data['fcm_token'] and login_data.fcm_token and old_token_data['fcm_token'] != login_data.fcm_token:
                     logger.info(f"Multi-device login for driver {driver_id}. Requesting permission from old device.")
 
                     from app.api.routes import ensure_login_requests_columns
-                    ensure_login_requests_columns()
+                    await run_in_db_executor(ensure_login_requests_columns)
 
                     request_id = str(uuid.uuid4())
                     expires_at = datetime.now() + timedelta(minutes=10)
                     device_info = login_data.device_info or "New Device"
 
-                    execute_query(
+                    await execute_query_async(
                         "INSERT INTO login_requests (request_id, user_id, user_type, new_fcm_token, expires_at, status) VALUES (%s, %s, %s, %s, %s, 'PENDING')",
                         (request_id, driver_id, 'driver', login_data.fcm_token, expires_at)
                     )
@@ -209,13 +230,13 @@ async def driver_login(login_data: LoginRequest):
 
                 # Direct Login flow: Update status/timestamp and FCM token
                 try:
-                    execute_query("UPDATE drivers SET updated_at = CURRENT_TIMESTAMP WHERE driver_id = %s", 
+                    await execute_query_async("UPDATE drivers SET updated_at = CURRENT_TIMESTAMP WHERE driver_id = %s", 
                                  (driver_id,))
                 except Exception as update_err:
                     logger.warning(f"Failed to update driver timestamp: {update_err}")
 
                 if login_data.fcm_token:
-                    execute_query(
+                    await execute_query_async(
                         "UPDATE drivers SET fcm_token = %s WHERE driver_id = %s",
                         (login_data.fcm_token, driver_id)
                     )
@@ -245,12 +266,48 @@ async def get_status():
     return {
         "status": "online" if notification_service.initialized else "offline",
         "initialized": notification_service.initialized,
+        "transport": notification_service.transport.name,
         "creds_found": notification_service.creds_path is not None,
         "creds_path": str(notification_service.creds_path) if notification_service.creds_path else None,
         "last_error": notification_service.last_error,
-        "project_id": os.environ.get('GOOGLE_CLOUD_PROJECT')
+        "project_id": os.environ.get('GOOGLE_CLOUD_PROJECT'),
+        "executor": fcm_executor.get_stats(),
+        "dead_tokens": dead_token_pruner.get_stats(),
+        "topics": topic_subscriptions.get_stats(),
+        "route_recipients": route_recipient_cache.get_stats(),
+        "trip_manifests": trip_manifests.get_stats(),
+        "proximity_store": proximity_service.store.get_stats(),
+        "route_cache_rebuilds": route_cache_rebuilder.get_stats(),
+        "broadcast_jobs": broadcast_jobs.get_stats()
     }
 
+@router.get("/notifications/outbox", tags=["Notifications"])
+async def get_outbox_status(x_admin_key: str = Header(..., alias="x-admin-key")):
+    """Queued push notifications by status plus this worker's delivery counters"""
+    if x_admin_key != ADMIN_KEY:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return await notification_outbox.get_stats()
+
+@router.post("/notifications/topics/resync", tags=["Notifications"])
+async def resync_topic_subscriptions(x_admin_key: str = Header(..., alias="x-admin-key")):
+    """Reconcile the route/stop/class topic membership of every registered token (run before enabling topic fan-out)"""
+    if x_admin_key != ADMIN_KEY:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    if not topic_subscriptions.enabled:
+        raise HTTPException(status_code=409, detail="Topic sync is disabled (FCM_TOPIC_SYNC)")
+    return {"success": True, **await topic_subscriptions.resync()}
+
+@router.post("/notifications/tokens/prune", tags=["Notifications"])
+async def prune_dead_tokens(x_admin_key: str = Header(..., alias="x-admin-key")):
+    """Remove the dead FCM tokens collected from send failures right away instead of after the prune delay"""
+    if x_admin_key != ADMIN_KEY:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    try:
+        result = await run_in_db_executor(dead_token_pruner.prune)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Dead token prune failed: {e}")
+    return {"success": True, **result}
+
 @router.post("/send-notification", tags=["Notifications"])
 async def send_notification(
     title: str = Body(...),
@@ -289,23 +346,19 @@ async def broadcast_drivers(
     message_type: str = Body("audio"),
     x_admin_key: str = Header(..., alias="x-admin-key")
 ):
-    """Send a notification to all drivers concurrently"""
+    """Send a notification to all drivers (batched multicast)"""
     if x_admin_key != ADMIN_KEY:
         raise HTTPException(status_code=401, detail="Unauthorized")
     
     # Fetch all driver tokens
-    drivers = execute_query("SELECT fcm_token FROM drivers WHERE fcm_token IS NOT NULL AND status = 'ACTIVE'", fetch_all=True)
+    drivers = await execute_query_async("SELECT fcm_token FROM drivers WHERE fcm_token IS NOT NULL AND status = 'ACTIVE'", fetch_all=True)
     driver_tokens = {d['fcm_token'] for d in drivers if d['fcm_token']}
     
     if not driver_tokens:
         return {"success": True, "delivered_count": 0, "total_found": 0, "message": "No active driver tokens found"}
 
-    # Send concurrently
-    tasks = [
-        notification_service.send_to_device(title, body, token, recipient_type="driver", message_type=message_type)
-        for token in driver_tokens
-    ]
-    results = await asyncio.gather(*tasks)
+    # Send as batched multicast calls
+    results = await notification_service.send_multicast(list(driver_tokens), title, body, message_type=message_type)
     
     success_count = sum(1 for r in results if r.get("success"))
     return {
@@ -322,55 +375,43 @@ async def broadcast_parents(
     message_type: str = Body("audio", alias="messageType", description="Type of message (default: audio)"),
     x_admin_key: str = Header(..., alias="x-admin-key")
 ):
-    """Send a notification to all parents concurrently (Saves to DB history first)"""
+    """Start a broadcast to all parents as a background job (Saves to DB history first); returns its job id"""
     if x_admin_key != ADMIN_KEY:
         raise HTTPException(status_code=401, detail="Unauthorized")
     
     # 1. Log the broadcast in history FIRST
     notification_id = str(uuid.uuid4())
     try:
-        admin_id = get_system_admin_id()
+        admin_id = await run_in_db_executor(get_system_admin_id)
         log_query = """
         INSERT INTO admin_parent_notifications (notification_id, title, message, recipient_type, sent_by_admin_id)
         VALUES (%s, %s, %s, 'ALL', %s)
         """
-        execute_query(log_query, (notification_id, title, body, admin_id))
+        await execute_query_async(log_query, (notification_id, title, body, admin_id))
     except Exception as log_err:
         logger.warning(f"Failed to log broadcast notification: {log_err}")
 
-    # 2. Fetch all unique parent tokens from database for ACTIVE parents only
-    query = """
-    SELECT DISTINCT ft.fcm_token 
-    FROM fcm_tokens ft
-    JOIN parents p ON ft.parent_id = p.parent_id
-    WHERE ft.parent_id IS NOT NULL 
-    AND p.parents_active_status = 'ACTIVE'
-    """
-    tokens = execute_query(query, fetch_all=True)
-    all_tokens = {t['fcm_token'] for t in tokens if t['fcm_token']}
-    
-    if not all_tokens:
-        return {"success": True, "delivered_count": 0, "total_found": 0, "message": "No active parent tokens found", "notification_id": notification_id}
-
-    # 3. Send concurrently
-    tasks = [
-        notification_service.send_to_device(title, body, t_val, recipient_type="parent", message_type=message_type)
-        for t_val in all_tokens
-    ]
-    results = await asyncio.gather(*tasks)
-    
-    success_count = sum(1 for r in results if r.get("success"))
-    failure_reasons = [r.get("error") for r in results if not r.get("success")]
-    
+    # 2. Stream the tokens and send them in a background job; progress is polled via the job id
+    job = await broadcast_jobs.start(title, body, message_type=message_type, notification_id=notification_id)
     return {
-        "success": True, 
-        "delivered_count": success_count, 
-        "total_tokens": len(all_tokens), 
-        "failure_reasons": failure_reasons[:10], # Show first 10 errors
-        "message": f"Broadcast sent to {success_count} parents",
+        "success": True,
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "message": "Broadcast to parents started",
+        "status_url": f"/api/v1/notifications/broadcast/jobs/{job['job_id']}",
         "notification_id": notification_id
     }
 
+@router.get("/notifications/broadcast/jobs/{job_id}", tags=["Notifications"])
+async def get_broadcast_job(job_id: str, x_admin_key: str = Header(..., alias="x-admin-key")):
+    """Progress of a parent broadcast: status plus sent/failed counts"""
+    if x_admin_key != ADMIN_KEY:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    job = await broadcast_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Broadcast job not found")
+    return job
+
 @router.post("/notifications/student/{student_id}", tags=["Notifications"])
 async def send_student_notification(
     student_id: str,
@@ -386,25 +427,21 @@ async def send_student_notification(
     # 1. Log in history FIRST
     notification_id = str(uuid.uuid4())
     try:
-        admin_id = get_system_admin_id()
+        admin_id = await run_in_db_executor(get_system_admin_id)
         log_query = """
         INSERT INTO admin_parent_notifications (notification_id, title, message, recipient_type, student_id, sent_by_admin_id)
         VALUES (%s, %s, %s, 'STUDENT', %s, %s)
         """
-        execute_query(log_query, (notification_id, title, body, student_id, admin_id))
+        await execute_query_async(log_query, (notification_id, title, body, student_id, admin_id))
     except Exception as log_err:
         logger.warning(f"Failed to log student notification: {log_err}")
 
-    tokens = execute_query("SELECT fcm_token FROM fcm_tokens WHERE student_id = %s", (student_id,), fetch_all=True)
+    tokens = await execute_query_async("SELECT fcm_token FROM fcm_tokens WHERE student_id = %s", (student_id,), fetch_all=True)
     if not tokens:
         return {"success": True, "message": "No tokens for student", "delivered_count": 0, "notification_id": notification_id}
     
     unique_tokens = {t['fcm_token'] for t in tokens if t['fcm_token']}
-    tasks = [
-        notification_service.send_to_device(title, body, t_val, recipient_type="student", message_type=message_type)
-        for t_val in unique_tokens
-    ]
-    results = await asyncio.gather(*tasks)
+    results = await notification_service.send_multicast(list(unique_tokens), title, body, message_type=message_type)
     
     success_count = sum(1 for r in results if r.get("success"))
     failure_reasons = [r.get("error") for r in results if not r.get("success")]
@@ -432,25 +469,21 @@ async def send_parent_notification(
     # 1. Log in history FIRST
     notification_id = str(uuid.uuid4())
     try:
-        admin_id = get_system_admin_id()
+        admin_id = await run_in_db_executor(get_system_admin_id)
         log_query = """
         INSERT INTO admin_parent_notifications (notification_id, title, message, recipient_type, recipient_id, sent_by_admin_id)
         VALUES (%s, %s, %s, 'PARENT_DIRECT', %s, %s)
         """
-        execute_query(log_query, (notification_id, title, body, parent_id, admin_id))
+        await execute_query_async(log_query, (notification_id, title, body, parent_id, admin_id))
     except Exception as log_err:
         logger.warning(f"Failed to log parent notification: {log_err}")
 
-    tokens = execute_query("SELECT fcm_token FROM fcm_tokens WHERE parent_id = %s", (parent_id,), fetch_all=True)
+    tokens = await execute_query_async("SELECT fcm_token FROM fcm_tokens WHERE parent_id = %s", (parent_id,), fetch_all=True)
     if not tokens:
         return {"success": True, "message": "No tokens for parent", "delivered_count": 0, "notification_id": notification_id}
     
     unique_tokens = {t['fcm_token'] for t in tokens if t['fcm_token']}
-    tasks = [
-        notification_service.send_to_device(title, body, t_val, recipient_type="parent", message_type=message_type)
-        for t_val in unique_tokens
-    ]
-    results = await asyncio.gather(*tasks)
+    results = await notification_service.send_multicast(list(unique_tokens), title, body, message_type=message_type)
     
     success_count = sum(1 for r in results if r.get("success"))
     failure_reasons = [r.get("error") for r in results if not r.get("success")]
@@ -478,31 +511,32 @@ async def send_route_notification(
     # 1. Log in history FIRST
     notification_id = str(uuid.uuid4())
     try:
-        admin_id = get_system_admin_id()
+        admin_id = await run_in_db_executor(get_system_admin_id)
         log_query = """
         INSERT INTO admin_parent_notifications (notification_id, title, message, recipient_type, route_id, sent_by_admin_id)
         VALUES (%s, %s, %s, 'ROUTE', %s, %s)
         """
-        execute_query(log_query, (notification_id, title, body, route_id, admin_id))
+        await execute_query_async(log_query, (notification_id, title, body, route_id, admin_id))
     except Exception as log_err:
         logger.warning(f"Failed to log route notification: {log_err}")
 
+    if topic_subscriptions.fanout:
+        audience = route_audience(route_id)
+        result = await notification_service.send_to_topic(title, body, message_type=message_type, **audience)
+        return _topic_send_response(result, audience, notification_id)
+
     query = """
     SELECT DISTINCT ft.fcm_token 
     FROM fcm_tokens ft
     JOIN students s ON (ft.student_id = s.student_id OR ft.parent_id = s.parent_id OR ft.parent_id = s.s_parent_id)
     WHERE s.pickup_route_id = %s OR s.drop_route_id = %s
     """
-    tokens = execute_query(query, (route_id, route_id), fetch_all=True)
+    tokens = await execute_query_async(query, (route_id, route_id), fetch_all=True)
     if not tokens:
         return {"success": True, "message": "No tokens for route", "delivered_count": 0, "notification_id": notification_id}
     
     unique_tokens = {t['fcm_token'] for t in tokens if t['fcm_token']}
-    tasks = [
-        notification_service.send_to_device(title, body, t_val, recipient_type="route", message_type=message_type)
-        for t_val in unique_tokens
-    ]
-    results = await asyncio.gather(*tasks)
+    results = await notification_service.send_multicast(list(unique_tokens), title, body, message_type=message_type)
     
     success_count = sum(1 for r in results if r.get("success"))
     return {"success": True, "delivered_count": success_count, "total_tokens": len(unique_tokens), "notification_id": notification_id}
@@ -522,31 +556,32 @@ async def send_class_notification(
     # 1. Log in history FIRST
     notification_id = str(uuid.uuid4())
     try:
-        admin_id = get_system_admin_id()
+        admin_id = await run_in_db_executor(get_system_admin_id)
         log_query = """
         INSERT INTO admin_parent_notifications (notification_id, title, message, recipient_type, class_id, sent_by_admin_id)
         VALUES (%s, %s, %s, 'CLASS', %s, %s)
         """
-        execute_query(log_query, (notification_id, title, body, class_id, admin_id))
+        await execute_query_async(log_query, (notification_id, title, body, class_id, admin_id))
     except Exception as log_err:
         logger.warning(f"Failed to log class notification: {log_err}")
 
+    if topic_subscriptions.fanout:
+        audience = {"topic": class_topic(class_id)}
+        result = await notification_service.send_to_topic(title, body, message_type=message_type, **audience)
+        return _topic_send_response(result, audience, notification_id)
+
     query = """
     SELECT DISTINCT ft.fcm_token 
     FROM fcm_tokens ft
     JOIN students s ON (ft.student_id = s.student_id OR ft.parent_id = s.parent_id OR ft.parent_id = s.s_parent_id)
     WHERE s.class_id = %s
     """
-    tokens = execute_query(query, (class_id,), fetch_all=True)
+    tokens = await execute_query_async(query, (class_id,), fetch_all=True)
     if not tokens:
         return {"success": True, "message": "No tokens for class", "delivered_count": 0, "notification_id": notification_id}
     
     unique_tokens = {t['fcm_token'] for t in tokens if t['fcm_token']}
-    tasks = [
-        notification_service.send_to_device(title, body, t_val, recipient_type="class", message_type=message_type)
-        for t_val in unique_tokens
-    ]
-    results = await asyncio.gather(*tasks)
+    results = await notification_service.send_multicast(list(unique_tokens), title, body, message_type=message_type)
     
     success_count = sum(1 for r in results if r.get("success"))
     return {"success": True, "delivered_count": success_count, "total_tokens": len(unique_tokens), "notification_id": notification_id}
@@ -567,7 +602,7 @@ async def send_location_notification(
     # 1. Log in history FIRST
     notification_id = str(uuid.uuid4())
     try:
-        admin_id = get_system_admin_id()
+        admin_id = await run_in_db_executor(get_system_admin_id)
         # Sanitize optional route_id
         safe_route_id = route_id if route_id and str(route_id).strip() != "" else None
         
@@ -575,10 +610,23 @@ async def send_location_notification(
         INSERT INTO admin_parent_notifications (notification_id, title, message, recipient_type, location_name, route_id, sent_by_admin_id)
         VALUES (%s, %s, %s, 'LOCATION', %s, %s, %s)
         """
-        execute_query(log_query, (notification_id, title, body, location_name, safe_route_id, admin_id))
+        await execute_query_async(log_query, (notification_id, title, body, location_name, safe_route_id, admin_id))
     except Exception as log_err:
         logger.error(f"Failed to log location notification: {log_err}")
 
+    if topic_subscriptions.fanout:
+        # A location is a handful of stops; FCM conditions take at most 5 topics, larger sets use multicast
+        stop_query = "SELECT stop_id FROM route_stops WHERE (location = %s OR ((location IS NULL OR location = '') AND stop_name = %s))"
+        stop_params = (location_name, location_name)
+        if route_id:
+            stop_query += " AND route_id = %s"
+            stop_params += (route_id,)
+        stops = await execute_query_async(stop_query, stop_params, fetch_all=True) or []
+        if 0 < len(stops) <= 5:
+            audience = {"condition": topic_condition([stop_topic(s['stop_id']) for s in stops])}
+            result = await notification_service.send_to_topic(title, body, message_type=message_type, **audience)
+            return _topic_send_response(result, audience, notification_id)
+
     if route_id:
         query = """
         SELECT DISTINCT ft.fcm_token 
@@ -599,22 +647,18 @@ async def send_location_notification(
         """
         params = (location_name, location_name)
 
-    tokens = execute_query(query, params, fetch_all=True)
+    tokens = await execute_query_async(query, params, fetch_all=True)
     if not tokens:
         return {"success": True, "message": "No tokens for location", "delivered_count": 0, "notification_id": notification_id}
     
     unique_tokens = {t['fcm_token'] for t in tokens if t['fcm_token']}
-    tasks = [
-        notification_service.send_to_device(title, body, t_val, recipient_type="location", message_type=message_type)
-        for t_val in unique_tokens
-    ]
-    results = await asyncio.gather(*tasks)
+    results = await notification_service.send_multicast(list(unique_tokens), title, body, message_type=message_type)
     
     success_count = sum(1 for r in results if r.get("success"))
     return {"success": True, "delivered_count": success_count, "total_tokens": len(unique_tokens), "notification_id": notification_id}
 
 from app.services.proximity_service import proximity_service
-from app.services.bus_tracking import bus_tracking_service
+from app.services.trip_lanes import trip_lanes
 import logging
 
 logger = logging.getLogger(__name__)
@@ -623,12 +667,20 @@ logger = logging.getLogger(__name__)
 async def update_bus_location_combined(location_data: BusLocationUpdate):
     """Combined bus tracking: handles stop progression, trip completion, AND proximity/geofence notifications"""
     try:
-        # 1. Run stop progression (updates current_stop_order, auto-completes trip, sends stop arrival notifications)
-        stop_result = await bus_tracking_service.update_bus_location(
-            trip_id=location_data.trip_id,
-            latitude=location_data.latitude,
-            longitude=location_data.longitude
+        # 1. Run stop progression on the trip's lane (updates current_stop_order, auto-completes trip, sends stop arrival notifications)
+        stop_result = await trip_lanes.submit(
+            location_data.trip_id,
+            location_data.latitude,
+            location_data.longitude,
+            location_data.timestamp
         )
+        if stop_result.get("ignored"):
+            return {
+                "success": True,
+                "trip_id": location_data.trip_id,
+                "stop_progression": stop_result,
+                "proximity_alerts": {"success": False, "message": "Stale location ignored"}
+            }
         
         # 2. Run proximity alerts (approaching/arrived geofence notifications)
         proximity_result = await proximity_service.process_location_update(
@@ -656,7 +708,7 @@ async def start_trip_v2(trip_id: str, x_admin_key: str = Header(..., alias="x-ad
     if x_admin_key != ADMIN_KEY:
         raise HTTPException(status_code=401, detail="Unauthorized")
     # Fetch the route_id from DB
-    trip = execute_query("SELECT route_id FROM trips WHERE trip_id = %s", (trip_id,), fetch_one=True)
+    trip = await execute_query_async("SELECT route_id FROM trips WHERE trip_id = %s", (trip_id,), fetch_one=True)
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
     return await proximity_service.start_trip(trip_id, trip["route_id"])
@@ -667,7 +719,7 @@ async def complete_trip_v2(trip_id: str, x_admin_key: str = Header(..., alias="x
     if x_admin_key != ADMIN_KEY:
         raise HTTPException(status_code=401, detail="Unauthorized")
     # Fetch the route_id from DB
-    trip = execute_query("SELECT route_id FROM trips WHERE trip_id = %s", (trip_id,), fetch_one=True)
+    trip = await execute_query_async("SELECT route_id FROM trips WHERE trip_id = %s", (trip_id,), fetch_one=True)
     if not trip:
         raise HTTPException(status_code=404, detail="Trip not found")
     return await proximity_service.complete_trip(trip_id, trip["route_id"])
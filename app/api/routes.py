@@ -1,5 +1,6 @@
-from fastapi import APIRouter, HTTPException, status, File, UploadFile, Body
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, HTTPException, status, File, UploadFile, Body, Depends, Request, WebSocket, WebSocketDisconnect, Query
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from typing import List, Optional
 from datetime import datetime, date, timedelta
 import uuid
@@ -10,14 +11,24 @@ import asyncio
 import csv
 import io
 
-from app.core.database import get_db, execute_query
+from app.core.database import (
+    get_db, execute_query, execute_query_async, execute_many, run_in_db_executor, get_pool_stats,
+    get_query_stats, reset_query_stats,
+    db_unit_of_work, after_commit
+)
 from app.api.models import *
 from app.core.auth import create_access_token
 from app.services.bus_tracking import bus_tracking_service
+from app.services.trip_state import trip_state_cache
+from app.services.stop_index import stop_index, geofence_radius_m
+from app.services.trip_lanes import trip_lanes
+from app.services.live_locations import live_location_buffer
+from app.services.live_events import live_event_broker, topic_for
 from app.notification_api.service import notification_service
 from app.services.cascade_updates import cascade_service
+from app.services.topic_subscriptions import topic_subscriptions, route_audience
 from app.services.upload_service import upload_service
-from app.core.security import get_password_hash, generate_default_password
+from app.core.security import get_password_hash, get_password_hashes, generate_default_password
 from app.services.cleanup_service import cleanup_service
 
 router = APIRouter()
@@ -98,6 +109,22 @@ async def manual_cleanup_logs(days: int = 30):
     else:
         raise HTTPException(status_code=500, detail="Cleanup failed")
 
+@router.get("/maintenance/db-pool", tags=["Dashboard"])
+async def get_db_pool_stats():
+    """Database connection pool usage (open, idle, in-use connections and checkout counters)"""
+    return {"status": "success", "data": get_pool_stats()}
+
+@router.get("/maintenance/query-stats", tags=["Dashboard"])
+async def get_sql_query_stats(sort_by: str = "total_ms", limit: int = 50):
+    """Per-statement SQL stats (calls, errors, rows, latency percentiles) sorted by total_ms, avg_ms, max_ms, calls or errors"""
+    return {"status": "success", "data": get_query_stats(sort_by=sort_by, limit=limit)}
+
+@router.post("/maintenance/query-stats/reset", tags=["Dashboard"])
+async def reset_sql_query_stats():
+    """Clear the collected SQL statement stats"""
+    reset_query_stats()
+    return {"status": "success", "message": "Query stats reset"}
+
 # =====================================================
 # USER PROFILE & AUTHENTICATION
 # =====================================================
@@ -110,10 +137,14 @@ async def logout(fcm_token: Optional[str] = Body(None, embed=True)):
     Call this when the user explicitly logs out or when the app is being uninstalled/reset.
     """
     if fcm_token:
+        route_ids = cascade_service.routes_for_tokens([fcm_token])
         # Remove from fcm_tokens table (primarily Parents/Students)
         execute_query("DELETE FROM fcm_tokens WHERE fcm_token = %s", (fcm_token,))
+        for route_id in route_ids:
+            cascade_service.remove_route_tokens(route_id, [fcm_token])
         # Remove from drivers table (Direct column)
         execute_query("UPDATE drivers SET fcm_token = NULL WHERE fcm_token = %s", (fcm_token,))
+        topic_subscriptions.request_sync(tokens=[fcm_token])
         logger.info(f"FCM token removed during logout: {fcm_token}")
     return {"message": "Logged out successfully and FCM token removed"}
 
@@ -197,6 +228,7 @@ async def respond_to_login_request(request_id: str, response_data: dict = Body(.
         execute_query("DELETE FROM fcm_tokens WHERE parent_id = %s", (user_id,))
         execute_query("INSERT INTO fcm_tokens (fcm_id, fcm_token, parent_id) VALUES (%s, %s, %s)", 
                       (str(uuid.uuid4()), new_token, user_id))
+        cascade_service.update_fcm_token_cascades(None, {"fcm_token": old_token}, {"fcm_token": new_token, "parent_id": user_id})
     else: # driver
         result = execute_query("SELECT fcm_token FROM drivers WHERE driver_id = %s", (user_id,), fetch_one=True)
         old_token = result['fcm_token'] if result else None
@@ -418,7 +450,7 @@ async def update_admin_status(admin_id: str, status_update: StatusUpdate):
         raise HTTPException(status_code=404, detail="Admin not found")
     return await get_admin(admin_id)
 
-@router.delete("/admins/{admin_id}", tags=["Admins"])
+@router.delete("/admins/{admin_id}", tags=["Admins"], dependencies=[Depends(db_unit_of_work)])
 async def delete_admin(admin_id: str):
     """Delete admin with cleanup"""
     try:
@@ -611,17 +643,9 @@ async def create_admin_parent_notification(notification: AdminParentNotification
         if target_tokens:
             unique_tokens = list(set(target_tokens))
             from app.notification_api.service import notification_service
-            tasks = [
-                notification_service.send_to_device(
-                    notification.title, notification.message, token, 
-                    recipient_type="parent", message_type="audio"
-                )
-                for token in unique_tokens
-            ]
-            async def run_parallel_sends():
-                await asyncio.gather(*tasks, return_exceptions=True)
-            
-            asyncio.create_task(run_parallel_sends())
+            asyncio.create_task(
+                notification_service.broadcast_to_tokens(unique_tokens, notification.title, notification.message, message_type="audio")
+            )
         
         return await get_admin_parent_notification(notification_id)
     except Exception as e:
@@ -1017,6 +1041,7 @@ async def update_parent_fcm_token(parent_id: str, fcm_data: dict):
         """
         fcm_id = str(uuid.uuid4())
         execute_query(query, (fcm_id, fcm_token, parent_id))
+        cascade_service.update_fcm_token_cascades(fcm_id, None, {"fcm_token": fcm_token, "parent_id": parent_id})
         
         return {
             "message": "FCM token updated successfully",
@@ -1052,7 +1077,7 @@ async def get_all_parent_fcm_tokens():
     fcm_tokens = [{"fcm_id": fid, "fcm_token": tk} for tk, fid in token_map.items()]
     return {"fcm_tokens": fcm_tokens, "count": len(fcm_tokens)}
 
-@router.delete("/parents/{parent_id}", tags=["Parents"])
+@router.delete("/parents/{parent_id}", tags=["Parents"], dependencies=[Depends(db_unit_of_work)])
 async def delete_parent(parent_id: str):
     """Delete parent with cascade cleanup"""
     try:
@@ -1079,6 +1104,12 @@ async def delete_parent(parent_id: str):
         logger.error(f"Delete parent error: {e}")
         raise HTTPException(status_code=500, detail="Failed to delete parent")
 
+PARENT_INSERT_QUERY = """
+INSERT INTO parents (parent_id, phone, email, password_hash, name, parent_role, 
+                   door_no, street, city, district, pincode)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
 @router.post("/parents/bulk", response_model=BulkCreateResponse, tags=["Parents"])
 async def bulk_create_parents(bulk_data: BulkParentCreate):
     """Bulk create multiple parents in a single request (JSON)"""
@@ -1089,33 +1120,28 @@ async def bulk_create_parents(bulk_data: BulkParentCreate):
         "errors": []
     }
     
-    with get_db() as conn:
-        with conn.cursor() as cursor:
-            for parent in bulk_data.parents:
-                try:
-                    parent_id = str(uuid.uuid4())
-                    try:
-                        default_password = generate_default_password(parent.name, parent.phone)
-                    except ValueError as e:
-                        results["failed"] += 1
-                        results["errors"].append({"phone": parent.phone, "error": str(e)})
-                        continue
-                        
-                    hashed_password = get_password_hash(default_password)
-                    
-                    query = """
-                    INSERT INTO parents (parent_id, phone, email, password_hash, name, parent_role, 
-                                       door_no, street, city, district, pincode)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """
-                    cursor.execute(query, (parent_id, parent.phone, parent.email, hashed_password, 
-                                         parent.name, parent.parent_role.value, parent.door_no, parent.street,
-                                         parent.city, parent.district, parent.pincode))
-                    
-                    results["success"] += 1
-                except Exception as e:
-                    results["failed"] += 1
-                    results["errors"].append({"phone": parent.phone, "error": str(e)})
+    valid = []
+    passwords = []
+    for parent in bulk_data.parents:
+        try:
+            passwords.append(generate_default_password(parent.name, parent.phone))
+            valid.append(parent)
+        except ValueError as e:
+            results["failed"] += 1
+            results["errors"].append({"phone": parent.phone, "error": str(e)})
+    
+    hashes = await run_in_threadpool(get_password_hashes, passwords)
+    rows = [
+        (str(uuid.uuid4()), parent.phone, parent.email, hashed_password, parent.name, parent.parent_role.value,
+         parent.door_no, parent.street, parent.city, parent.district, parent.pincode)
+        for parent, hashed_password in zip(valid, hashes)
+    ]
+    inserted = await run_in_db_executor(execute_many, PARENT_INSERT_QUERY, rows)
+    
+    results["success"] = inserted["success"]
+    results["failed"] += inserted["failed"]
+    for err in inserted["errors"]:
+        results["errors"].append({"phone": valid[err["index"]].phone, "error": err["error"]})
     
     return results
 
@@ -1136,48 +1162,50 @@ async def bulk_upload_parents_csv(file: UploadFile = File(...)):
         "errors": []
     }
     
-    with get_db() as conn:
-        with conn.cursor() as cursor:
-            for row in reader:
-                results["total"] += 1
-                try:
-                    parent_id = str(uuid.uuid4())
-                    name = row.get('name')
-                    phone = row.get('phone', '') # Keep as original (likely string or int)
-                    email = row.get('email')
-                    if email:
-                        email = email.strip()
-                        if email.lower() in ["", "none", "null", "undefined"]:
-                            email = None
-                    else:
-                        email = None
-                    role = row.get('parent_role', 'GUARDIAN').upper()
-                    
-                    if not name or not phone:
-                        raise ValueError("Name and phone are required")
-                    
-                    try:
-                        default_password = generate_default_password(name, phone)
-                    except ValueError as e:
-                        results["failed"] += 1
-                        results["errors"].append({"phone": phone, "error": str(e)})
-                        continue
-                        
-                    hashed_password = get_password_hash(default_password)
-                    
-                    query = """
-                    INSERT INTO parents (parent_id, phone, email, password_hash, name, parent_role, 
-                                       door_no, street, city, district, pincode)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """
-                    cursor.execute(query, (parent_id, phone, email, hashed_password, 
-                                         name, role, row.get('door_no'), row.get('street'),
-                                         row.get('city'), row.get('district'), row.get('pincode')))
-                    
-                    results["success"] += 1
-                except Exception as e:
-                    results["failed"] += 1
-                    results["errors"].append({"row": results["total"], "error": str(e)})
+    parsed = []  # (csv row number, parsed parent fields)
+    passwords = []
+    for row in reader:
+        results["total"] += 1
+        try:
+            name = row.get('name')
+            phone = row.get('phone', '') # Keep as original (likely string or int)
+            email = row.get('email')
+            if email:
+                email = email.strip()
+                if email.lower() in ["", "none", "null", "undefined"]:
+                    email = None
+            else:
+                email = None
+            role = row.get('parent_role', 'GUARDIAN').upper()
+            
+            if not name or not phone:
+                raise ValueError("Name and phone are required")
+            
+            try:
+                default_password = generate_default_password(name, phone)
+            except ValueError as e:
+                results["failed"] += 1
+                results["errors"].append({"phone": phone, "error": str(e)})
+                continue
+            
+            passwords.append(default_password)
+            parsed.append((results["total"], (name, phone, email, role, row.get('door_no'), row.get('street'),
+                                              row.get('city'), row.get('district'), row.get('pincode'))))
+        except Exception as e:
+            results["failed"] += 1
+            results["errors"].append({"row": results["total"], "error": str(e)})
+    
+    hashes = await run_in_threadpool(get_password_hashes, passwords)
+    rows = [
+        (str(uuid.uuid4()), phone, email, hashed_password, name, role, door_no, street, city, district, pincode)
+        for (_, (name, phone, email, role, door_no, street, city, district, pincode)), hashed_password in zip(parsed, hashes)
+    ]
+    inserted = await run_in_db_executor(execute_many, PARENT_INSERT_QUERY, rows)
+    
+    results["success"] = inserted["success"]
+    results["failed"] += inserted["failed"]
+    for err in inserted["errors"]:
+        results["errors"].append({"row": parsed[err["index"]][0], "error": err["error"]})
     
     return results
 
@@ -1356,7 +1384,7 @@ async def get_all_driver_fcm_tokens():
     fcm_tokens = [{"fcm_id": did, "fcm_token": tk} for tk, did in token_map.items()]
     return {"fcm_tokens": fcm_tokens, "count": len(fcm_tokens)}
 
-@router.delete("/drivers/{driver_id}", tags=["Drivers"])
+@router.delete("/drivers/{driver_id}", tags=["Drivers"], dependencies=[Depends(db_unit_of_work)])
 async def delete_driver(driver_id: str):
     """Delete driver with cleanup"""
     try:
@@ -1538,7 +1566,7 @@ async def update_route_status(route_id: str, status_update: StatusUpdate):
         raise HTTPException(status_code=404, detail="Route not found")
     return await get_route(route_id)
 
-@router.delete("/routes/{route_id}", tags=["Routes"])
+@router.delete("/routes/{route_id}", tags=["Routes"], dependencies=[Depends(db_unit_of_work)])
 async def delete_route(route_id: str):
     """Delete route with cascade cleanup"""
     try:
@@ -1555,6 +1583,8 @@ async def delete_route(route_id: str):
         result = execute_query(query, (route_id,))
         if result == 0:
             raise HTTPException(status_code=404, detail="Route not found")
+        after_commit(trip_state_cache.invalidate_route, route_id)
+        after_commit(stop_index.remove_route, route_id)
         
         return {"message": "Route deleted successfully"}
     except HTTPException:
@@ -1652,12 +1682,12 @@ async def create_route_stop(route_stop: RouteStopCreate):
                 stop_id = str(uuid.uuid4())
                 insert_query = """
                 INSERT INTO route_stops (stop_id, route_id, stop_name, location, latitude, longitude, 
-                                       pickup_stop_order, drop_stop_order)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                                       geofence_radius_m, pickup_stop_order, drop_stop_order)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
                 """
                 cursor.execute(insert_query, (
                     stop_id, route_id, route_stop.stop_name, route_stop.location,
-                    route_stop.latitude, route_stop.longitude, 
+                    route_stop.latitude, route_stop.longitude, route_stop.geofence_radius_m,
                     new_pickup, new_drop
                 ))
                 # Transaction commits automatically via get_db()
@@ -1665,6 +1695,8 @@ async def create_route_stop(route_stop: RouteStopCreate):
 
         # 9. Rebuild route_stop_fcm_cache for that route
         cascade_service.update_route_fcm_cache(route_id)
+        after_commit(trip_state_cache.invalidate_route, route_id)
+        after_commit(stop_index.reload_route_in_background, route_id)
 
         # 10. Return updated stop list sorted by pickup_stop_order
         return await get_all_route_stops(route_id)
@@ -1708,6 +1740,33 @@ async def get_route_stops_drop_order(route_id: str):
     stops = execute_query(query, (route_id,), fetch_all=True)
     return stops or []
 
+@router.get("/route-stops/nearby", response_model=List[NearbyStopResponse], tags=["Route Stops"])
+async def get_nearby_route_stops(
+    latitude: float = Query(..., ge=-90, le=90),
+    longitude: float = Query(..., ge=-180, le=180),
+    radius_m: Optional[int] = Query(None, ge=10, le=20000),
+    route_id: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500)
+):
+    """Stops of every route (or one route) within radius_m of a point, nearest first - answered from the in-memory stop index"""
+    try:
+        await run_in_db_executor(stop_index.ensure_loaded)
+        found = stop_index.nearby(latitude, longitude, radius_m, route_id=route_id)[:limit]
+        return [
+            {**{k: stop[k] for k in ("stop_id", "route_id", "stop_name", "location", "latitude", "longitude",
+                                     "pickup_stop_order", "drop_stop_order")},
+             "geofence_radius_m": geofence_radius_m(stop), "distance_m": round(distance_m, 1)}
+            for stop, distance_m in found
+        ]
+    except Exception as e:
+        logger.error(f"Nearby stops error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to search nearby stops")
+
+@router.get("/route-stops/index/stats", tags=["Route Stops"])
+async def get_stop_index_stats():
+    """In-memory stop index counters"""
+    return stop_index.get_stats()
+
 @router.get("/route-stops/{stop_id}", response_model=RouteStopResponse, tags=["Route Stops"])
 async def get_route_stop(stop_id: str):
     """Get route stop by ID"""
@@ -1717,7 +1776,7 @@ async def get_route_stop(stop_id: str):
         raise HTTPException(status_code=404, detail="Route stop not found")
     return stop
 
-@router.put("/route-stops/{stop_id}", response_model=RouteStopResponse, tags=["Route Stops"])
+@router.put("/route-stops/{stop_id}", response_model=RouteStopResponse, tags=["Route Stops"], dependencies=[Depends(db_unit_of_work)])
 async def update_route_stop(stop_id: str, stop_update: RouteStopUpdate):
     """Update route stop and reorder with transactional shifting if order changed"""
     try:
@@ -1833,6 +1892,9 @@ async def update_route_stop(stop_id: str, stop_update: RouteStopUpdate):
         # 3. Trigger cascade updates
         new_data = stop_update.model_dump(exclude_unset=True)
         cascade_service.update_route_stop_cascades(stop_id, old_stop, new_data)
+        # Caches must not see this request's uncommitted stop rows
+        after_commit(trip_state_cache.invalidate_route, old_stop['route_id'])
+        after_commit(stop_index.reload_route_in_background, old_stop['route_id'])
         
         return await get_route_stop(stop_id)
     except HTTPException:
@@ -1841,7 +1903,7 @@ async def update_route_stop(stop_id: str, stop_update: RouteStopUpdate):
         logger.error(f"Update route stop error: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to update route stop: {str(e)}")
 
-@router.delete("/route-stops/{stop_id}", tags=["Route Stops"])
+@router.delete("/route-stops/{stop_id}", tags=["Route Stops"], dependencies=[Depends(db_unit_of_work)])
 async def delete_route_stop(stop_id: str):
     """Delete route stop and reorder remaining stops using transactional shifting"""
     try:
@@ -1882,6 +1944,8 @@ async def delete_route_stop(stop_id: str):
         
         # 3. Update FCM cache for the route
         cascade_service.update_route_fcm_cache(route_id)
+        after_commit(trip_state_cache.invalidate_route, route_id)
+        after_commit(stop_index.reload_route_in_background, route_id)
         
         return {"message": "Route stop deleted and route shifted successfully"}
     except HTTPException:
@@ -1906,38 +1970,46 @@ async def bulk_create_route_stops(bulk_data: BulkRouteStopCreate):
         "errors": []
     }
     
-    affected_routes = set()
+    # Validate every referenced route with a single lookup
+    route_ids = list({stop.route_id for stop in bulk_data.stops})
+    existing_routes = set()
+    if route_ids:
+        placeholders = ','.join(['%s'] * len(route_ids))
+        found = await execute_query_async(f"SELECT route_id FROM routes WHERE route_id IN ({placeholders})", tuple(route_ids), fetch_all=True)
+        existing_routes = {r['route_id'] for r in found or []}
     
-    with get_db() as conn:
-        with conn.cursor() as cursor:
-            for stop in bulk_data.stops:
-                try:
-                    # Validate route exists
-                    cursor.execute("SELECT route_id FROM routes WHERE route_id = %s", (stop.route_id,))
-                    route = cursor.fetchone()
-                    if not route:
-                        raise ValueError(f"Route {stop.route_id} not found")
-                    
-                    stop_id = str(uuid.uuid4())
-                    query = """
-                    INSERT INTO route_stops (stop_id, route_id, stop_name, location, latitude, longitude, 
-                                           pickup_stop_order, drop_stop_order)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                    """
-                    cursor.execute(query, (
-                        stop_id, stop.route_id, stop.stop_name, stop.location,
-                        stop.latitude, stop.longitude,
-                        stop.pickup_stop_order, stop.drop_stop_order
-                    ))
-                    
-                    affected_routes.add(stop.route_id)
-                    results["success"] += 1
-                except Exception as e:
-                    results["failed"] += 1
-                    results["errors"].append({"stop_name": stop.stop_name, "route_id": stop.route_id, "error": str(e)})
+    valid = []
+    for stop in bulk_data.stops:
+        if stop.route_id not in existing_routes:
+            results["failed"] += 1
+            results["errors"].append({"stop_name": stop.stop_name, "route_id": stop.route_id, "error": f"Route {stop.route_id} not found"})
+        else:
+            valid.append(stop)
+    
+    query = """
+    INSERT INTO route_stops (stop_id, route_id, stop_name, location, latitude, longitude, 
+                           geofence_radius_m, pickup_stop_order, drop_stop_order)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """
+    rows = [
+        (str(uuid.uuid4()), stop.route_id, stop.stop_name, stop.location, stop.latitude, stop.longitude,
+         stop.geofence_radius_m, stop.pickup_stop_order, stop.drop_stop_order)
+        for stop in valid
+    ]
+    inserted = await run_in_db_executor(execute_many, query, rows)
+    
+    failed_indexes = {err["index"] for err in inserted["errors"]}
+    results["success"] = inserted["success"]
+    results["failed"] += inserted["failed"]
+    for err in inserted["errors"]:
+        stop = valid[err["index"]]
+        results["errors"].append({"stop_name": stop.stop_name, "route_id": stop.route_id, "error": err["error"]})
+    affected_routes = {stop.route_id for i, stop in enumerate(valid) if i not in failed_indexes}
     
     # Rebuild FCM cache for all affected routes
     for route_id in affected_routes:
+        after_commit(trip_state_cache.invalidate_route, route_id)
+        after_commit(stop_index.reload_route_in_background, route_id)
         try:
             cascade_service.update_route_fcm_cache(route_id)
         except Exception as e:
@@ -2155,7 +2227,7 @@ async def get_bus_by_driver(driver_id: str):
         raise HTTPException(status_code=404, detail="No bus found for this driver")
     return result
 
-@router.delete("/buses/{bus_id}", tags=["Buses"])
+@router.delete("/buses/{bus_id}", tags=["Buses"], dependencies=[Depends(db_unit_of_work)])
 async def delete_bus(bus_id: str):
     """Delete bus with cleanup"""
     try:
@@ -2255,7 +2327,7 @@ async def update_class_status(class_id: str, status_update: StatusUpdate):
         raise HTTPException(status_code=404, detail="Class not found")
     return await get_class(class_id)
 
-@router.delete("/classes/{class_id}", tags=["Classes"])
+@router.delete("/classes/{class_id}", tags=["Classes"], dependencies=[Depends(db_unit_of_work)])
 async def delete_class(class_id: str):
     """Delete class with cleanup"""
     try:
@@ -2921,7 +2993,7 @@ async def demote_all_classes(demote_data: BulkDemoteRequest):
         logger.error(f"Demote all classes error: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to demote classes: {str(e)}")
 
-@router.delete("/students/{student_id}", tags=["Students"])
+@router.delete("/students/{student_id}", tags=["Students"], dependencies=[Depends(db_unit_of_work)])
 async def delete_student(student_id: str):
     """Delete student with cascade cleanup"""
     try:
@@ -2958,28 +3030,27 @@ async def bulk_create_students(bulk_data: BulkStudentCreate):
         "errors": []
     }
     
-    with get_db() as conn:
-        with conn.cursor() as cursor:
-            for student in bulk_data.students:
-                try:
-                    student_id = str(uuid.uuid4())
-                    query = """
-                    INSERT INTO students (student_id, parent_id, s_parent_id, name, gender, dob, study_year, class_id,
-                                        pickup_route_id, drop_route_id, pickup_stop_id, drop_stop_id,
-                                        emergency_contact, student_photo_url, is_transport_user,
-                                        student_status, transport_status)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """
-                    cursor.execute(query, (student_id, student.parent_id, student.s_parent_id, student.name, student.gender.value,
-                                         student.dob, student.study_year, student.class_id, student.pickup_route_id, 
-                                         student.drop_route_id, student.pickup_stop_id, student.drop_stop_id,
-                                         student.emergency_contact, student.student_photo_url, student.is_transport_user,
-                                         student.student_status.value, student.transport_status.value))
-                    
-                    results["success"] += 1
-                except Exception as e:
-                    results["failed"] += 1
-                    results["errors"].append({"name": student.name, "error": str(e)})
+    query = """
+    INSERT INTO students (student_id, parent_id, s_parent_id, name, gender, dob, study_year, class_id,
+                        pickup_route_id, drop_route_id, pickup_stop_id, drop_stop_id,
+                        emergency_contact, student_photo_url, is_transport_user,
+                        student_status, transport_status)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """
+    rows = [
+        (str(uuid.uuid4()), student.parent_id, student.s_parent_id, student.name, student.gender.value,
+         student.dob, student.study_year, student.class_id, student.pickup_route_id, 
+         student.drop_route_id, student.pickup_stop_id, student.drop_stop_id,
+         student.emergency_contact, student.student_photo_url, student.is_transport_user,
+         student.student_status.value, student.transport_status.value)
+        for student in bulk_data.students
+    ]
+    inserted = await run_in_db_executor(execute_many, query, rows)
+    
+    results["success"] = inserted["success"]
+    results["failed"] = inserted["failed"]
+    for err in inserted["errors"]:
+        results["errors"].append({"name": bulk_data.students[err["index"]].name, "error": err["error"]})
     
     return results
 
@@ -3005,50 +3076,54 @@ async def bulk_upload_students_csv(file: UploadFile = File(...)):
         "errors": []
     }
     
-    with get_db() as conn:
-        with conn.cursor() as cursor:
-            for row in reader:
-                results["total"] += 1
-                try:
-                    student_id = str(uuid.uuid4())
-                    
-                    name = row.get('name')
-                    parent_id = row.get('parent_id')
-                    gender = row.get('gender', 'OTHER').upper()
-                    study_year = row.get('study_year', '2024-25')
-                    
-                    if not name or not parent_id:
-                        raise ValueError("Name and parent_id are required")
-
-                    query = """
-                    INSERT INTO students (student_id, parent_id, s_parent_id, name, gender, dob, study_year, class_id,
-                                        pickup_route_id, drop_route_id, pickup_stop_id, drop_stop_id,
-                                        emergency_contact, is_transport_user)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """
-                    
-                    # Convert optional fields (MySQL expects None for NULL)
-                    dob = row.get('dob') if row.get('dob') and row.get('dob') != '' else None
-                    class_id = row.get('class_id') if row.get('class_id') and row.get('class_id') != '' else None
-                    s_parent_id = row.get('s_parent_id') if row.get('s_parent_id') and row.get('s_parent_id') != '' else None
-                    
-                    emergency_raw = row.get('emergency_contact')
-                    emergency = int(emergency_raw) if emergency_raw and emergency_raw != '' else None
-                    
-                    is_transport_raw = row.get('is_transport_user', 'true').lower()
-                    is_transport = 1 if is_transport_raw in ['true', '1', 'yes'] else 0
-
-                    cursor.execute(query, (
-                        student_id, parent_id, s_parent_id, name, gender,
-                        dob, study_year, class_id, row.get('pickup_route_id'), 
-                        row.get('drop_route_id'), row.get('pickup_stop_id'), row.get('drop_stop_id'),
-                        emergency, is_transport
-                    ))
-                    
-                    results["success"] += 1
-                except Exception as e:
-                    results["failed"] += 1
-                    results["errors"].append({"row": results["total"], "name": row.get('name'), "error": str(e)})
+    rows = []
+    row_meta = []  # (csv row number, name) per entry in rows
+    for row in reader:
+        results["total"] += 1
+        try:
+            name = row.get('name')
+            parent_id = row.get('parent_id')
+            gender = row.get('gender', 'OTHER').upper()
+            study_year = row.get('study_year', '2024-25')
+            
+            if not name or not parent_id:
+                raise ValueError("Name and parent_id are required")
+            
+            # Convert optional fields (MySQL expects None for NULL)
+            dob = row.get('dob') if row.get('dob') and row.get('dob') != '' else None
+            class_id = row.get('class_id') if row.get('class_id') and row.get('class_id') != '' else None
+            s_parent_id = row.get('s_parent_id') if row.get('s_parent_id') and row.get('s_parent_id') != '' else None
+            
+            emergency_raw = row.get('emergency_contact')
+            emergency = int(emergency_raw) if emergency_raw and emergency_raw != '' else None
+            
+            is_transport_raw = row.get('is_transport_user', 'true').lower()
+            is_transport = 1 if is_transport_raw in ['true', '1', 'yes'] else 0
+
+            rows.append((
+                str(uuid.uuid4()), parent_id, s_parent_id, name, gender,
+                dob, study_year, class_id, row.get('pickup_route_id'), 
+                row.get('drop_route_id'), row.get('pickup_stop_id'), row.get('drop_stop_id'),
+                emergency, is_transport
+            ))
+            row_meta.append((results["total"], name))
+        except Exception as e:
+            results["failed"] += 1
+            results["errors"].append({"row": results["total"], "name": row.get('name'), "error": str(e)})
+    
+    query = """
+    INSERT INTO students (student_id, parent_id, s_parent_id, name, gender, dob, study_year, class_id,
+                        pickup_route_id, drop_route_id, pickup_stop_id, drop_stop_id,
+                        emergency_contact, is_transport_user)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """
+    inserted = await run_in_db_executor(execute_many, query, rows)
+    
+    results["success"] = inserted["success"]
+    results["failed"] += inserted["failed"]
+    for err in inserted["errors"]:
+        row_number, name = row_meta[err["index"]]
+        results["errors"].append({"row": row_number, "name": name, "error": err["error"]})
     
     return results
 
@@ -3113,17 +3188,17 @@ async def create_trip(trip: TripCreate):
         # Notify users of the scheduled trip
         try:
             from app.services.proximity_service import proximity_service
-            tokens = await proximity_service.fetch_tokens_by_route(trip.route_id, trip.trip_type.value)
-            if tokens:
-                title = "🚌 Trip Scheduled"
-                body = f"A new {trip.trip_type.value.lower()} trip has been scheduled for your route."
-                await notification_service.broadcast_to_tokens(
-                    list(set(tokens)), title, body,
-                    {"trip_id": trip_id, "route_id": trip.route_id, "status": "NOT_STARTED", "type": "proximity_alert"},
-                    message_type="audio"
+            title = "🚌 Trip Scheduled"
+            body = f"A new {trip.trip_type.value.lower()} trip has been scheduled for your route."
+            notice = {"trip_id": trip_id, "route_id": trip.route_id, "status": "NOT_STARTED", "type": "proximity_alert"}
+            if topic_subscriptions.fanout:
+                await notification_service.send_to_topic(
+                    title, body, message_type="audio", data=notice, **route_audience(trip.route_id, trip.trip_type)
                 )
-                
-                pass
+            else:
+                tokens = await proximity_service.fetch_tokens_by_route(trip.route_id, trip.trip_type.value)
+                if tokens:
+                    await notification_service.broadcast_to_tokens(list(set(tokens)), title, body, notice, message_type="audio")
         except Exception as notify_err:
             logger.warning(f"Failed to send scheduled trip notification: {notify_err}")
 
@@ -3181,6 +3256,7 @@ async def update_trip(trip_id: str, trip_update: TripUpdate):
     query = f"UPDATE trips SET {', '.join(update_fields)}, updated_at = CURRENT_TIMESTAMP WHERE trip_id = %s"
     
     execute_query(query, tuple(values))
+    trip_state_cache.invalidate(trip_id)
     return await get_trip(trip_id)
 
 @router.put("/trips/{trip_id}/status", response_model=TripResponse, tags=["Trips"])
@@ -3210,6 +3286,12 @@ async def update_trip_status(trip_id: str, status_update: TripStatusUpdate):
     else:
         query = "UPDATE trips SET status = %s, updated_at = CURRENT_TIMESTAMP WHERE trip_id = %s"
     execute_query(query, (new_status, trip_id))
+    if new_status in ("COMPLETED", "CANCELED"):
+        from app.services.proximity_service import proximity_service
+        after_commit(proximity_service.end_tracking, [trip_id], new_status)
+    else:
+        trip_state_cache.invalidate(trip_id)
+        live_event_broker.publish({"type": "trip_status", "trip_id": trip_id, "status": new_status})
     return await get_trip(trip_id)
 
 @router.post("/trips/{trip_id}/skip-next-stop", tags=["Trips"])
@@ -3264,6 +3346,11 @@ async def delete_trip(trip_id: str):
     result = execute_query(query, (trip_id,))
     if result == 0:
         raise HTTPException(status_code=404, detail="Trip not found")
+    from app.services.proximity_service import proximity_service
+    trip_state_cache.drop(trip_id)
+    trip_lanes.drop(trip_id)
+    live_event_broker.forget_trip(trip_id)
+    await proximity_service.forget_trip(trip_id)
     return {"message": "Trip deleted successfully"}
 
 # =====================================================
@@ -3465,6 +3552,7 @@ async def create_fcm_token(fcm_token: FCMTokenCreate):
         updated_at = CURRENT_TIMESTAMP
         """
         execute_query(query, (fcm_id, fcm_token.fcm_token, fcm_token.student_id, fcm_token.parent_id))
+        cascade_service.update_fcm_token_cascades(fcm_id, None, fcm_token.model_dump())
         
         # Return the actual record from database (includes timestamps)
         result = execute_query("SELECT * FROM fcm_tokens WHERE fcm_token = %s", (fcm_token.fcm_token,), fetch_one=True)
@@ -3746,10 +3834,12 @@ async def get_fcm_tokens_by_stop(stop_id: str):
 @router.delete("/fcm-tokens/{fcm_id}", tags=["FCM Tokens"])
 async def delete_fcm_token(fcm_id: str):
     """Delete FCM token"""
+    existing = execute_query("SELECT fcm_token, parent_id, student_id FROM fcm_tokens WHERE fcm_id = %s", (fcm_id,), fetch_one=True)
     query = "DELETE FROM fcm_tokens WHERE fcm_id = %s"
     result = execute_query(query, (fcm_id,))
     if result == 0:
         raise HTTPException(status_code=404, detail="FCM token not found")
+    cascade_service.update_fcm_token_cascades(fcm_id, existing, None)
     return {"message": "FCM token deleted successfully"}
 
 # =====================================================
@@ -3760,10 +3850,11 @@ async def delete_fcm_token(fcm_id: str):
 async def update_bus_stop_progression(location_data: BusLocationUpdate):
     """Bus stop progression tracking - handles stop updates and trip completion based on GPS proximity"""
     try:
-        result = await bus_tracking_service.update_bus_location(
-            trip_id=location_data.trip_id,
-            latitude=location_data.latitude,
-            longitude=location_data.longitude
+        result = await trip_lanes.submit(
+            location_data.trip_id,
+            location_data.latitude,
+            location_data.longitude,
+            location_data.timestamp
         )
         
         if result["success"]:
@@ -3777,6 +3868,51 @@ async def update_bus_stop_progression(location_data: BusLocationUpdate):
         logger.error(f"Bus location processing error: {e}")
         raise HTTPException(status_code=500, detail="Failed to process bus location")
 
+@router.post("/bus-tracking/locations/batch", tags=["Bus Tracking"])
+async def update_bus_locations_batch(batch: BusLocationBatch):
+    """Batched GPS upload - replays timestamped fixes (including ones buffered offline) through stop progression in order"""
+    try:
+        summary = await trip_lanes.submit_batch(
+            batch.trip_id,
+            [(fix.latitude, fix.longitude, fix.timestamp) for fix in batch.fixes]
+        )
+        results = summary["results"]
+        failed = [r for r in results if not r.get("success")]
+        latest = results[-1] if results else None
+        return {
+            "success": not failed,
+            "trip_id": batch.trip_id,
+            "received": len(batch.fixes),
+            "processed": summary["accepted"],
+            "stale": summary["stale"],
+            "failed": len(failed),
+            "current_stop_order": next((r["current_stop_order"] for r in reversed(results) if "current_stop_order" in r), None),
+            "latest": latest
+        }
+    except Exception as e:
+        logger.error(f"Batch location processing error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to process location batch")
+
+@router.post("/bus-tracking/locations/fleet", tags=["Bus Tracking"])
+async def update_fleet_locations(batch: FleetLocationBatch):
+    """Latest position of many ongoing trips - stop distances are screened for the whole fleet at once and only trips near a stop run progression"""
+    try:
+        summary = await trip_lanes.submit_fleet(
+            [(p.trip_id, p.latitude, p.longitude, p.timestamp) for p in batch.positions]
+        )
+        results = summary["results"]
+        return {
+            "success": all(r.get("success") for r in results),
+            "received": len(batch.positions),
+            "processed": summary["queued"],
+            "in_transit": summary["in_transit"],
+            "stale": sum(1 for r in results if r.get("ignored")),
+            "results": results
+        }
+    except Exception as e:
+        logger.error(f"Fleet location processing error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to process fleet locations")
+
 @router.post("/bus-tracking/notify", tags=["Bus Tracking"])
 async def send_custom_notification(notification: NotificationRequest):
     """Send custom notification to parents"""
@@ -3810,19 +3946,12 @@ async def send_custom_notification(notification: NotificationRequest):
         
         if students:
             student_ids = [s['student_id'] for s in students]
-            parent_tokens = bus_tracking_service.get_parent_tokens_for_students(student_ids)
+            parent_tokens = await run_in_db_executor(bus_tracking_service.get_parent_tokens_for_students, student_ids, route_id=trip['route_id'])
             
             if parent_tokens:
-                results = []
-                for token in parent_tokens:
-                    res = await notification_service.send_to_device(
-                        title="Bus Notification",
-                        body=notification.message,
-                        token=token,
-                        recipient_type="parent",
-                        message_type="custom"
-                    )
-                    results.append(res)
+                results = await notification_service.send_multicast(
+                    parent_tokens, "Bus Notification", notification.message, message_type="custom"
+                )
                 
                 return {
                     "success": True,
@@ -3904,22 +4033,16 @@ async def start_trip(trip_id: str):
         
         if first_stop_students:
             student_ids = [s['student_id'] for s in first_stop_students]
-            parent_tokens = bus_tracking_service.get_parent_tokens_for_students(student_ids)
+            parent_tokens = bus_tracking_service.get_parent_tokens_for_students(student_ids, route_id=trip_data['route_id'])
             if parent_tokens:
                 first_stop_loc = first_stop_students[0]['location'] or first_stop_students[0]['stop_name']
-                # Send notifications concurrently
-                tasks = [
-                    notification_service.send_to_device(
-                        title="Bus Trip Started",
-                        body=f"The bus has started! It is on the way to your stop ({first_stop_loc}).",
-                        token=token,
-                        recipient_type="parent",
-                        message_type="audio",
-                        data={"trip_id": trip_id, "status": "STARTED", "type": "proximity_alert"}
-                    )
-                    for token in set(parent_tokens)
-                ]
-                await asyncio.gather(*tasks)
+                await notification_service.broadcast_to_tokens(
+                    list(set(parent_tokens)),
+                    title="Bus Trip Started",
+                    body=f"The bus has started! It is on the way to your stop ({first_stop_loc}).",
+                    data={"trip_id": trip_id, "status": "STARTED", "type": "proximity_alert"},
+                    message_type="audio"
+                )
 
         # Also initialize Proximity Service state
         from app.services.proximity_service import proximity_service
@@ -3978,34 +4101,23 @@ async def update_driver_location(driver_id: str, location: DriverLocationUpdate)
     try:
         # Check if driver exists
         driver_check = "SELECT driver_id FROM drivers WHERE driver_id = %s"
-        if not execute_query(driver_check, (driver_id,), fetch_one=True):
+        if not await execute_query_async(driver_check, (driver_id,), fetch_one=True):
             raise HTTPException(status_code=404, detail="Driver not found")
 
-        # Update driver_live_locations table
-        query = """
-        INSERT INTO driver_live_locations (driver_id, latitude, longitude, updated_at)
-        VALUES (%s, %s, %s, CURRENT_TIMESTAMP)
-        ON DUPLICATE KEY UPDATE 
-            latitude = VALUES(latitude),
-            longitude = VALUES(longitude),
-            updated_at = CURRENT_TIMESTAMP
-        """
-        execute_query(query, (driver_id, location.latitude, location.longitude))
+        # Buffered; driver_live_locations is written by the periodic flush
+        live_location_buffer.record(driver_id, location.latitude, location.longitude)
         
         # Trigger bus tracking if there is an ongoing trip for this driver
-        active_trip = execute_query(
+        active_trip = await execute_query_async(
             "SELECT trip_id FROM trips WHERE driver_id = %s AND status = 'ONGOING' LIMIT 1",
             (driver_id,), fetch_one=True
         )
         if active_trip and 'trip_id' in active_trip:
-            from app.services.bus_tracking import bus_tracking_service
-            asyncio.create_task(
-                bus_tracking_service.update_bus_location(
-                    trip_id=active_trip['trip_id'],
-                    latitude=location.latitude,
-                    longitude=location.longitude
-                )
-            )
+            # Processed in the background on the trip's lane, in order with any other fixes for it
+            # (the lane publishes the position to live subscribers)
+            trip_lanes.submit(active_trip['trip_id'], location.latitude, location.longitude, location.timestamp)
+        else:
+            live_event_broker.publish_position(location.latitude, location.longitude, driver_id=driver_id)
             
         return {"message": "Location updated successfully"}
     except HTTPException:
@@ -4017,8 +4129,10 @@ async def update_driver_location(driver_id: str, location: DriverLocationUpdate)
 @router.get("/drivers/{driver_id}/location", response_model=DriverLocationResponse, tags=["Drivers"])
 async def get_driver_location(driver_id: str):
     """Get a specific driver's live location"""
-    query = "SELECT * FROM driver_live_locations WHERE driver_id = %s"
-    location = execute_query(query, (driver_id,), fetch_one=True)
+    location = live_location_buffer.get(driver_id)
+    if not location:
+        query = "SELECT * FROM driver_live_locations WHERE driver_id = %s"
+        location = await execute_query_async(query, (driver_id,), fetch_one=True)
     if not location:
         raise HTTPException(status_code=404, detail="Live location not found for this driver")
     return location
@@ -4027,8 +4141,66 @@ async def get_driver_location(driver_id: str):
 async def get_all_driver_locations():
     """Get all drivers' live locations (useful for admin map)"""
     query = "SELECT * FROM driver_live_locations"
-    locations = execute_query(query, fetch_all=True)
-    return locations or []
+    locations = await execute_query_async(query, fetch_all=True)
+    return live_location_buffer.merge(locations or [])
+
+# =====================================================
+# LIVE TRACKING STREAMS
+# =====================================================
+
+LIVE_KEEPALIVE_SECONDS = 15
+
+async def _sse_events(request: Request, subscription):
+    """Server-Sent Events body for one subscription, with keep-alive comments while idle"""
+    try:
+        while not await request.is_disconnected():
+            event = await subscription.get(timeout=LIVE_KEEPALIVE_SECONDS)
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n"
+    finally:
+        live_event_broker.unsubscribe(subscription)
+
+@router.get("/live/stream", tags=["Live Tracking"])
+async def stream_live_events(
+    request: Request,
+    trip_id: Optional[str] = None,
+    route_id: Optional[str] = None,
+    driver_id: Optional[str] = None
+):
+    """Server-Sent Events stream of bus positions and stop progression for a trip, route, driver or (no filter) the whole fleet.
+    The latest known positions are sent first, then every update as the tracking service processes it."""
+    subscription = live_event_broker.subscribe(topic_for(trip_id, route_id, driver_id))
+    return StreamingResponse(
+        _sse_events(request, subscription),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.websocket("/live/ws")
+async def live_events_websocket(
+    websocket: WebSocket,
+    trip_id: Optional[str] = None,
+    route_id: Optional[str] = None,
+    driver_id: Optional[str] = None
+):
+    """WebSocket variant of /live/stream (server-to-client JSON messages)"""
+    await websocket.accept()
+    subscription = live_event_broker.subscribe(topic_for(trip_id, route_id, driver_id))
+    try:
+        while True:
+            event = await subscription.get(timeout=LIVE_KEEPALIVE_SECONDS)
+            await websocket.send_json(event if event is not None else {"type": "keep_alive"})
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        live_event_broker.unsubscribe(subscription)
+
+@router.get("/live/stats", tags=["Live Tracking"])
+async def get_live_stats():
+    """Live subscription / publishing counters"""
+    return live_event_broker.get_stats()
 
 # =====================================================
 # APP VERSIONING
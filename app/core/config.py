@@ -10,6 +10,19 @@ class Settings(BaseSettings):
     DB_PASSWORD: str
     DB_NAME: str = "school_DB"
     
+    # Database Pool Configuration
+    DB_POOL_MIN_SIZE: int = 2
+    DB_POOL_MAX_SIZE: int = 10
+    DB_POOL_TIMEOUT: int = 10  # Seconds to wait for a free connection
+    DB_POOL_RECYCLE: int = 1800  # Close connections idle longer than this (seconds)
+    DB_POOL_PING_INTERVAL: int = 30  # Ping connections idle longer than this on checkout
+    DB_EXECUTOR_WORKERS: int = 10  # Threads running blocking queries for async handlers
+    BULK_INSERT_BATCH_SIZE: int = 500  # Rows per multi-row INSERT in bulk/CSV imports
+    
+    # Query Instrumentation
+    QUERY_STATS_ENABLED: bool = True
+    SLOW_QUERY_MS: int = 200  # Log statements slower than this (milliseconds)
+    
     # JWT Configuration
     SECRET_KEY: str
     ALGORITHM: str = "HS256"
@@ -25,9 +38,49 @@ class Settings(BaseSettings):
     
     # FCM Configuration
     FCM_SERVER_KEY: str = "your-fcm-server-key"
+    FCM_EXECUTOR_WORKERS: int = 8  # Threads dedicated to blocking Firebase calls
+    FCM_MAX_CONCURRENCY: int = 8  # In-flight Firebase calls; the rest wait (and are counted) in the queue
+    DEAD_TOKEN_PRUNE_DELAY: float = 5.0  # Seconds dead tokens are collected before one bulk prune
+    FCM_TOPIC_SYNC: bool = False  # Maintain route/stop/class topic membership for registered tokens
+    FCM_TOPIC_SYNC_INTERVAL: float = 5.0  # Seconds between syncs of tokens/students marked dirty
+    FCM_TOPIC_FANOUT: bool = False  # Send route/class/location broadcasts as topic sends (enable after a resync)
+    FCM_TRANSPORT: str = "firebase"  # "fake" sends to an in-process stub instead of Firebase (load tests, local runs)
+    FCM_FAKE_LATENCY_MS: float = 50.0  # Simulated latency of one fake FCM call
+    FCM_FAKE_ERROR_RATE: float = 0.0  # Fraction of fake sends failing with a transient error
+    FCM_FAKE_DEAD_RATE: float = 0.0  # Fraction of tokens the fake backend reports as unregistered
+    
+    # Notification Outbox Configuration
+    OUTBOX_WORKERS: int = 2  # Background delivery workers per process
+    OUTBOX_BATCH_SIZE: int = 20  # Rows claimed per worker round
+    OUTBOX_POLL_INTERVAL: float = 2.0  # Seconds an idle worker waits before polling again
+    OUTBOX_MAX_ATTEMPTS: int = 5  # Delivery attempts before a row is marked FAILED
+    OUTBOX_RETRY_BASE_SECONDS: int = 10  # First retry delay; doubles on every attempt
+    OUTBOX_LEASE_SECONDS: int = 60  # Claimed rows return to the queue if not finished within this
+    
+    # Broadcast Job Configuration
+    BROADCAST_CHUNK_SIZE: int = 500  # Parent tokens read and sent per multicast call (FCM allows up to 500)
+    BROADCAST_CONCURRENCY: int = 2  # Pages of one broadcast in flight at a time
+    BROADCAST_RATE_LIMIT: float = 0.0  # Tokens per second a broadcast may send (0 = unlimited)
+    BROADCAST_JOB_HISTORY: int = 50  # Finished jobs whose progress is kept in memory
     
     # Geofence Notification Configuration
-    GEOFENCE_RADIUS: int = 500
+    GEOFENCE_RADIUS: int = 500  # Default arrival radius (m) of a stop without its own geofence_radius_m
+    STOP_INDEX_CELL_DEG: float = 0.01  # Grid cell size of the in-memory stop index (~1.1 km)
+    STOP_INDEX_TTL: int = 300  # Seconds before the stop index is re-read from MySQL
+    
+    # Live Tracking Configuration
+    TRIP_STATE_TTL: int = 300  # Seconds before cached trip state is re-read from MySQL
+    LIVE_LOCATION_FLUSH_INTERVAL: float = 2.0  # Seconds between driver_live_locations flushes
+    ROUTE_RECIPIENT_CHECK_INTERVAL: float = 30.0  # Seconds a cached route's recipients are used before re-checking its version
+    ROUTE_CACHE_REBUILD_DELAY: float = 2.0  # Quiet period after the last edit before a dirty route is rebuilt
+    ROUTE_CACHE_REBUILD_MAX_DELAY: float = 30.0  # Longest a continuously edited route waits for its rebuild
+    ROUTE_CACHE_RECONCILE_INTERVAL: float = 3600.0  # Seconds between full rebuilds of every cached route to catch drift from deltas (0 disables)
+    TRIP_STORE_BACKEND: str = "memory"  # Proximity trip state: "memory" (per worker) or "redis" (shared; needs the redis package)
+    TRIP_STORE_URL: str = "redis://localhost:6379/0"  # Redis-compatible server used by the redis trip store
+    TRIP_STORE_TTL: int = 21600  # Seconds an unused trip's proximity state is kept (cancelled/abandoned trips expire)
+    TRIP_STORE_MAX_TRIPS: int = 1000  # Trips kept by the memory store before least recently used ones are evicted
+    TRIP_STORE_MAX_BYTES: int = 16777216  # Approximate state size (JSON bytes) the memory store may hold
+    
     # Upload Configuration
     UPLOAD_DIR: str = "uploads"
     BASE_URL: str = "http://localhost:8080"
@@ -1,13 +1,24 @@
 import pymysql
-from pymysql.cursors import DictCursor
-from contextlib import contextmanager
+from contextlib import contextmanager, asynccontextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from app.core.config import get_settings
+from app.core.query_stats import InstrumentedCursor, query_stats
+import asyncio
+import contextvars
+import functools
+import itertools
 import logging
+import threading
 import time
 
 settings = get_settings()
 logger = logging.getLogger(__name__)
 
+class PoolTimeoutError(Exception):
+    """Raised when no pooled connection becomes available within DB_POOL_TIMEOUT"""
+    pass
+
 def get_db_connection(max_retries=3, retry_delay=2):
     """Create a database connection with retry logic"""
     for attempt in range(max_retries):
@@ -18,7 +29,7 @@ def get_db_connection(max_retries=3, retry_delay=2):
                 user=settings.DB_USER,
                 password=settings.DB_PASSWORD,
                 database=settings.DB_NAME,
-                cursorclass=DictCursor,
+                cursorclass=InstrumentedCursor,
                 autocommit=False,
                 charset='utf8mb4',
                 connect_timeout=30,
@@ -34,32 +45,417 @@ def get_db_connection(max_retries=3, retry_delay=2):
                 logger.error(f"All database connection attempts failed: {e}")
                 raise
 
+class ConnectionPool:
+    """Thread-safe pool of PyMySQL connections shared by get_db() and execute_query().
+
+    Connections are handed out LIFO so the hottest connection is reused first, pinged on
+    checkout when they have been idle for longer than `ping_interval`, and closed once they
+    sit idle past `recycle` seconds (the pool never shrinks below `min_size` this way).
+    """
+
+    def __init__(self, min_size: int = 2, max_size: int = 10, timeout: float = 10,
+                 recycle: float = 1800, ping_interval: float = 30, connect=None):
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+        self._connect = connect or get_db_connection
+        self._idle = deque()  # (connection, last_used) - right end is the most recently used
+        self._size = 0        # idle + checked out connections
+        self._cond = threading.Condition()
+        self._closed = False
+        self._stats = {
+            "created": 0,
+            "closed": 0,
+            "recycled": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "health_check_failures": 0,
+        }
+
+    def _open(self):
+        conn = self._connect()
+        with self._cond:
+            self._stats["created"] += 1
+        return conn
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._stats["closed"] += 1
+
+    def _take_expired_locked(self):
+        """Pop idle connections that exceeded the recycle window (oldest first)"""
+        expired = []
+        now = time.monotonic()
+        while self._idle and self._size > self.min_size:
+            conn, last_used = self._idle[0]
+            if now - last_used < self.recycle:
+                break
+            self._idle.popleft()
+            self._size -= 1
+            self._stats["recycled"] += 1
+            expired.append(conn)
+        return expired
+
+    def acquire(self):
+        """Check out a healthy connection, opening a new one while below max_size"""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn, last_used, expired = None, None, []
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+                while True:
+                    expired.extend(self._take_expired_locked())
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeoutError(f"No database connection available within {self.timeout}s (max_size={self.max_size})")
+                    self._stats["waits"] += 1
+                    self._cond.wait(remaining)
+            for old in expired:
+                self._close_quietly(old)
+
+            if conn is None:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif time.monotonic() - last_used >= self.ping_interval:
+                try:
+                    conn.ping(reconnect=False)
+                except Exception as e:
+                    logger.warning(f"Discarding unhealthy pooled connection: {e}")
+                    with self._cond:
+                        self._stats["health_check_failures"] += 1
+                        self._size -= 1
+                        self._cond.notify()
+                    self._close_quietly(conn)
+                    continue
+
+            with self._cond:
+                self._stats["checkouts"] += 1
+            return conn
+
+    def release(self, conn, discard: bool = False):
+        """Return a connection to the pool, or close it if it is broken or the pool is closed"""
+        with self._cond:
+            keep = not discard and not self._closed and getattr(conn, "open", True)
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._size -= 1
+            self._cond.notify()
+        if not keep:
+            self._close_quietly(conn)
+
+    def warm(self):
+        """Open connections up to min_size so the first requests skip the handshake"""
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._open()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            self.release(conn)
+
+    def close(self):
+        """Close every idle connection; checked-out ones are closed when released"""
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._close_quietly(conn)
+
+    def get_stats(self):
+        with self._cond:
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                **self._stats,
+            }
+
+db_pool = ConnectionPool(
+    min_size=settings.DB_POOL_MIN_SIZE,
+    max_size=settings.DB_POOL_MAX_SIZE,
+    timeout=settings.DB_POOL_TIMEOUT,
+    recycle=settings.DB_POOL_RECYCLE,
+    ping_interval=settings.DB_POOL_PING_INTERVAL
+)
+
+def get_pool_stats():
+    """Snapshot of the shared connection pool counters"""
+    return db_pool.get_stats()
+
+def get_query_stats(sort_by: str = "total_ms", limit: int = 50):
+    """Per-statement fingerprint latency/row/error counters recorded by InstrumentedCursor"""
+    return query_stats.snapshot(sort_by=sort_by, limit=limit)
+
+def reset_query_stats():
+    query_stats.reset()
+
+class _UnitOfWork:
+    """Connection shared by every get_db() call made inside unit_of_work()"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.RLock()  # PyMySQL connections are not thread-safe
+        self.savepoints = itertools.count(1)
+        self.after_commit = []
+
+_current_uow = contextvars.ContextVar("db_unit_of_work", default=None)
+
+def after_commit(callback, *args):
+    """Run callback(*args) once the active unit of work has committed (it is dropped if the work rolls back);
+    runs immediately outside a unit of work. Use it for caches that must not see uncommitted rows."""
+    uow = _current_uow.get()
+    if uow is None:
+        callback(*args)
+    else:
+        uow.after_commit.append((callback, args))
+
+def _run_after_commit(callbacks):
+    for callback, args in callbacks:
+        try:
+            callback(*args)
+        except Exception as e:
+            logger.error(f"After-commit callback failed: {e}")
+
 @contextmanager
 def get_db():
-    """Context manager for database connections"""
+    """Context manager for pooled database connections (commit on success, rollback on error).
+
+    Inside unit_of_work() the active connection is reused and left for the unit of work to commit.
+    """
+    uow = _current_uow.get()
+    if uow is not None:
+        with uow.lock:
+            yield uow.connection
+        return
+
     connection = None
+    discard = False
     try:
-        connection = get_db_connection()
+        connection = db_pool.acquire()
         yield connection
         connection.commit()
-    except Exception as e:
+    except BaseException as e:
         if connection:
-            connection.rollback()
-        logger.error(f"Database operation failed: {e}")
-        raise e
+            try:
+                connection.rollback()
+            except Exception:
+                discard = True
+            if isinstance(e, (pymysql.err.OperationalError, pymysql.err.InterfaceError)):
+                discard = True
+        if isinstance(e, Exception):
+            logger.error(f"Database operation failed: {e}")
+        raise
     finally:
         if connection:
-            connection.close()
+            db_pool.release(connection, discard=discard)
+
+def _run_on_uow(uow, statement: str):
+    with uow.lock:
+        with uow.connection.cursor() as cursor:
+            cursor.execute(statement)
+
+@contextmanager
+def unit_of_work():
+    """Share one connection across every get_db()/execute_query() call in the block and commit once.
+
+    Nested blocks run as savepoints, so a failing inner step rolls back only its own writes.
+    """
+    uow = _current_uow.get()
+    if uow is not None:
+        name = f"uow_sp_{next(uow.savepoints)}"
+        callbacks = len(uow.after_commit)
+        _run_on_uow(uow, f"SAVEPOINT {name}")
+        try:
+            yield uow.connection
+        except BaseException:
+            _run_on_uow(uow, f"ROLLBACK TO SAVEPOINT {name}")
+            del uow.after_commit[callbacks:]
+            raise
+        else:
+            _run_on_uow(uow, f"RELEASE SAVEPOINT {name}")
+        return
+
+    with get_db() as connection:
+        uow = _UnitOfWork(connection)
+        token = _current_uow.set(uow)
+        try:
+            yield connection
+        finally:
+            _current_uow.reset(token)
+    _run_after_commit(uow.after_commit)
+
+@contextmanager
+def no_unit_of_work():
+    """Opt out of the active unit of work (long-running or fire-and-forget work uses its own connections)"""
+    token = _current_uow.set(None)
+    try:
+        yield
+    finally:
+        _current_uow.reset(token)
 
 def execute_query(query: str, params: tuple = None, fetch_one: bool = False, fetch_all: bool = False):
     """Execute a query and return results"""
     with get_db() as conn:
         with conn.cursor() as cursor:
             cursor.execute(query, params or ())
-            
+
             if fetch_one:
                 return cursor.fetchone()
             elif fetch_all:
                 return cursor.fetchall()
             else:
                 return cursor.rowcount
+
+def execute_many(query: str, rows: list, batch_size: int = None) -> dict:
+    """Insert rows as multi-row INSERTs, one short transaction per batch.
+
+    A failing batch is retried row by row so callers still get per-row errors.
+    Returns {"success", "failed", "errors": [{"index", "error"}]} with indexes into `rows`.
+    """
+    batch_size = batch_size or settings.BULK_INSERT_BATCH_SIZE
+    result = {"success": 0, "failed": 0, "errors": []}
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        try:
+            with get_db() as conn:
+                with conn.cursor() as cursor:
+                    cursor.executemany(query, batch)
+            result["success"] += len(batch)
+        except Exception as e:
+            logger.warning(f"Batch insert of {len(batch)} rows failed, retrying row by row: {e}")
+            with get_db() as conn:
+                with conn.cursor() as cursor:
+                    for offset, row in enumerate(batch):
+                        try:
+                            cursor.execute(query, row)
+                            result["success"] += 1
+                        except Exception as row_err:
+                            result["failed"] += 1
+                            result["errors"].append({"index": start + offset, "error": str(row_err)})
+    return result
+
+# =====================================================
+# ASYNC ACCESS (bounded DB executor)
+# =====================================================
+
+# Sized alongside the pool so queued queries wait here instead of on a pool checkout
+_db_executor = ThreadPoolExecutor(max_workers=settings.DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+async def run_in_db_executor(func, *args, **kwargs):
+    """Run a blocking DB callable on the bounded DB executor without stalling the event loop"""
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_db_executor, functools.partial(ctx.run, func, *args, **kwargs))
+
+async def execute_query_async(query: str, params: tuple = None, fetch_one: bool = False, fetch_all: bool = False):
+    """Awaitable execute_query for async handlers"""
+    return await run_in_db_executor(execute_query, query, params, fetch_one, fetch_all)
+
+class AsyncConnection:
+    """Awaitable facade over a pooled connection; every statement runs on the DB executor"""
+
+    def __init__(self, connection, lock=None):
+        self.connection = connection
+        self.lock = lock or threading.RLock()
+
+    async def execute(self, query: str, params: tuple = None, fetch_one: bool = False, fetch_all: bool = False):
+        def _run():
+            with self.lock:
+                with self.connection.cursor() as cursor:
+                    cursor.execute(query, params or ())
+                    if fetch_one:
+                        return cursor.fetchone()
+                    elif fetch_all:
+                        return cursor.fetchall()
+                    return cursor.rowcount
+        return await run_in_db_executor(_run)
+
+@asynccontextmanager
+async def get_db_async():
+    """Async counterpart of get_db(): one pooled connection/transaction, committed on exit"""
+    uow = _current_uow.get()
+    if uow is not None:
+        yield AsyncConnection(uow.connection, uow.lock)
+        return
+
+    ctx = get_db()
+    connection = await run_in_db_executor(ctx.__enter__)
+    try:
+        yield AsyncConnection(connection)
+    except BaseException as e:
+        await run_in_db_executor(ctx.__exit__, type(e), e, e.__traceback__)
+        raise
+    else:
+        await run_in_db_executor(ctx.__exit__, None, None, None)
+
+@asynccontextmanager
+async def unit_of_work_async():
+    """Async unit_of_work(): queries awaited through the DB executor inside the block share one transaction"""
+    uow = _current_uow.get()
+    if uow is not None:
+        name = f"uow_sp_{next(uow.savepoints)}"
+        callbacks = len(uow.after_commit)
+        await run_in_db_executor(_run_on_uow, uow, f"SAVEPOINT {name}")
+        try:
+            yield uow.connection
+        except BaseException:
+            await run_in_db_executor(_run_on_uow, uow, f"ROLLBACK TO SAVEPOINT {name}")
+            del uow.after_commit[callbacks:]
+            raise
+        else:
+            await run_in_db_executor(_run_on_uow, uow, f"RELEASE SAVEPOINT {name}")
+        return
+
+    ctx = get_db()
+    connection = await run_in_db_executor(ctx.__enter__)
+    uow = _UnitOfWork(connection)
+    token = _current_uow.set(uow)
+    try:
+        yield connection
+    except BaseException as e:
+        _current_uow.reset(token)
+        await run_in_db_executor(ctx.__exit__, type(e), e, e.__traceback__)
+        raise
+    else:
+        _current_uow.reset(token)
+        await run_in_db_executor(ctx.__exit__, None, None, None)
+        _run_after_commit(uow.after_commit)
+
+async def db_unit_of_work():
+    """FastAPI dependency: run the whole request in one unit of work (commit once, rollback on any error)"""
+    async with unit_of_work_async():
+        yield
+
+def shutdown_db_executor():
+    _db_executor.shutdown(wait=False, cancel_futures=True)
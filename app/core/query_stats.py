@@ -0,0 +1,143 @@
+import re
+import time
+import logging
+import threading
+from functools import lru_cache
+from pymysql.cursors import DictCursor
+from app.core.config import get_settings
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# Upper bounds (ms) of the latency histogram buckets; the last bucket catches everything slower
+LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float("inf"))
+
+_STRING_RE = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_RE = re.compile(r"%s|%\(\w+\)s")
+_IN_LIST_RE = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_VALUES_LIST_RE = re.compile(r"(\bVALUES\s*\([^)]*\))(?:\s*,\s*\([^)]*\))+", re.IGNORECASE)
+_WHITESPACE_RE = re.compile(r"\s+")
+
+@lru_cache(maxsize=2048)
+def fingerprint(sql: str) -> str:
+    """Normalize a statement so calls differing only in literals/placeholders share one entry"""
+    text = _STRING_RE.sub("?", sql)
+    text = _PLACEHOLDER_RE.sub("?", text)
+    text = _NUMBER_RE.sub("?", text)
+    text = _IN_LIST_RE.sub("IN (...)", text)
+    text = _VALUES_LIST_RE.sub(r"\1, ...", text)
+    return _WHITESPACE_RE.sub(" ", text).strip().rstrip(";")
+
+class QueryStats:
+    """Thread-safe per-fingerprint counters: calls, errors, rows and a latency histogram"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.started_at = time.time()
+
+    def record(self, sql: str, elapsed_ms: float, rows: int = 0, error: bool = False):
+        key = fingerprint(sql)
+        with self._lock:
+            entry = self._stats.get(key)
+            if entry is None:
+                entry = self._stats[key] = {
+                    "calls": 0, "errors": 0, "rows": 0,
+                    "total_ms": 0.0, "max_ms": 0.0,
+                    "buckets": [0] * len(LATENCY_BUCKETS_MS)
+                }
+            entry["calls"] += 1
+            entry["total_ms"] += elapsed_ms
+            entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+            if error:
+                entry["errors"] += 1
+            elif rows and rows > 0:
+                entry["rows"] += rows
+            for i, bound in enumerate(LATENCY_BUCKETS_MS):
+                if elapsed_ms <= bound:
+                    entry["buckets"][i] += 1
+                    break
+
+        if elapsed_ms >= settings.SLOW_QUERY_MS:
+            logger.warning(f"🐢 Slow query ({elapsed_ms:.1f} ms, rows={rows}): {key[:500]}")
+
+    @staticmethod
+    def _percentile(buckets, calls, pct):
+        """Upper bound of the bucket holding the given percentile"""
+        target = calls * pct
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, buckets):
+            seen += count
+            if seen >= target:
+                return bound if bound != float("inf") else None
+        return None
+
+    def snapshot(self, sort_by: str = "total_ms", limit: int = 50):
+        with self._lock:
+            items = [(k, dict(v, buckets=list(v["buckets"]))) for k, v in self._stats.items()]
+
+        queries = []
+        for sql, v in items:
+            calls = v["calls"]
+            queries.append({
+                "fingerprint": sql,
+                "calls": calls,
+                "errors": v["errors"],
+                "rows": v["rows"],
+                "total_ms": round(v["total_ms"], 2),
+                "avg_ms": round(v["total_ms"] / calls, 2) if calls else 0,
+                "max_ms": round(v["max_ms"], 2),
+                "p50_ms": self._percentile(v["buckets"], calls, 0.50),
+                "p95_ms": self._percentile(v["buckets"], calls, 0.95),
+                "p99_ms": self._percentile(v["buckets"], calls, 0.99),
+                "histogram": {
+                    ("le_" + str(b) if b != float("inf") else "le_inf"): c
+                    for b, c in zip(LATENCY_BUCKETS_MS, v["buckets"]) if c
+                }
+            })
+        if queries and sort_by in queries[0]:
+            queries.sort(key=lambda q: q[sort_by] or 0, reverse=True)
+        return {
+            "since": self.started_at,
+            "slow_query_ms": settings.SLOW_QUERY_MS,
+            "fingerprints": len(queries),
+            "queries": queries[:limit]
+        }
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.started_at = time.time()
+
+query_stats = QueryStats()
+
+class InstrumentedCursor(DictCursor):
+    """DictCursor that times every statement into query_stats"""
+
+    _in_executemany = False
+
+    def _timed(self, run, query):
+        start = time.perf_counter()
+        try:
+            result = run()
+        except Exception:
+            query_stats.record(query, (time.perf_counter() - start) * 1000, error=True)
+            raise
+        query_stats.record(query, (time.perf_counter() - start) * 1000, rows=self.rowcount)
+        return result
+
+    def execute(self, query, args=None):
+        # executemany() re-enters execute() with the multi-row statements it builds; it is recorded once as a whole
+        if not settings.QUERY_STATS_ENABLED or self._in_executemany:
+            return super().execute(query, args)
+        return self._timed(lambda: super(InstrumentedCursor, self).execute(query, args), query)
+
+    def executemany(self, query, args):
+        if not settings.QUERY_STATS_ENABLED:
+            return super().executemany(query, args)
+        self._in_executemany = True
+        try:
+            return self._timed(lambda: super(InstrumentedCursor, self).executemany(query, args), query)
+        finally:
+            self._in_executemany = False
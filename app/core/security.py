@@ -1,4 +1,7 @@
 import bcrypt
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a plain password against its hash using bcrypt"""
@@ -45,3 +48,10 @@ def generate_default_password(name: str, phone: int) -> str:
     phone_part = phone_str[-4:]
     
     return f"{name_part}@{phone_part}"
+
+def get_password_hashes(passwords: List[str]) -> List[str]:
+    """Hash many passwords in parallel (bcrypt releases the GIL), preserving order"""
+    if len(passwords) < 2:
+        return [get_password_hash(p) for p in passwords]
+    with ThreadPoolExecutor(max_workers=min(len(passwords), os.cpu_count() or 4)) as pool:
+        return list(pool.map(get_password_hash, passwords))
@@ -0,0 +1,92 @@
+import time
+import uuid
+import zlib
+import random
+import threading
+from typing import List
+from firebase_admin import messaging, exceptions as firebase_exceptions
+
+class FakeFCMTransport:
+    """In-process stand-in for FCM with simulated latency and failures.
+
+    Every call blocks for latency_ms (plus exponential jitter, which gives a realistic tail) like a
+    real HTTP round trip, and returns firebase_admin's response types. Tokens starting with "dead"
+    and a stable dead_rate fraction of all tokens are reported as unregistered on every call; any
+    other send fails with a transient UNAVAILABLE error with probability error_rate.
+    """
+    name = "fake"
+    requires_credentials = False
+
+    def __init__(self, latency_ms: float = 50.0, jitter: float = 0.2, error_rate: float = 0.0,
+                 dead_rate: float = 0.0, seed: int = None):
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.dead_rate = dead_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.latencies_ms: List[float] = []
+            self.stats = {"calls": 0, "messages": 0, "failed": 0, "dead": 0, "max_concurrent": 0}
+            self._concurrent = 0
+
+    def is_dead(self, token: str) -> bool:
+        return token.startswith("dead") or zlib.crc32(token.encode()) % 10000 < self.dead_rate * 10000
+
+    def _call(self, messages: int):
+        """Simulated round trip; counts concurrency so benchmarks can see pool saturation"""
+        with self._lock:
+            self._concurrent += 1
+            self.stats["max_concurrent"] = max(self.stats["max_concurrent"], self._concurrent)
+            delay_ms = self.latency_ms + self._random.expovariate(1.0) * self.latency_ms * self.jitter
+        start = time.perf_counter()
+        time.sleep(delay_ms / 1000)
+        with self._lock:
+            self._concurrent -= 1
+            self.stats["calls"] += 1
+            self.stats["messages"] += messages
+            self.latencies_ms.append((time.perf_counter() - start) * 1000)
+
+    def _failure(self, token: str):
+        if self.is_dead(token):
+            return messaging.UnregisteredError("Requested entity was not found.")
+        if self.error_rate and self._random.random() < self.error_rate:
+            return firebase_exceptions.UnavailableError("The service is currently unavailable.")
+        return None
+
+    def _record(self, failures: List):
+        with self._lock:
+            self.stats["failed"] += sum(1 for f in failures if f is not None)
+            self.stats["dead"] += sum(1 for f in failures if isinstance(f, messaging.UnregisteredError))
+
+    def send(self, message: messaging.Message) -> str:
+        self._call(1)
+        failure = self._failure(message.token) if message.token else None
+        self._record([failure])
+        if failure is not None:
+            raise failure
+        return f"projects/fake/messages/{uuid.uuid4().hex}"
+
+    def send_each_for_multicast(self, message: messaging.MulticastMessage) -> messaging.BatchResponse:
+        self._call(len(message.tokens))
+        failures = [self._failure(token) for token in message.tokens]
+        self._record(failures)
+        return messaging.BatchResponse([
+            messaging.SendResponse(None if failure else {"name": f"projects/fake/messages/{uuid.uuid4().hex}"}, failure)
+            for failure in failures
+        ])
+
+    def _manage(self, tokens: List[str]) -> messaging.TopicManagementResponse:
+        self._call(len(tokens))
+        return messaging.TopicManagementResponse(
+            {"results": [{"error": "NOT_FOUND"} if self.is_dead(token) else {} for token in tokens]}
+        )
+
+    def subscribe_to_topic(self, tokens: List[str], topic: str) -> messaging.TopicManagementResponse:
+        return self._manage(tokens)
+
+    def unsubscribe_from_topic(self, tokens: List[str], topic: str) -> messaging.TopicManagementResponse:
+        return self._manage(tokens)
@@ -2,26 +2,147 @@ import os
 import json
 import time
 import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any
 from pathlib import Path
 
 import firebase_admin
-from firebase_admin import credentials, messaging
+from firebase_admin import credentials, messaging, exceptions as firebase_exceptions
 import logging
+from app.core.config import get_settings
 
+settings = get_settings()
 logger = logging.getLogger(__name__)
 
 # Configuration
 ADMIN_KEY = 'selvagam-admin-key-2024'
+FCM_MULTICAST_LIMIT = 500  # Max tokens per send_each_for_multicast call
+FCM_TOPIC_BATCH_LIMIT = 1000  # Max tokens per subscribe/unsubscribe call
+# Error text FCM returns for tokens that will never be deliverable again (app uninstalled, token rotated)
+DEAD_TOKEN_MARKERS = ("registration-token-not-registered", "requested entity was not found",
+                      "not a valid fcm registration token", "invalid-registration-token")
+# Per-token reasons returned by topic subscribe/unsubscribe for tokens FCM no longer knows
+DEAD_TOPIC_REASONS = ("NOT_FOUND", "INVALID_ARGUMENT")
+
+def is_dead_token_error(error) -> bool:
+    """True when a send failure means the token itself is dead (not a transient or payload error)"""
+    if isinstance(error, (messaging.UnregisteredError, messaging.SenderIdMismatchError)):
+        return True
+    text = str(error).lower()
+    # InvalidArgument is also used for bad payloads, which must not cost anyone their token
+    if isinstance(error, firebase_exceptions.InvalidArgumentError):
+        return "registration token" in text
+    return any(marker in text for marker in DEAD_TOKEN_MARKERS)
+
+class FCMExecutor:
+    """Dedicated thread pool for blocking Firebase calls, gated by a concurrency semaphore.
+
+    Keeps slow FCM responses off the event loop and out of the default executor (used by
+    run_in_threadpool/to_thread), and counts how many calls are queued behind the semaphore.
+    """
+
+    def __init__(self, workers: int, max_concurrency: int):
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fcm")
+        self._semaphore = None
+        self._semaphore_loop = None
+        self.stats = {"calls": 0, "failed": 0, "queued": 0, "in_flight": 0, "max_queue_depth": 0, "total_ms": 0.0, "max_ms": 0.0}
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    async def run(self, func, *args, **kwargs):
+        """Run a blocking Firebase callable on the FCM pool"""
+        semaphore = self._get_semaphore()
+        self.stats["queued"] += 1
+        self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], self.stats["queued"])
+        try:
+            await semaphore.acquire()
+        finally:
+            self.stats["queued"] -= 1
+        self.stats["in_flight"] += 1
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+        except Exception:
+            self.stats["failed"] += 1
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.stats["calls"] += 1
+            self.stats["total_ms"] += elapsed_ms
+            self.stats["max_ms"] = max(self.stats["max_ms"], elapsed_ms)
+            self.stats["in_flight"] -= 1
+            semaphore.release()
+
+    def get_stats(self):
+        calls = self.stats["calls"]
+        return dict(
+            self.stats,
+            total_ms=round(self.stats["total_ms"], 2),
+            max_ms=round(self.stats["max_ms"], 2),
+            avg_ms=round(self.stats["total_ms"] / calls, 2) if calls else 0,
+            workers=self.workers,
+            max_concurrency=self.max_concurrency
+        )
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+fcm_executor = FCMExecutor(settings.FCM_EXECUTOR_WORKERS, settings.FCM_MAX_CONCURRENCY)
+
+class FirebaseTransport:
+    """Blocking FCM calls through firebase_admin (needs firebase-credentials.json).
+
+    A transport exposes the four messaging calls FCMService makes; they run on the FCM pool and
+    return firebase_admin's own response types, so another transport (see fake_transport.py) can
+    replace Firebase without touching the send paths.
+    """
+    name = "firebase"
+    requires_credentials = True
+
+    def send(self, message: messaging.Message) -> str:
+        return messaging.send(message)
+
+    def send_each_for_multicast(self, message: messaging.MulticastMessage) -> messaging.BatchResponse:
+        return messaging.send_each_for_multicast(message)
+
+    def subscribe_to_topic(self, tokens: List[str], topic: str) -> messaging.TopicManagementResponse:
+        return messaging.subscribe_to_topic(tokens, topic)
+
+    def unsubscribe_from_topic(self, tokens: List[str], topic: str) -> messaging.TopicManagementResponse:
+        return messaging.unsubscribe_from_topic(tokens, topic)
+
+def create_transport():
+    """Transport selected by FCM_TRANSPORT ("firebase", or "fake" for load tests and local runs)"""
+    if settings.FCM_TRANSPORT == "fake":
+        from app.notification_api.fake_transport import FakeFCMTransport
+        return FakeFCMTransport(latency_ms=settings.FCM_FAKE_LATENCY_MS, error_rate=settings.FCM_FAKE_ERROR_RATE,
+                                dead_rate=settings.FCM_FAKE_DEAD_RATE)
+    return FirebaseTransport()
 
 class FCMService:
-    def __init__(self):
-        self.creds_path = self._resolve_creds_path()
+    def __init__(self, transport=None):
+        self.transport = transport or create_transport()
+        self.creds_path = self._resolve_creds_path() if self.transport.requires_credentials else None
         self.initialized = False
         self.last_error = None
-        if self.creds_path:
+        if self.creds_path or not self.transport.requires_credentials:
             self.init_firebase()
 
+    def use_transport(self, transport):
+        """Swap the transport at runtime (benchmarks, local runs against the fake backend)"""
+        self.transport = transport
+        self.initialized = False
+        self.init_firebase()
+
     def _resolve_creds_path(self):
         current_dir = Path(__file__).parent
         project_root = current_dir.parent.parent
@@ -39,6 +160,10 @@ class FCMService:
         return path
 
     def init_firebase(self):
+        if not self.transport.requires_credentials:
+            self.initialized = True
+            self.last_error = None
+            return True, f"Using {self.transport.name} transport"
         try:
             if not self.creds_path:
                 self.creds_path = self._resolve_creds_path()
@@ -90,46 +215,63 @@ class FCMService:
         channel_id = "voice_notification_channel" if not is_silent else "default_channel"
         return sound, channel_id
 
-    async def send_to_topic(self, title: str, body: str, topic: str = 'all_users', message_type: str = 'audio'):
+    def _build_message_parts(self, title: str, body: str, message_type: str, data: Dict[str, Any] = None, ttl: int = None) -> Dict[str, Any]:
+        """notification/data/android/apns shared by single-device and multicast sends"""
+        sound, channel_id = self._get_sound_config(message_type)
+
+        # Build data payload for Flutter compatibility
+        fcm_data = {
+            'type': str(data.get('type', 'admin_notification')) if data and 'type' in data else 'admin_notification',
+            'title': str(title),
+            'body': str(body),
+            'messageType': str(message_type),
+            'timestamp': str(int(time.time() * 1000)),
+            'source': str(data.get('source', 'admin_panel')) if data and 'source' in data else 'admin_panel',
+        }
+
+        # Merge custom data
+        if data:
+            for k, v in data.items():
+                fcm_data[str(k)] = str(v)
+
+        return {
+            "notification": messaging.Notification(title=title, body=body),
+            "data": fcm_data,
+            "android": messaging.AndroidConfig(
+                priority='high',
+                ttl=ttl,
+                notification=messaging.AndroidNotification(
+                    sound=sound,
+                    channel_id=channel_id,
+                    priority='high',
+                    default_sound=True,
+                    default_vibrate_timings=True
+                )
+            ),
+            "apns": messaging.APNSConfig(
+                payload=messaging.APNSPayload(
+                    aps=messaging.Aps(sound=sound, content_available=True)
+                )
+            )
+        }
+
+    async def send_to_topic(self, title: str, body: str, topic: str = 'all_users', message_type: str = 'audio',
+                            data: Dict[str, Any] = None, condition: str = None):
+        """One send to every device subscribed to a topic (or matching a topic condition, max 5 topics)"""
         try:
             if not self.initialized:
                 success, error = self.init_firebase()
                 if not success:
                     return {"success": False, "error": f"Firebase not initialized: {error}"}
 
-            sound, channel_id = self._get_sound_config(message_type)
+            parts = self._build_message_parts(title, body, message_type, data, ttl=3600)
+            if condition:
+                message = messaging.Message(condition=condition, **parts)
+            else:
+                message = messaging.Message(topic=topic, **parts)
 
-            message = messaging.Message(
-                notification=messaging.Notification(title=title, body=body),
-                data={
-                    'type': 'admin_notification',
-                    'title': title,
-                    'body': body,
-                    'messageType': message_type,
-                    'timestamp': str(int(time.time() * 1000)),
-                    'source': 'admin_panel'
-                },
-                android=messaging.AndroidConfig(
-                    priority='high',
-                    ttl=3600,
-                    notification=messaging.AndroidNotification(
-                        sound=sound,
-                        channel_id=channel_id,
-                        priority='high',
-                        default_sound=True,
-                        default_vibrate_timings=True
-                    )
-                ),
-                apns=messaging.APNSConfig(
-                    payload=messaging.APNSPayload(
-                        aps=messaging.Aps(sound=sound, content_available=True)
-                    )
-                ),
-                topic=topic
-            )
-
-            response = messaging.send(message)
-            logger.info(f"Successfully sent topic message: {response}")
+            response = await fcm_executor.run(self.transport.send, message)
+            logger.info(f"Successfully sent topic message to {condition or topic}: {response}")
             return {"success": True, "messageId": response}
         except Exception as error:
             logger.error(f"FCM Topic Send Error: {error}")
@@ -145,52 +287,18 @@ class FCMService:
                 if not success:
                     return {"success": False, "error": f"Firebase not initialized: {error}"}
 
-            sound, channel_id = self._get_sound_config(message_type)
-
-            # Build data payload for Flutter compatibility
-            fcm_data = {
-                'type': str(data.get('type', 'admin_notification')) if data and 'type' in data else 'admin_notification',
-                'title': str(title),
-                'body': str(body),
-                'messageType': str(message_type),
-                'timestamp': str(int(time.time() * 1000)),
-                'source': str(data.get('source', 'admin_panel')) if data and 'source' in data else 'admin_panel',
-            }
-            
-            # Merge custom data
-            if data:
-                for k, v in data.items():
-                    fcm_data[str(k)] = str(v)
+            message = messaging.Message(token=token, **self._build_message_parts(title, body, message_type, data))
 
-            message = messaging.Message(
-                token=token,
-                notification=messaging.Notification(title=title, body=body),
-                data=fcm_data,
-                android=messaging.AndroidConfig(
-                    priority='high',
-                    notification=messaging.AndroidNotification(
-                        sound=sound,
-                        channel_id=channel_id,
-                        priority='high',
-                        default_sound=True,
-                        default_vibrate_timings=True
-                    )
-                ),
-                apns=messaging.APNSConfig(
-                    payload=messaging.APNSPayload(
-                        aps=messaging.Aps(sound=sound, content_available=True)
-                    )
-                )
-            )
-
-            # Using loop.run_in_executor to avoid blocking the event loop with the sync messaging.send
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(None, lambda: messaging.send(message))
+            # The send is blocking; run it on the dedicated FCM pool
+            response = await fcm_executor.run(self.transport.send, message)
             logger.info(f"FCM: Sent to device {token[:10]}... | ID: {response}")
             return {"success": True, "messageId": response}
         except Exception as error:
             err_msg = str(error)
             logger.error(f"FCM Device Send Error for token {token[:10]}...: {err_msg}")
+            if is_dead_token_error(error):
+                self._report_dead_tokens([token])
+                return {"success": False, "error": err_msg, "dead": True}
             return {"success": False, "error": err_msg}
 
     async def send_force_logout(self, token: str):
@@ -212,8 +320,7 @@ class FCMService:
                 }
             )
 
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(None, lambda: messaging.send(message))
+            response = await fcm_executor.run(self.transport.send, message)
             return {"success": True, "messageId": response}
         except Exception as error:
             logger.error(f"FCM Force Logout Error: {error}")
@@ -239,25 +346,121 @@ class FCMService:
                     "messageType": "action"
                 }
             )
-            response = messaging.send(message)
+            response = await fcm_executor.run(self.transport.send, message)
             return {"success": True, "message_id": response}
         except Exception as e:
             logger.error(f"FCM login request error: {e}")
             return {"success": False, "error": str(e)}
 
+    @staticmethod
+    def _is_valid_token(token: str) -> bool:
+        return bool(token) and token not in ("undefined", "null")
+
+    @staticmethod
+    def _report_dead_tokens(tokens: List[str]):
+        """Hand dead tokens to the pruner so they are removed instead of retried on every broadcast"""
+        from app.services.token_cleanup import dead_token_pruner
+        dead_token_pruner.report(tokens)
+
+    def _send_multicast_chunk(self, tokens: List[str], parts: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """One FCM call for up to FCM_MULTICAST_LIMIT tokens; results are in token order"""
+        try:
+            batch = self.transport.send_each_for_multicast(messaging.MulticastMessage(tokens=tokens, **parts))
+        except Exception as error:
+            logger.error(f"FCM Multicast Error for {len(tokens)} tokens: {error}")
+            return [{"token": token, "success": False, "error": str(error)} for token in tokens]
+
+        results = []
+        for token, response in zip(tokens, batch.responses):
+            if response.success:
+                results.append({"token": token, "success": True, "messageId": response.message_id})
+            else:
+                results.append({"token": token, "success": False, "error": str(response.exception),
+                                "dead": is_dead_token_error(response.exception)})
+        return results
+
+    async def send_multicast(self, tokens: List[str], title: str, body: str, data: Dict[str, Any] = None, message_type: str = "audio") -> List[Dict[str, Any]]:
+        """Send one notification to many devices, FCM_MULTICAST_LIMIT tokens per call.
+        Returns one {"token", "success", "messageId" | "error"} per distinct token."""
+        unique_tokens = list(dict.fromkeys(tokens))
+        valid = [t for t in unique_tokens if self._is_valid_token(t)]
+        results = {t: {"token": t, "success": False, "error": "Invalid token"} for t in unique_tokens if not self._is_valid_token(t)}
+
+        if valid:
+            if not self.initialized:
+                success, error = self.init_firebase()
+                if not success:
+                    return [{"token": t, "success": False, "error": f"Firebase not initialized: {error}"} for t in unique_tokens]
+
+            parts = self._build_message_parts(title, body, message_type, data)
+            chunks = [valid[i:i + FCM_MULTICAST_LIMIT] for i in range(0, len(valid), FCM_MULTICAST_LIMIT)]
+            chunk_results = await asyncio.gather(*[
+                fcm_executor.run(self._send_multicast_chunk, chunk, parts) for chunk in chunks
+            ])
+            for chunk_result in chunk_results:
+                for r in chunk_result:
+                    results[r["token"]] = r
+
+            dead = [r["token"] for r in results.values() if r.get("dead")]
+            if dead:
+                self._report_dead_tokens(dead)
+
+            delivered = sum(1 for r in results.values() if r["success"])
+            logger.info(f"FCM: Multicast '{title}' delivered to {delivered}/{len(valid)} devices in {len(chunks)} call(s)")
+        return [results[t] for t in unique_tokens]
+
+    def _update_topic_chunk(self, tokens: List[str], topic: str, subscribe: bool) -> Dict[str, Any]:
+        """One subscribe/unsubscribe call; returns {token: None on success | error reason}"""
+        manage = self.transport.subscribe_to_topic if subscribe else self.transport.unsubscribe_from_topic
+        try:
+            response = manage(tokens, topic)
+        except Exception as error:
+            logger.error(f"FCM Topic {'subscribe' if subscribe else 'unsubscribe'} error for {topic}: {error}")
+            return {token: str(error) for token in tokens}
+        outcome = {token: None for token in tokens}
+        for error in response.errors:
+            outcome[tokens[error.index]] = error.reason
+        return outcome
+
+    async def update_topic_membership(self, tokens: List[str], topic: str, subscribe: bool = True) -> Dict[str, Any]:
+        """(Un)subscribe tokens to a topic, FCM_TOPIC_BATCH_LIMIT per call.
+        Returns {token: None | error reason}; tokens FCM reports as unknown are handed to the dead token pruner."""
+        valid = [t for t in dict.fromkeys(tokens) if self._is_valid_token(t)]
+        if not valid:
+            return {}
+        if not self.initialized:
+            success, error = self.init_firebase()
+            if not success:
+                return {t: f"Firebase not initialized: {error}" for t in valid}
+
+        chunks = [valid[i:i + FCM_TOPIC_BATCH_LIMIT] for i in range(0, len(valid), FCM_TOPIC_BATCH_LIMIT)]
+        outcome = {}
+        for chunk_outcome in await asyncio.gather(*[
+            fcm_executor.run(self._update_topic_chunk, chunk, topic, subscribe) for chunk in chunks
+        ]):
+            outcome.update(chunk_outcome)
+
+        dead = [t for t, reason in outcome.items() if reason in DEAD_TOPIC_REASONS]
+        if dead and subscribe:
+            self._report_dead_tokens(dead)
+        return outcome
+
     async def broadcast_to_tokens(self, tokens: List[str], title: str, body: str, data: Dict[str, Any] = None, message_type: str = "audio"):
         if not tokens:
             return {"success": True, "delivered": 0, "total": 0}
-            
-        tasks = [
-            self.send_to_device(title, body, token, data=data, message_type=message_type)
-            for token in set(tokens) if token
-        ]
-        
-        results = await asyncio.gather(*tasks)
+
+        results = await self.send_multicast([t for t in tokens if t], title, body, data=data, message_type=message_type)
         success_count = sum(1 for r in results if r.get("success"))
-        
-        return {"success": True, "delivered": success_count, "total": len(tokens)}
+        failure_reasons = [r.get("error") for r in results if not r.get("success")]
+
+        return {
+            "success": True,
+            "delivered": success_count,
+            "failed": len(failure_reasons),
+            "dead_tokens": sum(1 for r in results if r.get("dead")),
+            "total": len(tokens),
+            "failure_reasons": failure_reasons[:10]
+        }
 
 
 # Global instance
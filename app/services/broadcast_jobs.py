@@ -0,0 +1,207 @@
+import time
+import uuid
+import asyncio
+import logging
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional
+from app.core.config import get_settings
+from app.core.database import execute_query_async, no_unit_of_work
+from app.notification_api.service import notification_service
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# Keyset pagination over the distinct tokens of active parents; each page starts after the last token seen.
+# Tokens are mixed-case, so both the comparison and the order use the binary collation (the column's
+# case-insensitive one would order 'ab' before 'AC' and treat tokens differing only in case as equal).
+PARENT_TOKENS_PAGE = """
+SELECT DISTINCT ft.fcm_token
+FROM fcm_tokens ft
+JOIN parents p ON ft.parent_id = p.parent_id
+WHERE ft.parent_id IS NOT NULL
+AND p.parents_active_status = 'ACTIVE'
+AND ft.fcm_token COLLATE utf8mb4_bin > %s
+ORDER BY ft.fcm_token COLLATE utf8mb4_bin
+LIMIT %s
+"""
+
+PARENT_TOKENS_COUNT = """
+SELECT COUNT(DISTINCT ft.fcm_token) AS total
+FROM fcm_tokens ft
+JOIN parents p ON ft.parent_id = p.parent_id
+WHERE ft.parent_id IS NOT NULL
+AND p.parents_active_status = 'ACTIVE'
+"""
+
+FINISHED = ("COMPLETED", "FAILED", "INTERRUPTED")
+
+class BroadcastJobManager:
+    """Runs school-wide parent broadcasts as background jobs.
+
+    Tokens are read BROADCAST_CHUNK_SIZE at a time and each page is sent as one multicast call,
+    with at most BROADCAST_CONCURRENCY pages in flight (and read ahead) per job and an optional
+    BROADCAST_RATE_LIMIT in tokens per second, so a broadcast neither holds every token in memory
+    nor takes the whole FCM executor from trip notifications. Progress is kept in memory for the
+    latest BROADCAST_JOB_HISTORY jobs and written to broadcast_jobs after every page.
+    """
+
+    def __init__(self, chunk_size: int = None, concurrency: int = None, rate_limit: float = None):
+        self.chunk_size = chunk_size or settings.BROADCAST_CHUNK_SIZE
+        self.concurrency = concurrency or settings.BROADCAST_CONCURRENCY
+        self.rate_limit = rate_limit if rate_limit is not None else settings.BROADCAST_RATE_LIMIT
+        self.history = settings.BROADCAST_JOB_HISTORY
+        self._jobs: Dict[str, Dict] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.stats = {"started": 0, "completed": 0, "failed": 0, "interrupted": 0, "tokens_sent": 0, "tokens_failed": 0}
+
+    async def start(self, title: str, body: str, message_type: str = "audio", notification_id: str = None) -> Dict:
+        """Register a broadcast job and start sending in the background; returns the job's initial status"""
+        job_id = str(uuid.uuid4())
+        job = {
+            "job_id": job_id, "notification_id": notification_id, "status": "QUEUED",
+            "total_tokens": None, "sent": 0, "failed": 0, "dead_tokens": 0, "chunks": 0,
+            "failure_reasons": [], "error": None,
+            "created_at": datetime.now().isoformat(), "finished_at": None
+        }
+        try:
+            await execute_query_async("""
+            INSERT INTO broadcast_jobs (job_id, notification_id, title, status)
+            VALUES (%s, %s, %s, 'QUEUED')
+            """, (job_id, notification_id, title))
+        except Exception as e:
+            logger.warning(f"Failed to record broadcast job {job_id}: {e}")
+
+        self._jobs[job_id] = job
+        self._trim()
+        self._tasks[job_id] = asyncio.create_task(self._run(job, title, body, message_type))
+        self.stats["started"] += 1
+        return dict(job)
+
+    async def stream_tokens(self) -> AsyncIterator[List[str]]:
+        """Yield active parent tokens one page at a time"""
+        after = ""
+        while True:
+            rows = await execute_query_async(PARENT_TOKENS_PAGE, (after, self.chunk_size), fetch_all=True) or []
+            tokens = [r['fcm_token'] for r in rows if r['fcm_token']]
+            if tokens:
+                yield tokens
+            if len(rows) < self.chunk_size or not tokens:
+                return
+            after = tokens[-1]
+
+    async def _throttle(self, started: float, dispatched: int):
+        """Hold the next page until the tokens already dispatched fit under the rate limit"""
+        if self.rate_limit and self.rate_limit > 0:
+            wait = dispatched / self.rate_limit - (time.monotonic() - started)
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+    async def _send_page(self, job: Dict, tokens: List[str], title: str, body: str, message_type: str):
+        results = await notification_service.send_multicast(tokens, title, body, message_type=message_type)
+        failed = [r for r in results if not r.get("success")]
+        job["sent"] += len(results) - len(failed)
+        job["failed"] += len(failed)
+        job["dead_tokens"] += sum(1 for r in failed if r.get("dead"))
+        job["chunks"] += 1
+        job["failure_reasons"] = (job["failure_reasons"] + [r.get("error") for r in failed])[:10]
+        self.stats["tokens_sent"] += len(results) - len(failed)
+        self.stats["tokens_failed"] += len(failed)
+        await self._save(job)
+
+    async def _run(self, job: Dict, title: str, body: str, message_type: str):
+        # Started from a request handler; must not join its unit of work
+        with no_unit_of_work():
+            slots = asyncio.Semaphore(self.concurrency)
+            pending, errors = set(), []
+
+            async def send(tokens):
+                try:
+                    await self._send_page(job, tokens, title, body, message_type)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    slots.release()
+
+            try:
+                job["status"] = "RUNNING"
+                count = await execute_query_async(PARENT_TOKENS_COUNT, fetch_one=True)
+                job["total_tokens"] = (count or {}).get("total")
+                await self._save(job)
+
+                started, dispatched = time.monotonic(), 0
+                async for tokens in self.stream_tokens():
+                    await slots.acquire()
+                    await self._throttle(started, dispatched)
+                    dispatched += len(tokens)
+                    task = asyncio.create_task(send(tokens))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                await asyncio.gather(*pending)
+                if errors:
+                    raise errors[0]
+                job["status"] = "COMPLETED"
+            except asyncio.CancelledError:
+                for task in pending:
+                    task.cancel()
+                job["status"] = "INTERRUPTED"
+                raise
+            except Exception as e:
+                logger.error(f"Broadcast job {job['job_id']} failed: {e}")
+                job["status"], job["error"] = "FAILED", str(e)[:500]
+            finally:
+                job["finished_at"] = datetime.now().isoformat()
+                self.stats[job["status"].lower()] += 1
+                self._tasks.pop(job["job_id"], None)
+                await self._save(job)
+                logger.info(f"📣 Broadcast job {job['job_id']} {job['status']}: {job['sent']} sent, {job['failed']} failed")
+
+    async def _save(self, job: Dict):
+        try:
+            await execute_query_async("""
+            UPDATE broadcast_jobs
+            SET status = %s, total_tokens = %s, sent_count = %s, failed_count = %s, dead_count = %s,
+                last_error = %s, finished_at = %s, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = %s
+            """, (job["status"], job["total_tokens"], job["sent"], job["failed"], job["dead_tokens"],
+                  (job["error"] or (job["failure_reasons"][0] if job["failure_reasons"] else None) or "")[:500] or None,
+                  job["finished_at"], job["job_id"]))
+        except Exception as e:
+            logger.warning(f"Failed to save progress of broadcast job {job['job_id']}: {e}")
+
+    def _trim(self):
+        """Forget the oldest finished jobs beyond the history size (their rows stay in broadcast_jobs)"""
+        finished = [job_id for job_id, job in self._jobs.items() if job["status"] in FINISHED]
+        for job_id in finished[:max(len(self._jobs) - self.history, 0)]:
+            del self._jobs[job_id]
+
+    async def get(self, job_id: str) -> Optional[Dict]:
+        """Job status from this process, or from broadcast_jobs when another worker ran it"""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return dict(job)
+        row = await execute_query_async("SELECT * FROM broadcast_jobs WHERE job_id = %s", (job_id,), fetch_one=True)
+        if not row:
+            return None
+        return {
+            "job_id": row['job_id'], "notification_id": row.get('notification_id'), "status": row['status'],
+            "total_tokens": row.get('total_tokens'), "sent": row.get('sent_count') or 0,
+            "failed": row.get('failed_count') or 0, "dead_tokens": row.get('dead_count') or 0,
+            "error": row.get('last_error'), "created_at": row.get('created_at'), "finished_at": row.get('finished_at')
+        }
+
+    async def stop(self):
+        """Cancel running jobs at shutdown; they are recorded as INTERRUPTED"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def get_stats(self):
+        return dict(self.stats, running=len(self._tasks), chunk_size=self.chunk_size,
+                    concurrency=self.concurrency, rate_limit=self.rate_limit)
+
+broadcast_jobs = BroadcastJobManager()
@@ -1,35 +1,62 @@
 import logging
-import math
 import json
 import asyncio
 import uuid
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 from datetime import datetime, timedelta
-from app.core.database import execute_query
-from app.notification_api.service import notification_service
-
+from app.core.database import execute_query, execute_query_async, run_in_db_executor, unit_of_work_async
+from app.core.config import get_settings
+from app.services.trip_state import TripState, first_stop_distances, trip_state_cache
+from app.services.stop_index import stop_index
+from app.services.trip_manifest import TripManifest, trip_manifests
+from app.services.geo import haversine_km
+from app.services.live_locations import live_location_buffer
+from app.services.live_events import live_event_broker
+from app.services.notification_outbox import notification_outbox
+from app.services.route_recipients import route_recipient_cache
+
+settings = get_settings()
 logger = logging.getLogger(__name__)
 
+FIRST_STOP_ALERT_KM = 1.0  # "Bus Nearby" alert for the first stop
+ARRIVAL_RADIUS_KM = settings.GEOFENCE_RADIUS / 1000  # Default distance along (and off) the route at which a stop is reached
+
 class BusTrackingService:
     def __init__(self):
         pass
         
     def calculate_distance(self, lat1: float, lon1: float, lat2: float, lon2: float) -> float:
         """Calculate distance between two points in kilometers"""
-        R = 6371  # Earth's radius in kilometers
-        
-        lat1_rad = math.radians(lat1)
-        lon1_rad = math.radians(lon1)
-        lat2_rad = math.radians(lat2)
-        lon2_rad = math.radians(lon2)
-        
-        dlat = lat2_rad - lat1_rad
-        dlon = lon2_rad - lon1_rad
-        
-        a = math.sin(dlat/2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon/2)**2
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-        
-        return R * c
+        return haversine_km(lat1, lon1, lat2, lon2)
+
+    @staticmethod
+    def arrived_stop(state: TripState, latitude: float, longitude: float) -> Optional[Dict]:
+        """The next unskipped stop if this fix has reached it, else None.
+
+        The fix is projected onto the route polyline from the current stop to one stop beyond the next, so a
+        stop passed between two pings still counts. It has reached the next stop when that stop is no more
+        than its arrival radius (geofence_radius_m, ARRIVAL_RADIUS_KM by default) further along the route,
+        the fix is within that radius of the route, and it is past the midpoint from the current stop
+        (anti-cascading). Before the first stop there is no route behind the bus, so only the distance to
+        the stop counts.
+        """
+        target = state.next_unskipped_stop(state.current_stop_order)
+        if not target:
+            return None
+        path = state.path
+        n = state.index_by_order[target['stop_order']]
+        current = path.index_after(state.current_stop_order) - 1
+        if current < 0:
+            along, off = path.project(latitude, longitude, n, n)
+        else:
+            along, off = path.project(latitude, longitude, current, min(n + 1, len(path.orders) - 1))
+
+        radius = target['arrival_radius_km']
+        if off > radius or path.stops_within(along + radius) <= n:
+            return None
+        if current >= 0 and along <= (path.offsets[current] + path.offsets[n]) / 2:
+            return None
+        return target
     
     def get_students_for_route_stop(self, route_id: str, stop_order: int, trip_type: str) -> List[Dict]:
         """Get students for a specific route stop based on trip type"""
@@ -60,6 +87,10 @@ class BusTrackingService:
         """Get students for all stops that share the same location name on a route"""
         if not location_name:
             return []
+
+        recipients = route_recipient_cache.get(route_id)
+        if recipients is not None:
+            return recipients.students_at(location_name, trip_type)
             
         if trip_type == "PICKUP":
             query = """
@@ -86,10 +117,14 @@ class BusTrackingService:
             """
         return execute_query(query, (route_id, location_name, location_name), fetch_all=True) or []
     
-    def get_parent_tokens_for_students(self, student_ids: List[str]) -> List[str]:
-        """Get parent FCM tokens for given students"""
+    def get_parent_tokens_for_students(self, student_ids: List[str], route_id: str = None) -> List[str]:
+        """Get parent FCM tokens for given students (from the route's cached recipients when they are all on it)"""
         if not student_ids:
             return []
+
+        recipients = route_recipient_cache.get(route_id) if route_id else None
+        if recipients is not None and recipients.covers(student_ids):
+            return recipients.tokens_for(student_ids)
             
         placeholders = ','.join(['%s'] * len(student_ids))
         query = f"""
@@ -116,332 +151,403 @@ class BusTrackingService:
         """Helper to log notification to admin_parent_notifications table (Disabled per user request)"""
         pass
 
-    async def update_bus_location(self, trip_id: str, latitude: float, longitude: float):
+    async def update_bus_location(self, trip_id: str, latitude: float, longitude: float, update_live_location: bool = True):
         """Automatic bus tracking - handle stop progression and trip completion"""
         try:
-            # Update driver_live_locations table (current location store)
-            update_live_query = """
-            INSERT INTO driver_live_locations (driver_id, latitude, longitude, updated_at)
-            SELECT driver_id, %s, %s, CURRENT_TIMESTAMP FROM trips WHERE trip_id = %s
-            ON DUPLICATE KEY UPDATE 
-                latitude = VALUES(latitude),
-                longitude = VALUES(longitude),
-                updated_at = CURRENT_TIMESTAMP
-            """
-            execute_query(update_live_query, (latitude, longitude, trip_id))
-
-            # Get trip details
-            trip_query = """
-            SELECT t.*, r.name as route_name, b.registration_number
-            FROM trips t
-            JOIN routes r ON t.route_id = r.route_id
-            JOIN buses b ON t.bus_id = b.bus_id
-            WHERE t.trip_id = %s AND t.status IN ('ONGOING', 'NOT_STARTED')
-            """
-            trip = execute_query(trip_query, (trip_id,), fetch_one=True)
-            
-            if not trip:
-                return {"success": False, "message": "Trip not found or not ongoing"}
-            
-            # Get route stops based on trip type
-            order_field = "pickup_stop_order" if trip['trip_type'] == "PICKUP" else "drop_stop_order"
-            # BUG FIX: Also filter out stops with NULL stop_order — without this, `s['stop_order'] > current_stop_order`
-            # raises TypeError (NoneType > int) which crashes the entire function and silently kills all notifications.
-            stops_query = f"""
-            SELECT stop_id, stop_name, location, latitude, longitude, {order_field} as stop_order
-            FROM route_stops 
-            WHERE route_id = %s
-              AND latitude IS NOT NULL AND longitude IS NOT NULL
-              AND {order_field} IS NOT NULL
-            ORDER BY {order_field}
-            """
-            
-            stops = execute_query(stops_query, (trip['route_id'],), fetch_all=True)
-            
-            if not stops:
-                return {"success": False, "message": "No stops with coordinates found"}
-
-            current_stop_order = trip['current_stop_order']
-            
-            # --- Logic for First Stop 500m Alert (Stored in DB) ---
-            if current_stop_order < 1 and not trip.get('is_first_stop_notified'):
-                first_stop = next((s for s in stops if s['stop_order'] == 1), None)
-                if first_stop:
-                    dist_to_first = self.calculate_distance(
-                        latitude, longitude,
-                        float(first_stop['latitude']), float(first_stop['longitude'])
-                    )
-                    if dist_to_first <= 1.0: # 1000m (1km)
-                        first_stop_loc = first_stop['location'] or first_stop['stop_name']
-                        logger.info(f"🔔 Notifying first stop 1000m alert: {first_stop_loc}")
-                        students = self.get_students_for_route_stop(trip['route_id'], 1, trip['trip_type'])
-                        if students:
-                            title = "🚌 Bus Nearby"
-                            body = f"The bus is approaching {first_stop_loc}. Please be ready."
-                            await self._broadcast_helper(students, title, body, {"trip_id": trip_id, "stop_name": first_stop_loc, "status": "UPCOMING"}, message_type="audio")
-                            self._log_notification(title, body, trip['route_id'], first_stop_loc)
-                        
-                        execute_query("UPDATE trips SET is_first_stop_notified = 1 WHERE trip_id = %s", (trip_id,))
-            
-            # --- Smart Lookahead Stop Logic (Handles Skips) ---
-            skipped_raw = trip.get('skipped_stops')
-            if isinstance(skipped_raw, list):
-                skipped_list = skipped_raw
-            elif isinstance(skipped_raw, str):
+            # All progression reads/writes share one transaction with the outbox rows for its pushes,
+            # so notifications are queued exactly when the progression commits
+            notifications = []
+            async with trip_state_cache.lock(trip_id):
                 try:
-                    skipped_list = json.loads(skipped_raw)
+                    async with unit_of_work_async():
+                        result = await self._process_location(trip_id, latitude, longitude, notifications, update_live_location)
+                        state = trip_state_cache.peek(trip_id)
+                        for students, title, body, data, tokens in notifications:
+                            await self._broadcast_helper(students, title, body, data, message_type="audio", wake=False,
+                                                         route_id=state.route_id if state else None, tokens=tokens)
                 except Exception:
-                    skipped_list = []
+                    # In-memory state may be ahead of a rolled back transaction
+                    trip_state_cache.invalidate(trip_id)
+                    raise
+            if notifications:
+                notification_outbox.wake()
+            self._publish_progress(trip_id, latitude, longitude, result, update_live_location)
+            return result
+        except Exception as e:
+            logger.error(f"Bus location processing error: {e}")
+            return {"success": False, "error": str(e)}
+
+    def _publish_progress(self, trip_id: str, latitude: float, longitude: float, result: Dict, include_position: bool):
+        """Push position / stop progression to live subscribers once the fix has been committed"""
+        state = trip_state_cache.peek(trip_id)
+        if not result.get("success") or not state:
+            return
+        if include_position:
+            live_event_broker.publish_position(
+                latitude, longitude, trip_id=trip_id, route_id=state.route_id,
+                driver_id=state.driver_id, current_stop_order=result["current_stop_order"]
+            )
+        if result.get("foreign_stops"):
+            live_event_broker.publish({
+                "type": "foreign_stop",
+                "trip_id": trip_id,
+                "route_id": state.route_id,
+                "driver_id": state.driver_id,
+                "stops": result["foreign_stops"]
+            })
+        if result.get("stops_passed"):
+            live_event_broker.publish({
+                "type": "stop_progress",
+                "trip_id": trip_id,
+                "route_id": state.route_id,
+                "driver_id": state.driver_id,
+                "current_stop_order": result["current_stop_order"],
+                "current_stop_info": result["current_stop_info"],
+                "stops_passed": result["stops_passed"]
+            })
+
+    def screen_fleet(self, fixes: List[tuple]) -> List[bool]:
+        """Which (state, latitude, longitude) fixes can change stop progression, for all trips in one kernel pass.
+        Fixes that cannot are only in transit and need no transaction; trips without a driver or stops always go the full way."""
+        first_distances = first_stop_distances(fixes)
+        return [
+            not state.driver_id or not state.stops
+            or (first is not None and first <= FIRST_STOP_ALERT_KM)
+            or self.arrived_stop(state, latitude, longitude) is not None
+            for (state, latitude, longitude), first in zip(fixes, first_distances)
+        ]
+
+    @staticmethod
+    def enter_foreign_stops(state: TripState, latitude: float, longitude: float) -> List[Dict]:
+        """Other routes' stops whose geofence the bus has just entered (covering for, or strayed onto, another
+        route); answered from the stop index once it is loaded, which is refreshed off the hot path"""
+        if stop_index.loaded_at is None:
+            return []
+        if stop_index.stale:
+            stop_index.refresh_in_background()
+        inside = {stop['stop_id']: (stop, d) for stop, d in stop_index.containing(latitude, longitude)
+                  if stop['route_id'] != state.route_id}
+        entered = [
+            {"stop_id": stop['stop_id'], "route_id": stop['route_id'], "stop_name": stop['stop_name'], "distance_m": round(d, 1)}
+            for stop_id, (stop, d) in inside.items() if stop_id not in state.foreign_stop_ids
+        ]
+        state.foreign_stop_ids = set(inside)
+        for stop in entered:
+            logger.info(f"🧭 Trip {state.trip_id} entered {stop['stop_name']} of route {stop['route_id']}")
+        return entered
+
+    def record_transit(self, state: TripState, latitude: float, longitude: float) -> Dict:
+        """Apply a fix screened as in transit: buffer the live location and publish it, without touching trips"""
+        live_location_buffer.record(state.driver_id, latitude, longitude)
+        result = {
+            "success": True,
+            "trip_id": state.trip_id,
+            "current_stop_order": state.current_stop_order,
+            "current_stop_info": None,
+            "stops_passed": 0,
+            "trip_completed": False,
+            "message": "In transit"
+        }
+        foreign_stops = self.enter_foreign_stops(state, latitude, longitude)
+        if foreign_stops:
+            result["foreign_stops"] = foreign_stops
+        self._publish_progress(state.trip_id, latitude, longitude, result, True)
+        return result
+
+    async def _recipients(self, state: TripState, manifest: Optional[TripManifest], location: str = None,
+                          stop_order: int = None) -> Tuple[List[Dict], Optional[List[str]]]:
+        """(students, parent tokens) at a location group or stop order of the trip: from its manifest when there is
+        one, otherwise queried (tokens None, resolved at delivery)"""
+        if manifest is not None:
+            group = manifest.at_location(location) if location is not None else manifest.at_stop_order(stop_order)
+            return group["students"], group["tokens"]
+        if location is not None:
+            students = await run_in_db_executor(self.get_students_for_location, state.route_id, location, state.trip_type)
+        else:
+            students = await run_in_db_executor(self.get_students_for_route_stop, state.route_id, stop_order, state.trip_type)
+        return students, None
+
+    @staticmethod
+    def _trip_ended(trip_id: str, notifications: List) -> Dict:
+        """The trip is no longer ongoing in MySQL: drop its cached state and the pushes queued for this fix"""
+        notifications.clear()
+        trip_state_cache.drop(trip_id)
+        logger.info(f"⏹️ Trip {trip_id} is no longer ongoing; dropped its tracking state")
+        return {"success": False, "message": "Trip not found or not ongoing"}
+
+    async def _process_location(self, trip_id: str, latitude: float, longitude: float, notifications: List,
+                                update_live_location: bool = True) -> Dict:
+        """Stop progression for one GPS fix; queues (students, title, body, data, tokens) notifications for the caller"""
+        state = await trip_state_cache.get(trip_id)
+
+        # Update the driver's live location (write-behind buffer); replayed batch fixes skip this
+        if update_live_location:
+            if state and state.driver_id:
+                live_location_buffer.record(state.driver_id, latitude, longitude)
             else:
-                skipped_list = []
-            
-            # FIX: Use >= instead of > so that stops at current_stop_order are also considered
-            # This fixes the case where skip_stop sets current_stop_order to the skipped stop's order
-            # FIX: Limit lookahead strictly to the single next stop to enforce order-based tracking
-            lookahead_stops = [s for s in stops if s['stop_order'] > current_stop_order and s['stop_order'] not in skipped_list][:1]
-            
-            stops_passed = 0
-            current_stop_info = None
-            arrived_stop = None
-
-            # --- Anti-Cascading Logic ---
-            # Calculate distance to the current stop (if any) to ensure we are actually moving away from it
-            # and closer to the next stop before triggering Arrival for the next stop.
-            current_stop = next((s for s in stops if s['stop_order'] == current_stop_order), None)
-            dist_to_current = float('inf')
-            if current_stop:
-                dist_to_current = self.calculate_distance(
-                    latitude, longitude,
-                    float(current_stop['latitude']), float(current_stop['longitude'])
-                )
-
-            # Find if we have reached any of the upcoming stops
-            for stop in lookahead_stops:
-                distance = self.calculate_distance(
-                    latitude, longitude, 
-                    float(stop['latitude']), float(stop['longitude'])
-                )
-                
-                # Check if we have REACHED the stop (within 500m) AND we are closer to it than the current stop
-                if distance <= 0.5 and distance < dist_to_current:
-                    arrived_stop = stop
-                    break
+                await execute_query_async("""
+                INSERT INTO driver_live_locations (driver_id, latitude, longitude, updated_at)
+                SELECT driver_id, %s, %s, CURRENT_TIMESTAMP FROM trips WHERE trip_id = %s
+                ON DUPLICATE KEY UPDATE 
+                    latitude = VALUES(latitude),
+                    longitude = VALUES(longitude),
+                    updated_at = CURRENT_TIMESTAMP
+                """, (latitude, longitude, trip_id))
+
+        if not state:
+            return {"success": False, "message": "Trip not found or not ongoing"}
+        
+        stops = state.stops
+        if not stops:
+            return {"success": False, "message": "No stops with coordinates found"}
 
-            if arrived_stop:
-                target_order = arrived_stop['stop_order']
-                
-                # 0. Check if this LOCATION (not just stop) was already reached/notified
-                original_logs = {}
-                try:
-                    logs_raw = trip.get('stop_logs')
-                    if logs_raw:
-                        original_logs = json.loads(logs_raw) if isinstance(logs_raw, str) else logs_raw
-                except:
-                    original_logs = {}
-                
-                current_loc_name = arrived_stop['location'] or arrived_stop['stop_name']
-                
-                # Find all stops sharing this location
-                same_location_stops = [s for s in stops if (s['location'] or s['stop_name']) == current_loc_name]
-                # FIX: Only treat a stop as "already notified" if the log entry is a real timestamp,
-                # NOT if it was "SKIPPED". Skipped stops should not prevent arrival notifications.
-                location_already_notified = any(
-                    s['stop_id'] in original_logs and original_logs[s['stop_id']] != "SKIPPED"
-                    for s in same_location_stops
-                )
-                
-                logger.info(f"📍 Stop Reached: {arrived_stop['stop_name']} (Group: {current_loc_name}) | Notified: {location_already_notified}")
-                
-                # 1. Update Database (mark current and intermediate stops as reached)
-                new_stop_logs = original_logs.copy()
-                for s in stops:
-                    if current_stop_order < s['stop_order'] <= target_order:
-                        s_id = s['stop_id']
-                        # Only set timestamp if not already set (preserve SKIPPED entries as-is, add timestamp for new ones)
-                        if s_id not in new_stop_logs or new_stop_logs[s_id] == "SKIPPED":
-                            # If it was skipped but we physically arrived, still mark intermediate ones
-                            if s['stop_order'] == target_order or s['stop_order'] not in skipped_list:
-                                new_stop_logs[s_id] = datetime.now().isoformat()
-                                if s['stop_order'] < target_order:
-                                    logger.warning(f"⚠️ Missed GPS update for intermediate stop: {s['stop_name']} (Order: {s['stop_order']}). Marking as reached implicitly.")
-
-                update_query = """
-                UPDATE trips SET 
-                    current_stop_order = %s, 
-                    stop_logs = %s,
-                    updated_at = CURRENT_TIMESTAMP 
-                WHERE trip_id = %s
-                """
-                execute_query(update_query, (target_order, json.dumps(new_stop_logs), trip_id))
+        current_stop_order = state.current_stop_order
+        
+        # --- Logic for First Stop 500m Alert (Stored in DB) ---
+        first_stop = state.first_stop_pending()
+        if first_stop:
+            if first_stop_distances([(state, latitude, longitude)])[0] <= FIRST_STOP_ALERT_KM: # 1000m (1km)
+                first_stop_loc = first_stop['location_key']
+                logger.info(f"🔔 Notifying first stop 1000m alert: {first_stop_loc}")
+                manifest = await run_in_db_executor(trip_manifests.for_trip, state)
+                students, tokens = await self._recipients(state, manifest, stop_order=1)
+                if students:
+                    title = "🚌 Bus Nearby"
+                    body = f"The bus is approaching {first_stop_loc}. Please be ready."
+                    notifications.append((students, title, body, {"trip_id": trip_id, "stop_name": first_stop_loc, "status": "UPCOMING"}, tokens))
+                    self._log_notification(title, body, state.route_id, first_stop_loc)
                 
-                stops_passed = target_order - current_stop_order
-                current_stop_order = target_order
-                current_stop_info = {"stop_name": arrived_stop['stop_name'], "stop_order": target_order}
-
-                # 2. Trigger Notifications ONLY if this is the FIRST stop in this location group
-                if not location_already_notified:
-                    # A. Arrival Notification (For all students at this location)
-                    students_arrived = self.get_students_for_location(trip['route_id'], current_loc_name, trip['trip_type'])
-                    if students_arrived:
-                        title = "🚌 Bus Arrived"
-                        message = f"The bus has arrived at {current_loc_name}."
-                        await self._broadcast_helper(students_arrived, title, message, {"trip_id": trip_id, "location": current_loc_name, "status": "ARRIVED"}, message_type="audio")
-                        self._log_notification(title, message, trip['route_id'], current_loc_name)
-                        logger.info(f"📣 Sent Arrival Notification for {current_loc_name} to {len(students_arrived)} students")
-
-                    # Find UNIQUE locations ahead to send approaching/nearby alerts once per area
-                    remaining_stops = [s for s in stops if s['stop_order'] > target_order and s['stop_order'] not in skipped_list]
-                    unique_locs_ahead = []
-                    seen_locs = {current_loc_name}
-                    for s in remaining_stops:
-                        loc = s['location'] or s['stop_name']
-                        if loc not in seen_locs:
-                            unique_locs_ahead.append(loc)
-                            seen_locs.add(loc)
-
-                    # B. Upcoming Stops Notifications (Next 5 Unique Locations)
-                    for i in range(min(len(unique_locs_ahead), 5)):
-                        future_loc = unique_locs_ahead[i]
-                        students_ahead = self.get_students_for_location(trip['route_id'], future_loc, trip['trip_type'])
-                        if students_ahead:
-                            if i == 0:
-                                title = "🚌 Bus Approaching"
-                                message = f"The bus has reached {current_loc_name} and will arrive at {future_loc} soon."
-                                status_val = "APPROACHING"
-                            else:
-                                title = "🚌 Bus Update"
-                                message = f"The bus has reached {current_loc_name}. Please be ready for your stop."
-                                status_val = "UPCOMING"
-
-                            await self._broadcast_helper(
-                                students_ahead, 
-                                title, 
-                                message, 
-                                {"trip_id": trip_id, "location": future_loc, "status": status_val}, 
-                                message_type="audio"
-                            )
-                            self._log_notification(title, message, trip['route_id'], future_loc)
-                            logger.info(f"📣 Sent '{status_val}' Notification for {future_loc} to {len(students_ahead)} students")
-
-
-            # Per user request: do not automatically complete the trip or tell the UI it's completed.
-            # The driver must manually complete it.
-            trip_completed = False
+                if not await execute_query_async(
+                    "UPDATE trips SET is_first_stop_notified = 1 WHERE trip_id = %s AND status IN ('ONGOING', 'NOT_STARTED')",
+                    (trip_id,)
+                ):
+                    return self._trip_ended(trip_id, notifications)
+                state.is_first_stop_notified = True
+        
+        # --- Route Progress Logic (Handles Skips) ---
+        skipped_list = state.skipped_set
+        
+        stops_passed = 0
+        current_stop_info = None
 
-            return {
-                "success": True,
-                "trip_id": trip_id,
-                "current_stop_order": current_stop_order,
-                "current_stop_info": current_stop_info,
-                "stops_passed": stops_passed,
-                "trip_completed": trip_completed,
-                "message": f"Reached {current_stop_info['stop_name']}" if current_stop_info else "In transit"
-            }
-            
-        except Exception as e:
-            logger.error(f"Bus location processing error: {e}")
-            return {"success": False, "error": str(e)}
+        # FIX: Limit progression strictly to the single next unskipped stop to enforce order-based tracking;
+        # reaching it is decided by projecting the fix onto the route (see arrived_stop)
+        arrived_stop = self.arrived_stop(state, latitude, longitude)
 
-    async def _broadcast_helper(self, students: List[Dict], title: str, body: str, data: Dict, message_type: str = "audio"):
-        """Helper to broadcast notifications asynchronously"""
+        if arrived_stop:
+            target_order = arrived_stop['stop_order']
+            
+            # 0. Check if this LOCATION (not just stop) was already reached/notified
+            original_logs = state.stop_logs
+            current_loc_name = arrived_stop['location_key']
+            
+            # Find all stops sharing this location
+            same_location_stops = state.location_groups.get(current_loc_name, [])
+            # FIX: Only treat a stop as "already notified" if the log entry is a real timestamp,
+            # NOT if it was "SKIPPED". Skipped stops should not prevent arrival notifications.
+            location_already_notified = any(
+                s['stop_id'] in original_logs and original_logs[s['stop_id']] != "SKIPPED"
+                for s in same_location_stops
+            )
+            
+            logger.info(f"📍 Stop Reached: {arrived_stop['stop_name']} (Group: {current_loc_name}) | Notified: {location_already_notified}")
+            
+            # 1. Update Database (mark current and intermediate stops as reached)
+            new_stop_logs = original_logs.copy()
+            for s in state.stops_between(current_stop_order, target_order):
+                s_id = s['stop_id']
+                # Only set timestamp if not already set (preserve SKIPPED entries as-is, add timestamp for new ones)
+                if s_id not in new_stop_logs or new_stop_logs[s_id] == "SKIPPED":
+                    # If it was skipped but we physically arrived, still mark intermediate ones
+                    if s['stop_order'] == target_order or s['stop_order'] not in skipped_list:
+                        new_stop_logs[s_id] = datetime.now().isoformat()
+                        if s['stop_order'] < target_order:
+                            logger.warning(f"⚠️ Missed GPS update for intermediate stop: {s['stop_name']} (Order: {s['stop_order']}). Marking as reached implicitly.")
+
+            # Same statuses the trip state is loaded for: a trip cancelled or completed meanwhile (by a
+            # route/bus cascade or another worker) matches nothing and stops being tracked here
+            update_query = """
+            UPDATE trips SET 
+                current_stop_order = %s, 
+                stop_logs = %s,
+                updated_at = CURRENT_TIMESTAMP 
+            WHERE trip_id = %s AND status IN ('ONGOING', 'NOT_STARTED')
+            """
+            if not await execute_query_async(update_query, (target_order, json.dumps(new_stop_logs), trip_id)):
+                return self._trip_ended(trip_id, notifications)
+            state.apply_arrival(target_order, new_stop_logs)
+            
+            stops_passed = target_order - current_stop_order
+            current_stop_order = target_order
+            current_stop_info = {"stop_name": arrived_stop['stop_name'], "stop_order": target_order}
+
+            # 2. Trigger Notifications ONLY if this is the FIRST stop in this location group
+            if not location_already_notified:
+                # Recipients come from the trip manifest: no per-location queries
+                manifest = await run_in_db_executor(trip_manifests.for_trip, state)
+
+                # A. Arrival Notification (For all students at this location)
+                students_arrived, tokens = await self._recipients(state, manifest, location=current_loc_name)
+                if students_arrived:
+                    title = "🚌 Bus Arrived"
+                    message = f"The bus has arrived at {current_loc_name}."
+                    notifications.append((students_arrived, title, message, {"trip_id": trip_id, "location": current_loc_name, "status": "ARRIVED"}, tokens))
+                    self._log_notification(title, message, state.route_id, current_loc_name)
+                    logger.info(f"📣 Sent Arrival Notification for {current_loc_name} to {len(students_arrived)} students")
+
+                # Find UNIQUE locations ahead to send approaching/nearby alerts once per area
+                remaining_stops = state.next_unskipped_stops(target_order)
+                unique_locs_ahead = []
+                seen_locs = {current_loc_name}
+                for s in remaining_stops:
+                    loc = s['location_key']
+                    if loc not in seen_locs:
+                        unique_locs_ahead.append(loc)
+                        seen_locs.add(loc)
+
+                # B. Upcoming Stops Notifications (Next 5 Unique Locations)
+                for i in range(min(len(unique_locs_ahead), 5)):
+                    future_loc = unique_locs_ahead[i]
+                    students_ahead, tokens = await self._recipients(state, manifest, location=future_loc)
+                    if students_ahead:
+                        if i == 0:
+                            title = "🚌 Bus Approaching"
+                            message = f"The bus has reached {current_loc_name} and will arrive at {future_loc} soon."
+                            status_val = "APPROACHING"
+                        else:
+                            title = "🚌 Bus Update"
+                            message = f"The bus has reached {current_loc_name}. Please be ready for your stop."
+                            status_val = "UPCOMING"
+
+                        notifications.append((
+                            students_ahead, 
+                            title, 
+                            message, 
+                            {"trip_id": trip_id, "location": future_loc, "status": status_val},
+                            tokens
+                        ))
+                        self._log_notification(title, message, state.route_id, future_loc)
+                        logger.info(f"📣 Sent '{status_val}' Notification for {future_loc} to {len(students_ahead)} students")
+
+
+        # Per user request: do not automatically complete the trip or tell the UI it's completed.
+        # The driver must manually complete it.
+        trip_completed = False
+
+        result = {
+            "success": True,
+            "trip_id": trip_id,
+            "current_stop_order": current_stop_order,
+            "current_stop_info": current_stop_info,
+            "stops_passed": stops_passed,
+            "trip_completed": trip_completed,
+            "message": f"Reached {current_stop_info['stop_name']}" if current_stop_info else "In transit"
+        }
+        foreign_stops = self.enter_foreign_stops(state, latitude, longitude)
+        if foreign_stops:
+            result["foreign_stops"] = foreign_stops
+        return result
+
+    async def _broadcast_helper(self, students: List[Dict], title: str, body: str, data: Dict, message_type: str = "audio",
+                                wake: bool = True, route_id: str = None, tokens: List[str] = None):
+        """Queue a notification for the students' parents in the outbox; delivery happens in the background workers.
+        tokens (from a trip manifest) are stored as-is, so delivery does not resolve the students again."""
         if data is None:
             data = {}
         if "type" not in data:
             data["type"] = "proximity_alert"
+        if tokens is not None and not tokens:
+            return
             
         student_ids = [st['student_id'] for st in students]
-        tokens = self.get_parent_tokens_for_students(student_ids)
-        if tokens:
-            await notification_service.broadcast_to_tokens(list(set(tokens)), title, body, data, message_type=message_type)
-        else:
-            logger.warning(f"⚠️ No FCM tokens found for parents of students: {student_ids}. Notification '{title}' not sent.")
+        await run_in_db_executor(
+            notification_outbox.enqueue, title, body, data=data, message_type=message_type,
+            student_ids=student_ids, route_id=route_id, tokens=tokens
+        )
+        if wake:
+            notification_outbox.wake()
+
+    async def _skip_under_lock(self, trip_id: str, apply):
+        """Run a manual skip like a GPS fix: under the trip's lock, against its cached state, in one unit of work"""
+        async with trip_state_cache.lock(trip_id):
+            try:
+                async with unit_of_work_async():
+                    state = await trip_state_cache.get(trip_id)
+                    result = await apply(state)
+            except Exception:
+                # In-memory state may be ahead of a rolled back transaction
+                trip_state_cache.invalidate(trip_id)
+                raise
+        if result.get("success"):
+            notification_outbox.wake()
+        return result
 
     async def skip_specific_stop(self, trip_id: str, stop_order: int):
         """Mark a specific stop_order as skipped for the current trip"""
         try:
-            query = "SELECT skipped_stops, stop_logs, trip_type, route_id, current_stop_order FROM trips WHERE trip_id = %s"
-            result = execute_query(query, (trip_id,), fetch_one=True)
-            if not result:
-                return {"success": False, "message": "Trip not found"}
-
-            current_order = result.get('current_stop_order', 0)
-            if stop_order <= current_order:
-                return {"success": False, "message": "Cannot skip a stop that the bus has already passed"}
-
-            order_field = "pickup_stop_order" if result.get('trip_type') == "PICKUP" else "drop_stop_order"
-            route_id = result.get('route_id')
-            stops_query = f"""
-            SELECT stop_id, stop_name, location, latitude, longitude, {order_field} as stop_order
-            FROM route_stops 
-            WHERE route_id = %s AND {order_field} IS NOT NULL
-            ORDER BY {order_field}
-            """
-            stops = execute_query(stops_query, (route_id,), fetch_all=True) or []
-
-            skipped_raw = result.get('skipped_stops')
-            if isinstance(skipped_raw, list):
-                skipped = skipped_raw
-            elif isinstance(skipped_raw, str):
-                try:
-                    skipped = json.loads(skipped_raw)
-                except Exception:
-                    skipped = []
-            else:
-                skipped = []
-                
-            all_remaining_unskipped = [
-                s for s in stops
-                if s['stop_order'] > current_order and s['stop_order'] not in skipped
-            ]
-            
-            if not all_remaining_unskipped:
-                return {"success": False, "message": "No more stops to skip"}
-                
-            # Guard: Last stop
-            if len(all_remaining_unskipped) == 1 and all_remaining_unskipped[0]['stop_order'] == stop_order:
-                return {
-                    "success": False,
-                    "message": f"Cannot skip '{all_remaining_unskipped[0]['stop_name']}' — it is the last stop on this route."
-                }
-            
-            # 2. Add new stop order if not already skipped
-            if stop_order not in skipped:
-                skipped.append(stop_order)
-            
-            # 3. Update stop_logs JSON trail (preserve existing entries)
-            current_stop_logs = {}
-            if result.get('stop_logs'):
-                try:
-                    current_stop_logs = json.loads(result['stop_logs']) if isinstance(result['stop_logs'], str) else result['stop_logs']
-                except Exception:
-                    current_stop_logs = {}
-            
-            # Find stop_id for this order to mark as SKIPPED
-            target_stop_data = next((s for s in stops if s['stop_order'] == stop_order), None)
-            if target_stop_data:
-                current_stop_logs[target_stop_data['stop_id']] = "SKIPPED"
-
-            # 4. Update DB
-            execute_query(
-                "UPDATE trips SET skipped_stops = %s, stop_logs = %s, updated_at = CURRENT_TIMESTAMP WHERE trip_id = %s",
-                (json.dumps(skipped), json.dumps(current_stop_logs), trip_id)
-            )
-
-            logger.info(f"🚫 Stop {stop_order} manually excluded from trip {trip_id}")
-            
-            # Send Notification to students at that specific stop
-            if target_stop_data:
-                students_skipped = self.get_students_for_route_stop(route_id, stop_order, result.get('trip_type'))
-                if students_skipped:
-                    title = "🚌 Stop Skipped"
-                    message = f"The bus will skip {target_stop_data['stop_name']} today."
-                    await self._broadcast_helper(students_skipped, title, message, {"trip_id": trip_id, "status": "SKIPPED"})
-            
-            return {"success": True, "message": f"Stop {stop_order} skipped for this trip", "skipped_stops": skipped}
+            return await self._skip_under_lock(trip_id, lambda state: self._skip_specific_stop(state, stop_order))
         except Exception as e:
             logger.error(f"Error skipping specific stop: {e}")
             return {"success": False, "error": str(e)}
 
+    async def _skip_specific_stop(self, state: Optional[TripState], stop_order: int):
+        if not state:
+            return {"success": False, "message": "Trip not found"}
+        trip_id = state.trip_id
+
+        current_order = state.current_stop_order
+        if stop_order <= current_order:
+            return {"success": False, "message": "Cannot skip a stop that the bus has already passed"}
+
+        stops = state.stops
+        skipped = list(state.skipped_stops)
+
+        all_remaining_unskipped = [
+            s for s in stops
+            if s['stop_order'] > current_order and s['stop_order'] not in skipped
+        ]
+
+        if not all_remaining_unskipped:
+            return {"success": False, "message": "No more stops to skip"}
+
+        # Guard: Last stop
+        if len(all_remaining_unskipped) == 1 and all_remaining_unskipped[0]['stop_order'] == stop_order:
+            return {
+                "success": False,
+                "message": f"Cannot skip '{all_remaining_unskipped[0]['stop_name']}' — it is the last stop on this route."
+            }
+
+        # 2. Add new stop order if not already skipped
+        if stop_order not in skipped:
+            skipped.append(stop_order)
+
+        # 3. Update stop_logs JSON trail (preserve existing entries, including arrivals)
+        current_stop_logs = dict(state.stop_logs)
+
+        # Find stop_id for this order to mark as SKIPPED
+        target_stop_data = state.by_order.get(stop_order)
+        if target_stop_data:
+            current_stop_logs[target_stop_data['stop_id']] = "SKIPPED"
+
+        # 4. Update DB
+        await execute_query_async(
+            "UPDATE trips SET skipped_stops = %s, stop_logs = %s, updated_at = CURRENT_TIMESTAMP WHERE trip_id = %s",
+            (json.dumps(skipped), json.dumps(current_stop_logs), trip_id)
+        )
+        state.apply_skip(skipped, current_stop_logs)
+
+        logger.info(f"🚫 Stop {stop_order} manually excluded from trip {trip_id}")
+
+        # Send Notification to students at that specific stop
+        if target_stop_data:
+            students_skipped = await run_in_db_executor(self.get_students_for_route_stop, state.route_id, stop_order, state.trip_type)
+            if students_skipped:
+                title = "🚌 Stop Skipped"
+                message = f"The bus will skip {target_stop_data['stop_name']} today."
+                await self._broadcast_helper(students_skipped, title, message, {"trip_id": trip_id, "status": "SKIPPED"}, wake=False)
+
+        return {"success": True, "message": f"Stop {stop_order} skipped for this trip", "skipped_stops": skipped}
+
     async def skip_stop(self, trip_id: str):
         """Manually skip the next target stop for a trip.
         
@@ -449,186 +555,114 @@ class BusTrackingService:
         The lookahead in update_bus_location naturally skips over it and finds the next real stop.
         """
         try:
-            # 1. Get trip details
-            trip_query = "SELECT * FROM trips WHERE trip_id = %s AND status = 'ONGOING'"
-            trip = execute_query(trip_query, (trip_id,), fetch_one=True)
-            if not trip:
-                return {"success": False, "message": "Trip not found or not ongoing"}
-
-            current_order = trip['current_stop_order']
-            order_field = "pickup_stop_order" if trip['trip_type'] == "PICKUP" else "drop_stop_order"
-            
-            # BUG FIX: Filter NULL stop_orders — unordered stops would bubble to the top
-            # of the sorted list and be incorrectly identified as "next stop".
-            stops_query = f"""
-            SELECT stop_id, stop_name, location, latitude, longitude, {order_field} as stop_order
-            FROM route_stops 
-            WHERE route_id = %s AND {order_field} IS NOT NULL
-            ORDER BY {order_field}
-            """
-            stops = execute_query(stops_query, (trip['route_id'],), fetch_all=True) or []
-            
-            # Parse current skipped_stops list
-            skipped_raw = trip.get('skipped_stops')
-            if isinstance(skipped_raw, list):
-                skipped_list = skipped_raw
-            elif isinstance(skipped_raw, str):
-                try:
-                    skipped_list = json.loads(skipped_raw)
-                except Exception:
-                    skipped_list = []
-            else:
-                skipped_list = []
+            return await self._skip_under_lock(trip_id, self._skip_next_stop)
+        except Exception as e:
+            logger.error(f"Manual skip error: {e}")
+            return {"success": False, "error": str(e)}
 
-            # Collect all remaining unskipped stops (used both for guard and notifications)
-            all_remaining_unskipped = [
-                s for s in stops
-                if s['stop_order'] > current_order and s['stop_order'] not in skipped_list
-            ]
+    async def _skip_next_stop(self, state: Optional[TripState]):
+        # 1. Trip details from the cached state (same view the GPS lane works on)
+        if not state or state.trip.get('status') != 'ONGOING':
+            return {"success": False, "message": "Trip not found or not ongoing"}
+        trip_id = state.trip_id
 
-            if not all_remaining_unskipped:
-                return {"success": False, "message": "No more stops to skip"}
+        current_order = state.current_stop_order
+        # NULL-ordered stops are already excluded from the cached stop list
+        stops = state.stops
+        skipped_list = list(state.skipped_stops)
 
-            next_unskipped = all_remaining_unskipped[0]
-            target_loc = next_unskipped['location'] or next_unskipped['stop_name']
-            
-            # Find all stops at this exact location
-            stops_to_skip = [
-                s for s in all_remaining_unskipped 
-                if (s['location'] or s['stop_name']) == target_loc
-            ]
-
-            # BUG FIX: Guard against skipping the LAST stop
-            if len(all_remaining_unskipped) <= len(stops_to_skip):
-                return {
-                    "success": False,
-                    "message": f"Cannot skip '{target_loc}' — it includes the last stop on this route."
-                }
-
-            # 2. Add to skipped_stops list (DO NOT advance current_stop_order)
-            for s in stops_to_skip:
-                if s['stop_order'] not in skipped_list:
-                    skipped_list.append(s['stop_order'])
-
-            # 3. Update stop_logs to mark as SKIPPED
-            current_stop_logs = {}
-            if trip.get('stop_logs'):
-                try:
-                    current_stop_logs = json.loads(trip['stop_logs']) if isinstance(trip['stop_logs'], str) else trip['stop_logs']
-                except Exception:
-                    current_stop_logs = {}
-            
-            for s in stops_to_skip:
-                current_stop_logs[s['stop_id']] = "SKIPPED"
+        # Collect all remaining unskipped stops (used both for guard and notifications)
+        all_remaining_unskipped = [
+            s for s in stops
+            if s['stop_order'] > current_order and s['stop_order'] not in skipped_list
+        ]
 
-            # 4. Update DB: keep current_stop_order the same, just update skipped_stops and stop_logs
-            execute_query(
-                "UPDATE trips SET skipped_stops = %s, stop_logs = %s, updated_at = CURRENT_TIMESTAMP WHERE trip_id = %s",
-                (json.dumps(skipped_list), json.dumps(current_stop_logs), trip_id)
-            )
-            
-            skipped_stop_name = target_loc
-            target_skip_order = stops_to_skip[0]['stop_order']
-
-            logger.info(f"⏭️ Manual Skip: Location {skipped_stop_name} (Order {target_skip_order})")
-
-            # 4.5. Trigger notification to the SKIPPED stops
-            for s in stops_to_skip:
-                students_skipped = self.get_students_for_route_stop(trip['route_id'], s['stop_order'], trip['trip_type'])
-                if students_skipped:
-                    title = "🚌 Stop Skipped"
-                    message = f"The bus will skip {s['stop_name']} today."
-                    await self._broadcast_helper(students_skipped, title, message, {"trip_id": trip_id, "status": "SKIPPED"})
-
-            # 5. Trigger notifications for the stops AFTER the skipped one
-            # Recompute remaining after the skip so the skipped stop is excluded
-            remaining_unskipped = [s for s in stops if s['stop_order'] > current_order and s['stop_order'] not in skipped_list]
-            
-            # A. Approaching Notification for the next unskipped stop
-            if remaining_unskipped:
-                next_actual = remaining_unskipped[0]
-                students_N1 = self.get_students_for_route_stop(trip['route_id'], next_actual['stop_order'], trip['trip_type'])
-                if students_N1:
-                    title = "🚌 Bus Approaching"
-                    message = f"The bus is skipping {skipped_stop_name} and will arrive at {next_actual['stop_name']} soon."
-                    await self._broadcast_helper(students_N1, title, message, {"trip_id": trip_id, "stop_name": next_actual['stop_name'], "status": "APPROACHING"})
-
-            # B. Upcoming Notification for subsequent unskipped stops (up to 4 more)
-            for i in range(1, min(len(remaining_unskipped), 5)):
-                future_stop = remaining_unskipped[i]
-                students_future = self.get_students_for_route_stop(trip['route_id'], future_stop['stop_order'], trip['trip_type'])
-                if students_future:
-                    title = "🚌 Bus Nearby"
-                    message = f"The bus is approaching {future_stop['stop_name']}. Please be ready."
-                    await self._broadcast_helper(students_future, title, message, {"trip_id": trip_id, "status": "UPCOMING"})
+        if not all_remaining_unskipped:
+            return {"success": False, "message": "No more stops to skip"}
 
+        next_unskipped = all_remaining_unskipped[0]
+        target_loc = next_unskipped['location'] or next_unskipped['stop_name']
+        
+        # Find all stops at this exact location
+        stops_to_skip = [
+            s for s in all_remaining_unskipped 
+            if (s['location'] or s['stop_name']) == target_loc
+        ]
+
+        # BUG FIX: Guard against skipping the LAST stop
+        if len(all_remaining_unskipped) <= len(stops_to_skip):
             return {
-                "success": True,
-                "message": f"Stop '{skipped_stop_name}' skipped",
-                "skipped_stop_order": target_skip_order,
-                "skipped_stops": skipped_list
+                "success": False,
+                "message": f"Cannot skip '{target_loc}' — it includes the last stop on this route."
             }
-        except Exception as e:
-            logger.error(f"Manual skip error: {e}")
-            return {"success": False, "error": str(e)}
+
+        # 2. Add to skipped_stops list (DO NOT advance current_stop_order)
+        for s in stops_to_skip:
+            if s['stop_order'] not in skipped_list:
+                skipped_list.append(s['stop_order'])
+
+        # 3. Update stop_logs to mark as SKIPPED (preserve existing entries, including arrivals)
+        current_stop_logs = dict(state.stop_logs)
+        for s in stops_to_skip:
+            current_stop_logs[s['stop_id']] = "SKIPPED"
+
+        # 4. Update DB: keep current_stop_order the same, just update skipped_stops and stop_logs
+        await execute_query_async(
+            "UPDATE trips SET skipped_stops = %s, stop_logs = %s, updated_at = CURRENT_TIMESTAMP WHERE trip_id = %s",
+            (json.dumps(skipped_list), json.dumps(current_stop_logs), trip_id)
+        )
+        state.apply_skip(skipped_list, current_stop_logs)
+        
+        skipped_stop_name = target_loc
+        target_skip_order = stops_to_skip[0]['stop_order']
+
+        logger.info(f"⏭️ Manual Skip: Location {skipped_stop_name} (Order {target_skip_order})")
+
+        # 4.5. Trigger notification to the SKIPPED stops
+        for s in stops_to_skip:
+            students_skipped = await run_in_db_executor(self.get_students_for_route_stop, state.route_id, s['stop_order'], state.trip_type)
+            if students_skipped:
+                title = "🚌 Stop Skipped"
+                message = f"The bus will skip {s['stop_name']} today."
+                await self._broadcast_helper(students_skipped, title, message, {"trip_id": trip_id, "status": "SKIPPED"}, wake=False)
+
+        # 5. Trigger notifications for the stops AFTER the skipped one
+        # Recompute remaining after the skip so the skipped stop is excluded
+        remaining_unskipped = [s for s in stops if s['stop_order'] > current_order and s['stop_order'] not in skipped_list]
+        
+        # A. Approaching Notification for the next unskipped stop
+        if remaining_unskipped:
+            next_actual = remaining_unskipped[0]
+            students_N1 = await run_in_db_executor(self.get_students_for_route_stop, state.route_id, next_actual['stop_order'], state.trip_type)
+            if students_N1:
+                title = "🚌 Bus Approaching"
+                message = f"The bus is skipping {skipped_stop_name} and will arrive at {next_actual['stop_name']} soon."
+                await self._broadcast_helper(students_N1, title, message, {"trip_id": trip_id, "stop_name": next_actual['stop_name'], "status": "APPROACHING"}, wake=False)
+
+        # B. Upcoming Notification for subsequent unskipped stops (up to 4 more)
+        for i in range(1, min(len(remaining_unskipped), 5)):
+            future_stop = remaining_unskipped[i]
+            students_future = await run_in_db_executor(self.get_students_for_route_stop, state.route_id, future_stop['stop_order'], state.trip_type)
+            if students_future:
+                title = "🚌 Bus Nearby"
+                message = f"The bus is approaching {future_stop['stop_name']}. Please be ready."
+                await self._broadcast_helper(students_future, title, message, {"trip_id": trip_id, "status": "UPCOMING"}, wake=False)
+
+        return {
+            "success": True,
+            "message": f"Stop '{skipped_stop_name}' skipped",
+            "skipped_stop_order": target_skip_order,
+            "skipped_stops": skipped_list
+        }
 
     
     def update_route_fcm_cache(self, route_id: str):
         """Update FCM token cache for route stops"""
         try:
-            # Get all stops for route with student/parent FCM tokens
-            query = """
-            SELECT 
-                rs.stop_id,
-                rs.stop_name,
-                rs.pickup_stop_order,
-                rs.drop_stop_order,
-                JSON_ARRAYAGG(
-                    JSON_OBJECT(
-                        'fcm_token', ft.fcm_token,
-                        'parent_id', ft.parent_id,
-                        'parent_name', p.name
-                    )
-                ) as fcm_data
-            FROM route_stops rs
-            LEFT JOIN students s ON (
-                (rs.stop_id = s.pickup_stop_id AND s.pickup_route_id = rs.route_id) OR
-                (rs.stop_id = s.drop_stop_id AND s.drop_route_id = rs.route_id)
-            )
-            LEFT JOIN fcm_tokens ft ON (s.student_id = ft.student_id OR s.parent_id = ft.parent_id OR s.s_parent_id = ft.parent_id)
-            LEFT JOIN parents p ON ft.parent_id = p.parent_id
-            WHERE rs.route_id = %s AND s.transport_status = 'ACTIVE' 
-            AND s.student_status IN ('CURRENT', 'ACTIVE') AND s.is_transport_user = 1
-            AND ft.fcm_token IS NOT NULL
-            GROUP BY rs.stop_id, rs.stop_name, rs.pickup_stop_order, rs.drop_stop_order
-            """
-            
-            stops_data = execute_query(query, (route_id,), fetch_all=True)
-            
-            # Create FCM cache map
-            fcm_map = {}
-            for stop in stops_data:
-                fcm_map[stop['stop_id']] = {
-                    "stop_name": stop['stop_name'],
-                    "pickup_order": stop['pickup_stop_order'],
-                    "drop_order": stop['drop_stop_order'],
-                    "fcm_tokens": json.loads(stop['fcm_data']) if stop['fcm_data'] else []
-                }
-            
-            # Update cache table
-            cache_query = """
-            INSERT INTO route_stop_fcm_cache (route_id, stop_fcm_map) 
-            VALUES (%s, %s)
-            ON DUPLICATE KEY UPDATE 
-            stop_fcm_map = VALUES(stop_fcm_map),
-            updated_at = CURRENT_TIMESTAMP
-            """
-            
-            execute_query(cache_query, (route_id, json.dumps(fcm_map)))
-            
-            return {"success": True, "route_id": route_id, "stops_cached": len(fcm_map)}
-            
+            recipients = route_recipient_cache.rebuild(route_id)
+            return {"success": True, "route_id": route_id, "stops_cached": len(recipients.fcm_map), "version": recipients.version}
         except Exception as e:
+            route_recipient_cache.invalidate(route_id)
             logger.error(f"FCM cache update error: {e}")
             return {"success": False, "error": str(e)}
 
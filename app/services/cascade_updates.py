@@ -1,7 +1,11 @@
 import logging
 from typing import Dict, Any, List
-from app.core.database import execute_query, get_db
-import json
+from app.core.database import execute_query, get_db, unit_of_work, after_commit
+from app.services.live_locations import live_location_buffer
+from app.services.topic_subscriptions import topic_subscriptions
+from app.services.route_recipients import route_recipient_cache
+from app.services.route_cache_rebuilder import route_cache_rebuilder
+from app.services.proximity_service import proximity_service
 
 logger = logging.getLogger(__name__)
 
@@ -12,17 +16,7 @@ class CascadeUpdateService:
         """Update all tables related to parent changes"""
         try:
             # Update FCM tokens cache for routes where this parent's students are enrolled
-            routes_query = """
-            SELECT DISTINCT s.pickup_route_id as route_id FROM students s 
-            WHERE s.parent_id = %s OR s.s_parent_id = %s
-            UNION
-            SELECT DISTINCT s.drop_route_id as route_id FROM students s 
-            WHERE s.parent_id = %s OR s.s_parent_id = %s
-            """
-            routes = execute_query(routes_query, (parent_id, parent_id, parent_id, parent_id), fetch_all=True)
-            
-            for route in routes:
-                self.update_route_fcm_cache(route['route_id'])
+            self._refresh_parent_students(parent_id)
                 
             logger.info(f"Updated cascades for parent {parent_id}")
             return True
@@ -37,18 +31,17 @@ class CascadeUpdateService:
             student_query = "SELECT pickup_route_id, drop_route_id FROM students WHERE student_id = %s"
             student = execute_query(student_query, (student_id,), fetch_one=True)
             
+            # Route/stop/class changes move the student's tokens between FCM topics. Marks are set once the
+            # request commits: a sync running earlier would read the old rows and use the mark up
+            after_commit(topic_subscriptions.request_sync, None, [student_id])
+
             if student:
-                # Update FCM cache for both pickup and drop routes
-                self.update_route_fcm_cache(student['pickup_route_id'])
-                if student['drop_route_id'] != student['pickup_route_id']:
-                    self.update_route_fcm_cache(student['drop_route_id'])
-                
-                # If route changed, update old routes too
+                # Re-place the student on its pickup and drop routes, and take it off old ones
+                route_ids = {student['pickup_route_id'], student['drop_route_id']}
                 if old_data:
-                    if old_data.get('pickup_route_id') != student['pickup_route_id']:
-                        self.update_route_fcm_cache(old_data['pickup_route_id'])
-                    if old_data.get('drop_route_id') != student['drop_route_id']:
-                        self.update_route_fcm_cache(old_data['drop_route_id'])
+                    route_ids |= {old_data.get('pickup_route_id'), old_data.get('drop_route_id')}
+                for route_id in route_ids:
+                    self.refresh_route_students(route_id, [student_id])
             
             logger.info(f"Updated cascades for student {student_id}")
             return True
@@ -64,10 +57,7 @@ class CascadeUpdateService:
             
             # If route is deactivated, handle active trips
             if new_data and new_data.get('routes_active_status') == 'INACTIVE':
-                execute_query(
-                    "UPDATE trips SET status = 'CANCELED' WHERE route_id = %s AND status IN ('NOT_STARTED', 'ONGOING')",
-                    (route_id,)
-                )
+                self._cancel_trips("route_id", route_id)
             
             logger.info(f"Updated cascades for route {route_id}")
             return True
@@ -85,16 +75,24 @@ class CascadeUpdateService:
                     (bus_id,)
                 )
                 # Cancel any ongoing trips for this bus
-                execute_query(
-                    "UPDATE trips SET status = 'CANCELED' WHERE bus_id = %s AND status IN ('NOT_STARTED', 'ONGOING')",
-                    (bus_id,)
-                )
+                self._cancel_trips("bus_id", bus_id)
             logger.info(f"Updated cascades for bus {bus_id} with status {new_status}")
             return True
         except Exception as e:
             logger.error(f"Bus cascade update error: {e}")
             return False
 
+    def _cancel_trips(self, column: str, value: str):
+        """Cancel the NOT_STARTED/ONGOING trips of a route or bus and stop tracking them once that commits"""
+        trips = execute_query(
+            f"SELECT trip_id FROM trips WHERE {column} = %s AND status IN ('NOT_STARTED', 'ONGOING')", (value,), fetch_all=True
+        ) or []
+        execute_query(
+            f"UPDATE trips SET status = 'CANCELED' WHERE {column} = %s AND status IN ('NOT_STARTED', 'ONGOING')", (value,)
+        )
+        if trips:
+            after_commit(proximity_service.end_tracking, [t['trip_id'] for t in trips])
+
     def update_bus_reassignment_cascades(self, bus_id: str, driver_id: str = None, route_id: str = None):
         """Update upcoming trips when bus driver or route is reassigned"""
         try:
@@ -136,30 +134,18 @@ class CascadeUpdateService:
     def update_fcm_token_cascades(self, fcm_id: str, old_data: Dict = None, new_data: Dict = None):
         """Update all tables related to FCM token changes"""
         try:
-            # Get affected routes through student/parent relationships
-            if new_data and new_data.get('parent_id'):
-                parent_id = new_data['parent_id']
-                routes_query = """
-                SELECT DISTINCT s.pickup_route_id as route_id FROM students s 
-                WHERE s.parent_id = %s OR s.s_parent_id = %s
-                UNION
-                SELECT DISTINCT s.drop_route_id as route_id FROM students s 
-                WHERE s.parent_id = %s OR s.s_parent_id = %s
-                """
-                routes = execute_query(routes_query, (parent_id, parent_id, parent_id, parent_id), fetch_all=True)
-                
-                for route in routes:
-                    self.update_route_fcm_cache(route['route_id'])
-            
-            if new_data and new_data.get('student_id'):
-                student_id = new_data['student_id']
-                student_query = "SELECT pickup_route_id, drop_route_id FROM students WHERE student_id = %s"
-                student = execute_query(student_query, (student_id,), fetch_one=True)
-                
-                if student:
-                    self.update_route_fcm_cache(student['pickup_route_id'])
-                    if student['drop_route_id'] != student['pickup_route_id']:
-                        self.update_route_fcm_cache(student['drop_route_id'])
+            after_commit(topic_subscriptions.request_sync, [(old_data or {}).get('fcm_token'), (new_data or {}).get('fcm_token')])
+
+            # Re-resolve the tokens of the students/parents the token belonged to before and after
+            for data in (old_data or {}, new_data or {}):
+                if data.get('parent_id'):
+                    self._refresh_parent_students(data['parent_id'])
+                if data.get('student_id'):
+                    student_query = "SELECT pickup_route_id, drop_route_id FROM students WHERE student_id = %s"
+                    student = execute_query(student_query, (data['student_id'],), fetch_one=True)
+                    if student:
+                        for route_id in {student['pickup_route_id'], student['drop_route_id']}:
+                            self.refresh_route_students(route_id, [data['student_id']])
             
             logger.info(f"Updated cascades for FCM token {fcm_id}")
             return True
@@ -167,153 +153,171 @@ class CascadeUpdateService:
             logger.error(f"FCM token cascade update error: {e}")
             return False
     
+    def _apply_route_delta(self, route_id: str, delta, items: List[str]):
+        """Apply a student/token change to one route's FCM cache; falls back to a full rebuild"""
+        if not route_id or not items:
+            return
+        try:
+            if delta(route_id, list(items)) is not None:
+                return
+        except Exception as e:
+            logger.warning(f"FCM cache delta failed for route {route_id}, rebuilding: {e}")
+        self.update_route_fcm_cache(route_id)
+
+    def refresh_route_students(self, route_id: str, student_ids: List[str]):
+        self._apply_route_delta(route_id, route_recipient_cache.refresh_students, student_ids)
+
+    def remove_route_students(self, route_id: str, student_ids: List[str]):
+        self._apply_route_delta(route_id, route_recipient_cache.remove_students, student_ids)
+
+    def remove_route_tokens(self, route_id: str, tokens: List[str]):
+        self._apply_route_delta(route_id, route_recipient_cache.remove_tokens, tokens)
+
+    def routes_for_tokens(self, tokens: List[str]) -> List[str]:
+        """Routes whose cached maps can contain these tokens; query before the tokens are deleted"""
+        tokens = [t for t in tokens if t]
+        if not tokens:
+            return []
+        placeholders = ", ".join(["%s"] * len(tokens))
+        params = tuple(tokens)
+        routes = execute_query(f"""
+        SELECT DISTINCT s.pickup_route_id AS route_id
+        FROM fcm_tokens ft
+        JOIN students s ON (s.student_id = ft.student_id OR s.parent_id = ft.parent_id OR s.s_parent_id = ft.parent_id)
+        WHERE ft.fcm_token IN ({placeholders}) AND s.pickup_route_id IS NOT NULL
+        UNION
+        SELECT DISTINCT s.drop_route_id AS route_id
+        FROM fcm_tokens ft
+        JOIN students s ON (s.student_id = ft.student_id OR s.parent_id = ft.parent_id OR s.s_parent_id = ft.parent_id)
+        WHERE ft.fcm_token IN ({placeholders}) AND s.drop_route_id IS NOT NULL
+        """, params + params, fetch_all=True) or []
+        return [row['route_id'] for row in routes]
+
+    def _refresh_parent_students(self, parent_id: str):
+        """Delta-update every route a parent's students ride (one query per route for just those students)"""
+        students = execute_query(
+            "SELECT student_id, pickup_route_id, drop_route_id FROM students WHERE parent_id = %s OR s_parent_id = %s",
+            (parent_id, parent_id), fetch_all=True
+        ) or []
+        by_route = {}
+        for student in students:
+            for route_id in (student['pickup_route_id'], student['drop_route_id']):
+                by_route.setdefault(route_id, set()).add(student['student_id'])
+        for route_id, student_ids in by_route.items():
+            self.refresh_route_students(route_id, list(student_ids))
+
     def update_route_fcm_cache(self, route_id: str):
-        """Update FCM token cache for a specific route"""
+        """Update FCM token cache for a specific route (table row + in-memory recipients)"""
+        if route_cache_rebuilder.running:
+            # Coalesced with other edits to the same route and rebuilt in the background
+            route_cache_rebuilder.mark_dirty(route_id)
+            return
         try:
-            # Get all stops for route with student/parent FCM tokens
-            query = """
-            SELECT 
-                rs.stop_id,
-                rs.stop_name,
-                rs.pickup_stop_order,
-                rs.drop_stop_order,
-                JSON_ARRAYAGG(
-                    JSON_OBJECT(
-                        'fcm_token', ft.fcm_token,
-                        'parent_id', ft.parent_id,
-                        'parent_name', p.name
-                    )
-                ) as fcm_data
-            FROM route_stops rs
-            LEFT JOIN students s ON (
-                (rs.stop_id = s.pickup_stop_id AND s.pickup_route_id = rs.route_id) OR
-                (rs.stop_id = s.drop_stop_id AND s.drop_route_id = rs.route_id)
-            )
-            LEFT JOIN fcm_tokens ft ON (s.student_id = ft.student_id OR s.parent_id = ft.parent_id OR s.s_parent_id = ft.parent_id)
-            LEFT JOIN parents p ON ft.parent_id = p.parent_id
-            WHERE rs.route_id = %s AND s.transport_status = 'ACTIVE' 
-            AND s.student_status IN ('CURRENT', 'ACTIVE') AND s.is_transport_user = True
-            AND ft.fcm_token IS NOT NULL
-            GROUP BY rs.stop_id, rs.stop_name, rs.pickup_stop_order, rs.drop_stop_order
-            """
-            
-            stops_data = execute_query(query, (route_id,), fetch_all=True)
-            
-            # Create FCM cache map
-            fcm_map = {}
-            for stop in stops_data:
-                fcm_map[stop['stop_id']] = {
-                    "stop_name": stop['stop_name'],
-                    "pickup_order": stop['pickup_stop_order'],
-                    "drop_order": stop['drop_stop_order'],
-                    "fcm_tokens": json.loads(stop['fcm_data']) if stop['fcm_data'] else []
-                }
-            
-            # Update cache table
-            cache_query = """
-            INSERT INTO route_stop_fcm_cache (route_id, stop_fcm_map) 
-            VALUES (%s, %s)
-            ON DUPLICATE KEY UPDATE 
-            stop_fcm_map = VALUES(stop_fcm_map),
-            updated_at = CURRENT_TIMESTAMP
-            """
-            
-            execute_query(cache_query, (route_id, json.dumps(fcm_map)))
-            logger.info(f"Updated FCM cache for route {route_id}")
-            
+            recipients = route_recipient_cache.rebuild(route_id)
+            logger.info(f"Updated FCM cache for route {route_id} (version {recipients.version})")
         except Exception as e:
+            route_recipient_cache.invalidate(route_id)
             logger.error(f"FCM cache update error for route {route_id}: {e}")
     
     def delete_cascades(self, table: str, record_id: str, record_data: Dict = None):
-        """Handle cascading deletes and check for blocking dependencies"""
+        """Handle cascading deletes and check for blocking dependencies (atomically)"""
         try:
-            if table == "admins":
-                # Check if this admin has sent notifications
-                # We'll automatically delete them as they are just logs
-                execute_query("DELETE FROM admin_parent_notifications WHERE sent_by_admin_id = %s", (record_id,))
-                logger.info(f"Cleaned up notifications for admin {record_id}")
+            # One transaction for checks + cleanup so a failure never leaves a half-applied cascade
+            with unit_of_work():
+                if table == "admins":
+                    # Check if this admin has sent notifications
+                    # We'll automatically delete them as they are just logs
+                    execute_query("DELETE FROM admin_parent_notifications WHERE sent_by_admin_id = %s", (record_id,))
+                    logger.info(f"Cleaned up notifications for admin {record_id}")
 
-            elif table == "parents":
-                # Check for students
-                students = execute_query("SELECT student_id, name FROM students WHERE parent_id = %s OR s_parent_id = %s", (record_id, record_id), fetch_all=True)
-                if students:
-                    student_names = ", ".join([s['name'] for s in students])
-                    raise ValueError(f"Cannot delete parent: Assigned to students ({student_names})")
+                elif table == "parents":
+                    # Check for students
+                    students = execute_query("SELECT student_id, name FROM students WHERE parent_id = %s OR s_parent_id = %s", (record_id, record_id), fetch_all=True)
+                    if students:
+                        student_names = ", ".join([s['name'] for s in students])
+                        raise ValueError(f"Cannot delete parent: Assigned to students ({student_names})")
                 
-                # Clean up FCM tokens
-                execute_query("DELETE FROM fcm_tokens WHERE parent_id = %s", (record_id,))
-                # Update routes where this parent's students were enrolled
-                if record_data:
-                    self.update_parent_cascades(record_id, record_data)
+                    # Clean up FCM tokens (and their topic memberships)
+                    if topic_subscriptions.enabled:
+                        tokens = execute_query("SELECT fcm_token FROM fcm_tokens WHERE parent_id = %s", (record_id,), fetch_all=True) or []
+                        after_commit(topic_subscriptions.request_sync, [t['fcm_token'] for t in tokens])
+                    execute_query("DELETE FROM fcm_tokens WHERE parent_id = %s", (record_id,))
+                    # Update routes where this parent's students were enrolled
+                    if record_data:
+                        self.update_parent_cascades(record_id, record_data)
                     
-            elif table == "students":
-                # Clean up FCM tokens and notifications
-                execute_query("DELETE FROM fcm_tokens WHERE student_id = %s", (record_id,))
-                execute_query("DELETE FROM admin_parent_notifications WHERE student_id = %s", (record_id,))
-                # Update route caches
-                if record_data:
-                    self.update_student_cascades(record_id, record_data)
+                elif table == "students":
+                    # Clean up FCM tokens and notifications; every token linked to the student changes topics
+                    if topic_subscriptions.enabled:
+                        after_commit(topic_subscriptions.request_sync, topic_subscriptions.tokens_for_students([record_id]))
+                    execute_query("DELETE FROM fcm_tokens WHERE student_id = %s", (record_id,))
+                    execute_query("DELETE FROM admin_parent_notifications WHERE student_id = %s", (record_id,))
+                    # Take the student off its routes' caches (the caller deletes the row afterwards)
+                    if record_data:
+                        for route_id in {record_data.get('pickup_route_id'), record_data.get('drop_route_id')}:
+                            self.remove_route_students(route_id, [record_id])
                     
-            elif table == "routes":
-                # Check for buses or route stops or students
-                buses = execute_query("SELECT registration_number FROM buses WHERE route_id = %s", (record_id,), fetch_all=True)
-                if buses:
-                    bus_nos = ", ".join([b['registration_number'] for b in buses])
-                    raise ValueError(f"Cannot delete route: Assigned to buses ({bus_nos})")
+                elif table == "routes":
+                    # Check for buses or route stops or students
+                    buses = execute_query("SELECT registration_number FROM buses WHERE route_id = %s", (record_id,), fetch_all=True)
+                    if buses:
+                        bus_nos = ", ".join([b['registration_number'] for b in buses])
+                        raise ValueError(f"Cannot delete route: Assigned to buses ({bus_nos})")
                 
-                students = execute_query("SELECT name FROM students WHERE pickup_route_id = %s OR drop_route_id = %s", (record_id, record_id), fetch_all=True)
-                if students:
-                    student_names = ", ".join([s['name'] for s in students])
-                    raise ValueError(f"Cannot delete route: Assigned to students ({student_names})")
+                    students = execute_query("SELECT name FROM students WHERE pickup_route_id = %s OR drop_route_id = %s", (record_id, record_id), fetch_all=True)
+                    if students:
+                        student_names = ", ".join([s['name'] for s in students])
+                        raise ValueError(f"Cannot delete route: Assigned to students ({student_names})")
 
-                # Clean up route stops (they are strictly part of the route)
-                execute_query("DELETE FROM route_stops WHERE route_id = %s", (record_id,))
+                    # Clean up route stops (they are strictly part of the route)
+                    execute_query("DELETE FROM route_stops WHERE route_id = %s", (record_id,))
                 
-                # Clean up route cache
-                execute_query("DELETE FROM route_stop_fcm_cache WHERE route_id = %s", (record_id,))
-                # Cancel active trips
-                execute_query(
-                    "UPDATE trips SET status = 'CANCELED' WHERE route_id = %s AND status IN ('NOT_STARTED', 'ONGOING')",
-                    (record_id,)
-                )
+                    # Clean up route cache
+                    execute_query("DELETE FROM route_stop_fcm_cache WHERE route_id = %s", (record_id,))
+                    route_recipient_cache.invalidate(record_id)
+                    # Cancel active trips
+                    execute_query(
+                        "UPDATE trips SET status = 'CANCELED' WHERE route_id = %s AND status IN ('NOT_STARTED', 'ONGOING')",
+                        (record_id,)
+                    )
                 
-            elif table == "route_stops":
-                # Check if students are assigned to this stop
-                students = execute_query("SELECT name FROM students WHERE pickup_stop_id = %s OR drop_stop_id = %s", (record_id, record_id), fetch_all=True)
-                if students:
-                    student_names = ", ".join([s['name'] for s in students])
-                    raise ValueError(f"Cannot delete stop: Assigned to students ({student_names})")
+                elif table == "route_stops":
+                    # Check if students are assigned to this stop
+                    students = execute_query("SELECT name FROM students WHERE pickup_stop_id = %s OR drop_stop_id = %s", (record_id, record_id), fetch_all=True)
+                    if students:
+                        student_names = ", ".join([s['name'] for s in students])
+                        raise ValueError(f"Cannot delete stop: Assigned to students ({student_names})")
 
-                # Update route cache
-                if record_data and record_data.get('route_id'):
-                    self.update_route_fcm_cache(record_data['route_id'])
+                    # Update route cache
+                    if record_data and record_data.get('route_id'):
+                        self.update_route_fcm_cache(record_data['route_id'])
             
-            elif table == "drivers":
-                # Check for buses or active trips
-                buses = execute_query("SELECT registration_number FROM buses WHERE driver_id = %s", (record_id,), fetch_all=True)
-                if buses:
-                    bus_nos = ", ".join([b['registration_number'] for b in buses])
-                    raise ValueError(f"Cannot delete driver: Assigned to buses ({bus_nos})")
+                elif table == "drivers":
+                    # Check for buses or active trips
+                    buses = execute_query("SELECT registration_number FROM buses WHERE driver_id = %s", (record_id,), fetch_all=True)
+                    if buses:
+                        bus_nos = ", ".join([b['registration_number'] for b in buses])
+                        raise ValueError(f"Cannot delete driver: Assigned to buses ({bus_nos})")
                 
-                # Check for active/ongoing trips
-                trips = execute_query("SELECT trip_id FROM trips WHERE driver_id = %s AND status IN ('NOT_STARTED', 'ONGOING')", (record_id,), fetch_all=True)
-                if trips:
-                    raise ValueError("Cannot delete driver: Has active or upcoming trips")
+                    # Check for active/ongoing trips
+                    trips = execute_query("SELECT trip_id FROM trips WHERE driver_id = %s AND status IN ('NOT_STARTED', 'ONGOING')", (record_id,), fetch_all=True)
+                    if trips:
+                        raise ValueError("Cannot delete driver: Has active or upcoming trips")
 
-                # Clean up live locations
-                execute_query("DELETE FROM driver_live_locations WHERE driver_id = %s", (record_id,))
-                execute_query("DELETE FROM driver_live_location WHERE driver_id = %s", (record_id,)) # Check both variants found in deps
+                    # Clean up live locations (including any position still waiting to be flushed)
+                    live_location_buffer.forget(record_id)
+                    execute_query("DELETE FROM driver_live_locations WHERE driver_id = %s", (record_id,))
 
-            elif table == "buses":
-                # Check for active/ongoing trips
-                trips = execute_query("SELECT trip_id FROM trips WHERE bus_id = %s AND status IN ('NOT_STARTED', 'ONGOING')", (record_id,), fetch_all=True)
-                if trips:
-                    raise ValueError("Cannot delete bus: Has active or upcoming trips")
+                elif table == "buses":
+                    # Check for active/ongoing trips
+                    trips = execute_query("SELECT trip_id FROM trips WHERE bus_id = %s AND status IN ('NOT_STARTED', 'ONGOING')", (record_id,), fetch_all=True)
+                    if trips:
+                        raise ValueError("Cannot delete bus: Has active or upcoming trips")
 
-            elif table == "classes":
-                # Clear class assignments for students in this class instead of blocking deletion
-                execute_query("UPDATE students SET class_id = NULL WHERE class_id = %s", (record_id,))
-                logger.info(f"Unassigned students from deleted class {record_id}")
+                elif table == "classes":
+                    # Clear class assignments for students in this class instead of blocking deletion
+                    execute_query("UPDATE students SET class_id = NULL WHERE class_id = %s", (record_id,))
+                    logger.info(f"Unassigned students from deleted class {record_id}")
             
             logger.info(f"Completed delete cascades for {table} {record_id}")
             return True
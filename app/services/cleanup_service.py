@@ -13,6 +13,7 @@ class CleanupService:
         Currently handles:
         - Trips logs (completed or canceled)
         - Notification logs
+        - Notification outbox rows (sent or failed)
         """
         try:
             cutoff_date = datetime.now() - timedelta(days=days)
@@ -33,9 +34,15 @@ class CleanupService:
             trip_result = execute_query(trip_query, (cutoff_str,))
             logger.info(f"Pruned {trip_result} old trip logs")
             
+            # 3. Prune delivered/failed push notifications from the outbox
+            outbox_query = "DELETE FROM notification_outbox WHERE created_at < %s AND status IN ('SENT', 'FAILED')"
+            outbox_result = execute_query(outbox_query, (cutoff_str,))
+            logger.info(f"Pruned {outbox_result} old outbox notifications")
+            
             return {
                 "notifications_pruned": notif_result,
                 "trips_pruned": trip_result,
+                "outbox_pruned": outbox_result,
                 "cutoff_date": cutoff_str
             }
             
@@ -0,0 +1,130 @@
+import math
+from bisect import bisect_right
+from typing import Dict, List, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; the kernels fall back to math
+    np = None
+
+EARTH_RADIUS_KM = 6371
+BACKEND = "numpy" if np is not None else "python"
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance between two points in kilometers"""
+    lat1_rad = math.radians(lat1)
+    lat2_rad = math.radians(lat2)
+    dlat = lat2_rad - lat1_rad
+    dlon = math.radians(lon2) - math.radians(lon1)
+
+    a = math.sin(dlat / 2) ** 2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+def _kernel(lat, lon, cos_lat, stop_lat, stop_lon, stop_cos):
+    """Haversine over arrays (radians): positions and stops are matched element-wise"""
+    a = np.sin((stop_lat - lat) / 2) ** 2 + cos_lat * stop_cos * np.sin((stop_lon - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+class StopCoordinates:
+    """A trip's stop coordinates prepared once (radians, cos(latitude)) for repeated distance checks.
+
+    With NumPy the coordinates are held as arrays and one call evaluates a position against any
+    number of stops; without it the same interface loops over math.
+    """
+
+    def __init__(self, stops: List[Dict]):
+        lat = [math.radians(s['latitude']) for s in stops]
+        lon = [math.radians(s['longitude']) for s in stops]
+        self.size = len(stops)
+        if np is not None:
+            self.lat = np.array(lat, dtype=float)
+            self.lon = np.array(lon, dtype=float)
+            self.cos_lat = np.cos(self.lat)
+        else:
+            self.lat, self.lon = lat, lon
+            self.cos_lat = [math.cos(l) for l in lat]
+
+    def distances_km(self, latitude: float, longitude: float, indices: Sequence[int] = None) -> List[float]:
+        """Distance from one position to the stops at indices (every stop by default)"""
+        if indices is None:
+            indices = range(self.size)
+        return fleet_distances_km([(self, latitude, longitude, list(indices))])[0]
+
+def fleet_distances_km(requests: Sequence[Tuple[StopCoordinates, float, float, List[int]]]) -> List[List[float]]:
+    """Distances for many positions, each against some stops of its own trip, in a single kernel pass.
+    requests are (coords, latitude, longitude, stop indices); returns one list of km per request."""
+    counts = [len(indices) for _, _, _, indices in requests]
+    if not sum(counts):
+        return [[] for _ in requests]
+
+    if np is None:
+        results = []
+        for coords, latitude, longitude, indices in requests:
+            lat, lon = math.radians(latitude), math.radians(longitude)
+            cos_lat = math.cos(lat)
+            distances = []
+            for i in indices:
+                a = math.sin((coords.lat[i] - lat) / 2) ** 2 + cos_lat * coords.cos_lat[i] * math.sin((coords.lon[i] - lon) / 2) ** 2
+                distances.append(2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0))))
+            results.append(distances)
+        return results
+
+    parts = [(coords, indices) for coords, _, _, indices in requests if indices]
+    stop_lat = np.concatenate([coords.lat[indices] for coords, indices in parts])
+    stop_lon = np.concatenate([coords.lon[indices] for coords, indices in parts])
+    stop_cos = np.concatenate([coords.cos_lat[indices] for coords, indices in parts])
+    lat = np.repeat(np.radians([r[1] for r in requests]), counts)
+    lon = np.repeat(np.radians([r[2] for r in requests]), counts)
+
+    distances = _kernel(lat, lon, np.cos(lat), stop_lat, stop_lon, stop_cos)
+    return [chunk.tolist() for chunk in np.split(distances, np.cumsum(counts)[:-1])]
+
+class RoutePath:
+    """A trip's ordered stops compiled into a polyline with cumulative distance offsets (km).
+
+    Fixes are projected onto a few segments around the trip's progress using a local equirectangular
+    frame per segment (accurate at stop spacing), which gives the distance along the route and the
+    distance off it; which stops lie behind a point is then a binary search on the offsets.
+    """
+
+    def __init__(self, stops: List[Dict]):
+        self.orders = [s['stop_order'] for s in stops]
+        self.lat = [math.radians(s['latitude']) for s in stops]
+        self.lon = [math.radians(s['longitude']) for s in stops]
+        self.offsets = [0.0] if stops else []
+        # Per segment: east/north scale (km per radian) and the segment vector in km
+        self.segments: List[Tuple[float, float, float, float]] = []
+        for a in range(len(stops) - 1):
+            kx = EARTH_RADIUS_KM * math.cos((self.lat[a] + self.lat[a + 1]) / 2)
+            ex = (self.lon[a + 1] - self.lon[a]) * kx
+            ey = (self.lat[a + 1] - self.lat[a]) * EARTH_RADIUS_KM
+            length = math.hypot(ex, ey)
+            self.segments.append((kx, ex, ey, length))
+            self.offsets.append(self.offsets[-1] + length)
+
+    def index_after(self, stop_order: int) -> int:
+        """Index of the first stop ordered after stop_order"""
+        return bisect_right(self.orders, stop_order)
+
+    def stops_within(self, along: float) -> int:
+        """Number of stops at or behind a distance along the route"""
+        return bisect_right(self.offsets, along)
+
+    def project(self, latitude: float, longitude: float, first: int, last: int) -> Tuple[float, float]:
+        """(distance along the route, distance off it) in km for a fix projected onto the path between
+        stop indices first..last; with first == last it is that stop's offset and the distance to it"""
+        lat, lon = math.radians(latitude), math.radians(longitude)
+        if first >= last:
+            kx = EARTH_RADIUS_KM * math.cos(self.lat[first])
+            return self.offsets[first], math.hypot((lon - self.lon[first]) * kx, (lat - self.lat[first]) * EARTH_RADIUS_KM)
+
+        best = None
+        for i in range(first, last):
+            kx, ex, ey, length = self.segments[i]
+            px = (lon - self.lon[i]) * kx
+            py = (lat - self.lat[i]) * EARTH_RADIUS_KM
+            t = min(max((px * ex + py * ey) / (length * length), 0.0), 1.0) if length else 0.0
+            off = math.hypot(px - t * ex, py - t * ey)
+            if best is None or off < best[1]:
+                best = (self.offsets[i] + t * length, off)
+        return best
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+FLEET = "fleet"
+
+def topic_for(trip_id: str = None, route_id: str = None, driver_id: str = None) -> str:
+    """Subscription topic for a trip, a route, a driver or (no filter) the whole fleet"""
+    if trip_id:
+        return f"trip:{trip_id}"
+    if route_id:
+        return f"route:{route_id}"
+    if driver_id:
+        return f"driver:{driver_id}"
+    return FLEET
+
+class Subscription:
+    """Bounded event queue for one connected client; a slow client loses its oldest events, never blocks publishers"""
+
+    def __init__(self, topic: str, max_queue: int):
+        self.topic = topic
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.dropped = 0
+
+    def push(self, event: Dict):
+        if self.queue.full():
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except asyncio.QueueEmpty:
+                pass
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout: float = None) -> Optional[Dict]:
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+class LiveEventBroker:
+    """In-process pub/sub for live bus positions and stop progression.
+
+    Events are published once by the tracking service and fanned out to every subscription on the
+    trip's, route's, driver's and fleet topics. The last position per trip/driver is kept so a new
+    subscriber gets the current state immediately instead of waiting for the next ping.
+    """
+
+    def __init__(self, max_queue: int = 100):
+        self.max_queue = max_queue
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+        self._positions: Dict[str, Dict] = {}
+        self.stats = {"published": 0, "delivered": 0}
+
+    def subscribe(self, topic: str) -> Subscription:
+        subscription = Subscription(topic, self.max_queue)
+        self._subscribers.setdefault(topic, set()).add(subscription)
+        for event in self.snapshot(topic):
+            subscription.push(event)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscribers = self._subscribers.get(subscription.topic)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                self._subscribers.pop(subscription.topic, None)
+
+    def snapshot(self, topic: str) -> List[Dict]:
+        """Latest known positions visible on a topic"""
+        if topic == FLEET:
+            return list(self._positions.values())
+        return [e for e in self._positions.values() if topic in self._topics(e)]
+
+    @staticmethod
+    def _topics(event: Dict) -> List[str]:
+        topics = [FLEET]
+        for key, prefix in (("trip_id", "trip"), ("route_id", "route"), ("driver_id", "driver")):
+            if event.get(key):
+                topics.append(f"{prefix}:{event[key]}")
+        return topics
+
+    def publish(self, event: Dict):
+        event.setdefault("at", datetime.now().isoformat())
+        self.stats["published"] += 1
+        if event.get("type") == "position":
+            key = event.get("trip_id") or f"driver:{event.get('driver_id')}"
+            self._positions[key] = event
+        for topic in self._topics(event):
+            for subscription in list(self._subscribers.get(topic, ())):
+                subscription.push(event)
+                self.stats["delivered"] += 1
+
+    def publish_position(self, latitude: float, longitude: float, trip_id: str = None, route_id: str = None,
+                         driver_id: str = None, current_stop_order: int = None):
+        self.publish({
+            "type": "position",
+            "trip_id": trip_id,
+            "route_id": route_id,
+            "driver_id": driver_id,
+            "latitude": latitude,
+            "longitude": longitude,
+            "current_stop_order": current_stop_order
+        })
+
+    def forget_trip(self, trip_id: str):
+        """Stop replaying a finished trip's last position to new subscribers"""
+        self._positions.pop(trip_id, None)
+
+    def get_stats(self):
+        return dict(self.stats, subscribers=sum(len(s) for s in self._subscribers.values()),
+                    topics=len(self._subscribers), known_positions=len(self._positions))
+
+live_event_broker = LiveEventBroker()
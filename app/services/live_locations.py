@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+from app.core.config import get_settings
+from app.core.database import execute_many, run_in_db_executor
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+UPSERT_LIVE_LOCATION = """
+INSERT INTO driver_live_locations (driver_id, latitude, longitude, updated_at)
+VALUES (%s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE
+    latitude = VALUES(latitude),
+    longitude = VALUES(longitude),
+    updated_at = VALUES(updated_at)
+"""
+
+class LiveLocationBuffer:
+    """Write-behind store for driver_live_locations.
+
+    Keeps the newest position per driver in memory, serves reads from it and flushes the drivers
+    that moved since the last flush as one multi-row upsert every LIVE_LOCATION_FLUSH_INTERVAL
+    seconds (and on shutdown).
+    """
+
+    def __init__(self, interval: float = None):
+        self.interval = interval if interval is not None else settings.LIVE_LOCATION_FLUSH_INTERVAL
+        self._lock = threading.Lock()
+        self._latest: Dict[str, Dict] = {}
+        self._dirty: Dict[str, Dict] = {}
+        self.stats = {"recorded": 0, "flushes": 0, "rows_written": 0, "flush_failures": 0}
+
+    def record(self, driver_id: str, latitude: float, longitude: float, updated_at: datetime = None):
+        location = {
+            "driver_id": driver_id,
+            "latitude": latitude,
+            "longitude": longitude,
+            "updated_at": updated_at or datetime.now()
+        }
+        with self._lock:
+            current = self._latest.get(driver_id)
+            if current and current["updated_at"] > location["updated_at"]:
+                return
+            self._latest[driver_id] = location
+            self._dirty[driver_id] = location
+            self.stats["recorded"] += 1
+
+    def get(self, driver_id: str) -> Optional[Dict]:
+        with self._lock:
+            location = self._latest.get(driver_id)
+            return dict(location) if location else None
+
+    def merge(self, rows: List[Dict]) -> List[Dict]:
+        """Overlay buffered positions on rows read from MySQL (newest wins, unflushed drivers appended)"""
+        with self._lock:
+            latest = dict(self._latest)
+        merged = []
+        for row in rows:
+            buffered = latest.pop(row['driver_id'], None)
+            if buffered and (not row.get('updated_at') or buffered['updated_at'] >= row['updated_at']):
+                merged.append(dict(row, **buffered))
+            else:
+                merged.append(row)
+        merged.extend(dict(location) for location in latest.values())
+        return merged
+
+    def forget(self, driver_id: str):
+        """Discard a driver's buffered position (the driver or its live location row is being deleted)"""
+        with self._lock:
+            self._latest.pop(driver_id, None)
+            self._dirty.pop(driver_id, None)
+
+    def flush(self) -> int:
+        """Write every dirty position in one batch; rows that could not be written are re-queued"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+
+        locations = list(dirty.values())
+        rows = [(l["driver_id"], l["latitude"], l["longitude"], l["updated_at"]) for l in locations]
+        try:
+            result = execute_many(UPSERT_LIVE_LOCATION, rows)
+        except Exception as e:
+            self.stats["flush_failures"] += 1
+            logger.error(f"Live location flush failed, keeping {len(rows)} position(s) buffered: {e}")
+            with self._lock:
+                for location in locations:
+                    self._dirty.setdefault(location["driver_id"], location)
+            return 0
+
+        # Per-row failures (e.g. a driver deleted meanwhile) are not retried
+        for error in result["errors"]:
+            logger.warning(f"Live location for driver {rows[error['index']][0]} not written: {error['error']}")
+        self.stats["flushes"] += 1
+        self.stats["rows_written"] += result["success"]
+        return result["success"]
+
+    async def run(self):
+        """Background flush loop started from the app lifespan"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await run_in_db_executor(self.flush)
+            except Exception as e:
+                logger.error(f"Live location flush loop error: {e}")
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, buffered_drivers=len(self._latest), pending_writes=len(self._dirty),
+                        flush_interval_seconds=self.interval)
+
+live_location_buffer = LiveLocationBuffer()
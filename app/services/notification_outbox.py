@@ -0,0 +1,175 @@
+import json
+import uuid
+import asyncio
+import logging
+from typing import Dict, List, Optional
+from app.core.config import get_settings
+from app.core.database import execute_query, execute_query_async, run_in_db_executor
+from app.notification_api.service import notification_service
+from app.services.trip_state import parse_json_field
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+class NotificationOutbox:
+    """Durable push queue backed by the notification_outbox table.
+
+    The request path only inserts a row (inside its own transaction, so a rolled back stop
+    progression never notifies anyone). Background workers claim due rows under a lease,
+    deliver them with batched multicast sends and retry failed tokens with exponential backoff.
+    Rows whose lease expired (worker crashed or was restarted mid-send) are claimed again.
+    """
+
+    def __init__(self):
+        self.worker_count = settings.OUTBOX_WORKERS
+        self.batch_size = settings.OUTBOX_BATCH_SIZE
+        self.poll_interval = settings.OUTBOX_POLL_INTERVAL
+        self.max_attempts = settings.OUTBOX_MAX_ATTEMPTS
+        self.retry_base = settings.OUTBOX_RETRY_BASE_SECONDS
+        self.lease_seconds = settings.OUTBOX_LEASE_SECONDS
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {"enqueued": 0, "claimed": 0, "sent": 0, "retried": 0, "failed": 0, "delivered_tokens": 0, "dead_tokens": 0}
+
+    def enqueue(self, title: str, body: str, data: Dict = None, message_type: str = "audio",
+                student_ids: List[str] = None, tokens: List[str] = None, route_id: str = None) -> str:
+        """Queue one notification for the parents of student_ids (or explicit tokens); joins the active unit of work.
+        route_id lets delivery resolve the students' tokens from that route's cached recipients."""
+        outbox_id = str(uuid.uuid4())
+        recipients = {"tokens": list(tokens)} if tokens is not None else {"student_ids": list(student_ids or [])}
+        if route_id and tokens is None:
+            recipients["route_id"] = route_id
+        execute_query("""
+        INSERT INTO notification_outbox (outbox_id, title, body, data, message_type, recipients)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        """, (outbox_id, title, body, json.dumps(data or {}), message_type, json.dumps(recipients)))
+        self.stats["enqueued"] += 1
+        return outbox_id
+
+    def wake(self):
+        """Let idle workers pick up freshly committed rows without waiting for the next poll"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def backoff(self, attempts: int) -> int:
+        return min(self.retry_base * (2 ** max(attempts - 1, 0)), 3600)
+
+    async def claim(self) -> List[Dict]:
+        """Lease up to batch_size due rows (pending, or sending with an expired lease)"""
+        lease_id = str(uuid.uuid4())
+        claimed = await execute_query_async("""
+        UPDATE notification_outbox
+        SET status = 'SENDING', locked_by = %s,
+            locked_until = CURRENT_TIMESTAMP + INTERVAL %s SECOND,
+            attempts = attempts + 1
+        WHERE (status = 'PENDING' AND next_attempt_at <= CURRENT_TIMESTAMP)
+           OR (status = 'SENDING' AND locked_until < CURRENT_TIMESTAMP)
+        ORDER BY next_attempt_at
+        LIMIT %s
+        """, (lease_id, self.lease_seconds, self.batch_size))
+        if not claimed:
+            return []
+        rows = await execute_query_async(
+            "SELECT * FROM notification_outbox WHERE locked_by = %s AND status = 'SENDING'",
+            (lease_id,), fetch_all=True
+        ) or []
+        self.stats["claimed"] += len(rows)
+        return rows
+
+    async def deliver(self, row: Dict) -> str:
+        """Send one claimed row and record the outcome; returns the new status"""
+        from app.services.bus_tracking import bus_tracking_service
+
+        recipients = parse_json_field(row.get('recipients'), {})
+        tokens = recipients.get('tokens')
+        if tokens is None:
+            tokens = await run_in_db_executor(bus_tracking_service.get_parent_tokens_for_students,
+                                              recipients.get('student_ids', []), route_id=recipients.get('route_id'))
+        tokens = list(dict.fromkeys(t for t in tokens if t))
+
+        delivered = row.get('delivered_count') or 0
+        failed_tokens, last_error = [], None
+        if tokens:
+            results = await notification_service.send_multicast(
+                tokens, row['title'], row['body'],
+                data=parse_json_field(row.get('data'), {}), message_type=row.get('message_type') or "audio"
+            )
+            delivered += sum(1 for r in results if r.get("success"))
+            failed = [r for r in results if not r.get("success")]
+            # Dead tokens are pruned by the send path; retrying them can never succeed
+            failed_tokens = [r["token"] for r in failed if not r.get("dead")]
+            last_error = failed[0].get("error") if failed else None
+            self.stats["delivered_tokens"] += len(results) - len(failed)
+            self.stats["dead_tokens"] += len(failed) - len(failed_tokens)
+
+        attempts = row.get('attempts') or 1
+        if failed_tokens and attempts < self.max_attempts:
+            await execute_query_async("""
+            UPDATE notification_outbox
+            SET status = 'PENDING', recipients = %s, delivered_count = %s, failed_count = %s, last_error = %s,
+                next_attempt_at = CURRENT_TIMESTAMP + INTERVAL %s SECOND, locked_by = NULL, locked_until = NULL
+            WHERE outbox_id = %s AND locked_by = %s
+            """, (json.dumps({"tokens": failed_tokens}), delivered, len(failed_tokens), (last_error or "")[:500] or None,
+                  self.backoff(attempts), row['outbox_id'], row['locked_by']))
+            self.stats["retried"] += 1
+            return "PENDING"
+
+        status = "FAILED" if failed_tokens and not delivered else "SENT"
+        await execute_query_async("""
+        UPDATE notification_outbox
+        SET status = %s, delivered_count = %s, failed_count = %s, last_error = %s,
+            sent_at = CURRENT_TIMESTAMP, locked_by = NULL, locked_until = NULL
+        WHERE outbox_id = %s AND locked_by = %s
+        """, (status, delivered, len(failed_tokens), (last_error or "")[:500] or None, row['outbox_id'], row['locked_by']))
+        self.stats["sent" if status == "SENT" else "failed"] += 1
+        return status
+
+    async def run_once(self) -> int:
+        rows = await self.claim()
+        outcomes = await asyncio.gather(*[self.deliver(row) for row in rows], return_exceptions=True)
+        for row, outcome in zip(rows, outcomes):
+            if isinstance(outcome, Exception):
+                # Lease expiry hands the row to the next claim
+                logger.error(f"Outbox delivery of {row.get('outbox_id')} failed: {outcome}")
+        return len(rows)
+
+    async def _worker(self, index: int):
+        while True:
+            self._wakeup.clear()
+            try:
+                if await self.run_once():
+                    continue
+            except Exception as e:
+                logger.error(f"Outbox worker {index} error: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.worker_count)]
+        logger.info(f"Notification outbox started with {self.worker_count} worker(s)")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        self._wakeup = None
+
+    async def get_stats(self):
+        counts = await execute_query_async(
+            "SELECT status, COUNT(*) AS count FROM notification_outbox GROUP BY status", fetch_all=True
+        ) or []
+        return {
+            "queue": {row['status']: row['count'] for row in counts},
+            "workers": len(self._tasks),
+            **self.stats
+        }
+
+notification_outbox = NotificationOutbox()
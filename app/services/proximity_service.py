@@ -3,10 +3,14 @@ import asyncio
 import os
 import httpx
 import uuid
-from typing import Dict, Any, List, Set, Optional
-from geopy.distance import distance as geodesic
+from typing import Dict, Any, List, Optional
 from app.notification_api.service import notification_service
 from app.core.database import execute_query
+from app.services.trip_state import trip_state_cache
+from app.services.trip_lanes import trip_lanes
+from app.services.proximity_store import create_trip_store
+from app.services.live_events import live_event_broker
+from app.services.topic_subscriptions import topic_subscriptions, route_audience
 
 logger = logging.getLogger(__name__)
 
@@ -15,10 +19,10 @@ APPROACHING_RADIUS = 1000  # 1km - notification to be ready
 ARRIVED_RADIUS = 50        # 50m - actual arrival/location notification
 
 class ProximityTrackingService:
-    def __init__(self):
-        # In-memory storage for active tracking state
-        self.active_trips: Dict[str, Dict[str, Any]] = {}
-        self.notified_stops: Dict[str, Set[str]] = {}
+    def __init__(self, store=None):
+        # Active tracking state (route stops + notified stops per trip), bounded and optionally shared
+        self.store = store or create_trip_store()
+        self._cleanups = set()
         self.main_backend_url = os.getenv("MAIN_BACKEND_URL", "http://localhost:8080/api/v1")
 
     async def fetch_tokens_by_route(self, route_id: str, trip_type: Any = None) -> List[str]:
@@ -80,20 +84,20 @@ class ProximityTrackingService:
             current_order = trip_info['current_stop_order']
             route_id = trip_info['route_id']
             
-            # Initialize trip data in cache if missing (or if order changed significantly)
-            if trip_id not in self.active_trips:
+            # Initialize trip data in the store if missing (or expired/evicted)
+            trip_data = await self.store.get(trip_id)
+            if trip_data is None:
                 stops = await self.fetch_route_stops(route_id, trip_info['trip_type'])
-                self.active_trips[trip_id] = {
+                trip_data = {
                     "trip_id": trip_id,
                     "route_id": route_id,
                     "stops": stops
                 }
-                self.notified_stops[trip_id] = set()
+                await self.store.put(trip_id, trip_data)
                 logger.info(f"✅ Initialized proximity tracking for {trip_id}")
             
-            trip_data = self.active_trips[trip_id]
             stops = trip_data.get("stops", [])
-            current_notified = self.notified_stops[trip_id]
+            current_notified = await self.store.notified(trip_id)
             current_loc = (lat, lng)
             
             results = []
@@ -167,20 +171,27 @@ class ProximityTrackingService:
         except Exception as e:
             logger.error(f"Failed to update trip status or initialize stop_logs: {e}")
 
+        # Fresh progression state for the GPS hot path
+        await trip_state_cache.warm(trip_id)
+        live_event_broker.publish({"type": "trip_status", "trip_id": trip_id, "route_id": route_id, "status": "ONGOING"})
+
         # Declare trip_type fallback in case trip_info fetch failed
         if 'trip_type' not in locals():
             trip_type = "PICKUP"
 
+        title = "🚌 Trip Started"
+        body = "The bus has started its trip from the school."
+        notice = {"trip_id": trip_id, "route_id": route_id, "status": "STARTED", "type": "proximity_alert"}
+        if topic_subscriptions.fanout:
+            # One topic send; FCM fans out to the route's subscribed devices
+            audience = route_audience(route_id, trip_type)
+            result = await notification_service.send_to_topic(title, body, message_type="audio", data=notice, **audience)
+            return {"success": True, "recipients": None, "topic": audience.get("topic") or audience.get("condition"),
+                    "sent": result.get("success", False)}
+
         tokens = await self.fetch_tokens_by_route(route_id, trip_type)
         if tokens:
-            title = "🚌 Trip Started"
-            body = "The bus has started its trip from the school."
-            await notification_service.broadcast_to_tokens(
-                tokens, title, body, 
-                {"trip_id": trip_id, "route_id": route_id, "status": "STARTED", "type": "proximity_alert"},
-                message_type="audio"
-            )
-            pass
+            await notification_service.broadcast_to_tokens(tokens, title, body, notice, message_type="audio")
         return {"success": True, "recipients": len(tokens)}
 
     async def complete_trip(self, trip_id: str, route_id: str):
@@ -208,12 +219,37 @@ class ProximityTrackingService:
         recipients_count = 0
         
         # Cleanup in-memory state
-        if trip_id in self.active_trips:
-            del self.active_trips[trip_id]
-        if trip_id in self.notified_stops:
-            del self.notified_stops[trip_id]
+        trip_state_cache.drop(trip_id)
+        trip_lanes.drop(trip_id)
+        live_event_broker.forget_trip(trip_id)
+        live_event_broker.publish({"type": "trip_status", "trip_id": trip_id, "route_id": route_id, "status": "COMPLETED"})
+        await self.forget_trip(trip_id)
             
         return {"success": True, "recipients": recipients_count, "trip_type": trip_type}
 
+    async def forget_trip(self, trip_id: str):
+        """Drop a finished (or cancelled/deleted) trip's tracking state"""
+        try:
+            await self.store.drop(trip_id)
+        except Exception as e:
+            # Expires on its own after TRIP_STORE_TTL
+            logger.warning(f"Could not drop proximity state of {trip_id}: {e}")
+
+    def end_tracking(self, trip_ids: List[str], status: str = "CANCELED"):
+        """Forget trips that ended outside complete_trip (status edit, route/bus cancellation) in every
+        in-process structure; synchronous so it can run as an after_commit callback"""
+        for trip_id in trip_ids:
+            trip_state_cache.drop(trip_id)
+            trip_lanes.drop(trip_id)
+            live_event_broker.forget_trip(trip_id)
+            live_event_broker.publish({"type": "trip_status", "trip_id": trip_id, "status": status})
+            try:
+                task = asyncio.get_running_loop().create_task(self.forget_trip(trip_id))
+            except RuntimeError:
+                # No event loop (called from a worker thread): the store entry expires after TRIP_STORE_TTL
+                continue
+            self._cleanups.add(task)
+            task.add_done_callback(self._cleanups.discard)
+
 # Global instance
 proximity_service = ProximityTrackingService()
@@ -0,0 +1,170 @@
+import json
+import time
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+from app.core.config import get_settings
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+class MemoryTripStore:
+    """Per-process proximity trip state with sliding TTL and LRU eviction.
+
+    Every trip holds its record (route, stops) plus the stop ids already notified. An entry expires
+    TRIP_STORE_TTL seconds after it was last used, so trips that are cancelled or never completed do
+    not stay around; beyond max_trips entries or max_bytes of (JSON-sized) state the least recently
+    used trips are evicted first.
+    """
+    name = "memory"
+
+    def __init__(self, ttl: float = None, max_trips: int = None, max_bytes: int = None):
+        self.ttl = ttl if ttl is not None else settings.TRIP_STORE_TTL
+        self.max_trips = max_trips if max_trips is not None else settings.TRIP_STORE_MAX_TRIPS
+        self.max_bytes = max_bytes if max_bytes is not None else settings.TRIP_STORE_MAX_BYTES
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0}
+
+    @staticmethod
+    def _size(entry: Dict) -> int:
+        return len(json.dumps(entry["record"], default=str)) + sum(len(s) + 4 for s in entry["notified"])
+
+    def _resize(self, entry: Dict):
+        size = self._size(entry)
+        self.bytes += size - entry["bytes"]
+        entry["bytes"] = size
+
+    def _remove(self, trip_id: str) -> Optional[Dict]:
+        entry = self._entries.pop(trip_id, None)
+        if entry is not None:
+            self.bytes -= entry["bytes"]
+        return entry
+
+    def _expire(self):
+        # Sliding TTL: least recently used first, so expired entries are all at the front
+        now = time.monotonic()
+        while self._entries:
+            trip_id, entry = next(iter(self._entries.items()))
+            if entry["expires_at"] > now:
+                break
+            self._remove(trip_id)
+            self.stats["expired"] += 1
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_trips or self.bytes > self.max_bytes):
+            trip_id, _ = next(iter(self._entries.items()))
+            self._remove(trip_id)
+            self.stats["evicted"] += 1
+            logger.info(f"🧹 Evicted proximity state of {trip_id}")
+
+    def _touch(self, trip_id: str) -> Optional[Dict]:
+        self._expire()
+        entry = self._entries.get(trip_id)
+        if entry is not None:
+            entry["expires_at"] = time.monotonic() + self.ttl
+            self._entries.move_to_end(trip_id)
+        return entry
+
+    async def get(self, trip_id: str) -> Optional[Dict]:
+        entry = self._touch(trip_id)
+        self.stats["hits" if entry is not None else "misses"] += 1
+        return entry["record"] if entry is not None else None
+
+    async def put(self, trip_id: str, record: Dict):
+        self._expire()
+        entry = self._remove(trip_id) or {"notified": set()}
+        entry.update(record=record, bytes=0, expires_at=time.monotonic() + self.ttl)
+        self._entries[trip_id] = entry
+        self._resize(entry)
+        self._evict()
+
+    async def mark_notified(self, trip_id: str, stop_id: str) -> bool:
+        """Record a notified stop; False when it already was (or the trip is not tracked)"""
+        entry = self._touch(trip_id)
+        if entry is None or stop_id in entry["notified"]:
+            return False
+        entry["notified"].add(stop_id)
+        self._resize(entry)
+        self._evict()
+        return True
+
+    async def notified(self, trip_id: str) -> Set[str]:
+        entry = self._touch(trip_id)
+        return set(entry["notified"]) if entry is not None else set()
+
+    async def drop(self, trip_id: str):
+        self._remove(trip_id)
+
+    async def close(self):
+        pass
+
+    def get_stats(self):
+        self._expire()
+        return dict(self.stats, backend=self.name, trips=len(self._entries), bytes=self.bytes,
+                    max_trips=self.max_trips, max_bytes=self.max_bytes, ttl=self.ttl)
+
+class RedisTripStore:
+    """Proximity trip state in a Redis-compatible server, shared by every worker and kept across restarts.
+
+    client is an asyncio Redis client (redis.asyncio). Each trip is a JSON string plus a set of notified
+    stop ids, both with a sliding TRIP_STORE_TTL; memory limits and LRU eviction are left to the server's
+    maxmemory / maxmemory-policy (use volatile-lru).
+    """
+    name = "redis"
+
+    def __init__(self, client, ttl: float = None, prefix: str = "proximity"):
+        self.client = client
+        self.ttl = int(ttl if ttl is not None else settings.TRIP_STORE_TTL)
+        self.prefix = prefix
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "bytes_written": 0}
+
+    def _keys(self, trip_id: str):
+        return f"{self.prefix}:trip:{trip_id}", f"{self.prefix}:notified:{trip_id}"
+
+    async def get(self, trip_id: str) -> Optional[Dict]:
+        key, notified_key = self._keys(trip_id)
+        value = await self.client.getex(key, ex=self.ttl)
+        if value is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        await self.client.expire(notified_key, self.ttl)
+        return json.loads(value)
+
+    async def put(self, trip_id: str, record: Dict):
+        value = json.dumps(record, default=str)
+        await self.client.set(self._keys(trip_id)[0], value, ex=self.ttl)
+        self.stats["writes"] += 1
+        self.stats["bytes_written"] += len(value)
+
+    async def mark_notified(self, trip_id: str, stop_id: str) -> bool:
+        """Record a notified stop; False when it already was (atomic across workers)"""
+        notified_key = self._keys(trip_id)[1]
+        added = await self.client.sadd(notified_key, stop_id)
+        await self.client.expire(notified_key, self.ttl)
+        return bool(added)
+
+    async def notified(self, trip_id: str) -> Set[str]:
+        return {s.decode() if isinstance(s, bytes) else s for s in await self.client.smembers(self._keys(trip_id)[1])}
+
+    async def drop(self, trip_id: str):
+        await self.client.delete(*self._keys(trip_id))
+
+    async def close(self):
+        # aclose() on redis-py 5+, close() before that
+        await (getattr(self.client, "aclose", None) or self.client.close)()
+
+    def get_stats(self):
+        return dict(self.stats, backend=self.name, ttl=self.ttl)
+
+def create_trip_store():
+    """Store selected by TRIP_STORE_BACKEND ("memory", or "redis" to share state across workers)"""
+    if settings.TRIP_STORE_BACKEND == "redis":
+        try:
+            import redis.asyncio as redis
+        except ImportError:  # redis is optional; without it each worker keeps its own state
+            logger.error("TRIP_STORE_BACKEND=redis but the redis package is not installed; using the memory store")
+            return MemoryTripStore()
+        return RedisTripStore(redis.from_url(settings.TRIP_STORE_URL))
+    return MemoryTripStore()
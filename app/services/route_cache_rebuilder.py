@@ -0,0 +1,136 @@
+import time
+import asyncio
+import logging
+import threading
+from typing import Dict, List, Set
+from app.core.config import get_settings
+from app.core.database import execute_query, no_unit_of_work, run_in_db_executor
+from app.services.route_recipients import route_recipient_cache
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+class RouteCacheRebuilder:
+    """Coalesces route FCM cache rebuilds requested by edits.
+
+    Edits only mark a route dirty. A route is rebuilt once it has been quiet for
+    ROUTE_CACHE_REBUILD_DELAY seconds, or at the latest ROUTE_CACHE_REBUILD_MAX_DELAY seconds after
+    it was first marked, so a bulk import or class promotion rebuilds each route once instead of
+    once per student. Staleness is measured from the first mark to the finished rebuild.
+
+    Most edits are applied to the cached maps as deltas and never get here; every
+    ROUTE_CACHE_RECONCILE_INTERVAL seconds all cached routes are queued for a reconciling rebuild
+    that counts any drift the deltas left behind.
+    """
+
+    def __init__(self, delay: float = None, max_delay: float = None, reconcile_interval: float = None):
+        self.delay = delay if delay is not None else settings.ROUTE_CACHE_REBUILD_DELAY
+        self.max_delay = max_delay if max_delay is not None else settings.ROUTE_CACHE_REBUILD_MAX_DELAY
+        self.reconcile_interval = reconcile_interval if reconcile_interval is not None else settings.ROUTE_CACHE_RECONCILE_INTERVAL
+        self.running = False
+        self._lock = threading.Lock()
+        self._dirty: Dict[str, Dict[str, float]] = {}  # route_id -> {"first": ts, "last": ts}
+        self._reconciling: Set[str] = set()  # Dirty only because of the periodic reconciliation
+        self.stats = {"marked": 0, "coalesced": 0, "rebuilds": 0, "failures": 0, "reconciles": 0,
+                      "staleness_total_ms": 0.0, "staleness_max_ms": 0.0}
+
+    def mark_dirty(self, route_id: str):
+        if not route_id:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self.stats["marked"] += 1
+            self._reconciling.discard(route_id)
+            entry = self._dirty.get(route_id)
+            if entry is None:
+                self._dirty[route_id] = {"first": now, "last": now}
+            else:
+                entry["last"] = now
+                self.stats["coalesced"] += 1
+
+    def schedule_reconcile(self) -> int:
+        """Queue every cached route for a reconciling rebuild; routes already dirty keep their marks"""
+        rows = execute_query("SELECT route_id FROM route_stop_fcm_cache", fetch_all=True) or []
+        now = time.monotonic()
+        with self._lock:
+            for row in rows:
+                if row['route_id'] not in self._dirty:
+                    self._dirty[row['route_id']] = {"first": now, "last": now}
+                    self._reconciling.add(row['route_id'])
+        return len(rows)
+
+    def due(self, now: float = None) -> List[str]:
+        """Dirty routes that are quiet long enough (or waited max_delay) and should be rebuilt now"""
+        now = now if now is not None else time.monotonic()
+        with self._lock:
+            return [route_id for route_id, entry in self._dirty.items()
+                    if now - entry["last"] >= self.delay or now - entry["first"] >= self.max_delay]
+
+    def rebuild(self, route_id: str) -> bool:
+        """Rebuild one dirty route; a mark that arrives during the rebuild keeps the route dirty"""
+        with self._lock:
+            entry = self._dirty.get(route_id)
+        if entry is None:
+            return False
+        marked_at = entry["last"]
+        reconcile = route_id in self._reconciling
+        try:
+            route_recipient_cache.rebuild(route_id, reconcile=reconcile)
+        except Exception as e:
+            self.stats["failures"] += 1
+            logger.error(f"Route FCM cache rebuild failed for {route_id}, will retry: {e}")
+            return False
+
+        staleness_ms = (time.monotonic() - entry["first"]) * 1000
+        with self._lock:
+            if self._dirty.get(route_id) is entry and entry["last"] == marked_at:
+                del self._dirty[route_id]
+                self._reconciling.discard(route_id)
+            if reconcile:
+                # Nobody waited on these; keep them out of the edit staleness numbers
+                self.stats["reconciles"] += 1
+                return True
+            self.stats["rebuilds"] += 1
+            self.stats["staleness_total_ms"] += staleness_ms
+            self.stats["staleness_max_ms"] = max(self.stats["staleness_max_ms"], staleness_ms)
+        return True
+
+    def flush(self) -> int:
+        """Rebuild every dirty route now (shutdown, or callers that need the cache current)"""
+        with self._lock:
+            routes = list(self._dirty)
+        return sum(1 for route_id in routes if self.rebuild(route_id))
+
+    async def run(self):
+        """Background rebuild loop started from the app lifespan"""
+        self.running = True
+        # Rebuilds are independent of the requests that marked the routes
+        with no_unit_of_work():
+            last_reconcile = time.monotonic()
+            try:
+                while True:
+                    await asyncio.sleep(min(self.delay, 1.0))
+                    if self.reconcile_interval and time.monotonic() - last_reconcile >= self.reconcile_interval:
+                        last_reconcile = time.monotonic()
+                        try:
+                            await run_in_db_executor(self.schedule_reconcile)
+                        except Exception as e:
+                            logger.error(f"Route FCM cache reconcile scheduling error: {e}")
+                    for route_id in self.due():
+                        try:
+                            await run_in_db_executor(self.rebuild, route_id)
+                        except Exception as e:
+                            logger.error(f"Route FCM cache rebuild loop error: {e}")
+            finally:
+                self.running = False
+
+    def get_stats(self):
+        now = time.monotonic()
+        with self._lock:
+            oldest = max((now - e["first"] for e in self._dirty.values()), default=0.0)
+            rebuilds = self.stats["rebuilds"]
+            return dict(self.stats, pending_routes=len(self._dirty), oldest_pending_ms=round(oldest * 1000, 1),
+                        staleness_avg_ms=round(self.stats["staleness_total_ms"] / rebuilds, 1) if rebuilds else 0.0,
+                        running=self.running)
+
+route_cache_rebuilder = RouteCacheRebuilder()
@@ -0,0 +1,276 @@
+import json
+import time
+import logging
+import threading
+from typing import Callable, Dict, Iterable, List, Optional
+from app.core.config import get_settings
+from app.core.database import execute_query, unit_of_work
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# One row per (stop, student, token); students without a token still get a row
+ROUTE_RECIPIENTS_QUERY = """
+SELECT
+    rs.stop_id, rs.stop_name, rs.location, rs.pickup_stop_order, rs.drop_stop_order,
+    s.student_id, s.name AS student_name,
+    (rs.stop_id = s.pickup_stop_id AND s.pickup_route_id = rs.route_id) AS is_pickup,
+    (rs.stop_id = s.drop_stop_id AND s.drop_route_id = rs.route_id) AS is_drop,
+    ft.fcm_token, ft.parent_id, p.name AS parent_name
+FROM route_stops rs
+JOIN students s ON (
+    (rs.stop_id = s.pickup_stop_id AND s.pickup_route_id = rs.route_id) OR
+    (rs.stop_id = s.drop_stop_id AND s.drop_route_id = rs.route_id)
+)
+LEFT JOIN fcm_tokens ft ON (s.student_id = ft.student_id OR s.parent_id = ft.parent_id OR s.s_parent_id = ft.parent_id)
+LEFT JOIN parents p ON ft.parent_id = p.parent_id
+WHERE rs.route_id = %s AND s.transport_status = 'ACTIVE'
+AND s.student_status IN ('CURRENT', 'ACTIVE') AND s.is_transport_user = 1
+"""
+
+def build_stop_fcm_map(rows: List[Dict]) -> Dict:
+    """stop_id -> {stop_name, location, pickup_order, drop_order, fcm_tokens, students}
+
+    fcm_tokens keeps the original {fcm_token, parent_id, parent_name} list; students lists each
+    student at the stop with the legs (pickup/drop) it boards there and every token that reaches it.
+    """
+    fcm_map = {}
+    for row in rows:
+        stop = fcm_map.get(row['stop_id'])
+        if stop is None:
+            stop = fcm_map[row['stop_id']] = {
+                "stop_name": row['stop_name'],
+                "location": row['location'],
+                "pickup_order": row['pickup_stop_order'],
+                "drop_order": row['drop_stop_order'],
+                "fcm_tokens": [],
+                "students": []
+            }
+        student = next((st for st in stop["students"] if st["student_id"] == row['student_id']), None)
+        if student is None:
+            student = {"student_id": row['student_id'], "name": row['student_name'],
+                       "pickup": bool(row['is_pickup']), "drop": bool(row['is_drop']), "tokens": []}
+            stop["students"].append(student)
+        token = row['fcm_token']
+        if token:
+            if token not in student["tokens"]:
+                student["tokens"].append(token)
+            if all(t['fcm_token'] != token for t in stop["fcm_tokens"]):
+                stop["fcm_tokens"].append({"fcm_token": token, "parent_id": row['parent_id'], "parent_name": row['parent_name']})
+    return fcm_map
+
+def _reindex_stop_tokens(fcm_map: Dict, token_info: Dict[str, Dict]):
+    """Rebuild each stop's fcm_tokens from its students and drop stops nobody boards at any more"""
+    for stop_id in list(fcm_map):
+        stop = fcm_map[stop_id]
+        if not stop["students"]:
+            del fcm_map[stop_id]
+            continue
+        tokens = []
+        for student in stop["students"]:
+            tokens.extend(t for t in student["tokens"] if t not in tokens)
+        stop["fcm_tokens"] = [token_info.get(t) or {"fcm_token": t, "parent_id": None, "parent_name": None} for t in tokens]
+
+def replace_students_in_map(fcm_map: Dict, student_ids: Iterable[str], rows: List[Dict]):
+    """Delta: re-place students on the route from their fresh rows (moved, (de)activated or new/removed tokens)"""
+    student_ids = set(student_ids)
+    token_info = {t["fcm_token"]: t for stop in fcm_map.values() for t in stop["fcm_tokens"]}
+    for stop in fcm_map.values():
+        stop["students"] = [st for st in stop["students"] if st["student_id"] not in student_ids]
+    for stop_id, fresh in build_stop_fcm_map(rows).items():
+        token_info.update((t["fcm_token"], t) for t in fresh["fcm_tokens"])
+        stop = fcm_map.setdefault(stop_id, dict(fresh, students=[]))
+        stop["students"].extend(fresh["students"])
+    _reindex_stop_tokens(fcm_map, token_info)
+
+def remove_tokens_from_map(fcm_map: Dict, tokens: Iterable[str]):
+    """Delta: forget tokens that were deleted (logout, dead token prune)"""
+    tokens = set(tokens)
+    for stop in fcm_map.values():
+        stop["fcm_tokens"] = [t for t in stop["fcm_tokens"] if t["fcm_token"] not in tokens]
+        for student in stop["students"]:
+            student["tokens"] = [t for t in student["tokens"] if t not in tokens]
+
+def canonical_map(fcm_map: Dict) -> Dict:
+    """Order-independent form of a map, to compare a delta-maintained map with a full rebuild"""
+    return {
+        stop_id: {
+            "stop_name": stop["stop_name"], "location": stop.get("location"),
+            "pickup_order": stop["pickup_order"], "drop_order": stop["drop_order"],
+            "fcm_tokens": sorted(t["fcm_token"] for t in stop["fcm_tokens"]),
+            "students": sorted((st["student_id"], st["pickup"], st["drop"], tuple(sorted(st["tokens"])))
+                               for st in stop.get("students", []))
+        }
+        for stop_id, stop in fcm_map.items()
+    }
+
+def _parse_map(value) -> Optional[Dict]:
+    return json.loads(value) if isinstance(value, str) else value
+
+def is_current_format(fcm_map: Dict) -> bool:
+    """Maps written before per-student recipients were cached cannot answer location lookups"""
+    return isinstance(fcm_map, dict) and all(isinstance(stop, dict) and "students" in stop for stop in fcm_map.values())
+
+class RouteRecipients:
+    """Read-only recipient indexes for one route, built from its stop_fcm_map"""
+
+    def __init__(self, route_id: str, fcm_map: Dict, version: Optional[int]):
+        self.route_id = route_id
+        self.fcm_map = fcm_map
+        self.version = version
+        self.checked_at = time.monotonic()
+        self.by_location: Dict[tuple, List[Dict]] = {}
+        self.tokens_by_student: Dict[str, List[str]] = {}
+        for stop in fcm_map.values():
+            location_key = stop.get("location") or stop["stop_name"]
+            for student in stop["students"]:
+                entry = {"student_id": student["student_id"], "name": student["name"], "stop_name": stop["stop_name"]}
+                for leg in ("pickup", "drop"):
+                    if student[leg]:
+                        self.by_location.setdefault((leg.upper(), location_key), []).append(entry)
+                tokens = self.tokens_by_student.setdefault(student["student_id"], [])
+                tokens.extend(t for t in student["tokens"] if t not in tokens)
+
+    def students_at(self, location_name: str, trip_type: str) -> List[Dict]:
+        """Same students get_students_for_location would select for this route"""
+        return list(self.by_location.get((trip_type, location_name), []))
+
+    def covers(self, student_ids: List[str]) -> bool:
+        return all(sid in self.tokens_by_student for sid in student_ids)
+
+    def tokens_for(self, student_ids: List[str]) -> List[str]:
+        tokens = {}
+        for sid in student_ids:
+            for token in self.tokens_by_student.get(sid, ()):
+                tokens[token] = True
+        return list(tokens)
+
+class RouteRecipientCache:
+    """In-memory copy of route_stop_fcm_cache used to resolve notification recipients.
+
+    Routes are loaded on first use (from the cache table, or rebuilt when the row is missing or in
+    the old format) and kept per process. Every write bumps the row's version; a cached route is
+    re-validated against it at most every ROUTE_RECIPIENT_CHECK_INTERVAL seconds, so a change made
+    by another worker is picked up without re-reading the map on every arrival. Callers fall back
+    to their SQL query when get() returns None.
+
+    Student and token edits are applied as deltas to the stored map (only the edited students are
+    queried); the full rebuild is kept for stop/route changes and periodic reconciliation.
+    """
+
+    def __init__(self, check_interval: float = None):
+        self.check_interval = check_interval if check_interval is not None else settings.ROUTE_RECIPIENT_CHECK_INTERVAL
+        self._lock = threading.Lock()
+        self._routes: Dict[str, RouteRecipients] = {}
+        self.stats = {"hits": 0, "loads": 0, "rebuilds": 0, "revalidations": 0, "unavailable": 0,
+                      "deltas": 0, "reconciled": 0, "drift": 0}
+
+    def _store(self, recipients: RouteRecipients) -> RouteRecipients:
+        with self._lock:
+            self._routes[recipients.route_id] = recipients
+        return recipients
+
+    def rebuild(self, route_id: str, reconcile: bool = False) -> RouteRecipients:
+        """Recompute a route's map from students/fcm_tokens, persist it and bump its version.
+        With reconcile, the stored map is compared first and a difference is counted as drift."""
+        previous = None
+        if reconcile:
+            row = execute_query("SELECT stop_fcm_map FROM route_stop_fcm_cache WHERE route_id = %s", (route_id,), fetch_one=True)
+            previous = _parse_map(row.get('stop_fcm_map')) if row else None
+        rows = execute_query(ROUTE_RECIPIENTS_QUERY, (route_id,), fetch_all=True) or []
+        fcm_map = build_stop_fcm_map(rows)
+        if reconcile:
+            self.stats["reconciled"] += 1
+            if is_current_format(previous) and canonical_map(previous) != canonical_map(fcm_map):
+                self.stats["drift"] += 1
+                logger.warning(f"Route FCM cache for {route_id} had drifted from the database; rebuilt")
+        execute_query("""
+        INSERT INTO route_stop_fcm_cache (route_id, stop_fcm_map, version)
+        VALUES (%s, %s, 1)
+        ON DUPLICATE KEY UPDATE
+        stop_fcm_map = VALUES(stop_fcm_map),
+        version = version + 1,
+        updated_at = CURRENT_TIMESTAMP
+        """, (route_id, json.dumps(fcm_map)))
+        row = execute_query("SELECT version FROM route_stop_fcm_cache WHERE route_id = %s", (route_id,), fetch_one=True)
+        self.stats["rebuilds"] += 1
+        return self._store(RouteRecipients(route_id, fcm_map, row.get('version') if row else None))
+
+    def _load(self, route_id: str) -> RouteRecipients:
+        row = execute_query("SELECT stop_fcm_map, version FROM route_stop_fcm_cache WHERE route_id = %s", (route_id,), fetch_one=True)
+        fcm_map = _parse_map(row.get('stop_fcm_map')) if row else None
+        if not is_current_format(fcm_map):
+            return self.rebuild(route_id)
+        self.stats["loads"] += 1
+        return self._store(RouteRecipients(route_id, fcm_map, row.get('version')))
+
+    def get(self, route_id: str) -> Optional[RouteRecipients]:
+        """Recipients for a route, or None when the cache cannot be used (callers then query directly)"""
+        if not route_id:
+            return None
+        with self._lock:
+            cached = self._routes.get(route_id)
+        try:
+            if cached is not None:
+                if time.monotonic() - cached.checked_at < self.check_interval:
+                    self.stats["hits"] += 1
+                    return cached
+                row = execute_query("SELECT version FROM route_stop_fcm_cache WHERE route_id = %s", (route_id,), fetch_one=True)
+                if row and cached.version is not None and row.get('version') == cached.version:
+                    self.stats["revalidations"] += 1
+                    cached.checked_at = time.monotonic()
+                    return cached
+            return self._load(route_id)
+        except Exception as e:
+            self.stats["unavailable"] += 1
+            logger.warning(f"Route recipient cache unavailable for route {route_id}: {e}")
+            return None
+
+    def apply_delta(self, route_id: str, mutate: Callable[[Dict], None]) -> Optional[bool]:
+        """Change a route's stored map in place under a row lock and bump its version.
+        Returns False when the route has no cached map (nothing to maintain) and None when the
+        map is in the old format and needs a full rebuild instead."""
+        with unit_of_work():
+            row = execute_query(
+                "SELECT stop_fcm_map, version FROM route_stop_fcm_cache WHERE route_id = %s FOR UPDATE",
+                (route_id,), fetch_one=True
+            )
+            if not row:
+                self.invalidate(route_id)
+                return False
+            fcm_map = _parse_map(row.get('stop_fcm_map'))
+            if not is_current_format(fcm_map):
+                return None
+            mutate(fcm_map)
+            execute_query(
+                "UPDATE route_stop_fcm_cache SET stop_fcm_map = %s, version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE route_id = %s",
+                (json.dumps(fcm_map), route_id)
+            )
+        version = row.get('version')
+        self.stats["deltas"] += 1
+        self._store(RouteRecipients(route_id, fcm_map, version + 1 if isinstance(version, int) else None))
+        return True
+
+    def refresh_students(self, route_id: str, student_ids: List[str]) -> Optional[bool]:
+        """Delta for students whose stop, status or tokens changed (only their rows are queried)"""
+        rows = execute_query(
+            ROUTE_RECIPIENTS_QUERY + f" AND s.student_id IN ({', '.join(['%s'] * len(student_ids))})",
+            (route_id, *student_ids), fetch_all=True
+        ) or []
+        return self.apply_delta(route_id, lambda fcm_map: replace_students_in_map(fcm_map, student_ids, rows))
+
+    def remove_students(self, route_id: str, student_ids: List[str]) -> Optional[bool]:
+        return self.apply_delta(route_id, lambda fcm_map: replace_students_in_map(fcm_map, student_ids, []))
+
+    def remove_tokens(self, route_id: str, tokens: List[str]) -> Optional[bool]:
+        return self.apply_delta(route_id, lambda fcm_map: remove_tokens_from_map(fcm_map, tokens))
+
+    def invalidate(self, route_id: str):
+        with self._lock:
+            self._routes.pop(route_id, None)
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, routes=len(self._routes), check_interval_seconds=self.check_interval)
+
+route_recipient_cache = RouteRecipientCache()
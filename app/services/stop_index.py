@@ -0,0 +1,163 @@
+import math
+import time
+import asyncio
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+from app.core.config import get_settings
+from app.core.database import execute_query, no_unit_of_work, run_in_db_executor
+from app.services.geo import haversine_km
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+KM_PER_DEGREE = 111.32
+
+STOPS_QUERY = """
+SELECT stop_id, route_id, stop_name, location, latitude, longitude, pickup_stop_order, drop_stop_order, geofence_radius_m
+FROM route_stops
+WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+"""
+
+def geofence_radius_m(stop: Dict) -> int:
+    """A stop's own geofence radius, or GEOFENCE_RADIUS when it has none"""
+    return stop.get('geofence_radius_m') or settings.GEOFENCE_RADIUS
+
+class StopSpatialIndex:
+    """In-memory grid index over the stops of every route.
+
+    Stops are bucketed into cells of cell_deg degrees, so "which stops are within R of this point" only
+    measures the stops in the few cells around the point instead of scanning route_stops. The whole
+    index is loaded at startup (or on first use) and again after STOP_INDEX_TTL to pick up edits made
+    by other workers; stop create/update/delete in this process re-read just the affected route.
+    """
+
+    def __init__(self, cell_deg: float = None, ttl: float = None):
+        self.cell_deg = cell_deg if cell_deg is not None else settings.STOP_INDEX_CELL_DEG
+        self.ttl = ttl if ttl is not None else settings.STOP_INDEX_TTL
+        self._lock = threading.Lock()
+        self._stops: Dict[str, Dict] = {}
+        self._cells: Dict[Tuple[int, int], List[Dict]] = {}
+        self._max_radius_m = settings.GEOFENCE_RADIUS
+        self.loaded_at: Optional[float] = None
+        self._refresh: Optional[asyncio.Task] = None
+        self._route_reloads = set()
+        self.stats = {"loads": 0, "route_reloads": 0, "queries": 0, "candidates": 0}
+
+    def _cell(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return math.floor(latitude / self.cell_deg), math.floor(longitude / self.cell_deg)
+
+    @staticmethod
+    def _entry(row: Dict) -> Dict:
+        stop = dict(row)
+        stop['latitude'] = float(row['latitude'])
+        stop['longitude'] = float(row['longitude'])
+        return stop
+
+    def _swap(self, stops: Dict[str, Dict]):
+        """Rebuild the cells for a new stop set and publish both at once (readers never see a partial index)"""
+        cells: Dict[Tuple[int, int], List[Dict]] = {}
+        for stop in stops.values():
+            cells.setdefault(self._cell(stop['latitude'], stop['longitude']), []).append(stop)
+        max_radius = max((geofence_radius_m(s) for s in stops.values()), default=settings.GEOFENCE_RADIUS)
+        self._stops, self._cells, self._max_radius_m = stops, cells, max_radius
+
+    @property
+    def stale(self) -> bool:
+        return self.loaded_at is None or time.monotonic() - self.loaded_at >= self.ttl
+
+    def load(self):
+        rows = execute_query(STOPS_QUERY, fetch_all=True) or []
+        stops = {row['stop_id']: self._entry(row) for row in rows}
+        with self._lock:
+            self._swap(stops)
+            self.loaded_at = time.monotonic()
+        self.stats["loads"] += 1
+        logger.info(f"🗺️ Stop index loaded: {len(stops)} stops in {len(self._cells)} cells")
+
+    def ensure_loaded(self):
+        if self.stale:
+            self.load()
+
+    async def _reload(self):
+        try:
+            await run_in_db_executor(self.load)
+        except Exception as e:
+            logger.warning(f"Stop index reload failed: {e}")
+
+    def refresh_in_background(self):
+        """Reload a stale index on the DB executor without holding up the caller (one reload at a time)"""
+        if self._refresh is not None and not self._refresh.done():
+            return
+        # The reload must not join the caller's unit of work
+        with no_unit_of_work():
+            self._refresh = asyncio.get_running_loop().create_task(self._reload())
+
+    def reload_route(self, route_id: str):
+        """Re-read one route's stops after an edit (a no-op until the index is first used)"""
+        if self.loaded_at is None:
+            return
+        try:
+            rows = execute_query(STOPS_QUERY + " AND route_id = %s", (route_id,), fetch_all=True) or []
+            with self._lock:
+                stops = {sid: s for sid, s in self._stops.items() if s['route_id'] != route_id}
+                stops.update((row['stop_id'], self._entry(row)) for row in rows)
+                self._swap(stops)
+            self.stats["route_reloads"] += 1
+        except Exception as e:
+            # Picked up by the next full load instead
+            self.loaded_at = None
+            logger.warning(f"Could not refresh stop index for route {route_id}: {e}")
+
+    def reload_route_in_background(self, route_id: str):
+        """reload_route on the DB executor, outside any unit of work (schedule it with after_commit)"""
+        if self.loaded_at is None:
+            return
+        with no_unit_of_work():
+            task = asyncio.get_running_loop().create_task(run_in_db_executor(self.reload_route, route_id))
+        self._route_reloads.add(task)
+        task.add_done_callback(self._route_reloads.discard)
+
+    def remove_route(self, route_id: str):
+        with self._lock:
+            self._swap({sid: s for sid, s in self._stops.items() if s['route_id'] != route_id})
+
+    def _candidates(self, latitude: float, longitude: float, radius_m: float) -> List[Dict]:
+        radius_km = radius_m / 1000
+        dlat = radius_km / KM_PER_DEGREE
+        dlon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+        lat_lo, lon_lo = self._cell(latitude - dlat, longitude - dlon)
+        lat_hi, lon_hi = self._cell(latitude + dlat, longitude + dlon)
+        cells = self._cells
+        found = []
+        for i in range(lat_lo, lat_hi + 1):
+            for j in range(lon_lo, lon_hi + 1):
+                found.extend(cells.get((i, j), ()))
+        self.stats["queries"] += 1
+        self.stats["candidates"] += len(found)
+        return found
+
+    def nearby(self, latitude: float, longitude: float, radius_m: float = None,
+               route_id: str = None) -> List[Tuple[Dict, float]]:
+        """Stops within radius_m (GEOFENCE_RADIUS by default) of a point, nearest first, with their distance in m"""
+        radius_m = radius_m if radius_m is not None else settings.GEOFENCE_RADIUS
+        results = []
+        for stop in self._candidates(latitude, longitude, radius_m):
+            if route_id and stop['route_id'] != route_id:
+                continue
+            distance_m = haversine_km(latitude, longitude, stop['latitude'], stop['longitude']) * 1000
+            if distance_m <= radius_m:
+                results.append((stop, distance_m))
+        results.sort(key=lambda r: r[1])
+        return results
+
+    def containing(self, latitude: float, longitude: float) -> List[Tuple[Dict, float]]:
+        """Stops whose own geofence contains a point, nearest first"""
+        return [(stop, d) for stop, d in self.nearby(latitude, longitude, self._max_radius_m) if d <= geofence_radius_m(stop)]
+
+    def get_stats(self):
+        return dict(self.stats, stops=len(self._stops), cells=len(self._cells), cell_deg=self.cell_deg,
+                    max_radius_m=self._max_radius_m,
+                    age_seconds=round(time.monotonic() - self.loaded_at, 1) if self.loaded_at is not None else None)
+
+stop_index = StopSpatialIndex()
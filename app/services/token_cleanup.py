@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import threading
+from typing import Dict, List, Optional, Set
+from app.core.config import get_settings
+from app.core.database import execute_query, no_unit_of_work, run_in_db_executor, unit_of_work
+from app.services.cascade_updates import cascade_service
+from app.services.topic_subscriptions import topic_subscriptions
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+class DeadTokenPruner:
+    """Bulk removal of FCM tokens that FCM reported as unregistered or invalid.
+
+    Send paths only report dead tokens; they are collected for DEAD_TOKEN_PRUNE_DELAY seconds and then
+    removed in one transaction: deleted from fcm_tokens, cleared from drivers.fcm_token, and
+    dropped from the route_stop_fcm_cache of every route whose students they belonged to.
+    """
+
+    def __init__(self, delay: float = None):
+        self.delay = delay if delay is not None else settings.DEAD_TOKEN_PRUNE_DELAY
+        self._lock = threading.Lock()
+        self._pending: Set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"reported": 0, "prunes": 0, "prune_failures": 0, "parent_tokens_removed": 0,
+                      "driver_tokens_cleared": 0, "routes_refreshed": 0}
+
+    def report(self, tokens: List[str]):
+        with self._lock:
+            fresh = set(t for t in tokens if t) - self._pending
+            self._pending |= fresh
+            self.stats["reported"] += len(fresh)
+        if fresh:
+            self._schedule()
+
+    def _schedule(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # No loop (sync caller); picked up by the next scheduled or explicit prune
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self._prune_later())
+
+    async def _prune_later(self):
+        await asyncio.sleep(self.delay)
+        # Runs after the reporting request finished; must not join its unit of work
+        with no_unit_of_work():
+            try:
+                await run_in_db_executor(self.prune)
+            except Exception as e:
+                logger.error(f"Dead token prune error: {e}")
+
+    def prune(self) -> Dict:
+        """Remove every pending dead token now; tokens are re-queued if the transaction fails"""
+        with self._lock:
+            tokens, self._pending = list(self._pending), set()
+        if not tokens:
+            return {"tokens": 0, "parent_tokens_removed": 0, "driver_tokens_cleared": 0, "routes_refreshed": 0}
+
+        placeholders = ", ".join(["%s"] * len(tokens))
+        params = tuple(tokens)
+        try:
+            with unit_of_work():
+                route_ids = cascade_service.routes_for_tokens(tokens)
+
+                removed = execute_query(f"DELETE FROM fcm_tokens WHERE fcm_token IN ({placeholders})", params)
+                cleared = execute_query(f"UPDATE drivers SET fcm_token = NULL WHERE fcm_token IN ({placeholders})", params)
+
+                for route_id in route_ids:
+                    cascade_service.remove_route_tokens(route_id, tokens)
+        except Exception as e:
+            self.stats["prune_failures"] += 1
+            logger.error(f"Dead token prune failed, keeping {len(tokens)} token(s) queued: {e}")
+            with self._lock:
+                self._pending.update(tokens)
+            raise
+
+        # Drop the pruned tokens' recorded topic memberships
+        topic_subscriptions.request_sync(tokens=tokens)
+        self.stats["prunes"] += 1
+        self.stats["parent_tokens_removed"] += removed or 0
+        self.stats["driver_tokens_cleared"] += cleared or 0
+        self.stats["routes_refreshed"] += len(route_ids)
+        logger.info(f"🧹 Pruned {len(tokens)} dead FCM token(s): {removed} parent, {cleared} driver, {len(route_ids)} route cache(s) updated")
+        return {"tokens": len(tokens), "parent_tokens_removed": removed or 0,
+                "driver_tokens_cleared": cleared or 0, "routes_refreshed": len(route_ids)}
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, pending=len(self._pending), prune_delay_seconds=self.delay)
+
+dead_token_pruner = DeadTokenPruner()
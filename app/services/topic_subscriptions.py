@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set
+from app.core.config import get_settings
+from app.core.database import execute_many, execute_query, execute_query_async, no_unit_of_work, run_in_db_executor
+from app.notification_api.service import notification_service, DEAD_TOPIC_REASONS
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+SYNC_CHUNK = 500  # Tokens resolved per SQL round trip
+
+def route_topic(route_id: str, trip_type: str) -> str:
+    return f"route_{route_id}_{str(trip_type).lower()}"
+
+def stop_topic(stop_id: str) -> str:
+    return f"stop_{stop_id}"
+
+def class_topic(class_id: str) -> str:
+    return f"class_{class_id}"
+
+def topic_condition(topics: List[str]) -> str:
+    """FCM condition reaching each device once even if it is in several of the topics (max 5)"""
+    return " || ".join(f"'{topic}' in topics" for topic in topics)
+
+def route_audience(route_id: str, trip_type=None) -> Dict[str, str]:
+    """send_to_topic kwargs for everyone riding a route, optionally only its PICKUP or DROP leg"""
+    if hasattr(trip_type, 'value'):
+        trip_type = trip_type.value
+    if trip_type in ("PICKUP", "DROP"):
+        return {"topic": route_topic(route_id, trip_type)}
+    return {"condition": topic_condition([route_topic(route_id, "PICKUP"), route_topic(route_id, "DROP")])}
+
+def _placeholders(values) -> str:
+    return ", ".join(["%s"] * len(values))
+
+class TopicSubscriptionManager:
+    """Keeps FCM topic membership in line with the database.
+
+    Every registered token is subscribed to the class topic of each student it belongs to and, for
+    students actively using transport, to their route (per PICKUP/DROP leg) and stop topics. Membership
+    is recorded in fcm_topic_subscriptions so a sync only sends the difference to FCM. Token and student
+    changes only mark tokens/students dirty; the background loop syncs them every
+    FCM_TOPIC_SYNC_INTERVAL seconds and resync() reconciles every known token.
+    """
+
+    def __init__(self):
+        self.enabled = settings.FCM_TOPIC_SYNC
+        self.fanout = settings.FCM_TOPIC_FANOUT
+        self.interval = settings.FCM_TOPIC_SYNC_INTERVAL
+        self._lock = threading.Lock()
+        self._tokens: Set[str] = set()
+        self._students: Set[str] = set()
+        self.stats = {"syncs": 0, "tokens_synced": 0, "subscribed": 0, "unsubscribed": 0, "failed": 0}
+
+    def request_sync(self, tokens: Iterable[str] = None, student_ids: Iterable[str] = None):
+        """Mark tokens (or every token of some students) for the next sync; safe from any thread"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._tokens.update(t for t in tokens or () if t)
+            self._students.update(s for s in student_ids or () if s)
+
+    def tokens_for_students(self, student_ids: List[str]) -> List[str]:
+        if not student_ids:
+            return []
+        rows = execute_query(f"""
+        SELECT DISTINCT ft.fcm_token
+        FROM fcm_tokens ft
+        JOIN students s ON (ft.student_id = s.student_id OR ft.parent_id = s.parent_id OR ft.parent_id = s.s_parent_id)
+        WHERE s.student_id IN ({_placeholders(student_ids)})
+        """, tuple(student_ids), fetch_all=True) or []
+        return [r['fcm_token'] for r in rows if r['fcm_token']]
+
+    def desired_topics(self, tokens: List[str]) -> Dict[str, Set[str]]:
+        """Topics each token should be in according to the database"""
+        rows = execute_query(f"""
+        SELECT ft.fcm_token, s.class_id, s.pickup_route_id, s.drop_route_id, s.pickup_stop_id, s.drop_stop_id,
+               (s.transport_status = 'ACTIVE' AND s.student_status IN ('CURRENT', 'ACTIVE') AND s.is_transport_user = 1) AS rides_bus
+        FROM fcm_tokens ft
+        JOIN students s ON (ft.student_id = s.student_id OR ft.parent_id = s.parent_id OR ft.parent_id = s.s_parent_id)
+        WHERE ft.fcm_token IN ({_placeholders(tokens)})
+        """, tuple(tokens), fetch_all=True) or []
+
+        desired = {token: set() for token in tokens}
+        for row in rows:
+            topics = desired.setdefault(row['fcm_token'], set())
+            if row['class_id']:
+                topics.add(class_topic(row['class_id']))
+            if row['rides_bus']:
+                topics.add(route_topic(row['pickup_route_id'], "PICKUP"))
+                topics.add(route_topic(row['drop_route_id'], "DROP"))
+                topics.add(stop_topic(row['pickup_stop_id']))
+                topics.add(stop_topic(row['drop_stop_id']))
+        return desired
+
+    def current_topics(self, tokens: List[str]) -> Dict[str, Set[str]]:
+        rows = execute_query(
+            f"SELECT fcm_token, topic FROM fcm_topic_subscriptions WHERE fcm_token IN ({_placeholders(tokens)})",
+            tuple(tokens), fetch_all=True
+        ) or []
+        current = defaultdict(set)
+        for row in rows:
+            current[row['fcm_token']].add(row['topic'])
+        return current
+
+    async def _apply(self, topic: str, tokens: List[str], subscribe: bool) -> List[str]:
+        """Tokens whose membership change FCM confirmed (unknown tokens count as removed)"""
+        outcome = await notification_service.update_topic_membership(tokens, topic, subscribe=subscribe)
+        done = [t for t in tokens if outcome.get(t) is None or (not subscribe and outcome[t] in DEAD_TOPIC_REASONS)]
+        self.stats["failed"] += len(tokens) - len(done)
+        return done
+
+    async def sync_tokens(self, tokens: Iterable[str]) -> Dict:
+        """Subscribe/unsubscribe tokens so FCM matches desired_topics"""
+        tokens = list(dict.fromkeys(t for t in tokens if t))
+        subscribed = unsubscribed = 0
+        for start in range(0, len(tokens), SYNC_CHUNK):
+            chunk = tokens[start:start + SYNC_CHUNK]
+            desired = await run_in_db_executor(self.desired_topics, chunk)
+            current = await run_in_db_executor(self.current_topics, chunk)
+
+            adds, removes = defaultdict(list), defaultdict(list)
+            for token in chunk:
+                for topic in desired.get(token, set()) - current.get(token, set()):
+                    adds[topic].append(token)
+                for topic in current.get(token, set()) - desired.get(token, set()):
+                    removes[topic].append(token)
+
+            added = await asyncio.gather(*[self._apply(topic, toks, True) for topic, toks in adds.items()])
+            removed = await asyncio.gather(*[self._apply(topic, toks, False) for topic, toks in removes.items()])
+            add_rows = [(token, topic) for topic, done in zip(adds, added) for token in done]
+            remove_rows = [(token, topic) for topic, done in zip(removes, removed) for token in done]
+
+            if add_rows:
+                await run_in_db_executor(execute_many,
+                                         "INSERT IGNORE INTO fcm_topic_subscriptions (fcm_token, topic) VALUES (%s, %s)", add_rows)
+            if remove_rows:
+                await run_in_db_executor(execute_many,
+                                         "DELETE FROM fcm_topic_subscriptions WHERE fcm_token = %s AND topic = %s", remove_rows)
+            subscribed += len(add_rows)
+            unsubscribed += len(remove_rows)
+
+        self.stats["syncs"] += 1
+        self.stats["tokens_synced"] += len(tokens)
+        self.stats["subscribed"] += subscribed
+        self.stats["unsubscribed"] += unsubscribed
+        return {"tokens": len(tokens), "subscribed": subscribed, "unsubscribed": unsubscribed}
+
+    async def flush(self) -> Optional[Dict]:
+        """Sync everything marked by request_sync; unsynced work is re-queued on failure"""
+        with self._lock:
+            tokens, self._tokens = self._tokens, set()
+            students, self._students = self._students, set()
+        if not tokens and not students:
+            return None
+        try:
+            tokens |= set(await run_in_db_executor(self.tokens_for_students, list(students)))
+            return await self.sync_tokens(tokens)
+        except Exception:
+            with self._lock:
+                self._tokens |= tokens
+                self._students |= students
+            raise
+
+    async def resync(self) -> Dict:
+        """Reconcile every registered token and every token we still hold memberships for"""
+        rows = await execute_query_async("""
+        SELECT fcm_token FROM fcm_tokens WHERE fcm_token IS NOT NULL
+        UNION
+        SELECT fcm_token FROM fcm_topic_subscriptions
+        """, fetch_all=True) or []
+        return await self.sync_tokens(r['fcm_token'] for r in rows)
+
+    async def run(self):
+        """Background sync loop started from the app lifespan"""
+        # Marks come from request handlers; syncing must not join their unit of work
+        with no_unit_of_work():
+            while True:
+                await asyncio.sleep(self.interval)
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logger.error(f"Topic subscription sync error: {e}")
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, enabled=self.enabled, fanout=self.fanout,
+                        pending_tokens=len(self._tokens), pending_students=len(self._students))
+
+topic_subscriptions = TopicSubscriptionManager()
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from app.core.database import no_unit_of_work
+from app.services.bus_tracking import bus_tracking_service
+from app.services.trip_state import TripState, trip_state_cache
+
+logger = logging.getLogger(__name__)
+
+def fix_time(timestamp: Optional[datetime]) -> Optional[float]:
+    """Epoch seconds of a client GPS timestamp (None when the client did not send one)"""
+    return timestamp.timestamp() if timestamp else None
+
+class TripLane:
+    """Queued fixes + worker for one trip"""
+
+    def __init__(self):
+        self.pending: List[Dict] = []
+        self.worker: Optional[asyncio.Task] = None
+        self.last_fix_at: Optional[float] = None
+
+    def newest_fix_at(self) -> Optional[float]:
+        for entry in reversed(self.pending):
+            if entry["fix_at"] is not None:
+                return entry["fix_at"]
+        return self.last_fix_at
+
+class TripLaneManager:
+    """Per-trip processing lanes for GPS fixes.
+
+    Fixes for one trip are processed strictly one after another. A burst of single pings that arrives
+    while the lane is busy is coalesced down to its most recent position, while batched fixes are all
+    replayed so no stop is missed. Fixes whose client timestamp is not newer than the last accepted one
+    are dropped, so a late or replayed ping can never move stop progression backwards or repeat an
+    arrival notification. Only the last fix of each drained run updates driver_live_locations.
+    """
+
+    def __init__(self):
+        self._lanes: Dict[str, TripLane] = {}
+        self.stats = {"submitted": 0, "processed": 0, "coalesced": 0, "stale": 0, "fleet_screened": 0, "fleet_in_transit": 0}
+
+    def _lane(self, trip_id: str) -> TripLane:
+        lane = self._lanes.get(trip_id)
+        if lane is None:
+            lane = self._lanes[trip_id] = TripLane()
+        return lane
+
+    def _ensure_worker(self, trip_id: str, lane: TripLane):
+        loop = asyncio.get_running_loop()
+        if lane.worker is None or lane.worker.done() or lane.worker.get_loop() is not loop:
+            lane.worker = loop.create_task(self._run(trip_id, lane))
+
+    @staticmethod
+    def _stale_result(trip_id: str) -> Dict:
+        return {"success": True, "ignored": True, "message": "Stale location ignored", "trip_id": trip_id}
+
+    def submit(self, trip_id: str, latitude: float, longitude: float, timestamp: Optional[datetime] = None) -> asyncio.Future:
+        """Queue a single fix; the future resolves with the progression result of the fix that absorbed it"""
+        future = asyncio.get_running_loop().create_future()
+        self.stats["submitted"] += 1
+        lane = self._lane(trip_id)
+
+        fix_at = fix_time(timestamp)
+        newest = lane.newest_fix_at()
+        if fix_at is not None and newest is not None and fix_at <= newest:
+            self.stats["stale"] += 1
+            future.set_result(self._stale_result(trip_id))
+            return future
+
+        entry = {"latitude": latitude, "longitude": longitude, "fix_at": fix_at, "coalesce": True, "waiters": [future]}
+        if lane.pending and lane.pending[-1]["coalesce"]:
+            self.stats["coalesced"] += 1
+            entry["waiters"] = lane.pending.pop()["waiters"] + entry["waiters"]
+        lane.pending.append(entry)
+        self._ensure_worker(trip_id, lane)
+        return future
+
+    async def submit_batch(self, trip_id: str, fixes: List[Tuple[float, float, datetime]]) -> Dict:
+        """Queue timestamped fixes (e.g. buffered while offline) and wait until every one has been replayed"""
+        self.stats["submitted"] += len(fixes)
+        lane = self._lane(trip_id)
+
+        newest = lane.newest_fix_at()
+        entries = []
+        # Sorted on epoch seconds: a batch may mix naive and timezone-aware timestamps, which do not compare
+        timed = sorted(((fix_time(timestamp), latitude, longitude) for latitude, longitude, timestamp in fixes), key=lambda f: f[0])
+        for fix_at, latitude, longitude in timed:
+            if newest is not None and fix_at <= newest:
+                continue
+            newest = fix_at
+            entries.append({"latitude": latitude, "longitude": longitude, "fix_at": fix_at, "coalesce": False, "waiters": []})
+        stale = len(fixes) - len(entries)
+        self.stats["stale"] += stale
+        if not entries:
+            return {"accepted": 0, "stale": stale, "results": []}
+
+        done = asyncio.get_running_loop().create_future()
+        entries[-1]["waiters"].append(done)
+        lane.pending.extend(entries)
+        self._ensure_worker(trip_id, lane)
+        await done
+        return {"accepted": len(entries), "stale": stale, "results": [e["result"] for e in entries]}
+
+    async def submit_fleet(self, positions: List[Tuple[str, float, float, Optional[datetime]]]) -> Dict:
+        """Latest position of many trips in one pass: the stop distances of every trip are screened with a
+        single kernel call, and only fixes that can change progression (or that meet a busy lane) are queued;
+        the rest are applied as in-transit positions without a transaction."""
+        self.stats["fleet_screened"] += len(positions)
+        results: List[Optional[Dict]] = [None] * len(positions)
+        fresh = []
+        for i, (trip_id, latitude, longitude, timestamp) in enumerate(positions):
+            fix_at = fix_time(timestamp)
+            newest = self._lane(trip_id).newest_fix_at()
+            if fix_at is not None and newest is not None and fix_at <= newest:
+                self.stats["stale"] += 1
+                results[i] = self._stale_result(trip_id)
+            else:
+                fresh.append((i, trip_id, latitude, longitude, timestamp, fix_at))
+
+        states = await asyncio.gather(*(trip_state_cache.get(f[1]) for f in fresh), return_exceptions=True)
+        quiet = [(f, s) for f, s in zip(fresh, states) if isinstance(s, TripState)]
+        needs_progress = bus_tracking_service.screen_fleet([(s, f[2], f[3]) for f, s in quiet]) if quiet else []
+        quiet = {f[0]: s for (f, s), progress in zip(quiet, needs_progress) if not progress}
+
+        queued, in_transit = [], 0
+        for i, trip_id, latitude, longitude, timestamp, fix_at in fresh:
+            lane = self._lane(trip_id)
+            busy = lane.pending or (lane.worker is not None and not lane.worker.done())
+            if i in quiet and not busy and not trip_state_cache.lock(trip_id).locked():
+                self.stats["submitted"] += 1
+                self.stats["fleet_in_transit"] += 1
+                in_transit += 1
+                results[i] = bus_tracking_service.record_transit(quiet[i], latitude, longitude)
+                if fix_at is not None:
+                    lane.last_fix_at = fix_at
+            else:
+                queued.append((i, self.submit(trip_id, latitude, longitude, timestamp)))
+        for i, future in queued:
+            results[i] = await future
+        return {"in_transit": in_transit, "queued": len(queued), "results": results}
+
+    async def _run(self, trip_id: str, lane: TripLane):
+        # Lane workers outlive the request that started them and must not join its unit of work
+        with no_unit_of_work():
+            while lane.pending:
+                run, lane.pending = lane.pending, []
+                for i, entry in enumerate(run):
+                    try:
+                        result = await bus_tracking_service.update_bus_location(
+                            trip_id, entry["latitude"], entry["longitude"],
+                            update_live_location=(i == len(run) - 1)
+                        )
+                    except Exception as e:
+                        logger.error(f"Trip lane {trip_id} failed: {e}")
+                        result = {"success": False, "error": str(e)}
+                    if entry["fix_at"] is not None:
+                        lane.last_fix_at = entry["fix_at"]
+                    entry["result"] = result
+                    self.stats["processed"] += 1
+                    for waiter in entry["waiters"]:
+                        if not waiter.done():
+                            waiter.set_result(result)
+
+    def drop(self, trip_id: str):
+        """Forget a finished trip's lane (an in-flight worker still drains what it already holds)"""
+        self._lanes.pop(trip_id, None)
+
+    def get_stats(self):
+        return dict(self.stats, active_lanes=sum(1 for l in self._lanes.values() if l.worker and not l.worker.done()),
+                    tracked_trips=len(self._lanes))
+
+trip_lanes = TripLaneManager()
@@ -0,0 +1,70 @@
+import logging
+from typing import Dict, Optional
+from app.services.route_recipients import RouteRecipients, route_recipient_cache
+
+logger = logging.getLogger(__name__)
+
+class TripManifest:
+    """Notification recipients of one trip, precomputed for its trip type.
+
+    Every location group (and stop order) maps to the students boarding there on this leg and their
+    deduplicated parent tokens, so a stop event needs no recipient lookups at all. Built from the
+    route's cached recipients; a manifest is replaced whenever those change (token/student edits).
+    """
+
+    def __init__(self, recipients: RouteRecipients, trip_type: str):
+        self.recipients = recipients
+        self.trip_type = trip_type
+        self.locations: Dict[str, Dict] = {}
+        self.stop_orders: Dict[int, Dict] = {}
+        leg, order_key = ("pickup", "pickup_order") if trip_type == "PICKUP" else ("drop", "drop_order")
+        for stop in recipients.fcm_map.values():
+            students = [
+                {"student_id": st["student_id"], "name": st["name"], "stop_name": stop["stop_name"], "location": stop.get("location")}
+                for st in stop["students"] if st[leg]
+            ]
+            if not students:
+                continue
+            location_key = stop.get("location") or stop["stop_name"]
+            self.locations.setdefault(location_key, {"students": []})["students"].extend(students)
+            self.stop_orders.setdefault(stop[order_key], {"students": []})["students"].extend(students)
+        for group in list(self.locations.values()) + list(self.stop_orders.values()):
+            group["tokens"] = recipients.tokens_for([st["student_id"] for st in group["students"]])
+
+    def at_location(self, location_key: str) -> Dict:
+        """{"students", "tokens"} boarding at a location group (empty when nobody does)"""
+        return self.locations.get(location_key) or {"students": [], "tokens": []}
+
+    def at_stop_order(self, stop_order: int) -> Dict:
+        return self.stop_orders.get(stop_order) or {"students": [], "tokens": []}
+
+    @property
+    def token_count(self) -> int:
+        return len({t for group in self.locations.values() for t in group["tokens"]})
+
+class TripManifests:
+    """Builds and refreshes the manifest held on each cached TripState"""
+
+    def __init__(self):
+        self.stats = {"built": 0, "hits": 0, "unavailable": 0}
+
+    def for_trip(self, state) -> Optional[TripManifest]:
+        """The trip's manifest, rebuilt in memory when its route's recipients have changed;
+        None when the route recipient cache cannot be used (callers then query directly)"""
+        recipients = route_recipient_cache.get(state.route_id)
+        if recipients is None:
+            self.stats["unavailable"] += 1
+            return None
+        manifest = state.manifest
+        if manifest is None or manifest.recipients is not recipients:
+            manifest = state.manifest = TripManifest(recipients, state.trip_type)
+            self.stats["built"] += 1
+            logger.info(f"📋 Trip manifest for {state.trip_id}: {len(manifest.locations)} locations, {manifest.token_count} tokens")
+        else:
+            self.stats["hits"] += 1
+        return manifest
+
+    def get_stats(self):
+        return dict(self.stats)
+
+trip_manifests = TripManifests()
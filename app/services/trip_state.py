@@ -0,0 +1,195 @@
+import json
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+from app.core.config import get_settings
+from app.core.database import execute_query_async, run_in_db_executor
+from app.services.geo import RoutePath, StopCoordinates, fleet_distances_km
+from app.services.stop_index import geofence_radius_m
+from app.services.trip_manifest import trip_manifests
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+def parse_json_field(raw, default):
+    """Decode a JSON column that may arrive as str, already-decoded value or NULL"""
+    if raw is None:
+        return default
+    if isinstance(raw, str):
+        try:
+            value = json.loads(raw)
+        except Exception:
+            return default
+    else:
+        value = raw
+    return value if isinstance(value, type(default)) else default
+
+class TripState:
+    """Parsed trip row + ordered stops used by the GPS hot path (mutated in place on arrival/skip)"""
+
+    def __init__(self, trip_id: str, trip: Dict, stops: List[Dict]):
+        self.trip = trip
+        self.trip_id = trip_id
+        self.route_id = trip['route_id']
+        self.trip_type = trip['trip_type']
+        self.driver_id = trip.get('driver_id')
+        self.current_stop_order = trip.get('current_stop_order') or 0
+        self.is_first_stop_notified = bool(trip.get('is_first_stop_notified'))
+        self.skipped_stops = parse_json_field(trip.get('skipped_stops'), [])
+        self.skipped_set = set(self.skipped_stops)
+        self.stop_logs = parse_json_field(trip.get('stop_logs'), {})
+        self.loaded_at = time.monotonic()
+        # Other routes' stops whose geofence the bus is currently inside
+        self.foreign_stop_ids = set()
+        # Notification recipients per location group (see trip_manifest.py), built on trip start
+        self.manifest = None
+
+        self.stops = []
+        for s in stops:
+            stop = dict(s)
+            stop['latitude'] = float(s['latitude'])
+            stop['longitude'] = float(s['longitude'])
+            stop['location_key'] = s['location'] or s['stop_name']
+            stop['arrival_radius_km'] = geofence_radius_m(s) / 1000
+            self.stops.append(stop)
+        self.by_order = {s['stop_order']: s for s in self.stops}
+        self.location_groups = {}
+        for s in self.stops:
+            self.location_groups.setdefault(s['location_key'], []).append(s)
+        # Distance kernel input and route polyline, built once per trip instead of per ping
+        self.coords = StopCoordinates(self.stops)
+        self.path = RoutePath(self.stops)
+        self.index_by_order = {s['stop_order']: i for i, s in enumerate(self.stops)}
+
+    def next_unskipped_stops(self, after_order: int) -> List[Dict]:
+        skipped = self.skipped_set
+        return [s for s in self.stops[self.path.index_after(after_order):] if s['stop_order'] not in skipped]
+
+    def next_unskipped_stop(self, after_order: int) -> Optional[Dict]:
+        for i in range(self.path.index_after(after_order), len(self.stops)):
+            if self.stops[i]['stop_order'] not in self.skipped_set:
+                return self.stops[i]
+        return None
+
+    def stops_between(self, after_order: int, up_to_order: int) -> List[Dict]:
+        """Stops ordered after after_order up to and including up_to_order"""
+        return self.stops[self.path.index_after(after_order):self.path.index_after(up_to_order)]
+
+    def first_stop_pending(self) -> Optional[Dict]:
+        """The first stop while its 1km "Bus Nearby" alert has not been sent"""
+        return self.by_order.get(1) if self.current_stop_order < 1 and not self.is_first_stop_notified else None
+
+    def apply_arrival(self, stop_order: int, stop_logs: Dict):
+        self.current_stop_order = stop_order
+        self.stop_logs = stop_logs
+
+    def apply_skip(self, skipped_stops: List[int], stop_logs: Dict):
+        self.skipped_stops = list(skipped_stops)
+        self.skipped_set = set(self.skipped_stops)
+        self.stop_logs = stop_logs
+
+def first_stop_distances(fixes: List[Tuple[TripState, float, float]]) -> List[Optional[float]]:
+    """Distance (km) to the first stop for fixes of one or many trips whose first-stop alert is pending,
+    evaluated in a single kernel pass; None where no alert is pending"""
+    requests = []
+    for state, latitude, longitude in fixes:
+        first = state.first_stop_pending()
+        requests.append((state.coords, latitude, longitude, [state.index_by_order[first['stop_order']]] if first else []))
+    return [distances[0] if distances else None for distances in fleet_distances_km(requests)]
+
+class TripStateCache:
+    """Per-process cache of TripState for ongoing trips.
+
+    Loaded at trip start (or lazily on the first ping), updated in place by the tracking service after
+    each write, and invalidated on trip/route-stop changes. Entries also expire after TRIP_STATE_TTL so
+    edits made by other workers are picked up eventually.
+    """
+
+    def __init__(self, ttl: int = None):
+        self.ttl = ttl if ttl is not None else settings.TRIP_STATE_TTL
+        self._states: Dict[str, TripState] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lock(self, trip_id: str) -> asyncio.Lock:
+        """Serializes pings for one trip so in-place updates never interleave"""
+        lock = self._locks.get(trip_id)
+        if lock is None:
+            lock = self._locks[trip_id] = asyncio.Lock()
+        return lock
+
+    async def _fetch(self, trip_id: str) -> Optional[TripState]:
+        trip_query = """
+        SELECT t.*, r.name as route_name, b.registration_number
+        FROM trips t
+        JOIN routes r ON t.route_id = r.route_id
+        JOIN buses b ON t.bus_id = b.bus_id
+        WHERE t.trip_id = %s AND t.status IN ('ONGOING', 'NOT_STARTED')
+        """
+        trip = await execute_query_async(trip_query, (trip_id,), fetch_one=True)
+        if not trip:
+            return None
+
+        order_field = "pickup_stop_order" if trip['trip_type'] == "PICKUP" else "drop_stop_order"
+        # NULL-ordered stops are excluded: they cannot take part in order-based progression
+        stops_query = f"""
+        SELECT stop_id, stop_name, location, latitude, longitude, geofence_radius_m, {order_field} as stop_order
+        FROM route_stops
+        WHERE route_id = %s
+          AND latitude IS NOT NULL AND longitude IS NOT NULL
+          AND {order_field} IS NOT NULL
+        ORDER BY {order_field}
+        """
+        stops = await execute_query_async(stops_query, (trip['route_id'],), fetch_all=True) or []
+        return TripState(trip_id, trip, stops)
+
+    async def load(self, trip_id: str) -> Optional[TripState]:
+        """(Re)load a trip from MySQL; trips that are not ONGOING/NOT_STARTED are not cached"""
+        state = await self._fetch(trip_id)
+        if state:
+            self._states[trip_id] = state
+        else:
+            self.drop(trip_id)
+        return state
+
+    async def get(self, trip_id: str) -> Optional[TripState]:
+        state = self._states.get(trip_id)
+        if state and time.monotonic() - state.loaded_at < self.ttl:
+            self.hits += 1
+            return state
+        self.misses += 1
+        return await self.load(trip_id)
+
+    def peek(self, trip_id: str) -> Optional[TripState]:
+        return self._states.get(trip_id)
+
+    def invalidate(self, trip_id: str):
+        self._states.pop(trip_id, None)
+
+    def invalidate_route(self, route_id: str):
+        for trip_id in [tid for tid, s in self._states.items() if s.route_id == route_id]:
+            self._states.pop(trip_id, None)
+
+    def drop(self, trip_id: str):
+        """Forget a finished trip entirely"""
+        self._states.pop(trip_id, None)
+        lock = self._locks.get(trip_id)
+        if lock is not None and not lock.locked():
+            self._locks.pop(trip_id, None)
+
+    async def warm(self, trip_id: str):
+        """Best-effort load at trip start; a failure just means the first ping loads it"""
+        try:
+            state = await self.load(trip_id)
+            if state:
+                await run_in_db_executor(trip_manifests.for_trip, state)
+        except Exception as e:
+            self.invalidate(trip_id)
+            logger.warning(f"Could not preload trip state for {trip_id}: {e}")
+
+    def get_stats(self):
+        return {"cached_trips": len(self._states), "hits": self.hits, "misses": self.misses, "ttl_seconds": self.ttl}
+
+trip_state_cache = TripStateCache()
@@ -0,0 +1,193 @@
+"""Notification fan-out benchmark against the in-process fake FCM backend.
+
+Drives the real send paths with FCMService switched to FakeFCMTransport (simulated per-call
+latency, transient errors and dead tokens) and the database calls of each path replaced by
+synthetic data, so no MySQL or Firebase is needed:
+
+  broadcast_to_tokens     FCMService.broadcast_to_tokens for N tokens
+  stop_alert              BusTrackingService._broadcast_helper for N students (outbox enqueue)
+                          followed by the outbox delivery of that row through the route recipient cache
+  route_drivers           POST /notifications/broadcast/drivers with N driver tokens
+  route_parents           POST /notifications/broadcast/parents with N parent tokens, until the job finishes
+
+Reports throughput (tokens/s) and p50/p95/p99 latency of the whole operation and of the individual
+FCM calls. Usage:
+
+  python benchmarks/bench_fanout.py --sizes 100,1000,10000 --repeat 5 --latency-ms 50 --error-rate 0.01
+  python benchmarks/bench_fanout.py --json results.json   # keep a baseline to compare before deploying
+"""
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import logging
+import argparse
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for key, value in {"DB_HOST": "localhost", "DB_USER": "bench", "DB_PASSWORD": "bench", "SECRET_KEY": "bench",
+                   "DOCS_USERNAME": "bench", "DOCS_PASSWORD": "bench"}.items():
+    os.environ.setdefault(key, value)
+
+import httpx
+from main import app
+from app.api import notification_routes
+from app.notification_api.fake_transport import FakeFCMTransport
+from app.notification_api.service import notification_service, fcm_executor
+from app.services.bus_tracking import bus_tracking_service
+from app.services.broadcast_jobs import broadcast_jobs, PARENT_TOKENS_PAGE, PARENT_TOKENS_COUNT
+from app.services.notification_outbox import notification_outbox
+from app.services.route_recipients import RouteRecipients, build_stop_fcm_map, route_recipient_cache
+
+HEADERS = {"User-Agent": "Mozilla/5.0 (bench)", "Origin": "https://transport.selvagam.com"}
+STUDENTS_PER_STOP = 25
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def make_tokens(n):
+    return [f"bench-token-{i:06d}" for i in range(n)]
+
+def make_route(n):
+    """Route recipients for n students, one parent token each"""
+    rows = [{"stop_id": f"stop{i // STUDENTS_PER_STOP}", "stop_name": f"Stop {i // STUDENTS_PER_STOP}",
+             "location": f"Area {i // STUDENTS_PER_STOP}", "pickup_stop_order": i // STUDENTS_PER_STOP,
+             "drop_stop_order": i // STUDENTS_PER_STOP, "student_id": f"std{i:06d}", "student_name": f"Student {i}",
+             "is_pickup": 1, "is_drop": 1, "fcm_token": f"bench-token-{i:06d}", "parent_id": f"par{i:06d}",
+             "parent_name": f"Parent {i}"} for i in range(n)]
+    return RouteRecipients("bench-route", build_stop_fcm_map(rows), 1)
+
+async def bench_broadcast_to_tokens(n):
+    result = await notification_service.broadcast_to_tokens(make_tokens(n), "Bench", "broadcast_to_tokens")
+    return result["delivered"]
+
+async def bench_stop_alert(n):
+    route = make_route(n)
+    rows = []
+
+    def enqueue_query(query, params=None, **kwargs):
+        outbox_id, title, body, data, message_type, recipients = params
+        rows.append({"outbox_id": outbox_id, "title": title, "body": body, "data": data, "message_type": message_type,
+                     "recipients": recipients, "attempts": 1, "locked_by": "bench", "delivered_count": 0})
+
+    async def update_query(*args, **kwargs):
+        return 1
+
+    students = [{"student_id": sid} for sid in route.tokens_by_student]
+    with patch("app.services.notification_outbox.execute_query", side_effect=enqueue_query), \
+         patch("app.services.notification_outbox.execute_query_async", side_effect=update_query), \
+         patch.object(route_recipient_cache, "get", return_value=route):
+        await bus_tracking_service._broadcast_helper(students, "Bus arriving", "Bench stop alert", {}, wake=False,
+                                                     route_id="bench-route")
+        before = notification_outbox.stats["delivered_tokens"]
+        await notification_outbox.deliver(rows[0])
+        return notification_outbox.stats["delivered_tokens"] - before
+
+async def bench_route_drivers(client, n):
+    async def drivers_query(query, params=None, fetch_one=False, fetch_all=False):
+        return [{"fcm_token": t} for t in make_tokens(n)]
+
+    with patch("app.api.notification_routes.execute_query_async", side_effect=drivers_query):
+        response = await client.post("/api/v1/notifications/broadcast/drivers", headers=HEADERS,
+                                     json={"title": "Bench", "body": "drivers", "message_type": "audio"})
+    return response.json()["delivered_count"]
+
+async def bench_route_parents(client, n):
+    tokens = make_tokens(n)
+
+    async def parents_query(query, params=None, fetch_one=False, fetch_all=False):
+        if query == PARENT_TOKENS_PAGE:
+            after, limit = params
+            start = next((i for i, t in enumerate(tokens) if t > after), len(tokens))
+            return [{"fcm_token": t} for t in tokens[start:start + limit]]
+        if query == PARENT_TOKENS_COUNT:
+            return {"total": n}
+        return None
+
+    with patch("app.api.notification_routes.execute_query_async", side_effect=parents_query), \
+         patch("app.api.notification_routes.get_system_admin_id", return_value="bench-admin"), \
+         patch("app.services.broadcast_jobs.execute_query_async", side_effect=parents_query):
+        response = await client.post("/api/v1/notifications/broadcast/parents", headers=HEADERS,
+                                     json={"title": "Bench", "body": "parents", "messageType": "audio"})
+        job_id = response.json()["job_id"]
+        task = broadcast_jobs._tasks.get(job_id)
+        if task:
+            await task
+        return (await broadcast_jobs.get(job_id))["sent"]
+
+async def run(args):
+    transport = FakeFCMTransport(latency_ms=args.latency_ms, jitter=args.jitter, error_rate=args.error_rate,
+                                 dead_rate=args.dead_rate, seed=42)
+    notification_service.use_transport(transport)
+    notification_routes.ADMIN_KEY = HEADERS["x-admin-key"] = "bench-admin-key"
+
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+    scenarios = {
+        "broadcast_to_tokens": bench_broadcast_to_tokens,
+        "stop_alert": bench_stop_alert,
+        "route_drivers": lambda n: bench_route_drivers(client, n),
+        "route_parents": lambda n: bench_route_parents(client, n),
+    }
+    selected = args.scenarios.split(",") if args.scenarios else list(scenarios)
+    report = []
+    # Dead tokens would be pruned from MySQL; only count them here
+    with patch("app.services.token_cleanup.dead_token_pruner.report"):
+        for name in selected:
+            await scenarios[name](10)  # warm-up: imports, pools, route table
+            for n in (int(s) for s in args.sizes.split(",")):
+                transport.reset()
+                durations, delivered = [], 0
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    delivered += await scenarios[name](n)
+                    durations.append((time.perf_counter() - start) * 1000)
+                report.append({
+                    "scenario": name, "recipients": n, "repeat": args.repeat,
+                    "tokens_per_s": round(n * args.repeat / (sum(durations) / 1000), 1),
+                    "delivered": delivered, "fcm_calls": transport.stats["calls"],
+                    "op_p50_ms": round(percentile(durations, 50), 1), "op_p95_ms": round(percentile(durations, 95), 1),
+                    "op_p99_ms": round(percentile(durations, 99), 1),
+                    "fcm_p50_ms": round(percentile(transport.latencies_ms, 50), 1),
+                    "fcm_p99_ms": round(percentile(transport.latencies_ms, 99), 1),
+                    "fcm_max_concurrent": transport.stats["max_concurrent"],
+                })
+    await client.aclose()
+    report_stats = fcm_executor.get_stats()
+    return report, {"fcm_executor_max_queue_depth": report_stats["max_queue_depth"]}
+
+def print_table(report):
+    columns = ["scenario", "recipients", "tokens_per_s", "op_p50_ms", "op_p95_ms", "op_p99_ms",
+               "fcm_calls", "fcm_p50_ms", "fcm_p99_ms", "fcm_max_concurrent", "delivered"]
+    widths = {c: max(len(c), *(len(str(r[c])) for r in report)) for c in columns}
+    print("  ".join(c.ljust(widths[c]) for c in columns))
+    for row in report:
+        print("  ".join(str(row[c]).ljust(widths[c]) for c in columns))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark notification fan-out against a fake FCM backend")
+    parser.add_argument("--sizes", default="100,1000,10000", help="Recipient counts (comma separated)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario and size")
+    parser.add_argument("--scenarios", default="", help="Subset of broadcast_to_tokens,stop_alert,route_drivers,route_parents")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Simulated latency of one FCM call")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Mean extra latency as a fraction of --latency-ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of sends failing transiently")
+    parser.add_argument("--dead-rate", type=float, default=0.0, help="Fraction of tokens reported unregistered")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    report, extra = asyncio.run(run(args))
+    print_table(report)
+    print(f"FCM executor: {fcm_executor.workers} workers, max concurrency {fcm_executor.max_concurrency}, "
+          f"max queue depth {extra['fcm_executor_max_queue_depth']}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": report, **extra}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,16 @@ import logging
 import secrets
 import asyncio
 from app.services.cleanup_service import cleanup_service
+from app.core.database import db_pool, shutdown_db_executor
+from app.services.live_locations import live_location_buffer
+from app.notification_api.service import fcm_executor
+from app.services.notification_outbox import notification_outbox
+from app.services.token_cleanup import dead_token_pruner
+from app.services.topic_subscriptions import topic_subscriptions
+from app.services.route_cache_rebuilder import route_cache_rebuilder
+from app.services.broadcast_jobs import broadcast_jobs
+from app.services.stop_index import stop_index
+from app.services.proximity_service import proximity_service
 from app.core.firewall import FirewallMiddleware
 settings = get_settings()
 logging.basicConfig(level=logging.INFO)
@@ -143,15 +153,64 @@ from contextlib import asynccontextmanager
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Pre-open the minimum number of pooled DB connections
+    try:
+        await asyncio.to_thread(db_pool.warm)
+        logger.info(f"Database pool warmed: {db_pool.get_stats()['size']} connection(s) open.")
+    except Exception as e:
+        logger.error(f"Database pool warm-up failed: {e}")
+    # Grid index over all route stops (geofence checks, nearby-stop queries)
+    try:
+        await asyncio.to_thread(stop_index.load)
+    except Exception as e:
+        logger.error(f"Stop index load failed: {e}")
+
     # Start the background cleanup task
     cleanup_task = asyncio.create_task(scheduled_cleanup())
-    logger.info("Lifespan startup complete: Scheduled cleanup task started.")
+    # Periodically write buffered driver positions to driver_live_locations
+    flush_task = asyncio.create_task(live_location_buffer.run())
+    # Deliver queued push notifications in the background
+    notification_outbox.start()
+    # Rebuild route FCM caches marked dirty by edits, coalesced per route
+    rebuild_task = asyncio.create_task(route_cache_rebuilder.run())
+    background_tasks = [cleanup_task, flush_task, rebuild_task]
+    # Keep FCM topic membership in line with token and student changes
+    if topic_subscriptions.enabled:
+        background_tasks.append(asyncio.create_task(topic_subscriptions.run()))
+    logger.info("Lifespan startup complete: Scheduled cleanup, live location flush and outbox tasks started.")
     yield
-    cleanup_task.cancel()
+    await notification_outbox.stop()
+    # Broadcasts still sending are recorded as INTERRUPTED
+    await broadcast_jobs.stop()
+    for task in background_tasks:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    # Last positions received before shutdown
     try:
-        await cleanup_task
-    except asyncio.CancelledError:
-        pass
+        await asyncio.to_thread(live_location_buffer.flush)
+    except Exception as e:
+        logger.error(f"Final live location flush failed: {e}")
+    # Routes edited during the last rebuild delay
+    try:
+        await asyncio.to_thread(route_cache_rebuilder.flush)
+    except Exception as e:
+        logger.error(f"Final route cache rebuild failed: {e}")
+    # Dead tokens reported during the last prune delay
+    try:
+        await asyncio.to_thread(dead_token_pruner.prune)
+    except Exception as e:
+        logger.error(f"Final dead token prune failed: {e}")
+    # Shared trip store connection (no-op for the memory store)
+    try:
+        await proximity_service.store.close()
+    except Exception as e:
+        logger.error(f"Trip store close failed: {e}")
+    fcm_executor.shutdown()
+    shutdown_db_executor()
+    db_pool.close()
 
 app.router.lifespan_context = lifespan
 
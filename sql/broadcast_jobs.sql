@@ -0,0 +1,19 @@
+-- Progress of school-wide parent broadcasts run as background jobs
+-- Updated after every page of tokens (see app/services/broadcast_jobs.py)
+
+CREATE TABLE IF NOT EXISTS `broadcast_jobs` (
+  `job_id` char(36) NOT NULL,
+  `notification_id` char(36) DEFAULT NULL,
+  `title` varchar(255) NOT NULL,
+  `status` varchar(20) NOT NULL DEFAULT 'QUEUED',
+  `total_tokens` int DEFAULT NULL,
+  `sent_count` int NOT NULL DEFAULT 0,
+  `failed_count` int NOT NULL DEFAULT 0,
+  `dead_count` int NOT NULL DEFAULT 0,
+  `last_error` varchar(500) DEFAULT NULL,
+  `finished_at` timestamp NULL DEFAULT NULL,
+  `created_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  `updated_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`job_id`),
+  KEY `idx_broadcast_status` (`status`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
@@ -0,0 +1,10 @@
+-- FCM topic memberships the backend has created (route/stop/class audiences)
+-- Lets a sync send only the difference to FCM (see app/services/topic_subscriptions.py)
+
+CREATE TABLE IF NOT EXISTS `fcm_topic_subscriptions` (
+  `fcm_token` varchar(255) NOT NULL,
+  `topic` varchar(100) NOT NULL,
+  `created_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`fcm_token`, `topic`),
+  KEY `idx_topic` (`topic`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
@@ -0,0 +1,25 @@
+-- Durable queue for stop arrival / approaching push notifications
+-- Rows are inserted in the same transaction as the stop progression that triggers them and
+-- delivered by background workers (see app/services/notification_outbox.py)
+
+CREATE TABLE IF NOT EXISTS `notification_outbox` (
+  `outbox_id` char(36) NOT NULL,
+  `title` varchar(255) NOT NULL,
+  `body` text NOT NULL,
+  `data` json DEFAULT NULL,
+  `message_type` varchar(20) DEFAULT 'audio',
+  `recipients` json NOT NULL,
+  `status` varchar(20) NOT NULL DEFAULT 'PENDING',
+  `attempts` int NOT NULL DEFAULT 0,
+  `delivered_count` int NOT NULL DEFAULT 0,
+  `failed_count` int NOT NULL DEFAULT 0,
+  `last_error` varchar(500) DEFAULT NULL,
+  `next_attempt_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `locked_by` char(36) DEFAULT NULL,
+  `locked_until` timestamp NULL DEFAULT NULL,
+  `sent_at` timestamp NULL DEFAULT NULL,
+  `created_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`outbox_id`),
+  KEY `idx_outbox_due` (`status`, `next_attempt_at`),
+  KEY `idx_outbox_lease` (`locked_by`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
@@ -0,0 +1,5 @@
+-- Version counter for route_stop_fcm_cache, bumped on every rebuild
+-- Workers keep an in-memory copy of each route's map and compare versions to pick up rebuilds
+-- (see app/services/route_recipients.py)
+ALTER TABLE route_stop_fcm_cache
+ADD COLUMN `version` int NOT NULL DEFAULT 1 AFTER `stop_fcm_map`;
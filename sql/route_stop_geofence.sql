@@ -0,0 +1,4 @@
+-- Per-stop geofence radius in meters; NULL uses the GEOFENCE_RADIUS setting
+-- Read by stop arrival detection and the in-memory stop index (see app/services/stop_index.py)
+ALTER TABLE route_stops
+ADD COLUMN `geofence_radius_m` int DEFAULT NULL AFTER `longitude`;
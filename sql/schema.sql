@@ -108,6 +108,7 @@ CREATE TABLE IF NOT EXISTS `route_stops` (
   `stop_name` varchar(100) NOT NULL,
   `latitude` decimal(10,7) DEFAULT NULL,
   `longitude` decimal(10,7) DEFAULT NULL,
+  `geofence_radius_m` int DEFAULT NULL,
   `pickup_stop_order` int NOT NULL,
   `created_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
   `drop_stop_order` int NOT NULL,
@@ -205,6 +206,7 @@ CREATE TABLE IF NOT EXISTS `driver_live_locations` (
 CREATE TABLE IF NOT EXISTS `route_stop_fcm_cache` (
   `route_id` char(36) NOT NULL,
   `stop_fcm_map` json NOT NULL,
+  `version` int NOT NULL DEFAULT 1,
   `updated_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
   PRIMARY KEY (`route_id`),
   CONSTRAINT `route_stop_fcm_cache_ibfk_1` FOREIGN KEY (`route_id`) REFERENCES `routes` (`route_id`)
@@ -218,3 +220,50 @@ CREATE TABLE IF NOT EXISTS `error_handling` (
   `created_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
   PRIMARY KEY (`error_id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+CREATE TABLE IF NOT EXISTS `notification_outbox` (
+  `outbox_id` char(36) NOT NULL,
+  `title` varchar(255) NOT NULL,
+  `body` text NOT NULL,
+  `data` json DEFAULT NULL,
+  `message_type` varchar(20) DEFAULT 'audio',
+  `recipients` json NOT NULL,
+  `status` varchar(20) NOT NULL DEFAULT 'PENDING',
+  `attempts` int NOT NULL DEFAULT 0,
+  `delivered_count` int NOT NULL DEFAULT 0,
+  `failed_count` int NOT NULL DEFAULT 0,
+  `last_error` varchar(500) DEFAULT NULL,
+  `next_attempt_at` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `locked_by` char(36) DEFAULT NULL,
+  `locked_until` timestamp NULL DEFAULT NULL,
+  `sent_at` timestamp NULL DEFAULT NULL,
+  `created_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`outbox_id`),
+  KEY `idx_outbox_due` (`status`, `next_attempt_at`),
+  KEY `idx_outbox_lease` (`locked_by`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+CREATE TABLE IF NOT EXISTS `fcm_topic_subscriptions` (
+  `fcm_token` varchar(255) NOT NULL,
+  `topic` varchar(100) NOT NULL,
+  `created_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`fcm_token`, `topic`),
+  KEY `idx_topic` (`topic`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+CREATE TABLE IF NOT EXISTS `broadcast_jobs` (
+  `job_id` char(36) NOT NULL,
+  `notification_id` char(36) DEFAULT NULL,
+  `title` varchar(255) NOT NULL,
+  `status` varchar(20) NOT NULL DEFAULT 'QUEUED',
+  `total_tokens` int DEFAULT NULL,
+  `sent_count` int NOT NULL DEFAULT 0,
+  `failed_count` int NOT NULL DEFAULT 0,
+  `dead_count` int NOT NULL DEFAULT 0,
+  `last_error` varchar(500) DEFAULT NULL,
+  `finished_at` timestamp NULL DEFAULT NULL,
+  `created_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP,
+  `updated_at` timestamp NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`job_id`),
+  KEY `idx_broadcast_status` (`status`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
@@ -1,4 +1,5 @@
 import pytest
+import app.core.database as database
 from fastapi.testclient import TestClient
 
 HEADERS = {
@@ -77,3 +78,15 @@ def test_delete_route_stop(client: TestClient, mock_db_cursor):
     assert response.status_code == 200
     data = response.json()
     assert "deleted" in data.get("message", "").lower()
+
+def test_stop_delete_invalidates_trip_state_after_commit(client: TestClient, mock_db_cursor, mocker):
+    mock_db_cursor.fetchone.return_value = mock_route_stop_data()
+    mock_db_cursor.fetchall.return_value = []
+    events = []
+    database.get_db.return_value.__exit__.side_effect = lambda *exc: events.append("commit") or False
+    mocker.patch("app.api.routes.trip_state_cache.invalidate_route", side_effect=lambda route_id: events.append("invalidate"))
+
+    response = client.delete("/api/v1/route-stops/stop123", headers=HEADERS)
+    assert response.status_code == 200
+    # The request's unit of work commits last; only then are cached trips dropped
+    assert events[-2:] == ["commit", "invalidate"]
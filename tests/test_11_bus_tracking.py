@@ -30,8 +30,8 @@ def test_send_custom_notification(client, mock_db_cursor, mocker):
     
     mocker.patch("app.api.routes.bus_tracking_service.get_parent_tokens_for_students", return_value=["token1"])
     from unittest.mock import AsyncMock
-    mock_send = AsyncMock(return_value={"success": True})
-    mocker.patch("app.api.routes.notification_service.send_to_device", new=mock_send)
+    mock_send = AsyncMock(return_value=[{"token": "token1", "success": True}])
+    mocker.patch("app.api.routes.notification_service.send_multicast", new=mock_send)
     
     payload = {
         "trip_id": "test_trip_123",
@@ -44,8 +44,8 @@ def test_send_device_notification(client, mocker):
 def test_broadcast_drivers(client, mock_db_cursor, mocker):
     mocker.patch("app.api.notification_routes.ADMIN_KEY", "test_admin_key")
     mock_db_cursor.fetchall.return_value = [{"fcm_token": "token1"}]
-    mock_send = AsyncMock(return_value={"success": True})
-    mocker.patch("app.api.notification_routes.notification_service.send_to_device", new=mock_send)
+    mock_send = AsyncMock(return_value=[{"token": "token1", "success": True}])
+    mocker.patch("app.api.notification_routes.notification_service.send_multicast", new=mock_send)
     
     payload = {
         "title": "Test Title",
@@ -59,10 +59,9 @@ def test_broadcast_parents(client, mock_db_cursor, mocker):
     mocker.patch("app.api.notification_routes.ADMIN_KEY", "test_admin_key")
     # Mock system admin lookup
     mock_db_cursor.fetchone.return_value = {"admin_id": "admin_123"}
-    # Mock parent tokens lookup
-    mock_db_cursor.fetchall.return_value = [{"fcm_token": "token1"}]
-    mock_send = AsyncMock(return_value={"success": True})
-    mocker.patch("app.api.notification_routes.notification_service.send_to_device", new=mock_send)
+    # Sending runs as a background job
+    mock_start = AsyncMock(return_value={"job_id": "job_1", "status": "QUEUED"})
+    mocker.patch("app.api.notification_routes.broadcast_jobs.start", new=mock_start)
     
     payload = {
         "title": "Test Title",
@@ -71,13 +70,15 @@ def test_broadcast_parents(client, mock_db_cursor, mocker):
     }
     response = client.post("/api/v1/notifications/broadcast/parents", json=payload, headers=HEADERS)
     assert response.status_code == status.HTTP_200_OK
+    assert response.json()["job_id"] == "job_1"
+    assert mock_start.call_args.args[:2] == ("Test Title", "Test Body")
 
 def test_send_student_notification(client, mock_db_cursor, mocker):
     mocker.patch("app.api.notification_routes.ADMIN_KEY", "test_admin_key")
     mock_db_cursor.fetchone.return_value = {"admin_id": "admin_123"}
     mock_db_cursor.fetchall.return_value = [{"fcm_token": "token1"}]
-    mock_send = AsyncMock(return_value={"success": True})
-    mocker.patch("app.api.notification_routes.notification_service.send_to_device", new=mock_send)
+    mock_send = AsyncMock(return_value=[{"token": "token1", "success": True}])
+    mocker.patch("app.api.notification_routes.notification_service.send_multicast", new=mock_send)
     
     payload = {
         "title": "Test Title",
@@ -90,8 +91,8 @@ def test_send_parent_notification_direct(client, mock_db_cursor, mocker):
     mocker.patch("app.api.notification_routes.ADMIN_KEY", "test_admin_key")
     mock_db_cursor.fetchone.return_value = {"admin_id": "admin_123"}
     mock_db_cursor.fetchall.return_value = [{"fcm_token": "token1"}]
-    mock_send = AsyncMock(return_value={"success": True})
-    mocker.patch("app.api.notification_routes.notification_service.send_to_device", new=mock_send)
+    mock_send = AsyncMock(return_value=[{"token": "token1", "success": True}])
+    mocker.patch("app.api.notification_routes.notification_service.send_multicast", new=mock_send)
     
     payload = {
         "title": "Test Title",
@@ -104,8 +105,8 @@ def test_send_route_notification(client, mock_db_cursor, mocker):
     mocker.patch("app.api.notification_routes.ADMIN_KEY", "test_admin_key")
     mock_db_cursor.fetchone.return_value = {"admin_id": "admin_123"}
     mock_db_cursor.fetchall.return_value = [{"fcm_token": "token1"}]
-    mock_send = AsyncMock(return_value={"success": True})
-    mocker.patch("app.api.notification_routes.notification_service.send_to_device", new=mock_send)
+    mock_send = AsyncMock(return_value=[{"token": "token1", "success": True}])
+    mocker.patch("app.api.notification_routes.notification_service.send_multicast", new=mock_send)
     
     payload = {
         "title": "Test Title",
@@ -118,8 +119,8 @@ def test_send_class_notification(client, mock_db_cursor, mocker):
     mocker.patch("app.api.notification_routes.ADMIN_KEY", "test_admin_key")
     mock_db_cursor.fetchone.return_value = {"admin_id": "admin_123"}
     mock_db_cursor.fetchall.return_value = [{"fcm_token": "token1"}]
-    mock_send = AsyncMock(return_value={"success": True})
-    mocker.patch("app.api.notification_routes.notification_service.send_to_device", new=mock_send)
+    mock_send = AsyncMock(return_value=[{"token": "token1", "success": True}])
+    mocker.patch("app.api.notification_routes.notification_service.send_multicast", new=mock_send)
     
     payload = {
         "title": "Test Title",
@@ -132,8 +133,8 @@ def test_send_location_notification(client, mock_db_cursor, mocker):
     mocker.patch("app.api.notification_routes.ADMIN_KEY", "test_admin_key")
     mock_db_cursor.fetchone.return_value = {"admin_id": "admin_123"}
     mock_db_cursor.fetchall.return_value = [{"fcm_token": "token1"}]
-    mock_send = AsyncMock(return_value={"success": True})
-    mocker.patch("app.api.notification_routes.notification_service.send_to_device", new=mock_send)
+    mock_send = AsyncMock(return_value=[{"token": "token1", "success": True}])
+    mocker.patch("app.api.notification_routes.notification_service.send_multicast", new=mock_send)
     
     payload = {
         "title": "Test Title",
@@ -12,7 +12,7 @@ HEADERS = {
 def test_bus_tracking_location_endpoint(client, mocker):
     # Mock the services called by the combined endpoint
     mock_update_bus = AsyncMock(return_value={"success": True})
-    mocker.patch("app.api.notification_routes.bus_tracking_service.update_bus_location", new=mock_update_bus)
+    mocker.patch("app.services.bus_tracking.bus_tracking_service.update_bus_location", new=mock_update_bus)
     
     mock_proximity = AsyncMock(return_value={
         "success": True, 
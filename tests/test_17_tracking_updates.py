@@ -46,9 +46,9 @@ def test_start_trip_route_endpoint(client, mock_db_cursor, mocker):
     mock_start = AsyncMock(return_value={"success": True, "recipients": 1})
     mocker.patch("app.services.proximity_service.proximity_service.start_trip", new=mock_start)
     
-    # Mock notification_service.send_to_device
-    mock_send = AsyncMock(return_value={"success": True})
-    mocker.patch("app.api.routes.notification_service.send_to_device", new=mock_send)
+    # Mock notification_service.broadcast_to_tokens
+    mock_send = AsyncMock(return_value={"success": True, "delivered": 1, "total": 1})
+    mocker.patch("app.api.routes.notification_service.broadcast_to_tokens", new=mock_send)
     
     response = client.put("/api/v1/trips/test_trip_123/start", headers=HEADERS)
     assert response.status_code == status.HTTP_200_OK
@@ -0,0 +1,75 @@
+import pytest
+from fastapi import status
+from unittest.mock import MagicMock
+from app.core.database import ConnectionPool, PoolTimeoutError
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 Safari",
+    "Origin": "https://transport.selvagam.com"
+}
+
+def make_pool(**kwargs):
+    factory = MagicMock(side_effect=lambda: MagicMock(open=True))
+    return ConnectionPool(connect=factory, **kwargs), factory
+
+def test_pool_reuses_released_connection():
+    pool, factory = make_pool(min_size=0, max_size=2)
+    conn = pool.acquire()
+    pool.release(conn)
+    assert pool.acquire() is conn
+    assert factory.call_count == 1
+
+def test_pool_times_out_when_exhausted():
+    pool, _ = make_pool(min_size=0, max_size=1, timeout=0.05)
+    pool.acquire()
+    with pytest.raises(PoolTimeoutError):
+        pool.acquire()
+    assert pool.get_stats()["timeouts"] == 1
+
+def test_pool_replaces_connection_failing_health_check():
+    pool, factory = make_pool(min_size=0, max_size=1, ping_interval=0)
+    conn = pool.acquire()
+    pool.release(conn)
+    conn.ping.side_effect = Exception("MySQL server has gone away")
+    fresh = pool.acquire()
+    assert fresh is not conn
+    assert conn.close.called
+    assert pool.get_stats()["health_check_failures"] == 1
+
+def test_pool_recycles_idle_connections_above_min_size():
+    pool, _ = make_pool(min_size=1, max_size=3, recycle=0)
+    first, second = pool.acquire(), pool.acquire()
+    pool.release(first)
+    pool.release(second)
+    pool.acquire()
+    stats = pool.get_stats()
+    assert stats["recycled"] == 1
+    assert stats["size"] == 1
+
+def test_pool_discards_broken_connection():
+    pool, _ = make_pool(min_size=0, max_size=1)
+    conn = pool.acquire()
+    pool.release(conn, discard=True)
+    assert pool.get_stats()["size"] == 0
+    assert conn.close.called
+
+def test_db_pool_stats_endpoint(client):
+    response = client.get("/api/v1/maintenance/db-pool", headers=HEADERS)
+    assert response.status_code == status.HTTP_200_OK
+    data = response.json()["data"]
+    assert {"size", "idle", "in_use", "max_size", "checkouts"} <= set(data)
+
+@pytest.mark.asyncio
+async def test_execute_query_async_runs_off_loop(mock_db_cursor):
+    from app.core.database import execute_query_async
+    mock_db_cursor.fetchone.return_value = {"driver_id": "d1"}
+    assert await execute_query_async("SELECT 1", fetch_one=True) == {"driver_id": "d1"}
+
+@pytest.mark.asyncio
+async def test_get_db_async_executes_on_shared_connection(mock_db_cursor, mock_db_connection):
+    from app.core.database import get_db_async
+    mock_db_cursor.fetchall.return_value = [{"trip_id": "t1"}]
+    async with get_db_async() as db:
+        rows = await db.execute("SELECT trip_id FROM trips", fetch_all=True)
+    assert rows == [{"trip_id": "t1"}]
+    mock_db_cursor.execute.assert_called_with("SELECT trip_id FROM trips", ())
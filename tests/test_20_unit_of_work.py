@@ -0,0 +1,108 @@
+import pytest
+from fastapi import FastAPI, Depends, HTTPException
+from fastapi.testclient import TestClient
+from unittest.mock import MagicMock
+import app.core.database as database
+from app.core.database import (
+    ConnectionPool, get_db as real_get_db, execute_query as real_execute_query,
+    unit_of_work, unit_of_work_async, no_unit_of_work, db_unit_of_work, execute_query_async, after_commit
+)
+
+@pytest.fixture
+def pool(mocker):
+    """Route get_db/execute_query back to the real implementations over a pool of mock connections"""
+    factory = MagicMock(side_effect=lambda: MagicMock(open=True))
+    test_pool = ConnectionPool(min_size=0, max_size=5, connect=factory)
+    mocker.patch("app.core.database.db_pool", test_pool)
+    mocker.patch("app.core.database.get_db", real_get_db)
+    mocker.patch("app.core.database.execute_query", real_execute_query)
+    return factory
+
+def executed(conn):
+    cursor = conn.cursor.return_value.__enter__.return_value
+    return [c.args[0] for c in cursor.execute.call_args_list]
+
+def test_unit_of_work_shares_one_connection_and_commits_once(pool):
+    with unit_of_work() as conn:
+        database.execute_query("UPDATE route_stops SET pickup_stop_order = 1")
+        database.execute_query("UPDATE route_stop_fcm_cache SET stop_fcm_map = '{}'")
+    assert pool.call_count == 1
+    assert conn.commit.call_count == 1
+    assert len(executed(conn)) == 2
+
+def test_unit_of_work_rolls_back_everything_on_error(pool):
+    with pytest.raises(ValueError):
+        with unit_of_work() as conn:
+            database.execute_query("DELETE FROM fcm_tokens WHERE parent_id = %s", ("p1",))
+            raise ValueError("Cannot delete parent")
+    conn.rollback.assert_called_once()
+    conn.commit.assert_not_called()
+
+def test_nested_unit_of_work_uses_savepoint(pool):
+    with unit_of_work() as conn:
+        with pytest.raises(RuntimeError):
+            with unit_of_work():
+                raise RuntimeError("cascade failed")
+    assert executed(conn) == ["SAVEPOINT uow_sp_1", "ROLLBACK TO SAVEPOINT uow_sp_1"]
+    conn.commit.assert_called_once()
+
+def test_no_unit_of_work_opts_out(pool):
+    with unit_of_work():
+        with no_unit_of_work():
+            database.execute_query("SELECT 1")
+    assert pool.call_count == 2
+
+@pytest.mark.asyncio
+async def test_async_unit_of_work_reaches_executor_queries(pool):
+    async with unit_of_work_async() as conn:
+        await execute_query_async("SELECT 1", fetch_one=True)
+        await execute_query_async("SELECT 2", fetch_one=True)
+    assert pool.call_count == 1
+    assert executed(conn) == ["SELECT 1", "SELECT 2"]
+    conn.commit.assert_called_once()
+
+def test_request_dependency_rolls_back_on_http_error(pool):
+    app = FastAPI()
+
+    @app.delete("/things/{thing_id}", dependencies=[Depends(db_unit_of_work)])
+    async def delete_thing(thing_id: str):
+        database.execute_query("DELETE FROM cascade_children WHERE thing_id = %s", (thing_id,))
+        if database.execute_query("DELETE FROM things WHERE thing_id = %s", (thing_id,)) == 0:
+            raise HTTPException(status_code=404, detail="Not found")
+        return {"ok": True}
+
+    conn = MagicMock(open=True)
+    conn.cursor.return_value.__enter__.return_value.rowcount = 0
+    pool.side_effect = lambda: conn
+    response = TestClient(app).delete("/things/t1")
+    assert response.status_code == 404
+    assert pool.call_count == 1
+    conn.rollback.assert_called_once()
+    conn.commit.assert_not_called()
+
+def test_after_commit_runs_only_once_committed(pool):
+    calls = []
+    with unit_of_work() as conn:
+        after_commit(calls.append, "outer")
+        with pytest.raises(RuntimeError):
+            with unit_of_work():
+                after_commit(calls.append, "rolled back savepoint")
+                raise RuntimeError("cascade failed")
+        conn.commit.side_effect = lambda: calls.append("commit")
+    assert calls == ["commit", "outer"]
+
+    with pytest.raises(ValueError):
+        with unit_of_work():
+            after_commit(calls.append, "rolled back")
+            raise ValueError("Cannot delete parent")
+    after_commit(calls.append, "no unit of work")
+    assert calls == ["commit", "outer", "no unit of work"]
+
+@pytest.mark.asyncio
+async def test_after_commit_in_async_unit_of_work(pool):
+    calls = []
+    async with unit_of_work_async() as conn:
+        conn.commit.side_effect = lambda: calls.append("commit")
+        after_commit(calls.append, "invalidate")
+        await execute_query_async("UPDATE route_stops SET pickup_stop_order = 2")
+    assert calls == ["commit", "invalidate"]
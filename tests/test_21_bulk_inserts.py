@@ -0,0 +1,42 @@
+import io
+from fastapi import status
+from app.core.database import execute_many
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 Safari",
+    "Origin": "https://transport.selvagam.com"
+}
+
+QUERY = "INSERT INTO students (student_id, name) VALUES (%s, %s)"
+
+def test_execute_many_groups_rows_into_batches(mock_db_cursor):
+    rows = [(f"s{i}", f"Student {i}") for i in range(5)]
+    result = execute_many(QUERY, rows, batch_size=2)
+    assert result == {"success": 5, "failed": 0, "errors": []}
+    assert [len(c.args[1]) for c in mock_db_cursor.executemany.call_args_list] == [2, 2, 1]
+
+def test_execute_many_reports_per_row_errors_for_failed_batch(mock_db_cursor):
+    rows = [("s1", "A"), ("s2", "B"), ("s3", "C")]
+    mock_db_cursor.executemany.side_effect = Exception("Duplicate entry")
+
+    def execute(query, params):
+        if params[0] == "s2":
+            raise Exception("Duplicate entry 's2'")
+    mock_db_cursor.execute.side_effect = execute
+
+    result = execute_many(QUERY, rows, batch_size=10)
+    assert result["success"] == 2
+    assert result["failed"] == 1
+    assert result["errors"] == [{"index": 1, "error": "Duplicate entry 's2'"}]
+
+def test_students_csv_upload_batches_rows(client, mock_db_cursor):
+    csv_data = "name,parent_id,gender\nAsha,p1,FEMALE\n,p2,MALE\nRavi,p3,MALE\n"
+    files = {"file": ("students.csv", io.BytesIO(csv_data.encode()), "text/csv")}
+    response = client.post("/api/v1/students/bulk/csv", files=files, headers=HEADERS)
+    assert response.status_code == status.HTTP_200_OK
+    data = response.json()
+    assert data["total"] == 3
+    assert data["success"] == 2
+    assert data["failed"] == 1
+    assert data["errors"][0]["row"] == 2
+    assert mock_db_cursor.executemany.call_count == 1
@@ -0,0 +1,40 @@
+from fastapi import status
+from app.core.query_stats import QueryStats, fingerprint
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 Safari",
+    "Origin": "https://transport.selvagam.com"
+}
+
+def test_fingerprint_normalizes_literals_and_lists():
+    a = fingerprint("SELECT * FROM trips  WHERE trip_id = 'abc' AND current_stop_order > 3")
+    b = fingerprint("SELECT * FROM trips WHERE trip_id = %s AND current_stop_order > %s")
+    assert a == b == "SELECT * FROM trips WHERE trip_id = ? AND current_stop_order > ?"
+    assert fingerprint("SELECT 1 FROM students WHERE student_id IN (%s, %s, %s)") == "SELECT ? FROM students WHERE student_id IN (...)"
+    assert fingerprint("INSERT INTO t (a, b) VALUES (1, 'x'), (2, 'y');") == "INSERT INTO t (a, b) VALUES (?, ?), ..."
+
+def test_query_stats_histogram_and_errors():
+    stats = QueryStats()
+    stats.record("SELECT * FROM trips WHERE trip_id = %s", 3.0, rows=1)
+    stats.record("SELECT * FROM trips WHERE trip_id = %s", 40.0, rows=1)
+    stats.record("SELECT * FROM trips WHERE trip_id = %s", 2.0, error=True)
+    entry = stats.snapshot()["queries"][0]
+    assert entry["calls"] == 3
+    assert entry["errors"] == 1
+    assert entry["rows"] == 2
+    assert entry["max_ms"] == 40.0
+    assert entry["p50_ms"] == 5
+    assert entry["p99_ms"] == 50
+    assert entry["histogram"] == {"le_5": 2, "le_50": 1}
+
+def test_slow_query_is_logged(caplog):
+    stats = QueryStats()
+    stats.record("SELECT SLEEP(1)", 5000.0)
+    assert any("Slow query" in r.message for r in caplog.records)
+
+def test_query_stats_endpoints(client):
+    response = client.get("/api/v1/maintenance/query-stats?limit=5", headers=HEADERS)
+    assert response.status_code == status.HTTP_200_OK
+    assert "queries" in response.json()["data"]
+    response = client.post("/api/v1/maintenance/query-stats/reset", headers=HEADERS)
+    assert response.status_code == status.HTTP_200_OK
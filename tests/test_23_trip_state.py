@@ -0,0 +1,113 @@
+import asyncio
+import json
+import pytest
+from unittest.mock import AsyncMock
+import app.core.database as database
+from app.core.database import unit_of_work_async
+from app.services.bus_tracking import bus_tracking_service
+from app.services.cascade_updates import cascade_service
+from app.services.proximity_service import proximity_service
+from app.services.trip_state import trip_state_cache
+
+TRIP = {
+    "trip_id": "trip_state_1", "route_id": "route_1", "trip_type": "PICKUP", "driver_id": "driver_1",
+    "status": "ONGOING", "current_stop_order": 0, "is_first_stop_notified": 1,
+    "skipped_stops": "[]", "stop_logs": "{}"
+}
+STOPS = [
+    {"stop_id": "s1", "stop_name": "Stop 1", "location": "Anna Nagar", "latitude": "13.0850", "longitude": "80.2100", "stop_order": 1},
+    {"stop_id": "s2", "stop_name": "Stop 2", "location": "Kilpauk", "latitude": "13.0820", "longitude": "80.2400", "stop_order": 2},
+]
+
+def selects():
+    return [c for c in database.execute_query.call_args_list if c.args[0].lstrip().upper().startswith("SELECT")]
+
+@pytest.fixture
+def tracked_trip(mock_db_cursor, mocker):
+    mock_db_cursor.fetchone.return_value = dict(TRIP)
+    mock_db_cursor.fetchall.return_value = [dict(s) for s in STOPS]
+    mocker.patch.object(bus_tracking_service, "_broadcast_helper", new=AsyncMock())
+    mocker.patch.object(bus_tracking_service, "get_students_for_location", return_value=[])
+    trip_state_cache.drop(TRIP["trip_id"])
+    yield TRIP["trip_id"]
+    trip_state_cache.drop(TRIP["trip_id"])
+
+@pytest.mark.asyncio
+async def test_cached_ping_issues_no_reads(tracked_trip):
+    await bus_tracking_service.update_bus_location(tracked_trip, 12.90, 80.10)
+    assert len(selects()) == 2  # trip + stops, loaded once
+    database.execute_query.reset_mock()
+
+    result = await bus_tracking_service.update_bus_location(tracked_trip, 12.90, 80.10)
+    assert result["success"] is True
+    assert selects() == []
+
+@pytest.mark.asyncio
+async def test_arrival_updates_state_in_place(tracked_trip):
+    result = await bus_tracking_service.update_bus_location(tracked_trip, 13.0851, 80.2101)
+    assert result["current_stop_order"] == 1
+    state = trip_state_cache.peek(tracked_trip)
+    assert state.current_stop_order == 1
+    assert "s1" in state.stop_logs
+
+def test_route_stop_change_invalidates_trip_state(tracked_trip):
+    asyncio.run(trip_state_cache.load(tracked_trip))
+    assert trip_state_cache.peek(tracked_trip) is not None
+    trip_state_cache.invalidate_route("route_1")
+    assert trip_state_cache.peek(tracked_trip) is None
+
+def stop_log_updates():
+    return [c for c in database.execute_query.call_args_list if c.args[0].startswith("UPDATE trips SET skipped_stops")]
+
+@pytest.mark.asyncio
+async def test_skip_keeps_arrival_logs_from_cached_state(tracked_trip, mock_db_cursor):
+    mock_db_cursor.fetchall.return_value = [dict(s) for s in STOPS] + [
+        {"stop_id": "s3", "stop_name": "Stop 3", "location": "Egmore", "latitude": "13.0780", "longitude": "80.2600", "stop_order": 3}
+    ]
+    await bus_tracking_service.update_bus_location(tracked_trip, 13.0851, 80.2101)
+    database.execute_query.reset_mock()
+
+    # The trips row still reads stop_logs "{}"; the skip must not write that stale copy back
+    result = await bus_tracking_service.skip_specific_stop(tracked_trip, 2)
+    assert result["success"] is True and selects() == []
+    skipped, stop_logs, _ = stop_log_updates()[0].args[1]
+    assert skipped == "[2]" and set(json.loads(stop_logs)) == {"s1", "s2"}
+    state = trip_state_cache.peek(tracked_trip)
+    assert state.current_stop_order == 1 and state.stop_logs == json.loads(stop_logs)
+
+@pytest.mark.asyncio
+async def test_skip_waits_for_trip_lock(tracked_trip, mock_db_cursor):
+    mock_db_cursor.fetchall.return_value = [dict(s) for s in STOPS] + [
+        {"stop_id": "s3", "stop_name": "Stop 3", "location": "Egmore", "latitude": "13.0780", "longitude": "80.2600", "stop_order": 3}
+    ]
+    async with trip_state_cache.lock(tracked_trip):
+        skip = asyncio.create_task(bus_tracking_service.skip_stop(tracked_trip))
+        await asyncio.sleep(0.01)
+        assert not skip.done() and stop_log_updates() == []
+    assert (await skip)["skipped_stop_order"] == 1
+
+@pytest.mark.asyncio
+async def test_route_deactivation_stops_tracking_its_trips(tracked_trip, mock_db_cursor, mocker):
+    await bus_tracking_service.update_bus_location(tracked_trip, 12.90, 80.10)
+    assert trip_state_cache.peek(tracked_trip) is not None
+    forget = mocker.patch.object(proximity_service, "forget_trip", new=AsyncMock())
+
+    mock_db_cursor.fetchall.return_value = [{"trip_id": tracked_trip}]
+    async with unit_of_work_async():
+        cascade_service.update_route_cascades("route_1", {}, {"routes_active_status": "INACTIVE"})
+        # Still tracked until the cancellation commits
+        assert trip_state_cache.peek(tracked_trip) is not None
+    await asyncio.sleep(0)
+    assert trip_state_cache.peek(tracked_trip) is None
+    forget.assert_awaited_once_with(tracked_trip)
+
+@pytest.mark.asyncio
+async def test_fix_for_trip_cancelled_elsewhere_drops_state(tracked_trip, mock_db_cursor):
+    await bus_tracking_service.update_bus_location(tracked_trip, 12.90, 80.10)
+    # Another worker cancelled the trip: the guarded progression UPDATE matches no row
+    mock_db_cursor.rowcount = 0
+
+    result = await bus_tracking_service.update_bus_location(tracked_trip, 13.0851, 80.2101)
+    assert result["success"] is False
+    assert trip_state_cache.peek(tracked_trip) is None
+    bus_tracking_service._broadcast_helper.assert_not_called()
@@ -0,0 +1,109 @@
+import asyncio
+import pytest
+from datetime import datetime, timedelta, timezone
+from app.services.bus_tracking import bus_tracking_service
+from app.services.trip_lanes import TripLaneManager
+
+T0 = datetime(2026, 1, 5, 7, 30, 0)
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 Safari",
+    "Origin": "https://transport.selvagam.com"
+}
+
+class Calls(list):
+    """Processed (trip_id, lat, lng) fixes plus the update_live_location flag of each"""
+    live_updates: list
+
+@pytest.fixture
+def processed(mocker):
+    calls = Calls()
+    live_updates = calls.live_updates = []
+
+    async def fake_update(trip_id, latitude, longitude, update_live_location=True):
+        calls.append((trip_id, latitude, longitude))
+        live_updates.append(update_live_location)
+        await asyncio.sleep(0.01)
+        return {"success": True, "latitude": latitude}
+
+    mocker.patch.object(bus_tracking_service, "update_bus_location", new=fake_update)
+    return calls
+
+@pytest.mark.asyncio
+async def test_burst_is_coalesced_to_latest_fix(processed):
+    lanes = TripLaneManager()
+    futures = [lanes.submit("trip_1", 13.0 + i / 100, 80.0, T0 + timedelta(seconds=i)) for i in range(5)]
+    results = await asyncio.gather(*futures)
+
+    # The whole burst lands before the lane worker runs, so only the newest fix is processed
+    assert processed == [("trip_1", 13.04, 80.0)]
+    assert [r["latitude"] for r in results] == [13.04] * 5
+    assert lanes.stats["coalesced"] == 4
+
+@pytest.mark.asyncio
+async def test_fix_arriving_mid_processing_waits_its_turn(processed):
+    lanes = TripLaneManager()
+    first = lanes.submit("trip_1", 13.0, 80.0, T0)
+    await asyncio.sleep(0)
+    second = lanes.submit("trip_1", 13.01, 80.0, T0 + timedelta(seconds=1))
+    await asyncio.gather(first, second)
+    assert processed == [("trip_1", 13.0, 80.0), ("trip_1", 13.01, 80.0)]
+
+@pytest.mark.asyncio
+async def test_older_fix_is_dropped(processed):
+    lanes = TripLaneManager()
+    await lanes.submit("trip_1", 13.05, 80.0, T0 + timedelta(seconds=10))
+    result = await lanes.submit("trip_1", 13.01, 80.0, T0 + timedelta(seconds=5))
+    assert result["ignored"] is True
+    assert processed == [("trip_1", 13.05, 80.0)]
+
+@pytest.mark.asyncio
+async def test_trips_are_processed_independently(processed):
+    lanes = TripLaneManager()
+    await asyncio.gather(lanes.submit("trip_1", 13.0, 80.0), lanes.submit("trip_2", 12.0, 79.0))
+    assert sorted(processed) == [("trip_1", 13.0, 80.0), ("trip_2", 12.0, 79.0)]
+
+@pytest.mark.asyncio
+async def test_batch_replays_every_fix_and_updates_live_location_once(processed):
+    lanes = TripLaneManager()
+    fixes = [(13.0 + i / 100, 80.0, T0 + timedelta(seconds=i)) for i in (2, 0, 1)]
+    summary = await lanes.submit_batch("trip_1", fixes)
+    assert summary["accepted"] == 3
+    assert [c[1] for c in processed] == [13.0, 13.01, 13.02]
+    assert processed.live_updates == [False, False, True]
+
+@pytest.mark.asyncio
+async def test_batch_skips_fixes_already_processed(processed):
+    lanes = TripLaneManager()
+    await lanes.submit("trip_1", 13.05, 80.0, T0 + timedelta(seconds=5))
+    summary = await lanes.submit_batch("trip_1", [(13.0 + i / 100, 80.0, T0 + timedelta(seconds=i)) for i in range(8)])
+    assert summary["stale"] == 6
+    assert [c[1] for c in processed] == [13.05, 13.06, 13.07]
+
+def test_batch_endpoint(client, processed):
+    payload = {
+        "trip_id": "trip_batch",
+        "fixes": [
+            {"latitude": 13.01, "longitude": 80.0, "timestamp": (T0 + timedelta(seconds=1)).isoformat()},
+            {"latitude": 13.00, "longitude": 80.0, "timestamp": T0.isoformat()},
+        ]
+    }
+    response = client.post("/api/v1/bus-tracking/locations/batch", json=payload, headers=HEADERS)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["received"] == 2
+    assert data["processed"] == 2
+    assert [c[1] for c in processed] == [13.00, 13.01]
+
+def test_batch_with_mixed_timezone_awareness(client, processed):
+    aware = (T0 + timedelta(seconds=1)).astimezone(timezone.utc)
+    payload = {
+        "trip_id": "trip_batch_tz",
+        "fixes": [
+            {"latitude": 13.01, "longitude": 80.0, "timestamp": aware.isoformat()},
+            {"latitude": 13.00, "longitude": 80.0, "timestamp": T0.isoformat()},
+        ]
+    }
+    response = client.post("/api/v1/bus-tracking/locations/batch", json=payload, headers=HEADERS)
+    assert response.status_code == 200
+    assert response.json()["processed"] == 2
+    assert [c[1] for c in processed] == [13.00, 13.01]
@@ -0,0 +1,63 @@
+import pytest
+import app.core.database as database
+from datetime import datetime, timedelta
+from app.services.live_locations import LiveLocationBuffer, live_location_buffer
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 Safari",
+    "Origin": "https://transport.selvagam.com"
+}
+
+T0 = datetime(2026, 1, 5, 7, 30, 0)
+
+@pytest.fixture
+def buffer():
+    return LiveLocationBuffer(interval=2)
+
+def test_positions_coalesce_into_one_multi_row_flush(buffer, mock_db_cursor):
+    for i in range(10):
+        buffer.record("driver_1", 13.0 + i / 100, 80.0, T0 + timedelta(seconds=i))
+    buffer.record("driver_2", 12.0, 79.0, T0)
+
+    assert buffer.flush() == 2
+    mock_db_cursor.executemany.assert_called_once()
+    rows = mock_db_cursor.executemany.call_args.args[1]
+    assert rows == [("driver_1", 13.09, 80.0, T0 + timedelta(seconds=9)), ("driver_2", 12.0, 79.0, T0)]
+    # Nothing moved since, nothing to write
+    assert buffer.flush() == 0
+
+def test_older_position_does_not_overwrite_newer(buffer):
+    buffer.record("driver_1", 13.05, 80.0, T0 + timedelta(seconds=5))
+    buffer.record("driver_1", 13.01, 80.0, T0)
+    assert buffer.get("driver_1")["latitude"] == 13.05
+
+def test_failed_flush_keeps_positions_buffered(buffer, mocker):
+    mocker.patch("app.services.live_locations.execute_many", side_effect=Exception("Lost connection"))
+    buffer.record("driver_1", 13.0, 80.0, T0)
+    assert buffer.flush() == 0
+    assert buffer.get_stats()["pending_writes"] == 1
+
+def test_merge_prefers_newer_buffered_position(buffer):
+    buffer.record("driver_1", 13.5, 80.5, T0 + timedelta(minutes=1))
+    buffer.record("driver_3", 11.0, 78.0, T0)
+    rows = [
+        {"driver_id": "driver_1", "latitude": 13.0, "longitude": 80.0, "updated_at": T0},
+        {"driver_id": "driver_2", "latitude": 12.0, "longitude": 79.0, "updated_at": T0},
+    ]
+    merged = {r["driver_id"]: r for r in buffer.merge(rows)}
+    assert merged["driver_1"]["latitude"] == 13.5
+    assert merged["driver_2"]["latitude"] == 12.0
+    assert "driver_3" in merged
+
+def test_driver_location_put_is_buffered_and_readable(client, mock_db_cursor):
+    live_location_buffer.forget("driver_buf")
+    mock_db_cursor.fetchone.return_value = {"driver_id": "driver_buf"}
+    response = client.put("/api/v1/drivers/driver_buf/location", json={"latitude": 13.08, "longitude": 80.27}, headers=HEADERS)
+    assert response.status_code == 200
+    assert not any("driver_live_locations" in c.args[0] for c in database.execute_query.call_args_list)
+
+    mock_db_cursor.fetchone.return_value = None
+    response = client.get("/api/v1/drivers/driver_buf/location", headers=HEADERS)
+    assert response.status_code == 200
+    assert response.json()["latitude"] == 13.08
+    live_location_buffer.forget("driver_buf")
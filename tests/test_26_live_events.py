@@ -0,0 +1,56 @@
+import pytest
+from app.services.live_events import LiveEventBroker, live_event_broker, topic_for
+from app.api.routes import _sse_events
+
+@pytest.mark.asyncio
+async def test_events_fan_out_to_matching_topics():
+    broker = LiveEventBroker()
+    trip_sub = broker.subscribe(topic_for(trip_id="trip_1"))
+    route_sub = broker.subscribe(topic_for(route_id="route_1"))
+    other_sub = broker.subscribe(topic_for(route_id="route_2"))
+    fleet_sub = broker.subscribe(topic_for())
+
+    broker.publish_position(13.0, 80.0, trip_id="trip_1", route_id="route_1", driver_id="driver_1")
+
+    for sub in (trip_sub, route_sub, fleet_sub):
+        assert (await sub.get(timeout=0.1))["latitude"] == 13.0
+    assert await other_sub.get(timeout=0.01) is None
+
+@pytest.mark.asyncio
+async def test_new_subscriber_gets_latest_position_first():
+    broker = LiveEventBroker()
+    broker.publish_position(13.0, 80.0, trip_id="trip_1", route_id="route_1")
+    broker.publish_position(13.1, 80.1, trip_id="trip_1", route_id="route_1")
+    sub = broker.subscribe(topic_for(route_id="route_1"))
+    assert (await sub.get(timeout=0.1))["latitude"] == 13.1
+    assert await sub.get(timeout=0.01) is None
+
+    broker.forget_trip("trip_1")
+    assert broker.subscribe(topic_for(trip_id="trip_1")).queue.empty()
+
+@pytest.mark.asyncio
+async def test_slow_subscriber_drops_oldest_events():
+    broker = LiveEventBroker(max_queue=2)
+    sub = broker.subscribe(topic_for(trip_id="trip_1"))
+    for i in range(5):
+        broker.publish({"type": "stop_progress", "trip_id": "trip_1", "current_stop_order": i})
+    assert sub.dropped == 3
+    assert (await sub.get(timeout=0.1))["current_stop_order"] == 3
+
+@pytest.mark.asyncio
+async def test_sse_body_formats_events(mocker):
+    request = mocker.Mock()
+    request.is_disconnected = mocker.AsyncMock(side_effect=[False, True])
+    sub = live_event_broker.subscribe(topic_for(trip_id="trip_sse"))
+    live_event_broker.publish({"type": "stop_progress", "trip_id": "trip_sse", "current_stop_order": 2})
+    chunks = [chunk async for chunk in _sse_events(request, sub)]
+    assert chunks[0].startswith("event: stop_progress\ndata: {")
+    assert live_event_broker.get_stats()["subscribers"] == 0
+
+def test_websocket_sends_snapshot(client):
+    live_event_broker.publish_position(12.9, 80.2, trip_id="trip_ws", route_id="route_ws", driver_id="driver_ws")
+    with client.websocket_connect("/api/v1/live/ws?route_id=route_ws") as ws:
+        event = ws.receive_json()
+    assert event["type"] == "position"
+    assert event["trip_id"] == "trip_ws"
+    live_event_broker.forget_trip("trip_ws")
@@ -0,0 +1,48 @@
+import pytest
+from types import SimpleNamespace
+from app.notification_api.service import FCMService, FirebaseTransport, FCM_MULTICAST_LIMIT
+
+def fake_batch(message):
+    return SimpleNamespace(responses=[
+        SimpleNamespace(success=not t.startswith("dead"), message_id=f"id-{t}",
+                        exception=None if not t.startswith("dead") else Exception("Requested entity was not found."))
+        for t in message.tokens
+    ])
+
+@pytest.fixture
+def service(mocker):
+    mocker.patch("app.services.token_cleanup.dead_token_pruner.report")
+    svc = FCMService.__new__(FCMService)
+    svc.initialized = True
+    svc.last_error = None
+    svc.creds_path = None
+    svc.transport = FirebaseTransport()
+    return svc
+
+@pytest.mark.asyncio
+async def test_broadcast_is_chunked_into_multicast_calls(service, mocker):
+    send = mocker.patch("app.notification_api.service.messaging.send_each_for_multicast", side_effect=fake_batch)
+    tokens = [f"token{i}" for i in range(1200)]
+    result = await service.broadcast_to_tokens(tokens + tokens[:10], "Title", "Body")
+
+    assert [len(c.args[0].tokens) for c in send.call_args_list] == [FCM_MULTICAST_LIMIT, FCM_MULTICAST_LIMIT, 200]
+    assert result["delivered"] == 1200
+    assert result["failed"] == 0
+
+@pytest.mark.asyncio
+async def test_results_map_back_to_tokens(service, mocker):
+    mocker.patch("app.notification_api.service.messaging.send_each_for_multicast", side_effect=fake_batch)
+    results = await service.send_multicast(["ok1", "dead1", "undefined", "ok2"], "Title", "Body", data={"trip_id": "t1"})
+
+    by_token = {r["token"]: r for r in results}
+    assert [r["token"] for r in results] == ["ok1", "dead1", "undefined", "ok2"]
+    assert by_token["ok1"] == {"token": "ok1", "success": True, "messageId": "id-ok1"}
+    assert by_token["dead1"]["error"] == "Requested entity was not found."
+    assert by_token["undefined"]["error"] == "Invalid token"
+
+@pytest.mark.asyncio
+async def test_failed_call_marks_its_chunk_failed(service, mocker):
+    mocker.patch("app.notification_api.service.messaging.send_each_for_multicast", side_effect=Exception("quota exceeded"))
+    result = await service.broadcast_to_tokens(["a", "b"], "Title", "Body")
+    assert result["delivered"] == 0
+    assert result["failure_reasons"] == ["quota exceeded", "quota exceeded"]
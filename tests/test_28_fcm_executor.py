@@ -0,0 +1,49 @@
+import time
+import asyncio
+import threading
+import pytest
+from app.notification_api.service import FCMExecutor, notification_service
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 Safari",
+    "Origin": "https://transport.selvagam.com"
+}
+
+@pytest.mark.asyncio
+async def test_concurrency_is_capped_and_queue_depth_recorded():
+    executor = FCMExecutor(workers=4, max_concurrency=2)
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    def slow_send():
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.02)
+        with lock:
+            active[0] -= 1
+        return threading.current_thread().name
+
+    names = await asyncio.gather(*[executor.run(slow_send) for _ in range(6)])
+    stats = executor.get_stats()
+    executor.shutdown()
+
+    assert peak[0] == 2
+    assert stats["calls"] == 6
+    assert stats["max_queue_depth"] >= 4
+    assert stats["queued"] == 0 and stats["in_flight"] == 0
+    assert all(name.startswith("fcm") for name in names)
+
+@pytest.mark.asyncio
+async def test_login_request_send_runs_on_fcm_pool(mocker):
+    seen = []
+    mocker.patch("app.notification_api.service.messaging.send", side_effect=lambda m: seen.append(threading.current_thread().name) or "msg-1")
+    mocker.patch.object(notification_service, "initialized", True)
+    result = await notification_service.send_login_request("token123", "req_1", "Pixel 8")
+    assert result == {"success": True, "message_id": "msg-1"}
+    assert seen[0].startswith("fcm")
+
+def test_status_reports_executor_metrics(client):
+    response = client.get("/api/v1/notifications/status", headers=HEADERS)
+    assert response.status_code == 200
+    assert "max_queue_depth" in response.json()["executor"]
@@ -0,0 +1,84 @@
+import json
+import pytest
+from unittest.mock import AsyncMock
+import app.core.database as database
+from app.services.bus_tracking import bus_tracking_service
+from app.services.notification_outbox import NotificationOutbox
+from app.services.trip_state import trip_state_cache
+from app.notification_api.service import notification_service
+
+TRIP = {
+    "trip_id": "trip_outbox_1", "route_id": "route_1", "trip_type": "PICKUP", "driver_id": "driver_1",
+    "status": "ONGOING", "current_stop_order": 0, "is_first_stop_notified": 1,
+    "skipped_stops": "[]", "stop_logs": "{}"
+}
+STOPS = [
+    {"stop_id": "s1", "stop_name": "Stop 1", "location": "Anna Nagar", "latitude": "13.0850", "longitude": "80.2100", "stop_order": 1},
+    {"stop_id": "s2", "stop_name": "Stop 2", "location": "Kilpauk", "latitude": "13.0820", "longitude": "80.2400", "stop_order": 2},
+]
+
+def outbox_updates():
+    return [c for c in database.execute_query.call_args_list if c.args[0].lstrip().startswith("UPDATE notification_outbox")]
+
+def row(**overrides):
+    base = {
+        "outbox_id": "ob1", "title": "🚌 Bus Arrived", "body": "The bus has arrived.", "data": '{"trip_id": "t1"}',
+        "message_type": "audio", "recipients": '{"tokens": ["tok1", "tok2"]}', "attempts": 1,
+        "delivered_count": 0, "locked_by": "lease1"
+    }
+    base.update(overrides)
+    return base
+
+@pytest.mark.asyncio
+async def test_arrival_enqueues_instead_of_sending(mock_db_cursor, mocker):
+    mock_db_cursor.fetchone.return_value = dict(TRIP)
+    mock_db_cursor.fetchall.return_value = [dict(s) for s in STOPS]
+    mocker.patch.object(bus_tracking_service, "get_students_for_location", return_value=[{"student_id": "std1"}])
+    send = mocker.patch.object(notification_service, "send_multicast", new=AsyncMock())
+    trip_state_cache.drop(TRIP["trip_id"])
+
+    result = await bus_tracking_service.update_bus_location(TRIP["trip_id"], 13.0851, 80.2101)
+    trip_state_cache.drop(TRIP["trip_id"])
+
+    assert result["current_stop_order"] == 1
+    inserts = [c for c in mock_db_cursor.execute.call_args_list if "INSERT INTO notification_outbox" in c.args[0]]
+    assert len(inserts) == 2  # arrival at Anna Nagar + approaching Kilpauk
+    assert json.loads(inserts[0].args[1][5]) == {"student_ids": ["std1"], "route_id": "route_1"}
+    send.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_delivered_row_is_marked_sent(mocker):
+    mocker.patch.object(notification_service, "send_multicast", new=AsyncMock(return_value=[
+        {"token": "tok1", "success": True}, {"token": "tok2", "success": True}
+    ]))
+    assert await NotificationOutbox().deliver(row()) == "SENT"
+    params = outbox_updates()[-1].args[1]
+    assert params[:3] == ("SENT", 2, 0)
+
+@pytest.mark.asyncio
+async def test_failed_tokens_are_retried_with_backoff(mocker):
+    mocker.patch.object(notification_service, "send_multicast", new=AsyncMock(return_value=[
+        {"token": "tok1", "success": True}, {"token": "tok2", "success": False, "error": "Service unavailable"}
+    ]))
+    outbox = NotificationOutbox()
+    assert await outbox.deliver(row(attempts=2)) == "PENDING"
+    params = outbox_updates()[-1].args[1]
+    assert json.loads(params[0]) == {"tokens": ["tok2"]}
+    assert params[1] == 1
+    assert params[4] == outbox.backoff(2) == outbox.retry_base * 2
+
+@pytest.mark.asyncio
+async def test_gives_up_after_max_attempts(mocker):
+    mocker.patch.object(notification_service, "send_multicast", new=AsyncMock(return_value=[
+        {"token": "tok1", "success": False, "error": "Service unavailable"}
+    ]))
+    outbox = NotificationOutbox()
+    assert await outbox.deliver(row(recipients='{"tokens": ["tok1"]}', attempts=outbox.max_attempts)) == "FAILED"
+
+@pytest.mark.asyncio
+async def test_claim_leases_due_rows(mock_db_cursor):
+    mock_db_cursor.fetchall.return_value = [row()]
+    rows = await NotificationOutbox().claim()
+    assert len(rows) == 1
+    claim_sql = database.execute_query.call_args_list[0].args[0]
+    assert "locked_until < CURRENT_TIMESTAMP" in claim_sql
@@ -0,0 +1,78 @@
+import pytest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+from firebase_admin import messaging, exceptions
+from app.notification_api.service import FCMService, FirebaseTransport, is_dead_token_error, notification_service
+from app.services.notification_outbox import NotificationOutbox
+from app.services.token_cleanup import DeadTokenPruner, dead_token_pruner
+
+def statements(cursor):
+    return [c.args[0].strip() for c in cursor.execute.call_args_list]
+
+@pytest.fixture
+def service():
+    svc = FCMService.__new__(FCMService)
+    svc.initialized = True
+    svc.last_error = None
+    svc.creds_path = None
+    svc.transport = FirebaseTransport()
+    return svc
+
+def test_dead_token_classification():
+    assert is_dead_token_error(messaging.UnregisteredError("Requested entity was not found."))
+    assert is_dead_token_error(exceptions.InvalidArgumentError("The registration token is not a valid FCM registration token"))
+    assert not is_dead_token_error(exceptions.InvalidArgumentError("Message payload is too large"))
+    assert not is_dead_token_error(exceptions.UnavailableError("Service unavailable"))
+    assert not is_dead_token_error(Exception("quota exceeded"))
+
+@pytest.mark.asyncio
+async def test_multicast_reports_only_dead_tokens(service, mocker):
+    report = mocker.patch.object(dead_token_pruner, "report")
+    errors = {"gone": messaging.UnregisteredError("Requested entity was not found."),
+              "busy": exceptions.UnavailableError("Service unavailable")}
+    mocker.patch("app.notification_api.service.messaging.send_each_for_multicast", side_effect=lambda m: SimpleNamespace(
+        responses=[SimpleNamespace(success=t not in errors, message_id=f"id-{t}", exception=errors.get(t)) for t in m.tokens]
+    ))
+
+    result = await service.broadcast_to_tokens(["ok", "gone", "busy"], "Title", "Body")
+
+    report.assert_called_once_with(["gone"])
+    assert result["failed"] == 2
+    assert result["dead_tokens"] == 1
+
+def test_prune_removes_tokens_and_updates_route_caches(mock_db_cursor, mocker):
+    mock_db_cursor.fetchall.return_value = [{"route_id": "route_1"}, {"route_id": "route_2"}]
+    remove = mocker.patch("app.services.token_cleanup.cascade_service.remove_route_tokens")
+    pruner = DeadTokenPruner(delay=0)
+    pruner.report(["tokA", "tokB", "tokA"])
+
+    result = pruner.prune()
+
+    sql = statements(mock_db_cursor)
+    assert any(s.startswith("DELETE FROM fcm_tokens WHERE fcm_token IN (%s, %s)") for s in sql)
+    assert any(s.startswith("UPDATE drivers SET fcm_token = NULL WHERE fcm_token IN (%s, %s)") for s in sql)
+    assert [c.args[0] for c in remove.call_args_list] == ["route_1", "route_2"]
+    assert sorted(remove.call_args_list[0].args[1]) == ["tokA", "tokB"]
+    assert result["tokens"] == 2 and result["routes_refreshed"] == 2
+    assert pruner.get_stats()["pending"] == 0
+
+def test_failed_prune_keeps_tokens_queued(mocker):
+    mocker.patch("app.services.token_cleanup.execute_query", side_effect=Exception("lock wait timeout"))
+    pruner = DeadTokenPruner(delay=0)
+    pruner.report(["tokA"])
+    with pytest.raises(Exception):
+        pruner.prune()
+    assert pruner.get_stats()["pending"] == 1
+    assert pruner.stats["prune_failures"] == 1
+
+@pytest.mark.asyncio
+async def test_outbox_does_not_retry_dead_tokens(mocker):
+    mocker.patch.object(notification_service, "send_multicast", new=AsyncMock(return_value=[
+        {"token": "tok1", "success": True}, {"token": "tok2", "success": False, "error": "Requested entity was not found.", "dead": True}
+    ]))
+    row = {"outbox_id": "ob1", "title": "t", "body": "b", "data": "{}", "message_type": "audio",
+           "recipients": '{"tokens": ["tok1", "tok2"]}', "attempts": 1, "delivered_count": 0, "locked_by": "lease1"}
+    outbox = NotificationOutbox()
+
+    assert await outbox.deliver(row) == "SENT"
+    assert outbox.stats["dead_tokens"] == 1
@@ -0,0 +1,97 @@
+import pytest
+from unittest.mock import AsyncMock
+from app.core.database import unit_of_work_async
+from app.notification_api.service import notification_service
+from app.services.cascade_updates import cascade_service
+from app.services.proximity_service import proximity_service
+from app.services.topic_subscriptions import TopicSubscriptionManager, topic_subscriptions, route_audience
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 Safari",
+    "Origin": "https://transport.selvagam.com",
+    "x-admin-key": "test_admin_key"
+}
+
+def test_route_audience():
+    assert route_audience("r1", "PICKUP") == {"topic": "route_r1_pickup"}
+    assert route_audience("r1") == {"condition": "'route_r1_pickup' in topics || 'route_r1_drop' in topics"}
+
+def test_desired_topics_follow_students(mock_db_cursor):
+    mock_db_cursor.fetchall.return_value = [
+        {"fcm_token": "tok1", "class_id": "c1", "pickup_route_id": "r1", "drop_route_id": "r2",
+         "pickup_stop_id": "s1", "drop_stop_id": "s2", "rides_bus": 1},
+        {"fcm_token": "tok2", "class_id": "c1", "pickup_route_id": "r1", "drop_route_id": "r1",
+         "pickup_stop_id": "s1", "drop_stop_id": "s1", "rides_bus": 0},
+    ]
+    desired = TopicSubscriptionManager().desired_topics(["tok1", "tok2", "tok3"])
+    assert desired["tok1"] == {"class_c1", "route_r1_pickup", "route_r2_drop", "stop_s1", "stop_s2"}
+    assert desired["tok2"] == {"class_c1"}
+    assert desired["tok3"] == set()
+
+@pytest.mark.asyncio
+async def test_sync_only_sends_the_difference(mocker):
+    manager = TopicSubscriptionManager()
+    mocker.patch.object(manager, "desired_topics", return_value={"tok1": {"route_r1_pickup", "stop_s1"}, "tok2": set()})
+    mocker.patch.object(manager, "current_topics", return_value={"tok1": {"stop_s1", "stop_old"}, "tok2": {"class_c1"}})
+    update = mocker.patch.object(notification_service, "update_topic_membership",
+                                 new=AsyncMock(side_effect=lambda tokens, topic, subscribe: {t: None for t in tokens}))
+    write = mocker.patch("app.services.topic_subscriptions.execute_many")
+
+    result = await manager.sync_tokens(["tok1", "tok2"])
+
+    calls = sorted((c.args[1], c.kwargs["subscribe"], tuple(c.args[0])) for c in update.call_args_list)
+    assert calls == [("class_c1", False, ("tok2",)), ("route_r1_pickup", True, ("tok1",)), ("stop_old", False, ("tok1",))]
+    assert result == {"tokens": 2, "subscribed": 1, "unsubscribed": 2}
+    assert write.call_args_list[0].args[1] == [("tok1", "route_r1_pickup")]
+
+def test_request_sync_is_a_noop_when_disabled():
+    manager = TopicSubscriptionManager()
+    manager.enabled = False
+    manager.request_sync(tokens=["tok1"], student_ids=["std1"])
+    assert manager.get_stats()["pending_tokens"] == 0
+
+@pytest.mark.asyncio
+async def test_start_trip_uses_one_topic_send(mock_db_cursor, mocker):
+    mock_db_cursor.fetchone.return_value = {"trip_type": "DROP"}
+    mocker.patch.object(topic_subscriptions, "fanout", True)
+    mocker.patch("app.services.proximity_service.trip_state_cache.warm", new=AsyncMock())
+    send = mocker.patch.object(notification_service, "send_to_topic", new=AsyncMock(return_value={"success": True}))
+    fetch = mocker.patch.object(proximity_service, "fetch_tokens_by_route", new=AsyncMock())
+
+    result = await proximity_service.start_trip("trip1", "r1")
+
+    assert result["topic"] == "route_r1_drop"
+    assert send.call_args.kwargs["topic"] == "route_r1_drop"
+    assert send.call_args.kwargs["data"]["status"] == "STARTED"
+    fetch.assert_not_called()
+
+def test_route_notification_fans_out_through_topic(client, mocker):
+    mocker.patch("app.api.notification_routes.ADMIN_KEY", "test_admin_key")
+    mocker.patch.object(topic_subscriptions, "fanout", True)
+    send = mocker.patch.object(notification_service, "send_to_topic", new=AsyncMock(return_value={"success": True, "messageId": "m1"}))
+    multicast = mocker.patch.object(notification_service, "send_multicast", new=AsyncMock())
+
+    response = client.post("/api/v1/notifications/route/r1", json={"title": "Hi", "body": "Route notice"}, headers=HEADERS)
+
+    assert response.status_code == 200
+    assert response.json()["fanout"] == "topic"
+    assert send.call_args.kwargs["condition"] == "'route_r1_pickup' in topics || 'route_r1_drop' in topics"
+    multicast.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_cascade_marks_sync_only_after_commit(mocker):
+    mark = mocker.patch.object(topic_subscriptions, "request_sync")
+    mocker.patch.object(topic_subscriptions, "enabled", True)
+    mocker.patch.object(topic_subscriptions, "tokens_for_students", return_value=["tok1"])
+
+    async with unit_of_work_async():
+        cascade_service.delete_cascades("students", "std1", {})
+        # A sync running now would still read the student's rows
+        mark.assert_not_called()
+    mark.assert_called_once_with(["tok1"])
+
+    with pytest.raises(ValueError):
+        async with unit_of_work_async():
+            cascade_service.update_student_cascades("std1")
+            raise ValueError("Student update failed")
+    mark.assert_called_once()
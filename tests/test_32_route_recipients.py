@@ -0,0 +1,71 @@
+import json
+import pytest
+from app.services.bus_tracking import bus_tracking_service
+from app.services.route_recipients import RouteRecipientCache, RouteRecipients, build_stop_fcm_map, route_recipient_cache
+
+ROWS = [
+    {"stop_id": "s1", "stop_name": "Gate 1", "location": "Anna Nagar", "pickup_stop_order": 1, "drop_stop_order": 2,
+     "student_id": "std1", "student_name": "Asha", "is_pickup": 1, "is_drop": 0, "fcm_token": "tokA", "parent_id": "p1", "parent_name": "Ravi"},
+    {"stop_id": "s1", "stop_name": "Gate 1", "location": "Anna Nagar", "pickup_stop_order": 1, "drop_stop_order": 2,
+     "student_id": "std1", "student_name": "Asha", "is_pickup": 1, "is_drop": 0, "fcm_token": "tokB", "parent_id": "p2", "parent_name": "Mala"},
+    {"stop_id": "s2", "stop_name": "Kilpauk", "location": "", "pickup_stop_order": 2, "drop_stop_order": 1,
+     "student_id": "std2", "student_name": "Bala", "is_pickup": 1, "is_drop": 1, "fcm_token": None, "parent_id": None, "parent_name": None},
+]
+
+def executed(cursor, fragment):
+    return [c for c in cursor.execute.call_args_list if fragment in c.args[0]]
+
+def test_map_keeps_tokens_and_indexes_students():
+    fcm_map = build_stop_fcm_map(ROWS)
+    assert [t["fcm_token"] for t in fcm_map["s1"]["fcm_tokens"]] == ["tokA", "tokB"]
+    recipients = RouteRecipients("r1", fcm_map, 3)
+
+    assert [s["student_id"] for s in recipients.students_at("Anna Nagar", "PICKUP")] == ["std1"]
+    assert recipients.students_at("Anna Nagar", "DROP") == []
+    assert [s["student_id"] for s in recipients.students_at("Kilpauk", "DROP")] == ["std2"]  # empty location falls back to stop name
+    assert recipients.tokens_for(["std1", "std2"]) == ["tokA", "tokB"]
+    assert recipients.covers(["std1", "std2"]) and not recipients.covers(["std3"])
+
+def test_cached_route_is_served_from_memory(mock_db_cursor):
+    mock_db_cursor.fetchone.return_value = {"stop_fcm_map": json.dumps(build_stop_fcm_map(ROWS)), "version": 4}
+    cache = RouteRecipientCache(check_interval=60)
+    assert cache.get("r1").version == 4
+    mock_db_cursor.execute.reset_mock()
+
+    assert cache.get("r1").students_at("Anna Nagar", "PICKUP")
+    mock_db_cursor.execute.assert_not_called()
+
+def test_version_change_reloads_route(mock_db_cursor):
+    mock_db_cursor.fetchone.return_value = {"stop_fcm_map": json.dumps(build_stop_fcm_map(ROWS)), "version": 4}
+    cache = RouteRecipientCache(check_interval=0)
+    cache.get("r1")
+
+    mock_db_cursor.fetchone.return_value = {"stop_fcm_map": json.dumps(build_stop_fcm_map(ROWS[:1])), "version": 4}
+    assert cache.get("r1").covers(["std2"])  # same version: kept
+    mock_db_cursor.fetchone.return_value = {"stop_fcm_map": json.dumps(build_stop_fcm_map(ROWS[:1])), "version": 5}
+    assert not cache.get("r1").covers(["std2"])
+
+def test_legacy_map_is_rebuilt(mock_db_cursor):
+    legacy = {"s1": {"stop_name": "Gate 1", "pickup_order": 1, "drop_order": 2, "fcm_tokens": []}}
+    mock_db_cursor.fetchone.return_value = {"stop_fcm_map": json.dumps(legacy), "version": 1}
+    mock_db_cursor.fetchall.return_value = ROWS
+    recipients = RouteRecipientCache().get("r1")
+
+    assert recipients.covers(["std1", "std2"])
+    assert executed(mock_db_cursor, "INSERT INTO route_stop_fcm_cache")
+
+def test_arrival_lookup_skips_student_joins(mock_db_cursor, mocker):
+    recipients = RouteRecipients("r1", build_stop_fcm_map(ROWS), 1)
+    mocker.patch.object(route_recipient_cache, "get", return_value=recipients)
+
+    students = bus_tracking_service.get_students_for_location("r1", "Anna Nagar", "PICKUP")
+    tokens = bus_tracking_service.get_parent_tokens_for_students(["std1"], route_id="r1")
+
+    assert [s["student_id"] for s in students] == ["std1"]
+    assert tokens == ["tokA", "tokB"]
+    assert not executed(mock_db_cursor, "FROM students")
+
+def test_uncovered_students_fall_back_to_sql(mock_db_cursor, mocker):
+    mocker.patch.object(route_recipient_cache, "get", return_value=RouteRecipients("r1", build_stop_fcm_map(ROWS), 1))
+    mock_db_cursor.fetchall.return_value = [{"fcm_token": "tokZ"}]
+    assert bus_tracking_service.get_parent_tokens_for_students(["std9"], route_id="r1") == ["tokZ"]
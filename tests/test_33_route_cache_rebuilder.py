@@ -0,0 +1,48 @@
+import pytest
+from app.services.cascade_updates import cascade_service
+from app.services.route_cache_rebuilder import RouteCacheRebuilder, route_cache_rebuilder
+from app.services.route_recipients import route_recipient_cache
+
+def test_repeated_marks_rebuild_once(mocker):
+    rebuild = mocker.patch.object(route_recipient_cache, "rebuild")
+    rebuilder = RouteCacheRebuilder(delay=0, max_delay=30)
+    for _ in range(5):
+        rebuilder.mark_dirty("r1")
+    rebuilder.mark_dirty("r2")
+
+    assert rebuilder.flush() == 2
+    assert sorted(c.args[0] for c in rebuild.call_args_list) == ["r1", "r2"]
+    stats = rebuilder.get_stats()
+    assert stats["coalesced"] == 4 and stats["rebuilds"] == 2 and stats["pending_routes"] == 0
+
+def test_due_waits_for_quiet_period_but_not_forever():
+    rebuilder = RouteCacheRebuilder(delay=2, max_delay=10)
+    rebuilder.mark_dirty("r1")
+    entry = rebuilder._dirty["r1"]
+    assert rebuilder.due(now=entry["last"] + 1) == []
+    assert rebuilder.due(now=entry["last"] + 2) == ["r1"]
+
+    entry["first"] -= 10  # still being edited, but marked 10s ago
+    assert rebuilder.due(now=entry["last"] + 1) == ["r1"]
+
+def test_mark_during_rebuild_keeps_route_dirty(mocker):
+    rebuilder = RouteCacheRebuilder(delay=0, max_delay=30)
+    mocker.patch.object(route_recipient_cache, "rebuild", side_effect=lambda route_id, **kw: rebuilder.mark_dirty(route_id))
+    rebuilder.mark_dirty("r1")
+    assert rebuilder.rebuild("r1") is True
+    assert rebuilder.get_stats()["pending_routes"] == 1
+
+def test_failed_rebuild_is_retried(mocker):
+    mocker.patch.object(route_recipient_cache, "rebuild", side_effect=Exception("deadlock"))
+    rebuilder = RouteCacheRebuilder(delay=0, max_delay=30)
+    rebuilder.mark_dirty("r1")
+    assert rebuilder.rebuild("r1") is False
+    assert rebuilder.due() == ["r1"]
+
+def test_cascades_only_mark_routes_while_worker_runs(mocker):
+    rebuild = mocker.patch.object(route_recipient_cache, "rebuild")
+    mark = mocker.patch.object(route_cache_rebuilder, "mark_dirty")
+    mocker.patch.object(route_cache_rebuilder, "running", True)
+    cascade_service.update_route_fcm_cache("r1")
+    mark.assert_called_once_with("r1")
+    rebuild.assert_not_called()
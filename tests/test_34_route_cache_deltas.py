@@ -0,0 +1,101 @@
+import json
+import pytest
+from app.services.cascade_updates import cascade_service
+from app.services.route_cache_rebuilder import RouteCacheRebuilder
+from app.services.route_recipients import (
+    RouteRecipientCache, build_stop_fcm_map, canonical_map, remove_tokens_from_map, replace_students_in_map, route_recipient_cache
+)
+
+def row(stop_id, student_id, token, pickup=1, drop=1, parent_id="p1"):
+    return {"stop_id": stop_id, "stop_name": f"Stop {stop_id}", "location": f"Area {stop_id}", "pickup_stop_order": 1,
+            "drop_stop_order": 1, "student_id": student_id, "student_name": student_id, "is_pickup": pickup, "is_drop": drop,
+            "fcm_token": token, "parent_id": parent_id if token else None, "parent_name": "Parent" if token else None}
+
+ROWS = [row("s1", "std1", "tokA"), row("s1", "std2", "tokB", parent_id="p2"), row("s2", "std3", "tokC", parent_id="p3")]
+
+def executed(cursor, fragment):
+    return [c for c in cursor.execute.call_args_list if fragment in c.args[0]]
+
+def test_student_moved_between_stops_matches_full_rebuild():
+    fcm_map = build_stop_fcm_map(ROWS)
+    moved = [row("s2", "std1", "tokA"), row("s2", "std1", "tokD")]
+    replace_students_in_map(fcm_map, ["std1"], moved)
+
+    assert canonical_map(fcm_map) == canonical_map(build_stop_fcm_map(ROWS[1:] + moved))
+
+def test_last_student_leaving_drops_the_stop():
+    fcm_map = build_stop_fcm_map(ROWS)
+    replace_students_in_map(fcm_map, ["std3"], [])
+    assert list(fcm_map) == ["s1"]
+
+def test_token_removal_matches_full_rebuild():
+    fcm_map = build_stop_fcm_map(ROWS)
+    remove_tokens_from_map(fcm_map, ["tokB"])
+    expected = build_stop_fcm_map([ROWS[0], row("s1", "std2", None), ROWS[2]])
+    assert canonical_map(fcm_map) == canonical_map(expected)
+
+def test_delta_updates_row_under_lock_and_bumps_version(mock_db_cursor):
+    mock_db_cursor.fetchone.return_value = {"stop_fcm_map": json.dumps(build_stop_fcm_map(ROWS)), "version": 7}
+    mock_db_cursor.fetchall.return_value = [row("s2", "std1", "tokA")]
+    cache = RouteRecipientCache(check_interval=60)
+
+    assert cache.refresh_students("r1", ["std1"]) is True
+
+    assert executed(mock_db_cursor, "AND s.student_id IN (%s)")
+    assert executed(mock_db_cursor, "FOR UPDATE")
+    update = executed(mock_db_cursor, "UPDATE route_stop_fcm_cache")[0]
+    assert "version = version + 1" in update.args[0]
+    assert [s["student_id"] for s in json.loads(update.args[1][0])["s2"]["students"]] == ["std3", "std1"]
+
+    mock_db_cursor.execute.reset_mock()
+    recipients = cache.get("r1")  # served from memory, no re-read
+    assert recipients.version == 8 and recipients.students_at("Area s2", "PICKUP")
+    mock_db_cursor.execute.assert_not_called()
+
+def test_legacy_row_falls_back_to_full_rebuild(mock_db_cursor, mocker):
+    mock_db_cursor.fetchone.return_value = {"stop_fcm_map": json.dumps({"s1": {"stop_name": "Gate", "fcm_tokens": []}}), "version": 1}
+    rebuild = mocker.patch.object(cascade_service, "update_route_fcm_cache")
+
+    cascade_service.remove_route_tokens("r1", ["tokA"])
+
+    rebuild.assert_called_once_with("r1")
+    assert not executed(mock_db_cursor, "UPDATE route_stop_fcm_cache")
+
+def test_uncached_route_is_left_alone(mock_db_cursor, mocker):
+    mock_db_cursor.fetchone.return_value = None
+    rebuild = mocker.patch.object(cascade_service, "update_route_fcm_cache")
+    cascade_service.remove_route_tokens("r1", ["tokA"])
+    rebuild.assert_not_called()
+
+def test_reconcile_counts_drift(mock_db_cursor):
+    stale = build_stop_fcm_map(ROWS[:2])
+    mock_db_cursor.fetchone.return_value = {"stop_fcm_map": json.dumps(stale), "version": 3}
+    mock_db_cursor.fetchall.return_value = ROWS
+    cache = RouteRecipientCache()
+
+    cache.rebuild("r1", reconcile=True)
+    mock_db_cursor.fetchone.return_value = {"stop_fcm_map": json.dumps(build_stop_fcm_map(ROWS)), "version": 4}
+    cache.rebuild("r1", reconcile=True)
+
+    assert cache.get_stats()["reconciled"] == 2 and cache.get_stats()["drift"] == 1
+
+def test_reconcile_pass_rebuilds_quiet_routes_only_once(mock_db_cursor, mocker):
+    rebuild = mocker.patch.object(route_recipient_cache, "rebuild")
+    mock_db_cursor.fetchall.return_value = [{"route_id": "r1"}, {"route_id": "r2"}]
+    rebuilder = RouteCacheRebuilder(delay=0, max_delay=30, reconcile_interval=3600)
+
+    assert rebuilder.schedule_reconcile() == 2
+    rebuilder.mark_dirty("r2")  # edited meanwhile: a normal rebuild
+    rebuilder.flush()
+
+    assert {c.args[0]: c.kwargs["reconcile"] for c in rebuild.call_args_list} == {"r1": True, "r2": False}
+    stats = rebuilder.get_stats()
+    assert stats["reconciles"] == 1 and stats["rebuilds"] == 1 and stats["pending_routes"] == 0
+
+def test_student_delete_removes_it_from_route_maps(mocker):
+    remove = mocker.patch.object(cascade_service, "remove_route_students")
+    refresh = mocker.patch.object(cascade_service, "refresh_route_students")
+    cascade_service.delete_cascades("students", "std1", {"pickup_route_id": "r1", "drop_route_id": "r1"})
+
+    remove.assert_called_once_with("r1", ["std1"])
+    refresh.assert_not_called()
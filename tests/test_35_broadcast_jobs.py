@@ -0,0 +1,129 @@
+import asyncio
+import pytest
+from unittest.mock import AsyncMock
+from app.services.broadcast_jobs import BroadcastJobManager, PARENT_TOKENS_PAGE, PARENT_TOKENS_COUNT
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 Safari",
+    "Origin": "https://transport.selvagam.com",
+    "x-admin-key": "test_admin_key"
+}
+
+def fake_db(mocker, tokens, saved=None):
+    """Serve token pages like the keyset query would and record progress updates"""
+    async def execute(query, params=None, fetch_one=False, fetch_all=False):
+        if query == PARENT_TOKENS_PAGE:
+            after, limit = params
+            return [{"fcm_token": t} for t in sorted(tokens) if t > after][:limit]
+        if query == PARENT_TOKENS_COUNT:
+            return {"total": len(tokens)}
+        if "UPDATE broadcast_jobs" in query and saved is not None:
+            saved.append(params)
+        return None
+    return mocker.patch("app.services.broadcast_jobs.execute_query_async", side_effect=execute)
+
+def fake_send(mocker, delay=0.0, fail=(), seen=None):
+    active, peak = [0], [0]
+
+    async def send(tokens, title, body, message_type="audio"):
+        active[0] += 1
+        peak[0] = max(peak[0], active[0])
+        if seen is not None:
+            seen.append(list(tokens))
+        await asyncio.sleep(delay)
+        active[0] -= 1
+        return [{"token": t, "success": t not in fail, "error": None if t not in fail else "Requested entity was not found.",
+                 "dead": t in fail} for t in tokens]
+    mocker.patch("app.services.broadcast_jobs.notification_service.send_multicast", side_effect=send)
+    return peak
+
+@pytest.mark.asyncio
+async def test_tokens_are_streamed_in_pages_and_counted(mocker):
+    tokens = [f"tok{i:03d}" for i in range(25)]
+    saved, pages = [], []
+    fake_db(mocker, tokens, saved)
+    fake_send(mocker, fail={"tok003"}, seen=pages)
+    manager = BroadcastJobManager(chunk_size=10, concurrency=2, rate_limit=0)
+
+    job = await manager.start("Holiday", "School closed tomorrow")
+    assert job["status"] == "QUEUED"
+    await manager._tasks[job["job_id"]]
+
+    assert [len(p) for p in pages] == [10, 10, 5]
+    assert sorted(t for p in pages for t in p) == tokens
+    result = await manager.get(job["job_id"])
+    assert result["status"] == "COMPLETED" and result["total_tokens"] == 25
+    assert result["sent"] == 24 and result["failed"] == 1 and result["dead_tokens"] == 1
+    assert saved[-1][0] == "COMPLETED" and saved[-1][2:5] == (24, 1, 1)
+
+@pytest.mark.asyncio
+async def test_mixed_case_tokens_are_all_paged(mocker):
+    tokens = [f"{c}{i}" for i in range(4) for c in ("ab", "AC", "aD", "Ab", "_x")]
+    pages = []
+
+    async def execute(query, params=None, fetch_one=False, fetch_all=False):
+        if query == PARENT_TOKENS_PAGE:
+            after, limit = params
+            # MySQL with the collation the query asks for: binary, not the column's case-insensitive default
+            key = (lambda t: t) if "COLLATE utf8mb4_bin" in query else str.lower
+            return [{"fcm_token": t} for t in sorted(tokens, key=key) if key(t) > key(after)][:limit]
+        if query == PARENT_TOKENS_COUNT:
+            return {"total": len(tokens)}
+        return None
+
+    mocker.patch("app.services.broadcast_jobs.execute_query_async", side_effect=execute)
+    fake_send(mocker, seen=pages)
+    manager = BroadcastJobManager(chunk_size=3, concurrency=2, rate_limit=0)
+
+    job = await manager.start("Holiday", "School closed tomorrow")
+    await manager._tasks[job["job_id"]]
+
+    assert len(pages) == 7
+    assert sorted(t for p in pages for t in p) == sorted(tokens)
+    assert (await manager.get(job["job_id"]))["sent"] == len(tokens)
+
+@pytest.mark.asyncio
+async def test_pages_in_flight_are_capped(mocker):
+    fake_db(mocker, [f"tok{i:03d}" for i in range(60)])
+    peak = fake_send(mocker, delay=0.01)
+    manager = BroadcastJobManager(chunk_size=5, concurrency=3, rate_limit=0)
+
+    job = await manager.start("t", "b")
+    await manager._tasks[job["job_id"]]
+
+    assert peak[0] == 3
+    assert manager.get_stats()["tokens_sent"] == 60
+
+@pytest.mark.asyncio
+async def test_rate_limit_spreads_pages(mocker):
+    manager = BroadcastJobManager(chunk_size=10, concurrency=1, rate_limit=100)
+    mocker.patch("app.services.broadcast_jobs.time.monotonic", return_value=50.0)
+    sleep = mocker.patch("app.services.broadcast_jobs.asyncio.sleep", new=AsyncMock())
+
+    await manager._throttle(started=50.0, dispatched=0)
+    await manager._throttle(started=50.0, dispatched=300)
+    sleep.assert_awaited_once_with(3.0)
+
+@pytest.mark.asyncio
+async def test_stop_marks_running_jobs_interrupted(mocker):
+    saved = []
+    fake_db(mocker, [f"tok{i:03d}" for i in range(20)], saved)
+    fake_send(mocker, delay=10)
+    manager = BroadcastJobManager(chunk_size=5, concurrency=1, rate_limit=0)
+
+    job = await manager.start("t", "b")
+    await asyncio.sleep(0.01)
+    await manager.stop()
+
+    assert (await manager.get(job["job_id"]))["status"] == "INTERRUPTED"
+    assert saved[-1][0] == "INTERRUPTED"
+    assert manager.get_stats()["running"] == 0
+
+def test_job_status_endpoint(client, mocker):
+    mocker.patch("app.api.notification_routes.ADMIN_KEY", "test_admin_key")
+    jobs = {"job_1": {"job_id": "job_1", "status": "RUNNING", "sent": 500, "failed": 2}}
+    mocker.patch("app.api.notification_routes.broadcast_jobs.get", new=AsyncMock(side_effect=jobs.get))
+
+    response = client.get("/api/v1/notifications/broadcast/jobs/job_1", headers=HEADERS)
+    assert response.status_code == 200 and response.json()["sent"] == 500
+    assert client.get("/api/v1/notifications/broadcast/jobs/missing", headers=HEADERS).status_code == 404
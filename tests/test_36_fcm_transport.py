@@ -0,0 +1,41 @@
+import pytest
+from app.notification_api.fake_transport import FakeFCMTransport
+from app.notification_api.service import FCMService, FirebaseTransport
+
+@pytest.fixture
+def fake_service(mocker):
+    mocker.patch("app.services.token_cleanup.dead_token_pruner.report")
+    return FCMService(transport=FakeFCMTransport(latency_ms=0, seed=1))
+
+def test_fake_transport_needs_no_credentials(fake_service):
+    assert fake_service.initialized and fake_service.creds_path is None
+
+@pytest.mark.asyncio
+async def test_multicast_goes_through_the_transport(fake_service):
+    tokens = [f"tok{i}" for i in range(1200)] + ["dead-1"]
+    results = await fake_service.send_multicast(tokens, "Title", "Body")
+
+    transport = fake_service.transport
+    assert transport.stats["calls"] == 3 and transport.stats["messages"] == 1201
+    assert sum(r["success"] for r in results) == 1200
+    assert results[-1] == {"token": "dead-1", "success": False, "error": "Requested entity was not found.", "dead": True}
+
+@pytest.mark.asyncio
+async def test_transient_errors_are_not_dead(fake_service):
+    fake_service.transport.error_rate = 1.0
+    result = await fake_service.send_to_device("Title", "Body", "tok1")
+    assert result["success"] is False and "dead" not in result
+
+@pytest.mark.asyncio
+async def test_topic_membership_reports_unknown_tokens(fake_service):
+    outcome = await fake_service.update_topic_membership(["tok1", "dead-2"], "route_r1_pickup")
+    assert outcome == {"tok1": None, "dead-2": "NOT_FOUND"}
+
+def test_dead_rate_is_stable_per_token():
+    transport = FakeFCMTransport(latency_ms=0, dead_rate=0.1)
+    dead = [t for t in (f"tok{i}" for i in range(5000)) if transport.is_dead(t)]
+    assert 350 < len(dead) < 650
+    assert all(transport.is_dead(t) for t in dead)
+
+def test_firebase_transport_is_the_default():
+    assert isinstance(FCMService().transport, FirebaseTransport)
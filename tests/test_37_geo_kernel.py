@@ -0,0 +1,94 @@
+import pytest
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock
+import app.services.geo as geo
+from app.services.bus_tracking import bus_tracking_service
+from app.services.trip_lanes import TripLaneManager
+from app.services.trip_state import TripState, first_stop_distances
+
+T0 = datetime(2026, 1, 5, 7, 30, 0)
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 Safari",
+    "Origin": "https://transport.selvagam.com"
+}
+STOPS = [
+    {"stop_id": "s1", "stop_name": "Stop 1", "location": "Anna Nagar", "latitude": "13.0850", "longitude": "80.2100", "stop_order": 1},
+    {"stop_id": "s2", "stop_name": "Stop 2", "location": "Kilpauk", "latitude": "13.0820", "longitude": "80.2400", "stop_order": 2},
+    {"stop_id": "s3", "stop_name": "Stop 3", "location": "Egmore", "latitude": "13.0780", "longitude": "80.2600", "stop_order": 3},
+]
+
+def make_state(trip_id="trip_1", current=1, **trip):
+    row = {"route_id": "route_1", "trip_type": "PICKUP", "driver_id": "driver_1", "current_stop_order": current,
+           "is_first_stop_notified": 1, "skipped_stops": "[]", "stop_logs": "{}", **trip}
+    return TripState(trip_id, row, STOPS)
+
+@pytest.fixture(params=["numpy", "python"])
+def backend(request, monkeypatch):
+    if request.param == "python":
+        monkeypatch.setattr(geo, "np", None)
+    elif geo.np is None:
+        pytest.skip("NumPy not installed")
+    return request.param
+
+def test_kernel_matches_haversine(backend):
+    coords = geo.StopCoordinates([{"latitude": float(s["latitude"]), "longitude": float(s["longitude"])} for s in STOPS])
+    expected = [geo.haversine_km(13.08, 80.22, float(s["latitude"]), float(s["longitude"])) for s in STOPS]
+    assert coords.distances_km(13.08, 80.22) == pytest.approx(expected, rel=1e-9)
+    assert coords.distances_km(13.08, 80.22, [2, 0]) == pytest.approx([expected[2], expected[0]], rel=1e-9)
+
+def test_fleet_pass_splits_results_per_request(backend):
+    a, b = make_state("a").coords, make_state("b").coords
+    results = geo.fleet_distances_km([(a, 13.08, 80.22, [0, 1]), (b, 13.0, 80.0, []), (b, 13.078, 80.26, [2])])
+    assert [len(r) for r in results] == [2, 0, 1]
+    assert results[0][1] == pytest.approx(geo.haversine_km(13.08, 80.22, 13.082, 80.24))
+    assert results[2][0] == pytest.approx(0.0, abs=1e-6)
+
+def test_first_stop_distance_only_while_alert_pending(backend):
+    fresh = make_state("a", current=0, is_first_stop_notified=0)
+    notified = make_state("b", current=0)
+    distances = first_stop_distances([(fresh, 13.085, 80.22), (notified, 13.085, 80.22)])
+    assert distances[0] == pytest.approx(geo.haversine_km(13.085, 80.22, 13.085, 80.21)) and distances[1] is None
+
+def test_screen_flags_only_fixes_near_a_stop():
+    states = [make_state("a"), make_state("b"), make_state("c", driver_id=None)]
+    flags = bus_tracking_service.screen_fleet([(states[0], 13.0821, 80.2401), (states[1], 13.0835, 80.2250),
+                                               (states[2], 13.0835, 80.2250)])
+    assert flags == [True, False, True]
+
+@pytest.mark.asyncio
+async def test_fleet_submit_queues_only_trips_near_a_stop(mocker):
+    states = {"near": make_state("near"), "quiet": make_state("quiet")}
+    mocker.patch("app.services.trip_lanes.trip_state_cache.get", new=AsyncMock(side_effect=states.get))
+    record = mocker.patch("app.services.bus_tracking.live_location_buffer.record")
+    processed = []
+
+    async def fake_update(trip_id, latitude, longitude, update_live_location=True):
+        processed.append(trip_id)
+        return {"success": True, "trip_id": trip_id, "current_stop_order": 2}
+
+    mocker.patch.object(bus_tracking_service, "update_bus_location", new=fake_update)
+    lanes = TripLaneManager()
+    summary = await lanes.submit_fleet([("near", 13.0821, 80.2401, T0), ("quiet", 13.0835, 80.2250, T0)])
+
+    assert processed == ["near"]
+    assert summary["in_transit"] == 1 and summary["queued"] == 1
+    assert summary["results"][1]["message"] == "In transit"
+    record.assert_called_once_with("driver_1", 13.0835, 80.2250)
+
+    # The quiet trip's fix still advances its lane, so an older fix is dropped
+    again = await lanes.submit_fleet([("quiet", 13.0835, 80.2250, T0 - timedelta(seconds=5))])
+    assert again["results"][0]["ignored"] is True
+
+def test_fleet_endpoint(client, mocker):
+    submit = mocker.patch("app.api.routes.trip_lanes.submit_fleet", new=AsyncMock(return_value={
+        "in_transit": 1, "queued": 1,
+        "results": [{"success": True, "message": "In transit"}, {"success": True, "ignored": True}]
+    }))
+    response = client.post("/api/v1/bus-tracking/locations/fleet", headers=HEADERS, json={"positions": [
+        {"trip_id": "t1", "latitude": 13.08, "longitude": 80.22},
+        {"trip_id": "t2", "latitude": 13.09, "longitude": 80.23, "timestamp": T0.isoformat()},
+    ]})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["received"] == 2 and body["in_transit"] == 1 and body["stale"] == 1
+    assert submit.await_args.args[0][0] == ("t1", 13.08, 80.22, None)
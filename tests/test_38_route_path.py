@@ -0,0 +1,68 @@
+import pytest
+from app.services.bus_tracking import bus_tracking_service, ARRIVAL_RADIUS_KM
+from app.services.geo import RoutePath, haversine_km
+from app.services.trip_state import TripState
+
+# Three stops roughly east-west, ~3.2 km and ~2.2 km apart
+STOPS = [
+    {"stop_id": "s1", "stop_name": "Stop 1", "location": "Anna Nagar", "latitude": 13.0850, "longitude": 80.2100, "stop_order": 1},
+    {"stop_id": "s2", "stop_name": "Stop 2", "location": "Kilpauk", "latitude": 13.0820, "longitude": 80.2400, "stop_order": 2},
+    {"stop_id": "s3", "stop_name": "Stop 3", "location": "Egmore", "latitude": 13.0780, "longitude": 80.2600, "stop_order": 3},
+]
+
+def make_state(current=1, stops=STOPS, **trip):
+    row = {"route_id": "route_1", "trip_type": "PICKUP", "driver_id": "driver_1", "current_stop_order": current,
+           "is_first_stop_notified": 1, "skipped_stops": "[]", "stop_logs": "{}", **trip}
+    return TripState("trip_1", row, stops)
+
+def test_offsets_accumulate_segment_lengths():
+    path = RoutePath(STOPS)
+    legs = [haversine_km(a["latitude"], a["longitude"], b["latitude"], b["longitude"]) for a, b in zip(STOPS, STOPS[1:])]
+    assert path.offsets == pytest.approx([0.0, legs[0], legs[0] + legs[1]], rel=1e-3)
+    assert path.stops_within(legs[0] + 0.1) == 2
+    assert path.index_after(1) == 1 and path.index_after(0) == 0
+
+def test_projection_gives_distance_along_and_off_route():
+    path = RoutePath(STOPS)
+    along, off = path.project(13.0835, 80.2250, 0, 2)  # midway between stop 1 and 2
+    assert along == pytest.approx(path.offsets[1] / 2, rel=0.02) and off < 0.05
+    along, off = path.project(13.0935, 80.2250, 0, 2)  # ~1.1 km north of the route
+    assert off == pytest.approx(1.1, rel=0.05)
+
+def test_arrival_near_next_stop():
+    state = make_state()
+    assert bus_tracking_service.arrived_stop(state, 13.0821, 80.2401)["stop_id"] == "s2"
+    assert bus_tracking_service.arrived_stop(state, 13.0835, 80.2250) is None
+
+def test_stop_passed_between_pings_is_detected():
+    # ~1.1 km beyond stop 2 towards stop 3: outside the arrival radius, but stop 2 is behind the bus
+    assert haversine_km(13.0800, 80.2500, 13.0820, 80.2400) > ARRIVAL_RADIUS_KM
+    assert bus_tracking_service.arrived_stop(make_state(), 13.0800, 80.2500)["stop_id"] == "s2"
+
+def test_off_route_fix_does_not_arrive():
+    # Level with stop 2 along the route but ~0.9 km away from it
+    assert bus_tracking_service.arrived_stop(make_state(), 13.0900, 80.2400) is None
+
+def test_skipped_stop_is_jumped():
+    state = make_state(skipped_stops="[2]")
+    assert bus_tracking_service.arrived_stop(state, 13.0821, 80.2401) is None
+    assert bus_tracking_service.arrived_stop(state, 13.0781, 80.2599)["stop_id"] == "s3"
+
+def test_close_stops_need_the_midpoint():
+    close = STOPS[:1] + [dict(STOPS[0], stop_id="s1b", stop_name="Stop 1b", location="Shanthi Colony",
+                               longitude=80.2140, stop_order=2)]
+    state = make_state(stops=close)
+    # Both stops are within the radius: nearer to stop 1 than to stop 1b is not an arrival yet
+    assert bus_tracking_service.arrived_stop(state, 13.0850, 80.2115) is None
+    assert bus_tracking_service.arrived_stop(state, 13.0850, 80.2125)["stop_id"] == "s1b"
+
+def test_first_stop_before_the_route_uses_distance_to_it():
+    state = make_state(current=0)
+    assert bus_tracking_service.arrived_stop(state, 13.0850, 80.2060)["stop_id"] == "s1"
+    assert bus_tracking_service.arrived_stop(state, 13.0850, 80.2000) is None
+
+def test_next_stop_lookup_uses_order_index():
+    state = make_state(current=1, skipped_stops="[2]")
+    assert state.next_unskipped_stop(1)["stop_id"] == "s3"
+    assert [s["stop_id"] for s in state.stops_between(0, 2)] == ["s1", "s2"]
+    assert state.next_unskipped_stop(3) is None
@@ -0,0 +1,113 @@
+import asyncio
+import pytest
+from app.core.database import after_commit, unit_of_work_async
+from app.services.bus_tracking import bus_tracking_service
+from app.services.stop_index import StopSpatialIndex
+from app.services.trip_state import TripState
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 Safari",
+    "Origin": "https://transport.selvagam.com"
+}
+
+def stop(stop_id, route_id, lat, lng, order=1, radius=None):
+    return {"stop_id": stop_id, "route_id": route_id, "stop_name": f"Stop {stop_id}", "location": None,
+            "latitude": str(lat), "longitude": str(lng), "pickup_stop_order": order, "drop_stop_order": order,
+            "geofence_radius_m": radius}
+
+ROWS = [
+    stop("a1", "route_a", 13.0850, 80.2100),
+    stop("a2", "route_a", 13.0820, 80.2400, order=2),
+    stop("b1", "route_b", 13.0860, 80.2105),
+    stop("b2", "route_b", 13.0999, 80.2100, order=2, radius=1500),
+]
+
+@pytest.fixture
+def index(mocker):
+    query = mocker.patch("app.services.stop_index.execute_query", return_value=[dict(r) for r in ROWS])
+    idx = StopSpatialIndex(cell_deg=0.01, ttl=300)
+    idx.load()
+    idx.query = query
+    return idx
+
+def test_nearby_spans_routes_nearest_first(index):
+    found = index.nearby(13.0851, 80.2101, 500)
+    assert [s["stop_id"] for s, _ in found] == ["a1", "b1"]
+    assert found[0][1] < found[1][1] < 500
+    assert [s["stop_id"] for s, _ in index.nearby(13.0851, 80.2101, 500, route_id="route_b")] == ["b1"]
+
+def test_query_reaches_neighbouring_cells(index):
+    # a2 sits just past a cell boundary from the query point
+    assert [s["stop_id"] for s, _ in index.nearby(13.0799, 80.2399, 400)] == ["a2"]
+    assert index.get_stats()["candidates"] < len(ROWS) * index.get_stats()["queries"]
+
+def test_containing_uses_each_stops_radius(index):
+    # ~550 m from b2 and ~1 km from the others: only b2 (1500 m geofence) contains the point
+    assert [s["stop_id"] for s, _ in index.containing(13.0950, 80.2100)] == ["b2"]
+    assert index.nearby(13.0950, 80.2100) == []
+
+def test_route_reload_replaces_only_that_route(index):
+    index.query.return_value = [stop("a9", "route_a", 13.0700, 80.2700)]
+    index.reload_route("route_a")
+    assert "AND route_id = %s" in index.query.call_args.args[0]
+    assert {s["stop_id"] for s in index._stops.values()} == {"a9", "b1", "b2"}
+    index.remove_route("route_b")
+    assert list(index._stops) == ["a9"]
+
+@pytest.mark.asyncio
+async def test_route_reload_waits_for_commit(index):
+    index.query.reset_mock()
+    with pytest.raises(ValueError):
+        async with unit_of_work_async():
+            after_commit(index.reload_route_in_background, "route_a")
+            raise ValueError("Stop update failed")
+    assert not index._route_reloads
+    index.query.assert_not_called()
+
+    index.query.return_value = [stop("a9", "route_a", 13.0700, 80.2700)]
+    async with unit_of_work_async():
+        after_commit(index.reload_route_in_background, "route_a")
+        index.query.assert_not_called()
+    await asyncio.gather(*index._route_reloads)
+    assert {s["stop_id"] for s in index._stops.values()} == {"a9", "b1", "b2"}
+
+def test_reload_is_skipped_until_first_load(mocker):
+    query = mocker.patch("app.services.stop_index.execute_query")
+    StopSpatialIndex().reload_route("route_a")
+    query.assert_not_called()
+
+def test_arrival_uses_stop_geofence_radius():
+    stops = [
+        {"stop_id": "s1", "stop_name": "Stop 1", "location": None, "latitude": 13.0850, "longitude": 80.2100, "stop_order": 1},
+        {"stop_id": "s2", "stop_name": "Stop 2", "location": None, "latitude": 13.0820, "longitude": 80.2400, "stop_order": 2,
+         "geofence_radius_m": 100},
+    ]
+    trip = {"route_id": "route_a", "trip_type": "PICKUP", "driver_id": "d1", "current_stop_order": 1,
+            "is_first_stop_notified": 1, "skipped_stops": "[]", "stop_logs": "{}"}
+    # ~330 m short of stop 2 along the route: inside the default 500 m, outside its own 100 m
+    assert bus_tracking_service.arrived_stop(TripState("t1", trip, stops), 13.0823, 80.2370) is None
+    stops[1]["geofence_radius_m"] = None
+    assert bus_tracking_service.arrived_stop(TripState("t1", trip, stops), 13.0823, 80.2370)["stop_id"] == "s2"
+
+def test_foreign_stops_reported_on_entry(index, mocker):
+    mocker.patch("app.services.bus_tracking.stop_index", index)
+    trip = {"route_id": "route_a", "trip_type": "PICKUP", "driver_id": "d1", "current_stop_order": 0,
+            "is_first_stop_notified": 1, "skipped_stops": "[]", "stop_logs": "{}"}
+    state = TripState("t1", trip, [])
+
+    entered = bus_tracking_service.enter_foreign_stops(state, 13.0860, 80.2106)
+    assert [s["stop_id"] for s in entered] == ["b1"]
+    # Still inside: not reported again; route_a's own stop never is
+    assert bus_tracking_service.enter_foreign_stops(state, 13.0859, 80.2105) == []
+    assert bus_tracking_service.enter_foreign_stops(state, 13.0700, 80.2700) == []
+    assert state.foreign_stop_ids == set()
+
+def test_nearby_endpoint(client, index, mocker):
+    mocker.patch("app.api.routes.stop_index", index)
+    response = client.get("/api/v1/route-stops/nearby", headers=HEADERS,
+                          params={"latitude": 13.0851, "longitude": 80.2101, "radius_m": 500})
+    assert response.status_code == 200
+    body = response.json()
+    assert [s["stop_id"] for s in body] == ["a1", "b1"]
+    assert body[0]["geofence_radius_m"] == 500 and body[0]["distance_m"] < 50
+    assert client.get("/api/v1/route-stops/nearby", headers=HEADERS, params={"latitude": 95, "longitude": 80}).status_code == 422
@@ -0,0 +1,71 @@
+import json
+import pytest
+from app.services.bus_tracking import bus_tracking_service
+from app.services.route_recipients import RouteRecipients, build_stop_fcm_map
+from app.services.trip_manifest import TripManifests
+from app.services.trip_state import TripState, trip_state_cache
+
+TRIP = {
+    "trip_id": "trip_manifest_1", "route_id": "route_1", "trip_type": "PICKUP", "driver_id": "driver_1",
+    "status": "ONGOING", "current_stop_order": 0, "is_first_stop_notified": 1,
+    "skipped_stops": "[]", "stop_logs": "{}"
+}
+STOPS = [
+    {"stop_id": "s1", "stop_name": "Stop 1", "location": "Anna Nagar", "latitude": "13.0850", "longitude": "80.2100", "stop_order": 1},
+    {"stop_id": "s2", "stop_name": "Stop 2", "location": "Kilpauk", "latitude": "13.0820", "longitude": "80.2400", "stop_order": 2},
+]
+
+def student(stop_id, location, order, student_id, token, is_pickup=1, is_drop=1, parent_id=None):
+    return {"stop_id": stop_id, "stop_name": f"Stop {stop_id}", "location": location, "pickup_stop_order": order,
+            "drop_stop_order": 3 - order, "student_id": student_id, "student_name": student_id, "is_pickup": is_pickup,
+            "is_drop": is_drop, "fcm_token": token, "parent_id": parent_id or f"p_{student_id}", "parent_name": "Parent"}
+
+def recipients(version=1):
+    rows = [
+        student("s1", "Anna Nagar", 1, "std1", "tok1"),
+        # Siblings sharing one parent token
+        student("s1", "Anna Nagar", 1, "std2", "tok1", parent_id="p_std1"),
+        student("s1", "Anna Nagar", 1, "std3", "tok3", is_pickup=0),
+        student("s2", "Kilpauk", 2, "std4", "tok4"),
+    ]
+    return RouteRecipients("route_1", build_stop_fcm_map(rows), version)
+
+def make_state():
+    return TripState(TRIP["trip_id"], dict(TRIP), [dict(s) for s in STOPS])
+
+def test_manifest_groups_trip_leg_by_location(mocker):
+    mocker.patch("app.services.trip_manifest.route_recipient_cache.get", return_value=recipients())
+    manifest = TripManifests().for_trip(make_state())
+
+    arrival = manifest.at_location("Anna Nagar")
+    assert [st["student_id"] for st in arrival["students"]] == ["std1", "std2"]
+    assert arrival["tokens"] == ["tok1"]
+    assert manifest.at_stop_order(2)["tokens"] == ["tok4"]
+    assert manifest.at_location("Egmore") == {"students": [], "tokens": []}
+
+def test_manifest_rebuilt_only_when_recipients_change(mocker):
+    route = recipients()
+    get = mocker.patch("app.services.trip_manifest.route_recipient_cache.get", return_value=route)
+    manifests, state = TripManifests(), make_state()
+
+    first = manifests.for_trip(state)
+    assert manifests.for_trip(state) is first
+    get.return_value = recipients(version=2)
+    assert manifests.for_trip(state) is not first
+    assert manifests.get_stats() == {"built": 2, "hits": 1, "unavailable": 0}
+
+@pytest.mark.asyncio
+async def test_arrival_enqueues_manifest_tokens_without_lookups(mock_db_cursor, mocker):
+    mock_db_cursor.fetchone.return_value = dict(TRIP)
+    mock_db_cursor.fetchall.return_value = [dict(s) for s in STOPS]
+    mocker.patch("app.services.trip_manifest.route_recipient_cache.get", return_value=recipients())
+    lookup = mocker.patch.object(bus_tracking_service, "get_students_for_location")
+    trip_state_cache.drop(TRIP["trip_id"])
+
+    result = await bus_tracking_service.update_bus_location(TRIP["trip_id"], 13.0851, 80.2101)
+    trip_state_cache.drop(TRIP["trip_id"])
+
+    assert result["current_stop_order"] == 1
+    lookup.assert_not_called()
+    inserts = [c for c in mock_db_cursor.execute.call_args_list if "INSERT INTO notification_outbox" in c.args[0]]
+    assert [json.loads(c.args[1][5]) for c in inserts] == [{"tokens": ["tok1"]}, {"tokens": ["tok4"]}]
@@ -0,0 +1,142 @@
+import pytest
+from unittest.mock import MagicMock
+from app.services.proximity_service import ProximityTrackingService
+from app.services.proximity_store import MemoryTripStore, RedisTripStore
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class FakeRedis:
+    """The few asyncio Redis commands RedisTripStore uses, over one dict shared by every "worker" """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.data = {}
+        self.expires = {}
+
+    def _live(self, key):
+        if key in self.expires and self.expires[key] <= self.clock():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.data[key] = value
+        self.expires[key] = self.clock() + ex
+
+    async def getex(self, key, ex=None):
+        value = self._live(key)
+        if value is not None:
+            self.expires[key] = self.clock() + ex
+        return value
+
+    async def expire(self, key, seconds):
+        if self._live(key) is not None:
+            self.expires[key] = self.clock() + seconds
+
+    async def sadd(self, key, member):
+        members = self._live(key)
+        if members is None:
+            members = self.data[key] = set()
+        added = member not in members
+        members.add(member)
+        return int(added)
+
+    async def smembers(self, key):
+        return set(self._live(key) or ())
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+
+@pytest.fixture
+def clock(mocker):
+    clock = Clock()
+    mocker.patch("app.services.proximity_store.time.monotonic", clock)
+    return clock
+
+def record(trip_id, stops=1):
+    return {"trip_id": trip_id, "route_id": "route_1", "stops": [{"stop_id": f"s{i}", "stop_order": i} for i in range(stops)]}
+
+@pytest.mark.asyncio
+async def test_memory_store_expires_unused_trips(clock):
+    store = MemoryTripStore(ttl=60, max_trips=10, max_bytes=10000)
+    await store.put("cancelled", record("cancelled"))
+    await store.put("active", record("active"))
+    clock.now += 45
+    assert await store.get("active") is not None
+    clock.now += 30
+    # Only the trip nobody used within the TTL is gone
+    assert await store.get("cancelled") is None
+    assert await store.get("active") is not None
+    assert store.get_stats()["expired"] == 1
+
+@pytest.mark.asyncio
+async def test_memory_store_evicts_least_recently_used(clock):
+    store = MemoryTripStore(ttl=60, max_trips=2, max_bytes=6000)
+    await store.put("a", record("a"))
+    await store.put("b", record("b"))
+    await store.get("a")
+    await store.put("c", record("c"))
+    assert await store.get("b") is None and await store.get("a") is not None
+
+    # Byte budget: a large trip pushes out the least recently used one
+    store.max_trips = 10
+    await store.put("big", record("big", stops=150))
+    stats = store.get_stats()
+    assert stats["trips"] == 2 and stats["bytes"] <= store.max_bytes and stats["evicted"] == 2
+    assert await store.get("c") is None and await store.get("a") is not None
+    await store.drop("big")
+    await store.drop("a")
+    assert store.get_stats()["bytes"] == 0
+
+@pytest.mark.asyncio
+async def test_memory_store_tracks_notified_stops(clock):
+    store = MemoryTripStore(ttl=60, max_trips=10, max_bytes=10000)
+    assert await store.mark_notified("t1", "s1") is False
+    await store.put("t1", record("t1"))
+    before = store.bytes
+    assert await store.mark_notified("t1", "s1") is True
+    assert await store.mark_notified("t1", "s1") is False
+    assert await store.notified("t1") == {"s1"} and store.bytes > before
+
+@pytest.mark.asyncio
+async def test_redis_store_is_shared_across_workers(clock):
+    server = FakeRedis(clock)
+    worker_a, worker_b = RedisTripStore(server, ttl=60), RedisTripStore(server, ttl=60)
+
+    await worker_a.put("t1", record("t1"))
+    assert await worker_b.get("t1") == record("t1")
+    assert await worker_a.mark_notified("t1", "s1") is True
+    assert await worker_b.mark_notified("t1", "s1") is False
+    assert await worker_b.notified("t1") == {"s1"}
+
+    # A new process (restart) sees the same state until it expires
+    restarted = RedisTripStore(server, ttl=60)
+    clock.now += 59
+    assert await restarted.get("t1") is not None
+    clock.now += 61
+    assert await restarted.get("t1") is None and await restarted.notified("t1") == set()
+
+@pytest.mark.asyncio
+async def test_proximity_service_uses_store(clock, mocker):
+    query = MagicMock(side_effect=lambda q, params=None, **kw: (
+        {"current_stop_order": 1, "route_id": "route_1", "trip_type": "PICKUP", "status": "ONGOING"} if "FROM trips" in q
+        else [{"stop_id": "s1", "stop_name": "Stop 1", "latitude": 13.0, "longitude": 80.0, "stop_order": 1}] if "route_stops" in q
+        else None
+    ))
+    mocker.patch("app.services.proximity_service.execute_query", query)
+    store = RedisTripStore(FakeRedis(clock), ttl=60)
+    worker_a, worker_b = ProximityTrackingService(store=store), ProximityTrackingService(store=store)
+
+    await worker_a.process_location_update("t1", 13.0, 80.0)
+    assert (await worker_b.process_location_update("t1", 13.0, 80.0))["success"] is True
+    assert sum(1 for c in query.call_args_list if "route_stops" in c.args[0]) == 1
+
+    await worker_b.complete_trip("t1", "route_1")
+    assert await store.get("t1") is None